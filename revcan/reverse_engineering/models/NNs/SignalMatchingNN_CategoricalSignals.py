@@ -12,6 +12,9 @@ from collections import defaultdict
 from pathlib import Path
 from typing import Dict, Tuple, List
 from revcan.reverse_engineering.models.experiment import Experiment
+from revcan.reverse_engineering.models.experiment_store import ExperimentStore
+from revcan.reverse_engineering.models.NNs.batched_training import BatchedMLP, fit_batched_models, pad_signal_tensors
+from revcan.reverse_engineering.models.NNs.data_preparation import build_signal_tensors, load_signal_datasets
 
 def train_signal_model(
         X_train, 
@@ -68,12 +71,16 @@ def train_signal_model(
         logits = model(X_test)
         preds = torch.argmax(logits, dim=1)
 
-        accuracy = accuracy_score(y_test.numpy(), preds.numpy())
-        precision = precision_score(y_test.numpy(), preds.numpy(), average='weighted', zero_division=0)
-        recall = recall_score(y_test.numpy(), preds.numpy(), average='weighted', zero_division=0)
-        f1 = f1_score(y_test.numpy(), preds.numpy(), average='weighted', zero_division=0)
+    return model, calculate_metrics(preds, y_test)
 
-    return model, {
+
+def calculate_metrics(preds, y_test):
+    accuracy = accuracy_score(y_test.numpy(), preds.numpy())
+    precision = precision_score(y_test.numpy(), preds.numpy(), average='weighted', zero_division=0)
+    recall = recall_score(y_test.numpy(), preds.numpy(), average='weighted', zero_division=0)
+    f1 = f1_score(y_test.numpy(), preds.numpy(), average='weighted', zero_division=0)
+
+    return {
         "accuracy": accuracy,
         "precision": precision,
         "recall": recall,
@@ -81,6 +88,59 @@ def train_signal_model(
     }
 
 
+# Train one model per signal like train_signal_model, but all models of a group at once as one batched model.
+# signal_data maps each signal key to (X_train, y_train, X_test, y_test) as returned by preprocess_signal_df.
+# Early stopping per signal is enabled by setting patience (epochs without improvement of the training loss).
+def train_signal_models_batched(
+        signal_data: Dict[Tuple[int, int], Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]],
+        hidden_layers_config: List[int] = [64, 32],
+        epochs=20,
+        batch_size=64,
+        patience: int = None,
+        min_delta: float = 0.0,
+        signals_per_group: int = 256):
+
+    models = {}
+    results = {}
+    signal_keys = list(signal_data)
+
+    # Groups bound the memory of the stacked activations
+    for group_start in range(0, len(signal_keys), signals_per_group):
+        group_keys = signal_keys[group_start:group_start + signals_per_group]
+        X_train, train_mask = pad_signal_tensors([signal_data[key][0] for key in group_keys])
+        y_train, _ = pad_signal_tensors([signal_data[key][1].long() for key in group_keys])
+        X_test, _ = pad_signal_tensors([signal_data[key][2] for key in group_keys])
+        input_sizes = [signal_data[key][0].shape[1] for key in group_keys]
+
+        # The output layer is padded to the largest number of classes, missing classes of a signal are masked
+        num_classes = torch.tensor([len(np.unique(signal_data[key][1].numpy())) for key in group_keys])
+        class_mask = torch.arange(int(num_classes.max()))[None, None, :] < num_classes[:, None, None]
+
+        def per_sample_loss(logits, yb):
+            logits = logits.masked_fill(~class_mask, -1e9)
+            return nn.functional.cross_entropy(logits.reshape(-1, logits.shape[-1]), yb.reshape(-1),
+                                               reduction='none').view(yb.shape)
+
+        model = BatchedMLP(len(group_keys), X_train.shape[2], hidden_layers_config, int(num_classes.max()), input_sizes)
+        epochs_trained = fit_batched_models(model, X_train, y_train, train_mask, per_sample_loss,
+                                            epochs=epochs, batch_size=batch_size, patience=patience,
+                                            min_delta=min_delta)
+
+        # Evaluation
+        model.eval()
+        with torch.no_grad():
+            logits = model(X_test).masked_fill(~class_mask, -1e9)
+            preds = torch.argmax(logits, dim=2)
+
+        for i, key in enumerate(group_keys):
+            y_test = signal_data[key][3]
+            models[key] = model.to_sequential(i, input_size=input_sizes[i], output_size=int(num_classes[i]))
+            results[key] = calculate_metrics(preds[i, :len(y_test)], y_test)
+            results[key]["epochs"] = int(epochs_trained[i])
+
+    return models, results
+
+
 def load_data(experiment: Experiment) -> pd.DataFrame:
     # Use a nested dict to store values by (server_id, did, gear)
     grouped_data = defaultdict(list)
@@ -112,6 +172,27 @@ def load_data(experiment: Experiment) -> pd.DataFrame:
 
     return df
 
+# Array-native replacement of load_data, custom_train_test_split, split_df_by_signal, expand_signal_df,
+# one_hot_encode_ground_truth and preprocess_signal_df. Returns (X_train, y_train, X_test, y_test) per signal,
+# see train_signal_models_batched. Classes are the sorted ground truth values of a signal.
+# Payloads are memory-mapped from the store for columnar experiments; values are zero padded instead of NaN padded.
+def prepare_signal_data(
+        experiment: Experiment,
+        store: ExperimentStore = None,
+        train_set_percentage: int = 75,
+        seed: int = None,
+        skip_ambiguous_signals=False,
+        skip_useless_signals=False):
+
+    # Map each sample index to a ground truth (gear), empty ground truths are skipped
+    ground_truths = np.array(experiment.external_alphanumeric_measurements[0].values, dtype=object)
+    valid_ground_truths = np.array([bool(gt) for gt in ground_truths], dtype=bool)
+
+    datasets = load_signal_datasets(experiment, ground_truths, valid_ground_truths, store=store)
+    return build_signal_tensors(datasets, categorical=True, train_set_percentage=train_set_percentage, seed=seed,
+                                skip_ambiguous_signals=skip_ambiguous_signals,
+                                skip_useless_signals=skip_useless_signals)
+
 def custom_train_test_split(df, train_set_percentage: int = 75):
     train_records = []
     test_records = []
@@ -12,6 +12,10 @@ from collections import defaultdict
 from pathlib import Path
 from typing import Dict, Tuple, List
 from revcan.reverse_engineering.models.experiment import Experiment
+from revcan.reverse_engineering.models.groundtruth_alignment import GroundtruthAlignment
+from revcan.reverse_engineering.models.experiment_store import ExperimentStore
+from revcan.reverse_engineering.models.NNs.batched_training import BatchedMLP, fit_batched_models, pad_signal_tensors
+from revcan.reverse_engineering.models.NNs.data_preparation import build_signal_tensors, load_signal_datasets
 
 def train_signal_model(
         X_train, 
@@ -58,21 +62,70 @@ def train_signal_model(
     with torch.no_grad():
         preds = model(X_test).squeeze()
 
+    return model, calculate_metrics(preds, y_test)
+
+
+def calculate_metrics(preds, y_test):
+    with torch.no_grad():
         mse = nn.functional.mse_loss(preds, y_test.float()).item()
         mae = nn.functional.l1_loss(preds, y_test.float()).item()
         ss_res = torch.sum((y_test - preds) ** 2)
         ss_tot = torch.sum((y_test - torch.mean(y_test)) ** 2)
         r2_score = 1 - ss_res / ss_tot if ss_tot != 0 else float('nan')
 
-    return model, {
+    return {
         "mse": mse,
         "mae": mae,
         "r2": r2_score.item() if torch.is_tensor(r2_score) else r2_score
     }
 
 
-
-def load_data(experiment: Experiment) -> pd.DataFrame:
+# Train one model per signal like train_signal_model, but all models of a group at once as one batched model.
+# signal_data maps each signal key to (X_train, y_train, X_test, y_test) as returned by preprocess_signal_df.
+# Early stopping per signal is enabled by setting patience (epochs without improvement of the training loss).
+def train_signal_models_batched(
+        signal_data: Dict[Tuple[int, int], Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]],
+        hidden_layers_config: List[int] = [64, 32],
+        epochs=20,
+        batch_size=64,
+        patience: int = None,
+        min_delta: float = 0.0,
+        signals_per_group: int = 256):
+
+    models = {}
+    results = {}
+    signal_keys = list(signal_data)
+
+    # Groups bound the memory of the stacked activations
+    for group_start in range(0, len(signal_keys), signals_per_group):
+        group_keys = signal_keys[group_start:group_start + signals_per_group]
+        X_train, train_mask = pad_signal_tensors([signal_data[key][0] for key in group_keys])
+        y_train, _ = pad_signal_tensors([signal_data[key][1].float() for key in group_keys])
+        X_test, _ = pad_signal_tensors([signal_data[key][2] for key in group_keys])
+        input_sizes = [signal_data[key][0].shape[1] for key in group_keys]
+
+        model = BatchedMLP(len(group_keys), X_train.shape[2], hidden_layers_config, 1, input_sizes)
+        epochs_trained = fit_batched_models(model, X_train, y_train, train_mask,
+                                            lambda pred, yb: (pred.squeeze(-1) - yb) ** 2,
+                                            epochs=epochs, batch_size=batch_size, patience=patience,
+                                            min_delta=min_delta)
+
+        # Evaluation
+        model.eval()
+        with torch.no_grad():
+            preds = model(X_test).squeeze(-1)
+
+        for i, key in enumerate(group_keys):
+            y_test = signal_data[key][3]
+            models[key] = model.to_sequential(i, input_size=input_sizes[i])
+            results[key] = calculate_metrics(preds[i, :len(y_test)], y_test)
+            results[key]["epochs"] = int(epochs_trained[i])
+
+    return models, results
+
+
+
+def load_data(experiment: Experiment, alignment: GroundtruthAlignment = None) -> pd.DataFrame:
     grouped_data = defaultdict(list)
 
     # Map each sample index to a ground truth 
@@ -82,7 +135,14 @@ def load_data(experiment: Experiment) -> pd.DataFrame:
         server_id = signal.serverid
         did = signal.did.did
 
-        for value_obj, gt in zip(signal.values, ground_truths):
+        # With an alignment index, each sample is mapped to the nearest ground truth sample in time instead
+        signal_ground_truths = ground_truths
+        if alignment is not None:
+            aligned_values = alignment.get_groundtruth_values(server_id, did)
+            if aligned_values is not None:
+                signal_ground_truths = aligned_values.tolist()
+
+        for value_obj, gt in zip(signal.values, signal_ground_truths):
             if gt is not None:
                 grouped_data[(server_id, did, gt)].append(value_obj.value)
 
@@ -102,6 +162,29 @@ def load_data(experiment: Experiment) -> pd.DataFrame:
 
     return df
 
+# Array-native replacement of load_data, custom_train_test_split, split_df_by_signal, expand_signal_df and
+# preprocess_signal_df. Returns (X_train, y_train, X_test, y_test) per signal, see train_signal_models_batched.
+# Payloads are memory-mapped from the store for columnar experiments; values are zero padded instead of NaN padded.
+def prepare_signal_data(
+        experiment: Experiment,
+        store: ExperimentStore = None,
+        alignment: GroundtruthAlignment = None,
+        train_set_percentage: int = 75,
+        seed: int = None,
+        skip_ambiguous_signals=False,
+        skip_useless_signals=False):
+
+    ground_truth_signal = experiment.external_measurements[0]
+    if store is not None:
+        ground_truths = store.get_extern_signal_arrays(ground_truth_signal.id)[2][:, 0]
+    else:
+        ground_truths = np.array([val.value[0] for val in ground_truth_signal.values])
+
+    datasets = load_signal_datasets(experiment, ground_truths, store=store, alignment=alignment)
+    return build_signal_tensors(datasets, categorical=False, train_set_percentage=train_set_percentage, seed=seed,
+                                skip_ambiguous_signals=skip_ambiguous_signals,
+                                skip_useless_signals=skip_useless_signals)
+
 def custom_train_test_split(df, train_set_percentage: int = 75):
     train_records = []
     test_records = []
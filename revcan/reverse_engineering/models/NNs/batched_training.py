@@ -0,0 +1,229 @@
+"""
+This module defines the building blocks to train many small per-signal MLPs at once on the CPU.
+
+The MLPs of all signals share one architecture and are stored as stacked weight tensors, so a forward pass of
+all models is a single torch.baddbmm per layer. Inputs of different widths are zero padded (zero inputs do not
+contribute to the output) and samples beyond the number of samples of a signal are masked out of the loss.
+Every model keeps its own Adam state and step count; models without samples in a batch or which stopped
+early are not updated, so each model is trained as if it was trained on its own.
+
+Classes:
+    - BatchedMLP: A stack of independent MLPs with identical architecture.
+    - BatchedAdam: Adam optimizer with per-model step counts, which only updates the active models.
+"""
+
+import math
+from typing import Callable, List, Tuple
+
+import torch
+import torch.nn as nn
+
+
+class BatchedMLP(nn.Module):
+    """
+    A stack of independent MLPs with identical architecture and ReLU activations.
+
+    Attributes:
+        weights (nn.ParameterList): Weights of every layer, shape (models, in, out).
+        biases (nn.ParameterList): Biases of every layer, shape (models, 1, out).
+
+    Methods:
+        forward(x): Evaluates all models, x has the shape (models, samples, input_size).
+        to_sequential(index, input_size, output_size): Extracts a single model as nn.Sequential.
+    """
+
+    def __init__(self, number_of_models: int, input_size: int, hidden_layers_config: List[int], output_size: int,
+                 input_sizes: List[int] = None):
+        super().__init__()
+        sizes = [input_size] + list(hidden_layers_config) + [output_size]
+        self.weights = nn.ParameterList()
+        self.biases = nn.ParameterList()
+
+        for layer, (in_size, out_size) in enumerate(zip(sizes[:-1], sizes[1:])):
+            # Same initialisation range as nn.Linear, based on the unpadded input size of every model
+            if layer == 0 and input_sizes is not None:
+                bound = 1 / torch.tensor(input_sizes, dtype=torch.float32).clamp(min=1).sqrt().view(-1, 1, 1)
+            else:
+                bound = torch.full((number_of_models, 1, 1), 1 / math.sqrt(in_size))
+            self.weights.append(nn.Parameter((torch.rand(number_of_models, in_size, out_size) * 2 - 1) * bound))
+            self.biases.append(nn.Parameter((torch.rand(number_of_models, 1, out_size) * 2 - 1) * bound))
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        number_of_layers = len(self.weights)
+        for layer, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            x = torch.baddbmm(bias, x, weight)
+            if layer < number_of_layers - 1:
+                x = torch.relu(x)
+        return x
+
+    def to_sequential(self, index: int, input_size: int = None, output_size: int = None) -> nn.Sequential:
+        """
+        Extract a single model as nn.Sequential, equal to the model built by train_signal_model.
+
+        :param index: Index of the model.
+        :param input_size: Unpadded input size of the model; defaults to the padded size.
+        :param output_size: Unpadded output size of the model; defaults to the padded size.
+        :return: The model.
+        """
+        layers = []
+        number_of_layers = len(self.weights)
+        for layer, (weight, bias) in enumerate(zip(self.weights, self.biases)):
+            weight, bias = weight[index], bias[index, 0]
+            if layer == 0 and input_size is not None:
+                weight = weight[:input_size]
+            if layer == number_of_layers - 1 and output_size is not None:
+                weight, bias = weight[:, :output_size], bias[:output_size]
+
+            linear = nn.Linear(weight.shape[0], weight.shape[1])
+            with torch.no_grad():
+                linear.weight.copy_(weight.T)
+                linear.bias.copy_(bias)
+            layers.append(linear)
+            if layer < number_of_layers - 1:
+                layers.append(nn.ReLU())
+        return nn.Sequential(*layers)
+
+
+class BatchedAdam:
+    """
+    Adam optimizer for stacked per-model parameters (first dimension = model) with per-model step counts.
+
+    Methods:
+        zero_grad(): Clears the gradients.
+        step(active): Updates the parameters of the active models.
+    """
+
+    def __init__(self, parameters, number_of_models: int, lr=1e-3, betas=(0.9, 0.999), eps=1e-8):
+        self.parameters = list(parameters)
+        self.lr = lr
+        self.betas = betas
+        self.eps = eps
+        self.steps = torch.zeros(number_of_models)
+        self.exp_avg = [torch.zeros_like(parameter) for parameter in self.parameters]
+        self.exp_avg_sq = [torch.zeros_like(parameter) for parameter in self.parameters]
+
+    def zero_grad(self):
+        for parameter in self.parameters:
+            parameter.grad = None
+
+    @torch.no_grad()
+    def step(self, active: torch.Tensor):
+        """
+        Update the parameters of the active models with the same rule as torch.optim.Adam.
+
+        :param active: Boolean mask of the models to update.
+        """
+        beta1, beta2 = self.betas
+        self.steps += active.float()
+        steps = self.steps.clamp(min=1)
+        bias_correction1 = 1 - beta1 ** steps
+        bias_correction2 = 1 - beta2 ** steps
+
+        for parameter, exp_avg, exp_avg_sq in zip(self.parameters, self.exp_avg, self.exp_avg_sq):
+            if parameter.grad is None:
+                continue
+            shape = (-1,) + (1,) * (parameter.dim() - 1)
+            mask = active.view(shape)
+            grad = parameter.grad
+
+            exp_avg.copy_(torch.where(mask, beta1 * exp_avg + (1 - beta1) * grad, exp_avg))
+            exp_avg_sq.copy_(torch.where(mask, beta2 * exp_avg_sq + (1 - beta2) * grad * grad, exp_avg_sq))
+
+            denominator = exp_avg_sq.sqrt() / bias_correction2.sqrt().view(shape) + self.eps
+            update = (self.lr / bias_correction1).view(shape) * exp_avg / denominator
+            parameter.sub_(torch.where(mask, update, torch.zeros_like(update)))
+
+
+def pad_signal_tensors(tensors: List[torch.Tensor], pad_value=0) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Stack per-signal tensors of shape (samples,) or (samples, features) into one padded tensor.
+
+    :param tensors: Tensor of every signal.
+    :param pad_value: Value of the padded entries.
+    :return: Tuple of the padded tensor (signals, max samples[, max features]) and the sample mask (signals, max samples).
+    """
+    number_of_samples = max(len(tensor) for tensor in tensors)
+    trailing_shape = [max(tensor.shape[dim] for tensor in tensors) for dim in range(1, tensors[0].dim())]
+    padded = torch.full([len(tensors), number_of_samples] + trailing_shape, pad_value, dtype=tensors[0].dtype)
+    mask = torch.zeros(len(tensors), number_of_samples, dtype=torch.bool)
+    for i, tensor in enumerate(tensors):
+        padded[(i,) + tuple(slice(0, size) for size in tensor.shape)] = tensor
+        mask[i, :len(tensor)] = True
+    return padded, mask
+
+
+def fit_batched_models(model: BatchedMLP,
+                       X: torch.Tensor,
+                       y: torch.Tensor,
+                       sample_mask: torch.Tensor,
+                       per_sample_loss: Callable[[torch.Tensor, torch.Tensor], torch.Tensor],
+                       epochs=20,
+                       batch_size=64,
+                       patience: int = None,
+                       min_delta: float = 0.0,
+                       lr=1e-3) -> torch.Tensor:
+    """
+    Train all models of a BatchedMLP with mini-batches, each model on its own samples.
+
+    Every epoch the samples of every model are shuffled independently. The loss of a model is the mean loss of
+    its samples in the batch, as with a DataLoader per model. With early stopping, a model stops training once
+    its mean training loss did not improve by more than min_delta for patience epochs.
+
+    :param model: The models.
+    :param X: Padded inputs (models, samples, features).
+    :param y: Padded targets (models, samples).
+    :param sample_mask: Valid samples (models, samples).
+    :param per_sample_loss: Returns the loss of every sample (models, batch) for the outputs and targets of a batch.
+    :param epochs: Maximum number of epochs.
+    :param batch_size: Number of samples per batch and model.
+    :param patience: Number of epochs without improvement before a model stops; None disables early stopping.
+    :param min_delta: Minimum decrease of the loss counted as improvement.
+    :param lr: Learning rate.
+    :return: Number of epochs every model was trained.
+    """
+    number_of_models, number_of_samples = sample_mask.shape
+    optimizer = BatchedAdam(model.parameters(), number_of_models, lr=lr)
+
+    active = torch.ones(number_of_models, dtype=torch.bool)
+    best_loss = torch.full((number_of_models,), float('inf'))
+    epochs_without_improvement = torch.zeros(number_of_models, dtype=torch.long)
+    epochs_trained = torch.zeros(number_of_models, dtype=torch.long)
+    sample_counts = sample_mask.sum(dim=1).clamp(min=1)
+
+    for epoch in range(epochs):
+        if not active.any():
+            break
+        model.train()
+
+        # Shuffle the samples of every model independently, valid samples first
+        order = torch.argsort(torch.rand(number_of_models, number_of_samples) + (~sample_mask).float(), dim=1)
+        epoch_loss = torch.zeros(number_of_models)
+
+        for start in range(0, number_of_samples, batch_size):
+            index = order[:, start:start + batch_size]
+            batch_mask = torch.gather(sample_mask, 1, index)
+            batch_active = active & batch_mask.any(dim=1)
+            if not batch_active.any():
+                break
+
+            xb = torch.gather(X, 1, index.unsqueeze(-1).expand(-1, -1, X.shape[2]))
+            yb = torch.gather(y, 1, index)
+            losses = torch.where(batch_mask, per_sample_loss(model(xb), yb), torch.zeros(()))
+            model_losses = losses.sum(dim=1) / batch_mask.sum(dim=1).clamp(min=1)
+
+            # Parameters of different models are independent, so the summed loss yields the per-model gradients
+            optimizer.zero_grad()
+            (model_losses * batch_active).sum().backward()
+            optimizer.step(batch_active)
+            epoch_loss += losses.detach().sum(dim=1)
+
+        epochs_trained += active.long()
+        if patience is not None:
+            epoch_loss = epoch_loss / sample_counts
+            improved = epoch_loss < best_loss - min_delta
+            best_loss = torch.where(improved & active, epoch_loss, best_loss)
+            epochs_without_improvement = torch.where(improved, torch.zeros_like(epochs_without_improvement),
+                                                     epochs_without_improvement + 1)
+            active &= epochs_without_improvement < patience
+
+    return epochs_trained
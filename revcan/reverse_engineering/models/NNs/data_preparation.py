@@ -0,0 +1,207 @@
+"""
+This module defines the array-native data preparation of the signal matching NNs.
+
+Instead of building pandas rows per sample, the values of every signal are kept as a zero padded uint8 payload
+matrix with a length vector (see experiment_store.values_to_matrix) and a ground truth vector. Train/test splits
+are index arrays, stratified by ground truth value like custom_train_test_split and reproducible with a seed.
+The ambiguity and usefulness checks work on unique rows and column statistics of the payload matrix.
+
+Classes:
+    - SignalDataset: Payload matrix and ground truth of a single signal.
+"""
+
+from typing import Dict, List, NamedTuple, Tuple
+
+import numpy as np
+import torch
+
+from revcan.reverse_engineering.models.experiment import Experiment
+from revcan.reverse_engineering.models.experiment_store import ExperimentStore, values_to_matrix
+from revcan.reverse_engineering.models.groundtruth_alignment import GroundtruthAlignment
+
+
+class SignalDataset(NamedTuple):
+    server_id: int
+    did: int
+    lengths: np.ndarray
+    payload: np.ndarray
+    ground_truth: np.ndarray
+
+
+def load_signal_datasets(experiment: Experiment,
+                         ground_truth: np.ndarray,
+                         valid_ground_truth: np.ndarray = None,
+                         store: ExperimentStore = None,
+                         alignment: GroundtruthAlignment = None) -> List[SignalDataset]:
+    """
+    Build the dataset of every signal of an experiment.
+
+    Without alignment, sample i of a signal belongs to ground truth sample i (as in load_data). With an
+    alignment index, every sample belongs to the nearest ground truth sample in time.
+
+    :param experiment: The experiment; with a store, only its signal definitions are used.
+    :param ground_truth: Ground truth value per ground truth sample.
+    :param valid_ground_truth: Mask of the usable ground truth samples; samples of invalid ones are dropped.
+    :param store: Columnar experiment store the payloads are memory-mapped from.
+    :param alignment: Alignment index used instead of the positional mapping.
+    :return: List of datasets, signals without samples are skipped.
+    """
+    ground_truth = np.asarray(ground_truth)
+    if valid_ground_truth is None:
+        valid_ground_truth = np.ones(len(ground_truth), dtype=bool)
+
+    datasets = []
+    for signal in experiment.measurements:
+        if store is not None:
+            _, lengths, payload = store.get_signal_arrays(signal.serverid, signal.did.did)
+        else:
+            lengths, payload = values_to_matrix(signal.values)
+
+        aligned_ground_truth = alignment.get_groundtruth_values(signal.serverid, signal.did.did) \
+            if alignment is not None else None
+        if aligned_ground_truth is not None:
+            signal_ground_truth = aligned_ground_truth
+        else:
+            number_of_samples = min(len(lengths), len(ground_truth))
+            valid = valid_ground_truth[:number_of_samples]
+            lengths, payload = lengths[:number_of_samples][valid], payload[:number_of_samples][valid]
+            signal_ground_truth = ground_truth[:number_of_samples][valid]
+
+        if len(lengths) == 0:
+            continue
+        datasets.append(SignalDataset(signal.serverid, signal.did.did, np.asarray(lengths), np.asarray(payload),
+                                      signal_ground_truth))
+    return datasets
+
+
+def split_signal_dataset(dataset: SignalDataset, train_set_percentage: int = 75,
+                         rng: np.random.Generator = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Split the samples of a signal into train and test indices. Of the samples of every ground truth value,
+    ceil(train_set_percentage %) are randomly assigned to the train set, the rest to the test set.
+
+    :param dataset: The dataset of the signal.
+    :param train_set_percentage: Percentage of the samples of every ground truth value used for training.
+    :param rng: Random generator; a new unseeded one is used if None.
+    :return: Tuple of sorted train and test indices.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+
+    _, groups = np.unique(dataset.ground_truth, return_inverse=True)
+    groups = groups.ravel()
+    # Random order within every ground truth value, then rank of every sample within its value
+    permutation = rng.permutation(len(groups))
+    order = permutation[np.argsort(groups[permutation], kind='stable')]
+    sorted_groups = groups[order]
+    rank = np.arange(len(order)) - np.searchsorted(sorted_groups, sorted_groups, side='left')
+
+    train_counts = np.ceil(np.bincount(groups) * train_set_percentage / 100)
+    train = rank < train_counts[sorted_groups]
+    return np.sort(order[train]), np.sort(order[~train])
+
+
+def signal_dataset_features(dataset: SignalDataset, indices: np.ndarray = None) -> np.ndarray:
+    """
+    Get the normalised byte features of samples of a signal, as done by preprocess_signal_df.
+
+    :param dataset: The dataset of the signal.
+    :param indices: Indices of the samples; all samples if None.
+    :return: Feature matrix (samples x bytes).
+    """
+    payload = dataset.payload if indices is None else dataset.payload[indices]
+    X = payload.astype(np.float64)
+    X_mean = X.mean(axis=0)
+    X_std = X.std(axis=0) + 1e-6  # avoid division by zero
+    return (X - X_mean) / X_std
+
+
+def is_ambiguous_signal_dataset(dataset: SignalDataset, indices: np.ndarray = None) -> bool:
+    """
+    Check whether the same value of a signal occurs with more than one ground truth value.
+
+    :param dataset: The dataset of the signal.
+    :param indices: Indices of the samples checked; all samples if None.
+    :return: True if the signal is ambiguous or has no bytes.
+    """
+    if indices is None:
+        indices = np.arange(len(dataset.lengths))
+    if dataset.payload.shape[1] == 0 or len(indices) == 0:
+        return True
+
+    # The length is part of the value, as values are zero padded
+    rows = np.hstack([dataset.payload[indices].astype(np.int64), dataset.lengths[indices, None].astype(np.int64)])
+    _, row_ids = np.unique(rows, axis=0, return_inverse=True)
+
+    ground_truth = dataset.ground_truth[indices]
+    if np.issubdtype(ground_truth.dtype, np.floating):
+        # Round ground truth values to a tolerance to avoid floating point quirks
+        ground_truth = ground_truth.round(6)
+    _, ground_truth_ids = np.unique(ground_truth, return_inverse=True)
+
+    pairs = np.unique(np.stack([row_ids.ravel(), ground_truth_ids.ravel()], axis=1), axis=0)
+    return len(pairs) > row_ids.max() + 1
+
+
+def is_useless_signal_dataset(dataset: SignalDataset, indices: np.ndarray = None, threshold=1e-5,
+                              tolerance=0.99) -> bool:
+    """
+    Check whether (almost) all bytes of a signal are constant.
+
+    :param dataset: The dataset of the signal.
+    :param indices: Indices of the samples checked; all samples if None.
+    :param threshold: Standard deviation below which a byte counts as constant.
+    :param tolerance: Ratio of constant bytes above which the signal is useless.
+    :return: True if the signal is useless.
+    """
+    payload = dataset.payload if indices is None else dataset.payload[indices]
+    if payload.shape[1] == 0:
+        return True  # No usable features
+    stds = payload.astype(np.float64).std(axis=0)
+    return np.mean(stds < threshold) > tolerance
+
+
+def build_signal_tensors(datasets: List[SignalDataset],
+                         categorical: bool,
+                         train_set_percentage: int = 75,
+                         seed: int = None,
+                         skip_ambiguous_signals=False,
+                         skip_useless_signals=False,
+                         ) -> Dict[Tuple[int, int], Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]]:
+    """
+    Split and convert the datasets into the tensors expected by train_signal_model(s_batched).
+
+    :param datasets: The datasets of the signals.
+    :param categorical: If True, the targets are class indices (sorted ground truth values), else floats.
+    :param train_set_percentage: Percentage of the samples of every ground truth value used for training.
+    :param seed: Seed of the split.
+    :param skip_ambiguous_signals: Skip signals whose training samples are ambiguous.
+    :param skip_useless_signals: Skip signals whose bytes are (almost) constant in the train or test samples.
+    :return: Dict of (X_train, y_train, X_test, y_test) per (server ID, DID).
+    """
+    rng = np.random.default_rng(seed)
+    signal_data = {}
+
+    for dataset in datasets:
+        train_indices, test_indices = split_signal_dataset(dataset, train_set_percentage, rng)
+        if len(train_indices) == 0 or len(test_indices) == 0:
+            continue
+        if skip_ambiguous_signals and is_ambiguous_signal_dataset(dataset, train_indices):
+            continue
+        if skip_useless_signals and (is_useless_signal_dataset(dataset, train_indices)
+                                     or is_useless_signal_dataset(dataset, test_indices)):
+            continue
+
+        if categorical:
+            _, targets = np.unique(dataset.ground_truth, return_inverse=True)
+            targets = torch.tensor(targets.ravel(), dtype=torch.long)
+        else:
+            targets = torch.tensor(np.asarray(dataset.ground_truth, dtype=np.float64), dtype=torch.float32)
+
+        signal_data[(dataset.server_id, dataset.did)] = (
+            torch.tensor(signal_dataset_features(dataset, train_indices), dtype=torch.float32),
+            targets[torch.from_numpy(train_indices)],
+            torch.tensor(signal_dataset_features(dataset, test_indices), dtype=torch.float32),
+            targets[torch.from_numpy(test_indices)],
+        )
+    return signal_data
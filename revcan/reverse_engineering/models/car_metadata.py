@@ -19,6 +19,8 @@ class Server(BaseModel):
     discovery_complete_flag: bool = False
     first_unchecked_did_in_did_discovery: int = 0
     did_discovery_time_seconds: int = 0
+    # Services supported by this server (see 01_discover_services)
+    services: List[Service] = []
 
     #DID data-parameter-definitions as per ISO Table C.1
     #DID F180
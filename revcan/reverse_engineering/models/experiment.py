@@ -61,8 +61,29 @@ class Experiment(BaseModel):
 
     @classmethod
     def load(cls, filePath: str):
+        # Imported here to avoid a circular import, the store depends on the models of this module
+        from revcan.reverse_engineering.models.experiment_store import ExperimentStore, is_columnar_experiment_file
+
+        # Auto-detect format: columnar (npz) files are memory-mapped, everything else is legacy JSON
+        if is_columnar_experiment_file(filePath):
+            return ExperimentStore(filePath).to_experiment()
         with open(filePath, "r", encoding="utf-8") as f:
             return Experiment.model_validate_json(f.read())
+
+    @classmethod
+    def load_arrays(cls, filePath: str):
+        """
+        Load an experiment for analysis. Unlike load, no Value objects are created: the values of columnar (npz)
+        files stay memory-mapped, legacy JSON files are converted into arrays once.
+
+        :param filePath: Path to the experiment file.
+        :return: ExperimentStore of the experiment.
+        """
+        from revcan.reverse_engineering.models.experiment_store import ExperimentStore, is_columnar_experiment_file
+
+        if is_columnar_experiment_file(filePath):
+            return ExperimentStore(filePath)
+        return ExperimentStore.from_experiment(cls.load(filePath))
     
 
     def get_signal_by_ids (experiment, server_id:int, did:int) -> Signal|None:
@@ -98,72 +119,18 @@ class Experiment(BaseModel):
                           maximum_bitflip_rate=1.0,
                           print_results=True,
                           activate_logging_flag=False,
+                          number_of_processes=1,
                           ):
-        #inner function to calculate bitflip rate
-        def calculate_bitflip_rate(value1: List[int],
-                           value2: List[int],
-                           ):
-            # TODO: Check method for LSBF and MSBF
-            total_bit_flips = 0
-            total_bit_comparisons = 0
-
-            min_length = min(len(value1), len(value2))
-
-            for i in range(min_length):
-                # Compute the bitwise XOR of two integers to find differing bits.
-                xor_result = value1[i] ^ value2[i]
-                # Count the number of differing bits (Hamming distance).
-                bit_flips = bin(xor_result).count('1')
-                total_bit_flips += bit_flips
-                # Total bit comparisons = number of bits in the binary representation
-                # of the largest number encountered.
-                total_bit_comparisons += value1[i].bit_length()
-
-            # Add bitflips if values differ in length
-            if len(value1) > len(value2):
-                for i in range(len(value2), len(value1)):
-                    total_bit_comparisons += value1[i].bit_length()
-                    total_bit_flips += value1[i].bit_length()
-            elif len(value1) < len(value2):
-                for i in range(len(value1), len(value2)):
-                    total_bit_comparisons += value2[i].bit_length()
-                    total_bit_flips += value2[i].bit_length()
-
-            # Calculate the flip rate as the total bit flips divided by total bit comparisons.
-            flip_rate = total_bit_flips / total_bit_comparisons if total_bit_comparisons > 0 else 0.0
-
-            return flip_rate
-
-        if minimum_number_of_values < 2:
-            print(f'Error: minimum_number_of_values < 2: minimum_number_of_values = {minimum_number_of_values}.')
-            if activate_logging_flag:
-                logging.warning(f'Error: minimum_number_of_values < 2: minimum_number_of_values = {minimum_number_of_values}.')    
-
-        signals_to_keep = []
-
-        for signal in experiment.measurements:
-            # Check if at least minimum_number_of_values are present
-            if len(signal.values) < minimum_number_of_values:
-                print(f'Error: Less than {minimum_number_of_values} values for did {signal.did} on server {signal.serverid}.')
-                if activate_logging_flag:
-                    logging.warning(f'Error: Less than two values for did {signal.did} on server {signal.serverid}.')
-                #signals_to_be_removed.append(signal)
-            else:
-                # Calculate average bitflip rate for the singal's values
-                number_of_values = len(signal.values)
-                bitflip_rate = 0.0
-                for i in range(number_of_values-1):
-                    bitflip_rate += calculate_bitflip_rate(signal.values[i].value, signal.values[i+1].value)
-                bitflip_rate = bitflip_rate / number_of_values
-                if bitflip_rate < minimum_biflip_rate or bitflip_rate > maximum_bitflip_rate:
-                    #signals_to_be_removed.append(signal)
-                    pass
-                else:
-                    signals_to_keep.append(signal)     
-                
-        experiment.measurements = signals_to_keep
-
-        return experiment
+        # Imported here to avoid a circular import, the filter engine depends on the models of this module
+        from revcan.reverse_engineering.models.experiment_filters import filter_experiment_signals
+        return filter_experiment_signals(experiment,
+                                         filter_name='bitflip-rate',
+                                         keep_values_flag=keep_values_flag,
+                                         minimum_number_of_values=minimum_number_of_values,
+                                         minimum_bitflip_rate=minimum_biflip_rate,
+                                         maximum_bitflip_rate=maximum_bitflip_rate,
+                                         number_of_processes=number_of_processes,
+                                         activate_logging_flag=activate_logging_flag)
 
 
     def keep_constant_signals(experiment,
@@ -171,105 +138,43 @@ class Experiment(BaseModel):
                           minimum_number_of_values=2,
 
                           activate_logging_flag=False,
+                          number_of_processes=1,
                           ):
-        if minimum_number_of_values < 2:
-            print(f'Error: minimum_number_of_values < 2: minimum_number_of_values = {minimum_number_of_values}.')
-            if activate_logging_flag:
-                logging.warning(f'Error: minimum_number_of_values < 2: minimum_number_of_values = {minimum_number_of_values}.')  
-
-        #signals_to_be_removed = []
-        signals_to_keep = []
-
-        for signal in experiment.measurements:
-            # Check if at least minimum_number_of_values are present
-            if len(signal.values) < minimum_number_of_values:
-                print(f'Error: Less than {minimum_number_of_values} values for did {signal.did} on server {signal.serverid}.')
-                if activate_logging_flag:
-                    logging.warning(f'Error: Less than two values for did {signal.did} on server {signal.serverid}.')
-                #signals_to_be_removed.append(signal)
-            else:
-                if all(val.value == signal.values[0].value for val in signal.values):
-                    # Signal is constant
-                    if not keep_values_flag:
-                        signal.values = []
-                    signals_to_keep.append(signal)    
-                else:
-                    # Signal is non-constant
-                    #signals_to_be_removed.append(signal)
-                    pass
-                
-        experiment.measurements = signals_to_keep
-
-        return experiment    
+        from revcan.reverse_engineering.models.experiment_filters import filter_experiment_signals
+        return filter_experiment_signals(experiment,
+                                         filter_name='constant',
+                                         keep_values_flag=keep_values_flag,
+                                         minimum_number_of_values=minimum_number_of_values,
+                                         number_of_processes=number_of_processes,
+                                         activate_logging_flag=activate_logging_flag)
     
     def keep_non_constant_signals(experiment,
                             keep_values_flag= True,
                             minimum_number_of_values=2,
                             activate_logging_flag=False,
+                            number_of_processes=1,
                               ):
-        if minimum_number_of_values < 2:
-            print(f'Error: minimum_number_of_values < 2: minimum_number_of_values = {minimum_number_of_values}.')
-            if activate_logging_flag:
-                logging.warning(f'Error: minimum_number_of_values < 2: minimum_number_of_values = {minimum_number_of_values}.')  
-
-        signals_to_keep = []
-
-        for signal in experiment.measurements:
-            # Check if at least minimum_number_of_values are present
-            if len(signal.values) < minimum_number_of_values:
-                print(f'Error: Less than {minimum_number_of_values} values for did {signal.did} on server {signal.serverid}.')
-                if activate_logging_flag:
-                    logging.warning(f'Error: Less than two values for did {signal.did} on server {signal.serverid}.')
-                #signals_to_be_removed.append(signal)
-            else:
-                if not all(val.value == signal.values[0].value for val in signal.values):
-                    # Signal is non-constant
-                    if not keep_values_flag:
-                        signal.values = []
-                    signals_to_keep.append(signal)    
-                else:
-                    # Signal is constant
-                    #signals_to_be_removed.append(signal)
-                    pass
-                
-        experiment.measurements = signals_to_keep
-
-        return experiment
+        from revcan.reverse_engineering.models.experiment_filters import filter_experiment_signals
+        return filter_experiment_signals(experiment,
+                                         filter_name='non-constant',
+                                         keep_values_flag=keep_values_flag,
+                                         minimum_number_of_values=minimum_number_of_values,
+                                         number_of_processes=number_of_processes,
+                                         activate_logging_flag=activate_logging_flag)
 
     def keep_non_repeating_signals(experiment,
                             keep_values_flag: bool,
                             minimum_number_of_values=2,
                             activate_logging_flag=False,
+                            number_of_processes=1,
                               ):
-        if minimum_number_of_values < 2:
-            print(f'Error: minimum_number_of_values < 2: minimum_number_of_values = {minimum_number_of_values}.')
-            if activate_logging_flag:
-                logging.warning(f'Error: minimum_number_of_values < 2: minimum_number_of_values = {minimum_number_of_values}.')  
-
-        signals_to_keep = []
-
-        for signal in experiment.measurements:
-            # Check if at least minimum_number_of_values are present
-            if len(signal.values) < minimum_number_of_values:
-                print(f'Error: Less than {minimum_number_of_values} values for did {signal.did} on server {signal.serverid}.')
-                if activate_logging_flag:
-                    logging.warning(f'Error: Less than two values for did {signal.did} on server {signal.serverid}.')
-                #signals_to_be_removed.append(signal)
-            else:   
-                values_list = [tuple(val.value) if isinstance(val.value, list) else val.value for val in signal.values]  
-                if len(signal.values) == len(set(values_list)):
-                    # Signal has no repeating values
-                    if not keep_values_flag:
-                        signal.values = []
-                    signals_to_keep.append(signal)    
-                else:
-                    # Signal has repeating values
-                    #signals_to_be_removed.append(signal)
-                    pass
-                
-        experiment.measurements = signals_to_keep
-
-        return experiment
+        from revcan.reverse_engineering.models.experiment_filters import filter_experiment_signals
+        return filter_experiment_signals(experiment,
+                                         filter_name='non-repeating',
+                                         keep_values_flag=keep_values_flag,
+                                         minimum_number_of_values=minimum_number_of_values,
+                                         number_of_processes=number_of_processes,
+                                         activate_logging_flag=activate_logging_flag)
 
     def keep_signals_by_list(experiment,
                              signals_list: List[Signal],
@@ -291,6 +196,13 @@ class Experiment(BaseModel):
         return experiment    
     
     def save(self, filePath: str):
+        from revcan.reverse_engineering.models.experiment_store import COLUMNAR_FILE_SUFFIX, \
+            is_columnar_experiment_file, save_columnar_experiment
+
+        # Keep columnar files columnar; legacy JSON files are converted by saving them with the '.npz' suffix
+        if filePath.endswith(COLUMNAR_FILE_SUFFIX) or is_columnar_experiment_file(filePath):
+            save_columnar_experiment(self, filePath)
+            return
         with open(filePath, "w", encoding="utf-8") as f:
             json = self.model_dump_json(serialize_as_any=True)
             f.write(json)
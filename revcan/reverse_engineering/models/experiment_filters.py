@@ -0,0 +1,218 @@
+"""
+This module defines the vectorised filter engine for experiments.
+
+The values of every signal are converted into a zero padded payload matrix once. All filter statistics
+(bitflip rate, constant and non-repeating flags) are then computed with NumPy in a single pass per signal:
+bitflips via XOR and a popcount lookup table, constant signals via row-equality and repeating values via a
+unique-row check. The computation can be fanned out across signals with a process pool.
+
+Classes:
+    - SignalStatistics: Filter statistics of a single signal.
+"""
+
+import logging
+import multiprocessing
+from typing import List, NamedTuple, Tuple
+
+import numpy as np
+
+from revcan.reverse_engineering.models.experiment import Experiment
+from revcan.reverse_engineering.models.experiment_store import values_to_matrix
+
+FILTER_NAMES = ['constant', 'non-constant', 'non-repeating', 'bitflip-rate']
+
+# Number of set bits and bit length of every byte value
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+BIT_LENGTH_TABLE = np.array([i.bit_length() for i in range(256)], dtype=np.int64)
+
+
+class SignalStatistics(NamedTuple):
+    number_of_values: int
+    bitflip_rate: float
+    constant_flag: bool
+    non_repeating_flag: bool
+
+
+def _popcount(x: np.ndarray) -> np.ndarray:
+    if x.dtype == np.uint8:
+        return POPCOUNT_TABLE[x]
+    return np.frompyfunc(int.bit_count, 1, 1)(x.astype(object)).astype(np.int64)
+
+
+def _bit_length(x: np.ndarray) -> np.ndarray:
+    if x.dtype == np.uint8:
+        return BIT_LENGTH_TABLE[x]
+    return np.frompyfunc(int.bit_length, 1, 1)(x.astype(object)).astype(np.int64)
+
+
+def calculate_bitflip_rate(lengths: np.ndarray, payload: np.ndarray) -> float:
+    """
+    Calculate the average bitflip rate of consecutive values of a signal.
+
+    For every pair of consecutive values the bitflips of the common bytes are counted and divided by the bit
+    length of the bytes of the first value. Bytes of the longer value beyond the common length count as
+    flipped. The sum of the rates of all pairs is divided by the number of values.
+
+    :param lengths: Payload length of every value.
+    :param payload: Zero padded payload matrix, one row per value.
+    :return: The average bitflip rate.
+    """
+    number_of_values = len(lengths)
+    if number_of_values < 2:
+        return 0.0
+
+    first, second = payload[:-1], payload[1:]
+    first_lengths, second_lengths = lengths[:-1, None], lengths[1:, None]
+    byte_index = np.arange(payload.shape[1])[None, :]
+    common = byte_index < np.minimum(first_lengths, second_lengths)
+    extra = ~common & (byte_index < np.maximum(first_lengths, second_lengths))
+
+    xor = first ^ second
+    xor_bit_length = _bit_length(xor) * extra
+    bit_flips = (_popcount(xor) * common).sum(axis=1) + xor_bit_length.sum(axis=1)
+    bit_comparisons = (_bit_length(first) * common).sum(axis=1) + xor_bit_length.sum(axis=1)
+
+    rates = np.divide(bit_flips, bit_comparisons, out=np.zeros(len(bit_flips)), where=bit_comparisons > 0)
+    return float(rates.sum() / number_of_values)
+
+
+def is_constant(lengths: np.ndarray, payload: np.ndarray) -> bool:
+    """
+    Check whether all values of a signal are equal.
+
+    :param lengths: Payload length of every value.
+    :param payload: Zero padded payload matrix, one row per value.
+    :return: True if all values are equal.
+    """
+    if len(lengths) == 0:
+        return True
+    return bool((lengths == lengths[0]).all() and (payload == payload[0]).all())
+
+
+def is_non_repeating(lengths: np.ndarray, payload: np.ndarray) -> bool:
+    """
+    Check whether no value of a signal occurs more than once.
+
+    :param lengths: Payload length of every value.
+    :param payload: Zero padded payload matrix, one row per value.
+    :return: True if all values are unique.
+    """
+    number_of_values = len(lengths)
+    if number_of_values < 2:
+        return True
+    # The length is part of the key, as values are zero padded
+    rows = np.ascontiguousarray(np.hstack([
+        np.ascontiguousarray(payload).view(np.uint8).reshape(number_of_values, -1),
+        lengths.astype('<i4').view(np.uint8).reshape(number_of_values, 4),
+    ]))
+    keys = rows.view(np.dtype((np.void, rows.shape[1]))).ravel()
+    return len(np.unique(keys)) == number_of_values
+
+
+def calculate_signal_statistics(lengths: np.ndarray, payload: np.ndarray) -> SignalStatistics:
+    """
+    Calculate all filter statistics of a signal at once.
+
+    :param lengths: Payload length of every value.
+    :param payload: Zero padded payload matrix, one row per value.
+    :return: The statistics of the signal.
+    """
+    return SignalStatistics(
+        number_of_values=len(lengths),
+        bitflip_rate=calculate_bitflip_rate(lengths, payload),
+        constant_flag=is_constant(lengths, payload),
+        non_repeating_flag=is_non_repeating(lengths, payload),
+    )
+
+
+def _signal_statistics_task(matrix: Tuple[np.ndarray, np.ndarray]) -> SignalStatistics:
+    return calculate_signal_statistics(*matrix)
+
+
+def calculate_experiment_statistics(experiment: Experiment, number_of_processes: int = 1) -> List[SignalStatistics]:
+    """
+    Calculate the filter statistics of all signals of an experiment.
+
+    :param experiment: The experiment.
+    :param number_of_processes: Number of processes used. 1 computes the statistics in this process,
+        0 uses CPU-Cores-1.
+    :return: List of statistics in the order of experiment.measurements.
+    """
+    matrices = [values_to_matrix(signal.values) for signal in experiment.measurements]
+
+    if number_of_processes == 0:
+        number_of_processes = max(1, multiprocessing.cpu_count() - 1)
+
+    if number_of_processes == 1 or len(matrices) < 2:
+        return [calculate_signal_statistics(*matrix) for matrix in matrices]
+
+    chunksize = max(1, len(matrices) // (4 * number_of_processes))
+    with multiprocessing.Pool(number_of_processes) as pool:
+        return pool.map(_signal_statistics_task, matrices, chunksize)
+
+
+def filter_experiment_signals(experiment: Experiment,
+                              filter_name: str,
+                              keep_values_flag: bool = True,
+                              minimum_number_of_values=2,
+                              minimum_bitflip_rate=0.0,
+                              maximum_bitflip_rate=1.0,
+                              statistics: List[SignalStatistics] = None,
+                              number_of_processes: int = 1,
+                              activate_logging_flag=False,
+                              ) -> Experiment:
+    """
+    Keep only the signals of an experiment which pass the selected filter.
+
+    :param experiment: The experiment to be filtered.
+    :param filter_name: One of 'constant', 'non-constant', 'non-repeating', 'bitflip-rate'.
+    :param keep_values_flag: If False, the values of the kept signals are deleted. Not applied by 'bitflip-rate'.
+    :param minimum_number_of_values: Signals with less values are removed.
+    :param minimum_bitflip_rate: Minimum bitflip rate of the 'bitflip-rate' filter.
+    :param maximum_bitflip_rate: Maximum bitflip rate of the 'bitflip-rate' filter.
+    :param statistics: Precomputed statistics (see calculate_experiment_statistics); computed if None.
+    :param number_of_processes: Number of processes used to compute the statistics.
+    :param activate_logging_flag: Whether to log issues.
+    :return: The filtered experiment.
+    """
+    if filter_name not in FILTER_NAMES:
+        print(f'The provided filter_name {filter_name} is unknown. Please select one of these possible values: {", ".join(FILTER_NAMES)}')
+        if activate_logging_flag:
+            logging.warning(f'The provided filter_name {filter_name} is unknown. Please select one of these possible values: {", ".join(FILTER_NAMES)}')
+        return experiment
+
+    if minimum_number_of_values < 2:
+        print(f'Error: minimum_number_of_values < 2: minimum_number_of_values = {minimum_number_of_values}.')
+        if activate_logging_flag:
+            logging.warning(f'Error: minimum_number_of_values < 2: minimum_number_of_values = {minimum_number_of_values}.')
+
+    if statistics is None:
+        statistics = calculate_experiment_statistics(experiment, number_of_processes)
+
+    signals_to_keep = []
+
+    for signal, signal_statistics in zip(experiment.measurements, statistics):
+        # Check if at least minimum_number_of_values are present
+        if signal_statistics.number_of_values < minimum_number_of_values:
+            print(f'Error: Less than {minimum_number_of_values} values for did {signal.did} on server {signal.serverid}.')
+            if activate_logging_flag:
+                logging.warning(f'Error: Less than {minimum_number_of_values} values for did {signal.did} on server {signal.serverid}.')
+            continue
+
+        if filter_name == 'constant':
+            keep_signal_flag = signal_statistics.constant_flag
+        elif filter_name == 'non-constant':
+            keep_signal_flag = not signal_statistics.constant_flag
+        elif filter_name == 'non-repeating':
+            keep_signal_flag = signal_statistics.non_repeating_flag
+        else:
+            keep_signal_flag = minimum_bitflip_rate <= signal_statistics.bitflip_rate <= maximum_bitflip_rate
+
+        if keep_signal_flag:
+            if not keep_values_flag and filter_name != 'bitflip-rate':
+                signal.values = []
+            signals_to_keep.append(signal)
+
+    experiment.measurements = signals_to_keep
+
+    return experiment
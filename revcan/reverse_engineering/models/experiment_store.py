@@ -0,0 +1,329 @@
+"""
+This module defines a columnar, memory-mappable storage backend for experiments.
+
+An experiment file in the columnar format is an uncompressed npz archive. The experiment metadata
+(car, signal definitions, alphanumeric ground truth, ...) is stored as JSON in the member
+``__meta__``. The values of every signal are stored in three arrays per signal:
+
+    - ``signal_<i>_time``: timestamps as int64 nanoseconds (datetime64[ns])
+    - ``signal_<i>_length``: number of valid payload bytes per sample
+    - ``signal_<i>_payload``: zero padded payload matrix (uint8, one row per sample)
+
+External (ground truth) signals use the prefix ``extern_<i>`` and are stored the same way. Their payload
+matrix falls back to int64 if the values do not fit into a byte.
+
+Analysis code reads the values through an ExperimentStore (see Experiment.load_arrays), which only creates
+Value objects for signals that are explicitly materialised. Legacy JSON experiments are converted into arrays
+once when they are opened as store.
+
+Classes:
+    - ExperimentStore: Read-only, memory-mapped view of a columnar experiment file.
+"""
+
+import datetime
+import os
+import struct
+import zipfile
+from typing import Dict, List, Tuple
+
+import numpy as np
+from pydantic import TypeAdapter
+
+from revcan.reverse_engineering.models.experiment import Experiment, Signal, Extern_Signal, Value
+
+COLUMNAR_FILE_SUFFIX = ".npz"
+COLUMNAR_FORMAT_VERSION = 1
+
+_ZIP_MAGIC = b"PK\x03\x04"
+_ZIP_LOCAL_HEADER = struct.Struct("<4s5H3L2H")
+_META_KEY = "__meta__"
+_VERSION_KEY = "__version__"
+_VALUE_LIST_ADAPTER = TypeAdapter(List[Value])
+
+
+def is_columnar_experiment_file(file_path: str) -> bool:
+    """
+    Check whether the file at file_path is stored in the columnar format.
+
+    :param file_path: Path to the experiment file.
+    :return: True if the file is a columnar (npz) experiment file, False otherwise (e.g. legacy JSON).
+    """
+    try:
+        with open(file_path, "rb") as f:
+            return f.read(len(_ZIP_MAGIC)) == _ZIP_MAGIC
+    except FileNotFoundError:
+        return False
+
+
+def values_to_timestamps_ns(values: List[Value]) -> np.ndarray:
+    """
+    Convert the timestamps of a list of values into int64 nanoseconds.
+
+    :param values: List of values.
+    :return: Array of timestamps in nanoseconds (datetime64[ns] as int64).
+    """
+    times = np.empty(len(values), dtype="datetime64[ns]")
+    for i, value in enumerate(values):
+        time = value.time
+        if time.tzinfo is not None:
+            time = time.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        times[i] = np.datetime64(time, "ns")
+    return times.view(np.int64)
+
+
+def values_to_matrix(values: List[Value]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Convert a list of values into a zero padded payload matrix.
+
+    :param values: List of values.
+    :return: Tuple of payload lengths and payload matrix (uint8, or int64 if the values do not fit into a byte).
+    """
+    lengths = np.fromiter((len(value.value) for value in values), dtype=np.int32, count=len(values))
+    width = int(lengths.max()) if len(values) else 0
+
+    try:
+        payload = np.zeros((len(values), width), dtype=np.uint8)
+        for i, value in enumerate(values):
+            payload[i, :lengths[i]] = np.frombuffer(bytes(value.value), dtype=np.uint8)
+    except ValueError:
+        # Values do not fit into a byte (e.g. ground truth values)
+        payload = np.zeros((len(values), width), dtype=np.int64)
+        for i, value in enumerate(values):
+            payload[i, :lengths[i]] = value.value
+
+    return lengths, payload
+
+
+def matrix_to_values(times: np.ndarray, lengths: np.ndarray, payload: np.ndarray) -> List[Value]:
+    """
+    Convert timestamps, payload lengths and payload matrix back into a list of values.
+
+    :param times: Timestamps in nanoseconds.
+    :param lengths: Payload lengths.
+    :param payload: Zero padded payload matrix.
+    :return: List of values.
+    """
+    datetimes = times.astype("datetime64[ns]").astype("datetime64[us]").tolist()
+    rows = payload.tolist()
+    lengths = lengths.tolist()
+    # Validating the whole list at once is considerably faster than constructing every Value on its own
+    return _VALUE_LIST_ADAPTER.validate_python(
+        [{"time": datetimes[i], "value": rows[i][:lengths[i]]} for i in range(len(datetimes))])
+
+
+def _experiment_metadata(experiment: Experiment) -> Experiment:
+    # The experiment without any values of its signals
+    return experiment.model_copy(update={
+        "measurements": [Signal.model_construct(serverid=s.serverid, did=s.did, values=[])
+                         for s in experiment.measurements],
+        "external_measurements": [Extern_Signal.model_construct(name=s.name, id=s.id, values=[])
+                                  for s in experiment.external_measurements],
+    })
+
+
+def _experiment_arrays(experiment: Experiment) -> Dict[str, np.ndarray]:
+    arrays: Dict[str, np.ndarray] = {}
+    for i, signal in enumerate(experiment.measurements):
+        arrays[f"signal_{i}_time"] = values_to_timestamps_ns(signal.values)
+        arrays[f"signal_{i}_length"], arrays[f"signal_{i}_payload"] = values_to_matrix(signal.values)
+    for i, signal in enumerate(experiment.external_measurements):
+        arrays[f"extern_{i}_time"] = values_to_timestamps_ns(signal.values)
+        arrays[f"extern_{i}_length"], arrays[f"extern_{i}_payload"] = values_to_matrix(signal.values)
+    return arrays
+
+
+def save_columnar_experiment(experiment: Experiment, file_path: str):
+    """
+    Save an experiment in the columnar format.
+
+    :param experiment: Experiment to be saved.
+    :param file_path: Destination path. The path is used as is, no suffix is appended.
+    """
+    arrays = _experiment_arrays(experiment)
+
+    # Store the remaining experiment without any values as metadata
+    meta = _experiment_metadata(experiment)
+    arrays[_META_KEY] = np.frombuffer(meta.model_dump_json(serialize_as_any=True).encode("utf-8"), dtype=np.uint8)
+    arrays[_VERSION_KEY] = np.array(COLUMNAR_FORMAT_VERSION, dtype=np.int32)
+
+    # Write to a temporary file first, so an interrupted save never destroys the experiment and stores that mapped
+    # the previous file keep reading it. Pass a file object, otherwise numpy appends '.npz' to the path.
+    temporary_file_path = file_path + ".tmp"
+    with open(temporary_file_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(temporary_file_path, file_path)
+
+
+def convert_experiment_file(input_file_path: str, output_file_path: str) -> Experiment:
+    """
+    Convert an experiment file (legacy JSON or columnar) into the columnar format.
+
+    :param input_file_path: Path to the experiment file to be converted.
+    :param output_file_path: Path of the columnar experiment file to be written.
+    :return: The converted experiment.
+    """
+    experiment = Experiment.load(input_file_path)
+    save_columnar_experiment(experiment, output_file_path)
+    return experiment
+
+
+def memmap_npz_member(file_path: str, info: zipfile.ZipInfo) -> np.ndarray:
+    """
+    Memory-map a single array of an uncompressed npz archive. Compressed members are read instead.
+
+    :param file_path: Path to the npz archive.
+    :param info: Zip info of the member.
+    :return: The array.
+    """
+    with open(file_path, "rb") as f:
+        f.seek(info.header_offset)
+        header = _ZIP_LOCAL_HEADER.unpack(f.read(_ZIP_LOCAL_HEADER.size))
+        f.seek(header[9] + header[10], 1)
+        if info.compress_type != zipfile.ZIP_STORED:
+            # Compressed members cannot be mapped, fall back to reading them
+            with zipfile.ZipFile(file_path, "r") as archive:
+                return np.load(archive.open(info))
+
+        major, minor = np.lib.format.read_magic(f)
+        if (major, minor) == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+
+    if 0 in shape:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(file_path, dtype=dtype, mode="r", offset=offset, shape=shape,
+                     order="F" if fortran_order else "C")
+
+
+class ExperimentStore:
+    """
+    Read-only, memory-mapped view of a columnar experiment file.
+
+    Opening a store only parses the metadata. The arrays of a signal are memory-mapped on first access,
+    so scripts only touch the signals they actually read. Stores of experiments which are not stored in the
+    columnar format (see from_experiment) hold the arrays in memory instead.
+
+    Attributes:
+        file_path (str): Path to the columnar experiment file; None for stores created from an experiment.
+        experiment (Experiment): Experiment metadata; the values of all signals are empty.
+
+    Methods:
+        from_experiment(experiment): Creates an in-memory store of an experiment.
+        get_signal_arrays(server_id, did): Returns timestamps, lengths and payloads of a signal.
+        get_extern_signal_arrays(extern_id): Returns timestamps, lengths and values of an external signal.
+        get_signal_values(server_id, did): Returns the values of a signal as list of Value objects.
+        get_extern_signal_values(extern_id): Returns the values of an external signal as list of Value objects.
+        to_experiment(): Materialises the complete Experiment model.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._members: Dict[str, zipfile.ZipInfo] = {}
+        self._cache: Dict[str, np.ndarray] = {}
+
+        with zipfile.ZipFile(file_path, "r") as archive:
+            for info in archive.infolist():
+                self._members[info.filename[:-len(".npy")]] = info
+            version = int(np.load(archive.open(_VERSION_KEY + ".npy")))
+            meta = np.load(archive.open(_META_KEY + ".npy")).tobytes()
+
+        if version > COLUMNAR_FORMAT_VERSION:
+            raise ValueError(f"Unsupported columnar experiment format version {version} in '{file_path}'.")
+
+        self.experiment = Experiment.model_validate_json(meta)
+        self._build_index()
+
+    @classmethod
+    def from_experiment(cls, experiment: Experiment) -> "ExperimentStore":
+        """
+        Create an in-memory store of an experiment, e.g. of a legacy JSON file. The values are converted into
+        arrays once.
+
+        :param experiment: The experiment.
+        :return: The store.
+        """
+        store = cls.__new__(cls)
+        store.file_path = None
+        store._members = {}
+        store._cache = _experiment_arrays(experiment)
+        store.experiment = _experiment_metadata(experiment)
+        store._build_index()
+        return store
+
+    def _build_index(self):
+        self._signal_index = {(signal.serverid, signal.did.did): i
+                              for i, signal in enumerate(self.experiment.measurements)}
+        self._extern_index = {signal.id: i for i, signal in enumerate(self.experiment.external_measurements)}
+
+    def _array(self, key: str) -> np.ndarray:
+        if key not in self._cache:
+            self._cache[key] = memmap_npz_member(self.file_path, self._members[key])
+        return self._cache[key]
+
+    def _arrays(self, prefix: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        return self._array(prefix + "_time"), self._array(prefix + "_length"), self._array(prefix + "_payload")
+
+    def get_signal_arrays(self, server_id: int, did: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray] | None:
+        """
+        Get the memory-mapped arrays of a signal.
+
+        :param server_id: ID of the server.
+        :param did: Data identifier of the signal.
+        :return: Tuple of timestamps (int64 ns), payload lengths and payload matrix, or None if unknown.
+        """
+        index = self._signal_index.get((server_id, did))
+        if index is None:
+            return None
+        return self._arrays(f"signal_{index}")
+
+    def get_extern_signal_arrays(self, extern_id: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray] | None:
+        """
+        Get the memory-mapped arrays of an external (ground truth) signal.
+
+        :param extern_id: ID of the external signal.
+        :return: Tuple of timestamps (int64 ns), value lengths and value matrix, or None if unknown.
+        """
+        index = self._extern_index.get(extern_id)
+        if index is None:
+            return None
+        return self._arrays(f"extern_{index}")
+
+    def get_signal_values(self, server_id: int, did: int) -> List[Value]:
+        """
+        Get the values of a signal as list of Value objects.
+
+        :param server_id: ID of the server.
+        :param did: Data identifier of the signal.
+        :return: List of values, empty if the signal is unknown.
+        """
+        arrays = self.get_signal_arrays(server_id, did)
+        if arrays is None:
+            return []
+        return matrix_to_values(*arrays)
+
+    def get_extern_signal_values(self, extern_id: int) -> List[Value]:
+        """
+        Get the values of an external (ground truth) signal as list of Value objects.
+
+        :param extern_id: ID of the external signal.
+        :return: List of values, empty if the external signal is unknown.
+        """
+        arrays = self.get_extern_signal_arrays(extern_id)
+        if arrays is None:
+            return []
+        return matrix_to_values(*arrays)
+
+    def to_experiment(self) -> Experiment:
+        """
+        Materialise the complete Experiment model including all values.
+
+        :return: The experiment.
+        """
+        experiment = self.experiment.model_copy(deep=True)
+        for i, signal in enumerate(experiment.measurements):
+            signal.values = matrix_to_values(*self._arrays(f"signal_{i}"))
+        for i, signal in enumerate(experiment.external_measurements):
+            signal.values = matrix_to_values(*self._arrays(f"extern_{i}"))
+        return experiment
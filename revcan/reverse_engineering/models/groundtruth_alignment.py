@@ -0,0 +1,224 @@
+"""
+This module defines the ground truth alignment index of an experiment.
+
+For every signal the index maps sample i to the nearest sample of the ground truth signal. It is computed
+once per experiment with np.searchsorted and cached next to the experiment file as an uncompressed npz
+archive (``<experiment file>.alignment.npz``):
+
+    - ``__meta__``: JSON with the ground truth id, the signal keys and the modification time and size of
+      the experiment file the index was built from
+    - ``groundtruth_time`` / ``groundtruth_value``: timestamps (int64 ns) and first value of every ground truth sample
+    - ``indices``: ground truth indices of all signals, concatenated in the order of the signal keys
+    - ``offsets``: start of every signal in ``indices``
+
+The cache is rebuilt if the experiment file was modified or another ground truth signal is requested.
+All arrays are memory-mapped, so analyses running in several processes share them without copies.
+
+Classes:
+    - GroundtruthAlignment: Read-only, memory-mapped view of an alignment cache file.
+"""
+
+import json
+import logging
+import os
+import zipfile
+from typing import Dict, Tuple
+
+import numpy as np
+
+from revcan.reverse_engineering.models.experiment import Experiment
+from revcan.reverse_engineering.models.experiment_store import memmap_npz_member
+
+ALIGNMENT_FILE_SUFFIX = ".alignment.npz"
+ALIGNMENT_FORMAT_VERSION = 1
+
+_META_KEY = "__meta__"
+_VERSION_KEY = "__version__"
+
+
+def nearest_groundtruth_indices(times_ns: np.ndarray, groundtruth_times_ns: np.ndarray) -> np.ndarray:
+    """
+    Find the index of the nearest ground truth sample for every timestamp. Ties are resolved towards the
+    earlier ground truth sample. The ground truth timestamps have to be sorted.
+
+    :param times_ns: Timestamps of the measured values in nanoseconds.
+    :param groundtruth_times_ns: Sorted timestamps of the ground truth values in nanoseconds.
+    :return: Array of ground truth indices.
+    """
+    positions = np.searchsorted(groundtruth_times_ns, times_ns, side='left')
+    before = np.clip(positions - 1, 0, len(groundtruth_times_ns) - 1)
+    after = np.clip(positions, 0, len(groundtruth_times_ns) - 1)
+    take_before = np.abs(times_ns - groundtruth_times_ns[before]) <= np.abs(groundtruth_times_ns[after] - times_ns)
+    return np.where(take_before, before, after)
+
+
+def alignment_file_path(experiment_file_path: str) -> str:
+    """
+    Get the path of the alignment cache of an experiment file.
+
+    :param experiment_file_path: Path to the experiment file.
+    :return: Path to the alignment cache file.
+    """
+    # The extension is kept, as a JSON experiment and its columnar conversion usually share the same name
+    return experiment_file_path + ALIGNMENT_FILE_SUFFIX
+
+
+def _source_stamp(experiment_file_path: str) -> Tuple[int, int]:
+    stat = os.stat(experiment_file_path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def build_groundtruth_alignment(experiment_file_path: str, groundtruth_id: int = None,
+                                output_file_path: str = None) -> str:
+    """
+    Compute the alignment index of all signals of an experiment and write it to the cache file.
+
+    :param experiment_file_path: Path to the experiment file (JSON or columnar).
+    :param groundtruth_id: ID of the external signal used as ground truth; defaults to the first one.
+    :param output_file_path: Path of the cache file; defaults to alignment_file_path(experiment_file_path).
+    :return: Path of the written cache file.
+    """
+    if output_file_path is None:
+        output_file_path = alignment_file_path(experiment_file_path)
+    source_mtime_ns, source_size = _source_stamp(experiment_file_path)
+
+    store = Experiment.load_arrays(experiment_file_path)
+    experiment = store.experiment
+
+    if groundtruth_id is None:
+        groundtruth_id = experiment.external_measurements[0].id
+    groundtruth_arrays = store.get_extern_signal_arrays(groundtruth_id)
+    if groundtruth_arrays is None:
+        raise ValueError(f"Ground truth signal {groundtruth_id} not found in '{experiment_file_path}'.")
+    groundtruth_times_ns, _, groundtruth_payload = groundtruth_arrays
+
+    signal_keys, indices, offsets = [], [], [0]
+    for signal in experiment.measurements:
+        times_ns = store.get_signal_arrays(signal.serverid, signal.did.did)[0]
+        signal_indices = nearest_groundtruth_indices(np.asarray(times_ns), np.asarray(groundtruth_times_ns)) \
+            if len(groundtruth_times_ns) else np.zeros(0, dtype=np.int64)
+        signal_keys.append([signal.serverid, signal.did.did])
+        indices.append(signal_indices)
+        offsets.append(offsets[-1] + len(signal_indices))
+
+    meta = {
+        "groundtruth_id": groundtruth_id,
+        "source_mtime_ns": source_mtime_ns,
+        "source_size": source_size,
+        "signals": signal_keys,
+    }
+    arrays = {
+        _META_KEY: np.frombuffer(json.dumps(meta).encode("utf-8"), dtype=np.uint8),
+        _VERSION_KEY: np.array(ALIGNMENT_FORMAT_VERSION),
+        "groundtruth_time": np.asarray(groundtruth_times_ns, dtype=np.int64),
+        "groundtruth_value": np.asarray(groundtruth_payload[:, 0] if len(groundtruth_payload) else [],
+                                        dtype=np.float64),
+        "indices": np.concatenate(indices).astype(np.int64) if indices else np.zeros(0, dtype=np.int64),
+        "offsets": np.asarray(offsets, dtype=np.int64),
+    }
+
+    # Write to a temporary file first, so concurrent readers never map a partially written cache
+    temporary_file_path = output_file_path + ".tmp.npz"
+    np.savez(temporary_file_path, **arrays)
+    os.replace(temporary_file_path, output_file_path)
+    return output_file_path
+
+
+def load_groundtruth_alignment(experiment_file_path: str, groundtruth_id: int = None,
+                               activate_logging_flag=False) -> 'GroundtruthAlignment':
+    """
+    Open the alignment cache of an experiment, (re)building it if it is missing or outdated.
+
+    :param experiment_file_path: Path to the experiment file (JSON or columnar).
+    :param groundtruth_id: ID of the external signal used as ground truth; defaults to the first one.
+    :param activate_logging_flag: Whether to log issues.
+    :return: The alignment index.
+    """
+    cache_file_path = alignment_file_path(experiment_file_path)
+    if os.path.exists(cache_file_path):
+        try:
+            alignment = GroundtruthAlignment(cache_file_path)
+            if alignment.is_valid_for(experiment_file_path, groundtruth_id):
+                return alignment
+        except Exception as e:
+            print(f"Error loading alignment cache '{cache_file_path}': {e}. Rebuilding it.")
+            if activate_logging_flag:
+                logging.warning(f"Error loading alignment cache '{cache_file_path}': {e}. Rebuilding it.")
+
+    build_groundtruth_alignment(experiment_file_path, groundtruth_id, cache_file_path)
+    return GroundtruthAlignment(cache_file_path)
+
+
+class GroundtruthAlignment:
+    """
+    Read-only, memory-mapped view of an alignment cache file.
+
+    Attributes:
+        file_path (str): Path to the alignment cache file.
+        groundtruth_id (int): ID of the external signal used as ground truth.
+        groundtruth_times_ns (np.ndarray): Timestamps of the ground truth samples in nanoseconds.
+        groundtruth_values (np.ndarray): First value of every ground truth sample.
+
+    Methods:
+        is_valid_for(experiment_file_path, groundtruth_id): Checks whether the cache matches the experiment file.
+        get_indices(server_id, did): Returns the ground truth index of every sample of a signal.
+        get_groundtruth_values(server_id, did): Returns the ground truth value of every sample of a signal.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+
+        with zipfile.ZipFile(file_path, "r") as archive:
+            members = {info.filename[:-len(".npy")]: info for info in archive.infolist()}
+            version = int(np.load(archive.open(_VERSION_KEY + ".npy")))
+            meta = json.loads(np.load(archive.open(_META_KEY + ".npy")).tobytes())
+
+        if version > ALIGNMENT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported alignment format version {version} in '{file_path}'.")
+
+        self._meta = meta
+        self.groundtruth_id = meta["groundtruth_id"]
+        self.groundtruth_times_ns = memmap_npz_member(file_path, members["groundtruth_time"])
+        self.groundtruth_values = memmap_npz_member(file_path, members["groundtruth_value"])
+        self._indices = memmap_npz_member(file_path, members["indices"])
+        self._offsets = memmap_npz_member(file_path, members["offsets"])
+        self._signal_index: Dict[Tuple[int, int], int] = {(server_id, did): i
+                                                           for i, (server_id, did) in enumerate(meta["signals"])}
+
+    def is_valid_for(self, experiment_file_path: str, groundtruth_id: int = None) -> bool:
+        """
+        Check whether the cache was built from the current version of an experiment file.
+
+        :param experiment_file_path: Path to the experiment file.
+        :param groundtruth_id: Requested ground truth ID; None accepts any.
+        :return: True if the cache can be used.
+        """
+        if groundtruth_id is not None and groundtruth_id != self.groundtruth_id:
+            return False
+        return _source_stamp(experiment_file_path) == (self._meta["source_mtime_ns"], self._meta["source_size"])
+
+    def get_indices(self, server_id: int, did: int) -> np.ndarray | None:
+        """
+        Get the ground truth index of every sample of a signal as a view into the memory-mapped cache.
+
+        :param server_id: ID of the server.
+        :param did: Data identifier of the signal.
+        :return: Array of ground truth indices, or None if the signal is unknown.
+        """
+        index = self._signal_index.get((server_id, did))
+        if index is None:
+            return None
+        return self._indices[self._offsets[index]:self._offsets[index + 1]]
+
+    def get_groundtruth_values(self, server_id: int, did: int) -> np.ndarray | None:
+        """
+        Get the ground truth value aligned to every sample of a signal.
+
+        :param server_id: ID of the server.
+        :param did: Data identifier of the signal.
+        :return: Array of ground truth values, or None if the signal is unknown.
+        """
+        indices = self.get_indices(server_id, did)
+        if indices is None:
+            return None
+        return np.asarray(self.groundtruth_values)[indices]
@@ -0,0 +1,158 @@
+"""
+This module defines the batched least-squares engine used to match measured signals against a ground truth signal.
+
+For every signal the payload matrix and the aligned ground truth vector are built once. All byte windows of a
+length are viewed as one stacked array and interpreted with every datatype of that length, which yields a
+candidate matrix with one column per (datatype, start byte) combination. The closed-form solution of the 1-D
+linear regression y = slope * x + intercept (coefficients, residual, R², rank and singular values) is then
+computed for all candidates in one vectorised pass.
+
+Classes:
+    - CandidateScores: Regression results of all candidates of a signal.
+"""
+
+from typing import Dict, List, NamedTuple, Tuple
+
+import numpy as np
+
+# Datatypes evaluated per window length, interpreted with numpy's dtype strings
+DATA_TYPES = {
+    1: ['<u1', '<i1', '>u1', '>i1'],
+    2: ['<u2', '<i2', '<f2', '>u2', '>i2', '>f2'],
+    4: ['<u4', '<i4', '<f4', '>u4', '>i4', '>f4'],
+    8: ['<u8', '<i8', '<f8', '>u8', '>i8', '>f8'],
+}
+
+
+class CandidateScores(NamedTuple):
+    datatypes: np.ndarray
+    start_bytes: np.ndarray
+    lengths: np.ndarray
+    coefficients: np.ndarray
+    residuals: np.ndarray
+    r_squared: np.ndarray
+    singular_values: np.ndarray
+
+
+def build_candidates(lengths: np.ndarray, payload: np.ndarray, data_types: Dict[int, List[str]] = None
+                     ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Interpret all byte windows of a payload matrix with all datatypes.
+
+    Only windows which are contained in the payload of every value are considered.
+
+    :param lengths: Payload length of every value.
+    :param payload: Zero padded uint8 payload matrix, one row per value.
+    :param data_types: Datatypes per window length; defaults to DATA_TYPES.
+    :return: Tuple of candidate matrix (values x candidates, float64), datatypes, start bytes and lengths per candidate.
+    """
+    if data_types is None:
+        data_types = DATA_TYPES
+
+    number_of_values = len(lengths)
+    common_length = int(lengths.min()) if number_of_values else 0
+    payload = np.ascontiguousarray(payload[:, :common_length], dtype=np.uint8)
+
+    columns, datatypes, start_bytes, window_lengths = [], [], [], []
+    for length, types in data_types.items():
+        number_of_windows = common_length - length + 1
+        if number_of_windows <= 0:
+            continue
+        # (values, windows, length) copy of all byte windows, which can be viewed as any datatype of that length
+        windows = np.ascontiguousarray(np.lib.stride_tricks.sliding_window_view(payload, length, axis=1))
+        for datatype in types:
+            with np.errstate(over='ignore', invalid='ignore'):
+                columns.append(windows.view(datatype).reshape(number_of_values, number_of_windows).astype(np.float64))
+            datatypes += [datatype] * number_of_windows
+            start_bytes.append(np.arange(number_of_windows))
+            window_lengths += [length] * number_of_windows
+
+    if not columns:
+        return (np.empty((number_of_values, 0)), np.array([], dtype=str), np.array([], dtype=int),
+                np.array([], dtype=int))
+    return (np.hstack(columns), np.array(datatypes), np.concatenate(start_bytes), np.array(window_lengths))
+
+
+def candidate_values(lengths: np.ndarray, payload: np.ndarray, datatype: str, start_byte: int) -> np.ndarray:
+    """
+    Interpret a single byte window of a payload matrix with a datatype, as done by build_candidates.
+
+    :param lengths: Payload length of every value.
+    :param payload: Zero padded uint8 payload matrix, one row per value.
+    :param datatype: Numpy dtype string of the candidate.
+    :param start_byte: First byte of the window.
+    :return: Candidate values (float64), one per value.
+    """
+    length = np.dtype(datatype).itemsize
+    window = np.ascontiguousarray(payload[:, start_byte:start_byte + length], dtype=np.uint8)
+    with np.errstate(over='ignore', invalid='ignore'):
+        return window.view(datatype).reshape(len(lengths)).astype(np.float64)
+
+
+def solve_candidates(x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Solve the 1-D linear regression y = slope * x + intercept for every column of x in closed form.
+
+    The results equal np.linalg.lstsq on the system [x, 1]. Candidates for which lstsq would not return a residual
+    (rank < 2 or not more values than unknowns) or which contain non-finite values are marked invalid.
+
+    :param x: Candidate matrix (values x candidates).
+    :param y: Ground truth vector.
+    :return: Tuple of valid mask, coefficients (candidates x 2), residuals, R² and singular values (candidates x 2).
+    """
+    number_of_values = len(y)
+    with np.errstate(all='ignore'):
+        x_mean = x.mean(axis=0)
+        y_mean = y.mean()
+        x_centered = x - x_mean
+        y_centered = y - y_mean
+        sxx = np.einsum('ij,ij->j', x_centered, x_centered)
+        sxy = y_centered @ x_centered
+        syy = y_centered @ y_centered
+
+        slope = sxy / sxx
+        intercept = y_mean - slope * x_mean
+        residuals = np.maximum(syy - slope * sxy, 0.0)
+        r_squared = 1.0 - residuals / syy if syy > 0 else np.zeros_like(residuals)
+
+        # Singular values of [x, 1] from the eigenvalues of its 2x2 gram matrix
+        sum_xx = sxx + number_of_values * x_mean ** 2
+        half_trace = (sum_xx + number_of_values) / 2
+        determinant = number_of_values * sxx
+        root = np.sqrt(np.maximum(half_trace ** 2 - determinant, 0.0))
+        largest_eigenvalue = half_trace + root
+        # The product of the eigenvalues equals the determinant, which avoids cancellation for the smaller one
+        singular_values = np.sqrt(np.stack([largest_eigenvalue, determinant / largest_eigenvalue], axis=1))
+
+        # Rank 2 as determined by lstsq with its default cutoff rcond = eps * max(M, N)
+        full_rank = singular_values[:, 1] > np.finfo(np.float64).eps * max(number_of_values, 2) * singular_values[:, 0]
+
+        valid = (number_of_values > 2) & (sxx > 0) & full_rank & np.isfinite(slope) & np.isfinite(intercept) \
+            & np.isfinite(residuals) & np.isfinite(x).all(axis=0)
+
+    return valid, np.stack([slope, intercept], axis=1), residuals, r_squared, singular_values
+
+
+def score_signal(lengths: np.ndarray, payload: np.ndarray, y: np.ndarray,
+                 data_types: Dict[int, List[str]] = None) -> Tuple[CandidateScores, np.ndarray]:
+    """
+    Score all candidates of a signal against the aligned ground truth.
+
+    :param lengths: Payload length of every value.
+    :param payload: Zero padded uint8 payload matrix, one row per value.
+    :param y: Ground truth value aligned to every value of the signal.
+    :param data_types: Datatypes per window length; defaults to DATA_TYPES.
+    :return: Tuple of the scores of the valid candidates and their candidate matrix (values x valid candidates).
+    """
+    x, datatypes, start_bytes, window_lengths = build_candidates(lengths, payload, data_types)
+    valid, coefficients, residuals, r_squared, singular_values = solve_candidates(x, y.astype(np.float64))
+    scores = CandidateScores(
+        datatypes=datatypes[valid],
+        start_bytes=start_bytes[valid],
+        lengths=window_lengths[valid],
+        coefficients=coefficients[valid],
+        residuals=residuals[valid],
+        r_squared=r_squared[valid],
+        singular_values=singular_values[valid],
+    )
+    return scores, x[:, valid]
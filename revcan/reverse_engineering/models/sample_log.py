@@ -0,0 +1,201 @@
+"""
+This module defines an append-only, segmented log for samples read during an experiment.
+
+Every sample is appended as a compact binary record to the current segment file of the log directory:
+
+    server_id (uint16) | did (uint16) | time_ns (int64, time.time_ns()) | length (uint32) | payload (length bytes)
+
+Segments are flushed and fsynced periodically, so a crash or interruption only loses the samples of the
+last fsync interval. A new segment is started whenever the current one exceeds its maximum size and whenever
+the log is reopened, so a possibly truncated segment of an interrupted run is never appended to.
+Compaction folds all records into the signals of an experiment, which can then be saved to the experiment store.
+
+Classes:
+    - SampleLog: Append-only sample log consisting of one or more segment files.
+"""
+
+import datetime
+import os
+import struct
+import threading
+import time
+from typing import Dict, Iterator, List, Tuple
+
+from revcan.reverse_engineering.models.experiment import Experiment, Value
+
+SEGMENT_MAGIC = b"RCSL\x01"
+SEGMENT_PREFIX = "segment_"
+SEGMENT_SUFFIX = ".log"
+RECORD_HEADER = struct.Struct("<HHqI")
+
+
+class SampleLog:
+    """
+    A class representing an append-only sample log stored in a directory of segment files.
+
+    Attributes:
+        log_dir (str): Directory containing the segment files.
+        segment_max_bytes (int): Size after which a new segment is started.
+        fsync_interval_seconds (float): Maximum time between two fsyncs of the current segment.
+
+    Methods:
+        segment_paths(): Returns the paths of all segments in order.
+        append(server_id, did, time_ns, payload): Appends a sample record to the current segment.
+        sync(): Flushes and fsyncs the current segment.
+        close(): Syncs and closes the current segment.
+        records(): Iterates over all records of all segments.
+        get_sample_counts(): Returns the number of logged samples per (server_id, did).
+        compact(experiment): Appends all logged samples to the signals of the experiment.
+        remove_segments(): Deletes all segment files.
+    """
+
+    def __init__(self, log_dir: str, segment_max_bytes: int = 64 * 1024 * 1024, fsync_interval_seconds: float = 1.0):
+        self.log_dir = log_dir
+        self.segment_max_bytes = segment_max_bytes
+        self.fsync_interval_seconds = fsync_interval_seconds
+        self._segment = None
+        self._segment_bytes = 0
+        self._last_sync = 0.0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def segment_paths(self) -> List[str]:
+        """
+        Get the paths of all segment files of the log.
+
+        :return: List of segment paths in the order they were written.
+        """
+        if not os.path.isdir(self.log_dir):
+            return []
+        names = [name for name in os.listdir(self.log_dir)
+                 if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)]
+        return [os.path.join(self.log_dir, name) for name in sorted(names)]
+
+    def _open_new_segment(self):
+        self.close()
+        os.makedirs(self.log_dir, exist_ok=True)
+        paths = self.segment_paths()
+        index = int(os.path.basename(paths[-1])[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]) + 1 if paths else 0
+        path = os.path.join(self.log_dir, f"{SEGMENT_PREFIX}{index:06d}{SEGMENT_SUFFIX}")
+        self._segment = open(path, "xb")
+        self._segment.write(SEGMENT_MAGIC)
+        self._segment_bytes = len(SEGMENT_MAGIC)
+        self._last_sync = time.monotonic()
+
+    def append(self, server_id: int, did: int, time_ns: int, payload: bytes | None):
+        """
+        Append a sample record to the current segment.
+
+        :param server_id: ID of the server the sample was read from.
+        :param did: Data identifier of the sample.
+        :param time_ns: Timestamp of the sample in nanoseconds since epoch (time.time_ns()).
+        :param payload: Payload of the sample; None is stored as empty payload.
+        """
+        if payload is None:
+            payload = b""
+        # Samples may be appended by several reader threads
+        with self._lock:
+            if self._segment is None or self._segment_bytes >= self.segment_max_bytes:
+                self._open_new_segment()
+
+            self._segment.write(RECORD_HEADER.pack(server_id, did, time_ns, len(payload)) + payload)
+            self._segment_bytes += RECORD_HEADER.size + len(payload)
+
+            if time.monotonic() - self._last_sync >= self.fsync_interval_seconds:
+                self.sync()
+
+    def sync(self):
+        """
+        Flush and fsync the current segment.
+        """
+        if self._segment is not None:
+            self._segment.flush()
+            os.fsync(self._segment.fileno())
+            self._last_sync = time.monotonic()
+
+    def close(self):
+        """
+        Sync and close the current segment. The next append starts a new segment.
+        """
+        if self._segment is not None:
+            self.sync()
+            self._segment.close()
+            self._segment = None
+
+    @staticmethod
+    def _segment_records(path: str, read_payload: bool = True) -> Iterator[Tuple[int, int, int, bytes | None]]:
+        with open(path, "rb") as f:
+            if f.read(len(SEGMENT_MAGIC)) != SEGMENT_MAGIC:
+                print(f"Warning: Skipping invalid sample log segment '{path}'.")
+                return
+            segment_size = os.fstat(f.fileno()).st_size
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                server_id, did, time_ns, length = RECORD_HEADER.unpack(header)
+                if read_payload:
+                    payload = f.read(length)
+                    if len(payload) < length:
+                        return
+                else:
+                    payload = None
+                    if f.seek(length, 1) > segment_size:
+                        return
+                yield server_id, did, time_ns, payload
+
+    def records(self, read_payload: bool = True) -> Iterator[Tuple[int, int, int, bytes | None]]:
+        """
+        Iterate over all records of all segments. A truncated record at the end of a segment
+        (e.g. after a crash) is skipped.
+
+        :param read_payload: If False, payloads are skipped and None is returned instead.
+        :return: Iterator of (server_id, did, time_ns, payload) tuples.
+        """
+        if self._segment is not None:
+            self._segment.flush()
+        for path in self.segment_paths():
+            yield from self._segment_records(path, read_payload)
+
+    def get_sample_counts(self) -> Dict[Tuple[int, int], int]:
+        """
+        Get the number of logged samples per signal.
+
+        :return: Dictionary mapping (server_id, did) to the number of logged samples.
+        """
+        counts = {}
+        for server_id, did, _, _ in self.records(read_payload=False):
+            counts[(server_id, did)] = counts.get((server_id, did), 0) + 1
+        return counts
+
+    def compact(self, experiment: Experiment) -> Experiment:
+        """
+        Append all logged samples to the matching signals of the experiment. Records of signals which
+        are not part of the experiment are ignored. The segments are not removed, call remove_segments()
+        after the experiment has been saved successfully.
+
+        :param experiment: Experiment the samples belong to.
+        :return: The experiment including the logged samples.
+        """
+        signals = {(signal.serverid, signal.did.did): signal for signal in experiment.measurements}
+        for server_id, did, time_ns, payload in self.records():
+            signal = signals.get((server_id, did))
+            if signal is None:
+                continue
+            timestamp = datetime.datetime.fromtimestamp(time_ns // 1_000_000_000).replace(
+                microsecond=(time_ns // 1_000) % 1_000_000)
+            signal.values.append(Value(time=timestamp, value=list(payload)))
+        return experiment
+
+    def remove_segments(self):
+        """
+        Delete all segment files of the log.
+        """
+        self.close()
+        for path in self.segment_paths():
+            os.remove(path)
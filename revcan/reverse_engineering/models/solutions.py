@@ -0,0 +1,191 @@
+from pydantic import BaseModel, ConfigDict, field_serializer, field_validator
+from revcan.reverse_engineering.models.experiment import Extern_Signal
+from typing import Callable, List, NamedTuple, Optional, Tuple
+import heapq
+import itertools
+import os
+import time
+import numpy as np
+
+
+class Signal_Solution(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+    x: np.ndarray
+    y: np.ndarray
+    datatype: str
+    coefficients: np.ndarray
+    residuals: np.ndarray
+    rank: int
+    singular_values: np.ndarray
+    serverid: int
+    did: int
+    start_byte: int
+    length: int
+
+    @field_validator('x', 'y', 'coefficients', 'residuals', 'singular_values', mode='before')
+    def convert_list_to_array(cls, value):
+        if isinstance(value, np.ndarray):
+            return value
+        return np.asarray(value, dtype=float)
+
+    @field_serializer('x', 'y', 'coefficients', 'residuals', 'singular_values')
+    def convert_array_to_list(self, value: np.ndarray):
+        return value.tolist()
+
+
+class Solutions(BaseModel):
+    groundtruth: Optional[Extern_Signal] = None
+    solutions: List[Signal_Solution] = []
+
+    @classmethod
+    def load(cls, filePath: str):
+        with open(filePath, "r", encoding="utf-8") as f:
+            return Solutions.model_validate_json(f.read())
+
+    def save(self, filePath: str):
+        with open(filePath, "w", encoding="utf-8") as f:
+            json = self.model_dump_json()
+            f.write(json)
+
+
+class SolutionScore(NamedTuple):
+    serverid: int
+    did: int
+    datatype: str
+    start_byte: int
+    length: int
+    coefficients: np.ndarray
+    residual: float
+    r_squared: float
+    singular_values: np.ndarray
+
+
+RANK_BY = ['residuals', 'r_squared']
+
+
+class SolutionsWriter:
+    """
+    Streaming top-K reduction of the candidate scores of an analysis.
+
+    Only compact score records are kept in a bounded heap. The x and y vectors are materialised for the
+    retained candidates when the solutions are written, which happens periodically and on close. Every write
+    replaces the output file atomically, so an interrupted analysis leaves the best solutions found so far.
+
+    Attributes:
+        file_path (str): Path of the solutions file.
+        groundtruth (Extern_Signal): Ground truth signal stored with the solutions.
+        materialise (Callable): Returns the (x, y) vectors of a SolutionScore.
+        top_k (int): Number of retained candidates; 0 keeps all.
+        rank_by (str): 'residuals' (ascending) or 'r_squared' (descending).
+        flush_interval_seconds (float): Minimum time between two writes triggered by add.
+
+    Methods:
+        add(serverid, did, scores): Adds the candidate scores (see least_squares.CandidateScores) of a signal.
+        get_solution_scores(): Returns the retained scores, best first.
+        flush(): Writes the retained solutions.
+        close(): Writes the retained solutions a last time.
+    """
+
+    def __init__(self, file_path: str, groundtruth: Optional[Extern_Signal],
+                 materialise: Callable[[SolutionScore], Tuple[np.ndarray, np.ndarray]],
+                 top_k: int = 1000, rank_by: str = 'residuals', flush_interval_seconds: float = 30.0):
+        if rank_by not in RANK_BY:
+            raise ValueError(f"Unknown rank_by '{rank_by}'. Possible values: {', '.join(RANK_BY)}")
+        self.file_path = file_path
+        self.groundtruth = groundtruth
+        self.materialise = materialise
+        self.top_k = top_k
+        self.rank_by = rank_by
+        self.flush_interval_seconds = flush_interval_seconds
+
+        # Max-heap on the ranking key (smaller is better) holding (-key, sequence number, score)
+        self._heap = []
+        self._sequence = itertools.count()
+        self._last_flush = time.monotonic()
+        self._dirty = False
+
+    def _keys(self, scores) -> np.ndarray:
+        if self.rank_by == 'residuals':
+            return np.asarray(scores.residuals, dtype=np.float64)
+        return -np.asarray(scores.r_squared, dtype=np.float64)
+
+    def add(self, serverid: int, did: int, scores):
+        """
+        Add the candidate scores of a signal and write the solutions if the flush interval elapsed.
+
+        :param serverid: ID of the server.
+        :param did: Data identifier of the signal.
+        :param scores: Scores of the valid candidates of the signal (least_squares.CandidateScores).
+        """
+        keys = self._keys(scores)
+        candidates = np.flatnonzero(~np.isnan(keys))
+        # Only the best top_k candidates of a signal can enter the heap
+        if self.top_k and len(candidates) > self.top_k:
+            candidates = candidates[np.argpartition(keys[candidates], self.top_k - 1)[:self.top_k]]
+
+        for i in candidates:
+            key = float(keys[i])
+            if self.top_k and len(self._heap) >= self.top_k:
+                if key >= -self._heap[0][0]:
+                    continue
+                push = heapq.heapreplace
+            else:
+                push = heapq.heappush
+            push(self._heap, (-key, next(self._sequence), SolutionScore(
+                serverid=serverid,
+                did=did,
+                datatype=str(scores.datatypes[i]),
+                start_byte=int(scores.start_bytes[i]),
+                length=int(scores.lengths[i]),
+                coefficients=np.array(scores.coefficients[i]),
+                residual=float(scores.residuals[i]),
+                r_squared=float(scores.r_squared[i]),
+                singular_values=np.array(scores.singular_values[i]),
+            )))
+            self._dirty = True
+
+        if time.monotonic() - self._last_flush >= self.flush_interval_seconds:
+            self.flush()
+
+    def get_solution_scores(self) -> List[SolutionScore]:
+        """
+        Get the retained scores.
+
+        :return: List of scores, best first.
+        """
+        return [entry[2] for entry in sorted(self._heap, key=lambda entry: (-entry[0], entry[1]))]
+
+    def flush(self):
+        """
+        Materialise the retained solutions and replace the solutions file with them.
+        """
+        all_solutions = Solutions(groundtruth=self.groundtruth)
+        for score in self.get_solution_scores():
+            x, y = self.materialise(score)
+            all_solutions.solutions.append(Signal_Solution(
+                x=x,
+                y=y,
+                datatype=score.datatype,
+                coefficients=score.coefficients,
+                residuals=np.array([score.residual]),
+                rank=2,
+                singular_values=score.singular_values,
+                serverid=score.serverid,
+                did=score.did,
+                start_byte=score.start_byte,
+                length=score.length,
+            ))
+
+        temporary_file_path = self.file_path + ".tmp"
+        all_solutions.save(temporary_file_path)
+        os.replace(temporary_file_path, self.file_path)
+        self._last_flush = time.monotonic()
+        self._dirty = False
+
+    def close(self):
+        """
+        Write the retained solutions a last time.
+        """
+        if self._dirty or not os.path.exists(self.file_path):
+            self.flush()
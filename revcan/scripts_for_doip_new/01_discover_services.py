@@ -8,6 +8,8 @@ from revcan.modules.caringcaribou.caringcaribou.utils.constants import ARBITRATI
     BYTE_MAX
 from revcan.modules.caringcaribou.caringcaribou.utils.constants import ARBITRATION_ID_MIN
 from revcan.modules.caringcaribou.caringcaribou.utils.iso14229_1 import Constants, NegativeResponseCodes
+from revcan.signal_discovery.doip_session_pool import connection_manager
+from revcan.signal_discovery.service_scan import ServiceScanner
 from revcan.signal_discovery.utils.doipclient import DoIPClient
 from revcan.signal_discovery.utils.doipclient.connectors import DoIPClientUDSConnector
 
@@ -30,7 +32,7 @@ def service_discovery(ecu_logical_address, client_logical_address, ecu_ip_addres
 
     :param ecu_logical_address: arbitration ID for requests
     :param client_logical_address: arbitration ID for responses
-    :param timeout: delay between each request sent
+    :param timeout: time to wait for the response to each request
     :param min_id: first service ID to scan
     :param max_id: last service ID to scan
     :param print_results: whether progress should be printed to stdout
@@ -43,63 +45,50 @@ def service_discovery(ecu_logical_address, client_logical_address, ecu_ip_addres
     :return: list of supported service IDs
     :rtype [int]
     """
-    found_services = []
+    found_services = service_discovery_servers([ecu_logical_address], client_logical_address, ecu_ip_address,
+                                               timeout, min_id, max_id, print_results)
+    return found_services.get(ecu_logical_address, [])
 
-    print("Discovering Services\n")
-
-    try:
-
-        for service_id in range(min_id, max_id + 1):
-
-            if print_results:
-                print("\rProbing service 0x{0:02x} ({0}/{1}): found {2}; "
-                      .format(service_id, max_id, len(found_services)),
-                      end="")
-            stdout.flush()
 
-            doip_client = DoIPClient(ecu_ip_address, ecu_logical_address, client_logical_address=client_logical_address)
+def service_discovery_servers(server_ids, client_logical_address, ecu_ip_address, timeout,
+                              min_id=BYTE_MIN, max_id=BYTE_MAX, print_results=True, session_type=3):
+    """Scans for supported UDS services of several servers in parallel over one DoIP connection.
+       Every server is kept in the given session for the whole scan (see ServiceScanner).
 
-            conn = DoIPClientUDSConnector(doip_client)
-
-            s = struct.pack("<h", service_id)
-
-            doip_message = struct.pack("!HH", client_logical_address, ecu_logical_address) + s[:1] + b"\x00"
-
-            try:
-                with Client(conn, request_timeout=timeout) as client:
-                    extended_session(client, session_type=3)
+    :param server_ids: logical addresses of the servers
+    :param client_logical_address: arbitration ID for responses
+    :param timeout: time to wait for the response to each request
+    :param min_id: first service ID to scan
+    :param max_id: last service ID to scan
+    :param print_results: whether progress should be printed to stdout
+    :param session_type: diagnostic session used for the scan
+    :return: supported service IDs per reachable server
+    :rtype {int: [int]}
+    """
+    found_services = {}
 
-                    doip_client.send_doip(PAYLOAD_TYPE, doip_message)
-                    response = doip_client.receive_diagnostic(timeout)
+    print("Discovering Services\n")
 
-                    doip_client.close()
+    number_of_found_services = [0]
 
-                    if response is None or response[2] == NegativeResponseCodes.SERVICE_NOT_SUPPORTED:
-                        continue
+    def on_found(server_id, service_id):
+        number_of_found_services[0] += 1
 
-                    if response[2] == NegativeResponseCodes.SUB_FUNCTION_NOT_SUPPORTED or \
-                            response[2] == NegativeResponseCodes.INCORRECT_MESSAGE_LENGTH_OR_INVALID_FORMAT:
-                        response_id = service_id
-                        response_service_id = response[2]
-                        status = response[2]
-                        if response_id != Constants.NR_SI:
-                            request_id = service_id
-                            found_services.append(request_id)
-                        elif status != NegativeResponseCodes.SERVICE_NOT_SUPPORTED:
-                            # Any other response than "service not supported" counts
-                            found_services.append(response_service_id)
+    def on_progress(server_id, service_id):
+        if print_results:
+            print("\rProbing service 0x{0:02x} ({0}/{1}) of server 0x{2:04x}: found {3}; "
+                  .format(service_id, max_id, server_id, number_of_found_services[0]),
+                  end="")
+            stdout.flush()
 
-            except ConfigError:
-                sys.stderr = DevNull()
-                time.sleep(3)
-                continue
-            except OSError:
-                sys.stderr = DevNull()
-                time.sleep(3)
-                continue
-            except IndexError:
-                sys.stderr = DevNull()
-                continue
+    try:
+        with connection_manager.lease(ecu_ip_address, client_logical_address, server_ids[0]) as session:
+            scanner = ServiceScanner(session.doip_client, client_logical_address, timeout=timeout,
+                                     session_type=session_type)
+            found_services = scanner.scan(server_ids, range(min_id, max_id + 1), on_found=on_found,
+                                          on_progress=on_progress)
+        for server_id in scanner.unreachable_servers:
+            print(f"\nServer 0x{server_id:04x} is not reachable through the gateway.")
 
         if print_results:
             print("\nDone!")
@@ -112,10 +101,13 @@ def service_discovery(ecu_logical_address, client_logical_address, ecu_ip_addres
     except (ConnectionRefusedError, ConnectionResetError, TimeoutError, OSError):
         print("Please check the connection and try again.\n")
 
+    finally:
+        connection_manager.close(ecu_ip_address, client_logical_address)
+
     return found_services
 
 
-def __service_discovery_wrapper(config_file_path, car_model_file_path):
+def __service_discovery_wrapper(config_file_path, car_model_file_path, all_servers_flag=False):
     """Wrapper used to initiate a service discovery scan"""
     # Load config
     config = Config(config_file_path)
@@ -147,11 +139,22 @@ def __service_discovery_wrapper(config_file_path, car_model_file_path):
     arb_id_response = car.arb_id_pairs[0].client_logical_address
     timeout = doip_config.get("service_discovery_timeout")
     ecu_ip_address = config.get(f"vehicles.{car.model}_{car.vin}_ip_address")
-    # Probe services
-    found_services = service_discovery(arb_id_request,
-                                       arb_id_response, ecu_ip_address, timeout)
-    if found_services: # check if services were found
-        car.services = [] # Reset list of services first
+    # Probe services of the gateway address and, if requested, of all discovered servers in parallel
+    server_ids = [arb_id_request]
+    if all_servers_flag:
+        server_ids += [server.id for server in car.servers if server.id != arb_id_request]
+    found_services_per_server = service_discovery_servers(server_ids, arb_id_response, ecu_ip_address,
+                                                          doip_config.get("service_scan_timeout", timeout))
+    for server in car.servers:
+        if server.id in found_services_per_server:
+            server.services = [car_metadata.Service(id=service_id,
+                                                    name=UDS_SERVICE_NAMES.get(service_id, "Unknown service"))
+                               for service_id in found_services_per_server[server.id]]
+
+    found_services = found_services_per_server.get(arb_id_request, [])
+    if found_services or len(server_ids) > 1: # check if services were found
+        if found_services:
+            car.services = [] # Reset list of services first
         for service_id in found_services:
             service_id_name = UDS_SERVICE_NAMES.get(service_id, "Unknown service")
             print("Supported service 0x{0:02x}: {1}".format(service_id, service_id_name))
@@ -183,6 +186,12 @@ if __name__ == "__main__":
         type=str,
         help="Path to car model",
     )
+    argparser.add_argument(
+        "--all_servers_flag",
+        dest="all_servers_flag",
+        type=bool,
+        help="Flag that indicates whether to scan the services of all discovered servers in parallel",
+    )
     args = argparser.parse_args()
 
-    __service_discovery_wrapper(args.config_file_path, args.car_model_path)
\ No newline at end of file
+    __service_discovery_wrapper(args.config_file_path, args.car_model_path, args.all_servers_flag)
\ No newline at end of file
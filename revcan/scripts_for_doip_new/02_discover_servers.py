@@ -1,5 +1,6 @@
 import json
 import argparse
+import bisect
 import sys
 import time
 import logging
@@ -13,96 +14,31 @@ from revcan.signal_discovery.utils.udsoncan.services import DiagnosticSessionCon
 from revcan.config import Config
 from revcan.reverse_engineering.models import car_metadata
 from display_car_metadata import display_car_metadata
+from revcan.signal_discovery.doip_session_pool import DoIPSessionPool
+from revcan.signal_discovery.ecu_identification import IdentificationCache, read_ecu_identification, \
+    read_ecu_identifications
+from revcan.signal_discovery.server_scan import scan_servers
 from revcan.signal_discovery.utils.doipclient import DoIPClient
 
 
 
-def request_ecu_metadata(client: Client, server: car_metadata.Server):
-    metadata_dids=[0xf180, 0xf181, 0xf182, 0xf183,0xf184, 0xf185,0xf186,0xf187,0xf188,0xf189,0xf18A,0xf18B,0xf18C,0xf18D,0xf18E,0xf18F,0xf190,0xf191,0xf192,0xf193,0xf194,0xf195,0xf196,0xf197,0xf198,0xf199,0xf19A,0xf19B,0xf19C,0xf19D,0xf19E,0xf19F ]
-
-    for did in metadata_dids:
-        response = client.read_data_by_identifier_first(didlist=[did])
-
-        if response is None:
-            continue
-
-        if isinstance(response, bytes):
-            try:
-                response = response.decode('utf-8')
-            except UnicodeDecodeError:
-                try:
-                    response = response.decode('latin-1')
-                except UnicodeDecodeError:
-                    print(f"Warning: Could not decode response for DID {did}.")
-                    response = ""
-            
-            match did:
-                    case 0xf180 :
-                        server.BootSoftwareIdentificationDataIdentifier = response
-                    case 0xf181:
-                        server.applicationSoftwareIdentificationDataIdentifier = response
-                    case 0xf182:
-                        server.applicationDataIdentificationDataIdentifier = response
-                    case 0xf183:
-                        server.bootSoftwareFingerprintDataIdentifier = response
-                    case 0xf184:
-                        server.applicationSoftwareFingerprintDataIdentifier = response
-                    case 0xf185:
-                        server.applicationDataFingerprintDataIdentifier = response
-                    case 0xf186:
-                        server.ActiveDiagnosticSessionDataIdentifier = response
-                    case 0xf187:
-                        server.vehicleManufacturerSparePartNumberDataIdentifier = response
-                    case 0xf188:
-                        server.vehicleManufacturerECUSoftwareNumberDataIdentifier = response
-                    case 0xf189:
-                        server.vehicleManufacturerECUSoftwareVersionNumberDataIdentier = response
-                    case 0xf18A:
-                        server.systemSupplierIdentifierDataIdentifier = response
-                    case 0xf18B:
-                        server.ECUManufacturingDateDataIdentifier = response
-                    case 0xf18C:
-                        server.ECUSerialNumberDataIdentifier = response
-                    case 0xf18D:
-                        server.supportedFunctionalUnitsDataIdentifier = response
-                    case 0xf18E:
-                        server.VehicleManufacturerKitAssemblyPartNumberDataIdentifier = response
-                    case 0xf18F:
-                        server.RegulationXSoftwareIdentificationNumbers = response
-                    case 0xf190:
-                        server.VINDataIdentifier = response
-                    case 0xf191:
-                        server.vehicleManufacturerECUHardwareNumberDataIdentifier = response
-                    case 0xf192:
-                        server.systemSupplierECUHardwareNumberDataIdentifier = response
-                    case 0xf193:
-                        server.systemSupplierECUHardwareVersionNumberDataIdentifier = response
-                    case 0xf194:
-                        server.systemSupplierECUSoftwareNumberDataIdentifier = response
-                    case 0xf195:
-                        server.systemSupplierECUSoftwareVersionNumberDataIdentifier = response
-                    case 0xf196:
-                        server.exhaustRegulationOrTypeApprovalNumberDataIdentifier = response
-                    case 0xf197:
-                        server.systemNameOrEngineTypeDataIdentifier = response
-                    case 0xf198:
-                        server.repairShopCodeOrTesterSerialNumberDataIdentifier = response
-                    case 0xf199:
-                        server.programmingDateDataIdentifier = response
-                    case 0xf19A:
-                        server.calibrationRepairShopCodeOrCalibrationEquipmentSerialNumberDataIdentifier = response
-                    case 0xf19B:
-                        server.calibrationDateDataIdentifier = response
-                    case 0xf19C:
-                        server.calibrationEquipmentSoftwareNumberDataIdentifier = response
-                    case 0xf19D:
-                        server.ECUInstallationDateDataIdentifier = response
-                    case 0xf19E:
-                        server.ODXFileDataIdentifier = response
-                    case 0xf19E:
-                        server.EntityDataIdentifier = response
-                    case _:
-                        print("unknown did requested")
+def request_ecu_metadata(client: Client, server: car_metadata.Server, max_dids_per_request=32):
+    """
+    Request the identification DIDs (0xF180 - 0xF19F) of a server with multi-DID requests.
+
+    Args:
+        client (Client): UDS client addressing the server.
+        server (Server): The server, its identification fields are updated.
+        max_dids_per_request (int): Maximum number of DIDs per request.
+    """
+    read_ecu_identification(lambda didlist: client.read_data_by_identifier(didlist=didlist), server,
+                            max_dids_per_request=max_dids_per_request)
+
+
+def identification_cache_path(doip_config, car_model_path: str) -> str:
+    # The cache is shared by all car models of a directory unless configured otherwise
+    return doip_config.get("ecu_identification_cache") or \
+        os.path.join(os.path.dirname(os.path.abspath(car_model_path)), "ecu_identification_cache.json")
 
 
 def __wrapper_request_ecu_metadata(config_file_path: str, 
@@ -140,48 +76,19 @@ def __wrapper_request_ecu_metadata(config_file_path: str,
         print("client_logical_address not found in the configuration.")
         return
 
-    current_count = 0
-
-    for server in car.servers:
-        current_count+=1
-        try:
-            doip_client = DoIPClient(
-                ecu_ip_address=config.get(f"vehicles.{car.model}_{car.vin}_ip_address"),
-                initial_ecu_logical_address=server.id,
-                client_logical_address=client_logical_address,
-                # client_ip_address=self.client_ip_address,
-            )
-            conn = DoIPClientUDSConnector(doip_client)
-
-            with Client(
-                    conn, request_timeout=timeout) as client:
-                response = client.change_session(
-                    DiagnosticSessionControl.Session.defaultSession
-                )
-            
-            if print_results:
-                print(f"Requesting ECU metadata for server 0x{server.id:04x}: {current_count}/{len(car.servers)}")
-
-            # Request ECU metadata for discovered server
-            with Client(conn, request_timeout=timeout) as client:
-                request_ecu_metadata(client, car.servers[-1])
-        
-        except KeyboardInterrupt:
-            return
-        except ConnectionRefusedError:
-            time.sleep(delay)
-        except ConnectionResetError:
-            time.sleep(delay)
-            continue
-        except TimeoutError:
-            #sys.stderr = self.DevNull()
-            continue
-        except OSError:
-            return
-        
-        # Catch all unexpected exceptions and make sure everything is saved before leaving.
-        except Exception:
-            return
+    # Read the identification of all servers concurrently, unchanged servers are taken from the cache
+    session_pool = DoIPSessionPool(config.get(f"vehicles.{car.model}_{car.vin}_ip_address"), client_logical_address,
+                                   max_in_flight_per_gateway=doip_config.get("max_in_flight_per_gateway", 4),
+                                   max_in_flight_per_server=1,
+                                   request_timeout=timeout)
+    try:
+        read_ecu_identifications(session_pool, car.servers, vin=car.vin,
+                                 cache=IdentificationCache(identification_cache_path(doip_config, car_model_path)),
+                                 max_dids_per_request=doip_config.get("ecu_identification_max_batch_size", 32),
+                                 max_workers=doip_config.get("max_in_flight_per_gateway", 4),
+                                 print_results=print_results)
+    except KeyboardInterrupt:
+        pass
     
     car.save(car_model_path)
 
@@ -196,149 +103,119 @@ def uds_server_discovery(
         print_results=True,
         activate_logging_flag=False,
         client_logical_address:int=None,
+        number_of_connections=1,
+        pipeline_depth=4,
+        requests_per_second=0,
+        identification_cache: IdentificationCache = None,
 ):
     """
     Discover UDS servers using the specified parameters.
 
+    The addresses are probed over activated DoIP connections which are re-used for all addresses (see
+    server_scan). Addresses the gateway rejects with a diagnostic negative acknowledgement are skipped immediately.
+
     Args:
         ecu_ip_address (str): The network adapter to use for discovery.
         min_id (int): The minimum arbitration ID to consider.
         max_id (int): The maximum arbitration ID to consider.
         blacklist (list): A list of blacklisted ID ranges.
-        auto_blacklist_duration (float): Duration for which to blacklist an address.
-        delay (float): Delay between requests.
+        delay (float): Delay after a refused or reset connection.
         print_results (bool): Whether to print the discovery results.
         client_logical_address (str): Logical address of the client.
+        number_of_connections (int): Number of DoIP connections probing in parallel.
+        pipeline_depth (int): Number of probes in flight per connection.
+        requests_per_second (float): Rate limit of all connections together, <= 0 disables it.
+        identification_cache (IdentificationCache): Cache of the ECU identifications of known servers.
 
     Returns:
         list: A list of discovered servers.
     """
 
     # adds all the blacklisted addresses to the blacklist
-    blacklist_final = []
+    blacklist_final = set()
     for i in blacklist:
-        numbers = list(range(i[0], i[1]))
-        for number in numbers:
-            blacklist_final.append(number)
+        blacklist_final.update(range(i[0], i[1]))
+    server_ids = [server_id for server_id in range(min_id, max_id + 1) if server_id not in blacklist_final]
+
     found_servers=[]
-    server_id = min_id-1
+    known_server_ids = {server.id for server in car.servers}
     start_time = time.time()
-    while server_id < max_id:
-        server_id += 1
-
-        if server_id in blacklist:
-            # Ignore blacklisted arbitration IDs
-            continue
 
-        if print_results:
-            print("\rSending Diagnostic Session Control to 0x{0:04x}: found {1} - {2:.2f}% complete."
-                  .format(server_id, len(car.servers), ((server_id / max_id) * 100)),end="")
+    def on_found(server_id):
+        print(
+            "\n\nFound diagnostics server "
+            "listening at 0x{0:04x}, "
+            "response at 0x{1:04x}".format(client_logical_address, server_id)
+        )
         if activate_logging_flag:
-            logging.info("Sending Diagnostic Session Control to 0x{0:04x}: found {1} - {2:.2f}% complete."
-                  .format(server_id, len(car.servers), ((server_id / max_id) * 100)))
+            logging.info("\n\nFound diagnostics server "
+                "listening at 0x{0:04x}, "
+                "response at 0x{1:04x}".format(client_logical_address, server_id))
+        found_servers.append(hex(server_id))
+        if server_id not in known_server_ids:
+            known_server_ids.add(server_id)
+            # Connections scan different blocks, keep the servers sorted by address
+            position = bisect.bisect_left(car.servers, server_id, key=lambda server: server.id)
+            car.servers.insert(position, car_metadata.Server(id=server_id, max_payload_length=-1, parameters=[]))
+
+    def on_progress(server_id):
+        car.first_unchecked_server_id_in_server_discovery = max_id + 1 if server_id is None else server_id
+        if print_results:
+            print("\rSending Diagnostic Session Control up to 0x{0:04x}: found {1} - {2:.2f}% complete."
+                  .format(car.first_unchecked_server_id_in_server_discovery, len(car.servers),
+                          ((min(car.first_unchecked_server_id_in_server_discovery, max_id) / max_id) * 100)), end="")
+
+    # Suppress lower-level messages
+    if activate_logging_flag:
+        logging.getLogger().setLevel(logging.WARNING)
 
-        # Suppress lower-level messages
+    try:
+        scan_servers(ecu_ip_address, client_logical_address, server_ids,
+                     on_found=on_found,
+                     on_progress=on_progress,
+                     number_of_connections=number_of_connections,
+                     pipeline_depth=pipeline_depth,
+                     requests_per_second=requests_per_second,
+                     timeout=timeout)
+    except KeyboardInterrupt:
+        end_time = time.time()
+        total_time = int(round(end_time - start_time))
+        car.server_discovery_time_seconds += total_time
+        print(f"\nServer Discovery interrupted. Time elapsed: {total_time} seconds.")
+        if activate_logging_flag:
+            logging.warning(f"\nServer Discovery interrupted. Time elapsed: {total_time} seconds.")
+        return found_servers
+    except (ConnectionRefusedError, ConnectionResetError, TimeoutError, OSError) as e:
+        end_time = time.time()
+        total_time = int(round(end_time - start_time))
+        car.server_discovery_time_seconds += total_time
+        print(f"\nServer Discovery interrupted. {type(e).__name__}: {e}")
+        print("Please check the connection and try again.\n")
         if activate_logging_flag:
-            logging.getLogger().setLevel(logging.WARNING)
-
-        try:
-            doip_client = DoIPClient(
-                ecu_ip_address=ecu_ip_address,
-                initial_ecu_logical_address=server_id,
-                client_logical_address=client_logical_address,
-                # client_ip_address=self.client_ip_address,
-            )
-            conn = DoIPClientUDSConnector(doip_client)
-
-            with Client(
-                    conn, request_timeout=timeout) as client:
-                response = client.change_session(
-                    DiagnosticSessionControl.Session.defaultSession
-                )
-
-            # Acitvate lower-level messages again
-            if activate_logging_flag:
-                logging.getLogger().setLevel(logging.INFO)
-
-            if response == None:
-                continue
-            elif response.positive:
-                print(
-                    "\n\nFound diagnostics server "
-                    "listening at 0x{0:04x}, "
-                    "response at 0x{1:04x}".format(client_logical_address, server_id)
-                )
-                if activate_logging_flag:
-                    logging.info("\n\nFound diagnostics server "
-                        "listening at 0x{0:04x}, "
-                        "response at 0x{1:04x}".format(client_logical_address, server_id))
-                # # adds the found servers to the list;
-                # # the loop asures that only the ecu addresses are added and not the tester
-                # if client_id_status == 1:
-                found_servers.append(hex(server_id))
-                if not car.servers or server_id != car.servers[-1].id:
-                    car.servers.append(car_metadata.Server(id=server_id, max_payload_length=-1, parameters=[]))
-                
-                # Request ECU metadata for discovered server
-                try:
-                    with Client(conn, request_timeout=timeout) as client:
-                        request_ecu_metadata(client, car.servers[-1])
-                except Exception as e:
-                    print(f"\033[91mError while requesting metadata for server 0x{server_id:04x}: {e}")
-                    if activate_logging_flag:
-                        logging.warning(f"\033[91mError while requesting metadata for server 0x{server_id:04x}: {e}")
-                    continue    
-
-            else:
-                blacklist.add(server_id)
-
-        except KeyboardInterrupt:
-            end_time = time.time()
-            total_time = int(round(end_time - start_time))
-            car.server_discovery_time_seconds += total_time
-            car.first_unchecked_server_id_in_server_discovery = server_id
-            print(f"\nServer Discovery interrupted. Time elapsed: {total_time} seconds.")
-            if activate_logging_flag:
-                logging.warning(f"\nServer Discovery interrupted. Time elapsed: {total_time} seconds.")
-            return
-        except ConnectionRefusedError as e:
-            print(f"\nServer Discovery interrupted. ConnectionRefusedError: {e}")
-            if activate_logging_flag:
-                logging.warning(f"\nServer Discovery interrupted. ConnectionRefusedError: {e}")
-            time.sleep(delay)
-        except ConnectionResetError as e:
-            print(f"\nServer Discovery interrupted. ConnectionResetError: {e}")
-            if activate_logging_flag:
-                logging.warning(f"\nServer Discovery interrupted. ConnectionResetError: {e}")
-            time.sleep(delay)
-            continue
-        except TimeoutError as e:
-            #sys.stderr = self.DevNull()
-            print(f"\nServer Discovery interrupted. TimeoutError: {e}")
-            if activate_logging_flag:
-                logging.warning(f"\nServer Discovery interrupted. TimeoutError: {e}")
-            continue
-        except OSError as e:
-            end_time = time.time()
-            total_time = int(round(end_time - start_time))
-            car.server_discovery_time_seconds += total_time
-            car.first_unchecked_server_id_in_server_discovery = server_id
-            print(f"\nServer Discovery interrupted. OSError: {e}")
-            print("Please check the connection and try again.\n")
-            if activate_logging_flag:
-                logging.warning(f"\nServer Discovery interrupted. OSError: {e}")
-            return
-        
-        # Catch all unexpected exceptions and make sure everything is saved before leaving.
-        except Exception:
-            car.first_unchecked_server_id_in_server_discovery = server_id
-            return
+            logging.warning(f"\nServer Discovery interrupted. {type(e).__name__}: {e}")
+        time.sleep(delay)
+        return found_servers
+    finally:
+        # Acitvate lower-level messages again
+        if activate_logging_flag:
+            logging.getLogger().setLevel(logging.INFO)
 
     end_time = time.time()
     total_time = int(round(end_time - start_time))
     car.server_discovery_time_seconds += total_time
     car.first_unchecked_server_id_in_server_discovery = max_id+1
-    return
+
+    # Request ECU metadata for the discovered servers concurrently
+    new_servers = [server for server in car.servers if hex(server.id) in found_servers]
+    if new_servers:
+        session_pool = DoIPSessionPool(ecu_ip_address, client_logical_address,
+                                       max_in_flight_per_gateway=max(1, number_of_connections),
+                                       max_in_flight_per_server=1,
+                                       request_timeout=timeout)
+        read_ecu_identifications(session_pool, new_servers, vin=car.vin, cache=identification_cache,
+                                 max_workers=max(1, number_of_connections), print_results=print_results,
+                                 activate_logging_flag=activate_logging_flag)
+    return found_servers
 
 
 
@@ -412,7 +289,12 @@ def dump_servers(config_file_path: str,
         ecu_ip_address=config.get(f"vehicles.{car.model}_{car.vin}_ip_address"),
         client_logical_address=client_logical_address,
         min_id=car.first_unchecked_server_id_in_server_discovery,
+        timeout=doip_config.get("server_scan_timeout", 1),
         activate_logging_flag=activate_logging_flag,
+        number_of_connections=doip_config.get("server_scan_connections", 1),
+        pipeline_depth=doip_config.get("server_scan_pipeline_depth", 4),
+        requests_per_second=doip_config.get("server_scan_requests_per_second", 0),
+        identification_cache=IdentificationCache(identification_cache_path(doip_config, car_model_path)),
     )
     
     car.save(car_model_path)
@@ -1,4 +1,5 @@
 import argparse
+import bisect
 import sys
 import time
 from datetime import date
@@ -10,6 +11,10 @@ from revcan.modules.caringcaribou.caringcaribou.modules.doip import DevNull
 from revcan.reverse_engineering.models import car_metadata
 from display_car_metadata import display_car_metadata
 from revcan.reverse_engineering.models.car_metadata import Server
+from revcan.signal_discovery.did_discovery_orchestrator import DIDDiscoveryOrchestrator
+from revcan.signal_discovery.did_prior_index import DIDPriorIndex
+from revcan.signal_discovery.did_search import DIDSearch
+from revcan.signal_discovery.doip_session_pool import DoIPSessionPool, connection_manager
 from revcan.signal_discovery.utils.doipclient import DoIPClient
 from revcan.signal_discovery.utils.doipclient.connectors import DoIPClientUDSConnector
 
@@ -26,6 +31,7 @@ def did_discovery(servers,
                   timeout=1,
                   print_results=True,
                   activate_logging_flag=False,
+                  did_prior: DIDPriorIndex = None,
 ):
     """
     Discover payload length for known servers and DIDs in a car model.
@@ -35,8 +41,10 @@ def did_discovery(servers,
         client_logical_address (int): The address that will receive the response from the ECU.
         ecu_ip_address (str): IP address of the ECU to connect to.
         possible_dids (List[int]): List of possible Data Identifiers (DIDs) to probe.
+        batch_size (int): Maximum number of DIDs per request. Lowered automatically if the server rejects a batch.
         timeout (int): Timeout in seconds for each request.
         print_results (bool): Flag to print progress.
+        did_prior (DIDPriorIndex): Known DIDs of other cars. If set, the densest DID ranges are probed first.
 
     Returns:
         List[Server]: The list of servers with discovered parameters added.
@@ -78,92 +86,69 @@ def did_discovery(servers,
             # Start measurement of time for did discovery process
             start_time = time.time()
 
-            
-            doip_client = DoIPClient(ecu_ip_address=ecu_ip_address, initial_ecu_logical_address=server.id,
-                                     client_logical_address=client_logical_address)
-            conn = DoIPClientUDSConnector(doip_client)
-        
-            for i in range(0, len(possible_dids_server), batch_size):
-                did_batch = possible_dids_server[i:i+batch_size]
-
-                if print_results:
-                    print("\rProbing DIDs 0x{1:04x} to 0x{2:04x} for server 0x{0:04x}: found {3} - {4:.2f}% complete."
-                          .format(server.id, did_batch[0], did_batch[-1], len(server.parameters), ((did_batch[-1] / max(possible_dids)) * 100)), end="")
-
+            def read_data(didlist):
                 # Suppress lower-level messages
                 if activate_logging_flag:
                     logging.getLogger().setLevel(logging.WARNING)
-                
-                # Establish a client to read data by identifier
                 try:
-                    with Client(conn, request_timeout=timeout) as client:
-                        response = client.read_data_by_identifier(didlist=did_batch)
+                    return client.read_data_by_identifier(didlist=didlist)
+                except OSError:
+                    # Connection issues are handled per server below
+                    raise
                 except Exception as e:
-                    print(f"An issue occurred while probing DIDs 0x{did_batch[0]:04x} to 0x{did_batch[-1]:04x} for server 0x{server.id:04x}: {e}")
+                    # Handled like a missing response, the batch is bisected
+                    print(f"An issue occurred while probing DIDs 0x{didlist[0]:04x} to 0x{didlist[-1]:04x} for server 0x{server.id:04x}: {e}")
+                    if activate_logging_flag:
+                        logging.warning(f"An issue occurred while probing DIDs 0x{didlist[0]:04x} to 0x{didlist[-1]:04x} for server 0x{server.id:04x}: {e}")
+                    return None
+                finally:
+                    # Acitvate lower-level messages again
                     if activate_logging_flag:
-                        logging.warning(f"An issue occurred while probing DIDs 0x{did_batch[0]:04x} to 0x{did_batch[-1]:04x} for server 0x{server.id:04x}: {e}")
+                        logging.getLogger().setLevel(logging.INFO)
+
+            def on_found(did, length):
+                # Save the parameter, DIDs of dense ranges are found out of order and again after a resume
+                position = bisect.bisect_left(server.parameters, did, key=lambda parameter: parameter.did)
+                if position < len(server.parameters) and server.parameters[position].did == did:
+                    server.parameters[position].length = length
+                else:
+                    server.parameters.insert(position, car_metadata.Parameter(did=did, length=length))
+                    found_dids.append(car_metadata.Parameter(did=did, length=length))
 
-                # Acitvate lower-level messages again
+                if print_results:
+                    print("\033[92m\rFound did 0x{1:04x} for server 0x{0:04x}: found {2}\033[0m"
+                          .format(server.id, did, len(server.parameters)), end="")
                 if activate_logging_flag:
-                    logging.getLogger().setLevel(logging.INFO)
+                    logging.info("Found did 0x{1:04x} for server 0x{0:04x}: found {2}"
+                                 .format(server.id, did, len(server.parameters)))
 
-                #print(f"Response: {response}")
-                # Check if batch size is to big
-                if "NegativeResponse(IncorrectMessageLengthOrInvalidFormat)" in str(response):
-                    print(f"The current batch size of {batch_size} is too big. Please reduce the batch size.")
-                    end_time = time.time()
-                    total_time = int(round(end_time - start_time))
-                    server.did_discovery_time_seconds += total_time
-                    print(f"\nDiscovery for server 0x{server.id:04x} interrupted. Time elapsed: {total_time} seconds.")
-                    return servers
+            def on_progress(did):
+                server.first_unchecked_did_in_did_discovery = did + 1
+                if print_results:
+                    print("\rProbing DIDs up to 0x{1:04x} for server 0x{0:04x}: found {2} - {3:.2f}% complete ({4} requests)."
+                          .format(server.id, did, len(server.parameters), ((did / max(possible_dids)) * 100),
+                                  did_search.number_of_requests), end="")
+
+            # Batch width adapts to the hit density and the multi-DID limit of the server, see DIDSearch
+            did_search = DIDSearch(read_data, max_batch_size=batch_size)
+            if did_prior is not None:
+                priority_dids, remaining_dids = did_prior.split_search_space(server, possible_dids_server)
+                if print_results and priority_dids:
+                    print(f"Probing {len(priority_dids)} DIDs of known dense ranges first for server 0x{server.id:04x}.")
+            else:
+                priority_dids, remaining_dids = [], possible_dids_server
+            # One session of the connection manager per search, re-used by the following servers
+            with connection_manager.lease(ecu_ip_address, client_logical_address, server.id) as session:
+                client = session.get_client(server.id, timeout)
+                did_search.search_prioritised(priority_dids, remaining_dids, on_found=on_found, on_progress=on_progress)
+
+            if print_results:
+                print(f"\nServer 0x{server.id:04x}: {len(found_dids)} DIDs found with {did_search.number_of_requests} requests "
+                      f"(multi-DID limit {did_search.max_dids_per_request}).")
+            if activate_logging_flag:
+                logging.info(f"Server 0x{server.id:04x}: {len(found_dids)} DIDs found with {did_search.number_of_requests} requests "
+                             f"(multi-DID limit {did_search.max_dids_per_request}).")
 
-                # Check if found dids
-                if not "NegativeResponse(RequestOutOfRange)" in str(response):               
-                    # Check all dids in batch again
-                    counter = 0
-                    for did in did_batch:
-                        counter += 1
-                        if print_results:
-                            print("\rProbing did 0x{1:04x} ({4}/{5}) from  for server 0x{0:04x}: found {2} - {3:.2f}% complete."
-                                .format(server.id, did, len(server.parameters), ((did / max(possible_dids)) * 100), counter, batch_size), end="")
-
-                        # Suppress lower-level messages
-                        if activate_logging_flag:
-                            logging.getLogger().setLevel(logging.WARNING)
-                        
-                        # Establish a client to read data by identifier
-                        try:
-                            with Client(conn, request_timeout=timeout) as client:
-                                response = client.read_data_by_identifier_first(didlist=[did])
-                        except Exception as e:
-                            print(f"An issue occurred while probing DID 0x{did:04x} for server 0x{server.id:04x}: {e}")
-                            if activate_logging_flag:
-                                logging.warning(f"An issue occurred while probing DID 0x{did:04x} for server 0x{server.id:04x}: {e}")
-
-                        # Acitvate lower-level messages again
-                        if activate_logging_flag:
-                            logging.getLogger().setLevel(logging.INFO)
-
-                        # If DID found -> Save the parameter
-                        # read first only returns the value or None
-                        if response is not None and response != b'\x00':
-                            length = len(response)
-                            if server.parameters and server.parameters[-1].did == did:
-                                server.parameters[-1].length = length
-                            else:
-                                server.parameters.append(car_metadata.Parameter(did=did, length=length))
-                                found_dids.append(car_metadata.Parameter(did=did, length=length))
-                                server.first_unchecked_did_in_did_discovery = did + 1
-                            
-                            if print_results:
-                                print("\033[92m\rFound did 0x{1:04x} for server 0x{0:04x}: found {2}"
-                                    .format(server.id, did, len(server.parameters)), end="")
-                            if activate_logging_flag:
-                                logging.info("Found did 0x{1:04x} for server 0x{0:04x}: found {2}"
-                                            .format(server.id, did, len(server.parameters)))
-                
-                server.first_unchecked_did_in_did_discovery = did_batch[-1] + 1
-                    
             print(f"\nDID discovery complete for server 0x{server.id:04x}.\n")
             if activate_logging_flag:
                 logging.info(f"\nDID discovery complete for server 0x{server.id:04x}.\n")
@@ -211,10 +196,10 @@ def did_discovery(servers,
             end_time = time.time()
             total_time = int(round(end_time - start_time))
             server.did_discovery_time_seconds += total_time
-            print(f"\nBrokenPipeError occured for server 0x{server.id:04x} for DID 0x{did:04x}. Time elapsed: {total_time} seconds.")
+            print(f"\nBrokenPipeError occured for server 0x{server.id:04x} for DID 0x{server.first_unchecked_did_in_did_discovery:04x}. Time elapsed: {total_time} seconds.")
             print(f"\nRestarting DID discovery.")
             if activate_logging_flag:
-                logging.warning(f"\nBrokenPipeError occured for server 0x{server.id:04x} for DID 0x{did:04x}. Time elapsed: {total_time} seconds.")
+                logging.warning(f"\nBrokenPipeError occured for server 0x{server.id:04x} for DID 0x{server.first_unchecked_did_in_did_discovery:04x}. Time elapsed: {total_time} seconds.")
                 logging.warning(f"\nRestarting DID discovery.")
             return did_discovery(servers=servers,
                                client_logical_address = client_logical_address,
@@ -222,7 +207,8 @@ def did_discovery(servers,
                                possible_dids=possible_dids,
                                batch_size=batch_size, 
                                timeout=timeout,
-                               activate_logging_flag=activate_logging_flag)
+                               activate_logging_flag=activate_logging_flag,
+                               did_prior=did_prior)
 
         except OSError:
             end_time = time.time()
@@ -234,7 +220,7 @@ def did_discovery(servers,
                 logging.info("Please check the connection and try again.\n")
         
 
-
+    connection_manager.close(ecu_ip_address, client_logical_address)
     return servers
 
 
@@ -293,19 +279,19 @@ def __did_discovery_wrapper(config_file_path,
         return
 
     timeout = doip_config.get("service_discovery_timeout")
-    batch_size = doip_config.get("batch_size")
+    batch_size = doip_config.get("did_discovery_max_batch_size", doip_config.get("batch_size"))
     ecu_ip_address = config.get(f"vehicles.{car.model}_{car.vin}_ip_address")
 
-    whitelist = [[0x0000, 0xFFFF]]
+    whitelist = doip_config.get("did_discovery_whitelist", [[0x0000, 0xFFFF]])
 
-    blacklist = []
+    blacklist = doip_config.get("did_discovery_blacklist", [])
 
     
     # small helper function to transform the lists of ranges into a single list
     def process_range(range_list):
-        result = []
+        result = set()
         for start, end in range_list:
-            result.extend(range(start,end + 1))
+            result.update(range(start,end + 1))
         return result
 
     whitelist = process_range(whitelist)
@@ -313,7 +299,16 @@ def __did_discovery_wrapper(config_file_path,
     
 
     # Remove blacklisted items from the whitelist
-    dids_whitelist_wo_blacklist = [did for did in whitelist if did not in blacklist]
+    dids_whitelist_wo_blacklist = sorted(whitelist - blacklist)
+
+    # Build the DID prior from previously discovered cars, the current car model is excluded
+    did_prior = None
+    if doip_config.get("did_prior_car_models") or doip_config.get("did_prior_databases"):
+        did_prior = DIDPriorIndex.from_files(doip_config.get("did_prior_car_models") or [],
+                                             doip_config.get("did_prior_databases") or [],
+                                             exclude_paths=[car_model_file_path],
+                                             activate_logging_flag=activate_logging_flag)
+        print(f"DID prior built from {len(did_prior.entries)} known servers.")
 
     # Reset discovery complete flag for all servers if reset_discovery_complete_flag is set to true
     if reset_discovery_complete_flag:
@@ -323,13 +318,35 @@ def __did_discovery_wrapper(config_file_path,
             server.parameters = []
 
     # Probe dids
-    car.servers = did_discovery(servers=car.servers,
-                               client_logical_address = client_logical_address,
-                               ecu_ip_address=ecu_ip_address,
-                               batch_size=batch_size, 
-                               possible_dids=dids_whitelist_wo_blacklist, 
-                               timeout=timeout,
-                               activate_logging_flag=activate_logging_flag)
+    max_workers = doip_config.get("did_discovery_max_workers", 1)
+    if max_workers > 1:
+        # Search several servers in parallel, sharing the connections and the request rate of the gateway
+        session_pool = DoIPSessionPool(ecu_ip_address, client_logical_address,
+                                       max_in_flight_per_gateway=doip_config.get("max_in_flight_per_gateway", max_workers),
+                                       max_in_flight_per_server=1,
+                                       request_timeout=timeout)
+        orchestrator = DIDDiscoveryOrchestrator(session_pool,
+                                                max_batch_size=batch_size,
+                                                max_workers=max_workers,
+                                                requests_per_second=doip_config.get("did_discovery_requests_per_second", 50),
+                                                max_retries=doip_config.get("did_discovery_max_retries", 5),
+                                                did_prior=did_prior,
+                                                activate_logging_flag=activate_logging_flag)
+        try:
+            # The progress is saved periodically, so an interrupted discovery resumes at the first unchecked DID
+            orchestrator.run(car.servers, dids_whitelist_wo_blacklist,
+                             checkpoint=lambda: car.save(car_model_file_path))
+        except KeyboardInterrupt:
+            print("\nDID discovery interrupted.")
+    else:
+        car.servers = did_discovery(servers=car.servers,
+                                   client_logical_address = client_logical_address,
+                                   ecu_ip_address=ecu_ip_address,
+                                   batch_size=batch_size, 
+                                   possible_dids=dids_whitelist_wo_blacklist, 
+                                   timeout=timeout,
+                                   activate_logging_flag=activate_logging_flag,
+                                   did_prior=did_prior)
     
 
     try:
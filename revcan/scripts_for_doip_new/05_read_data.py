@@ -6,12 +6,17 @@ import logging
 import os
 
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
 
 from revcan.config import Config
 from revcan.modules.caringcaribou.caringcaribou.modules.doip import DevNull
 from revcan.reverse_engineering.models import car_metadata
 from revcan.reverse_engineering.models.car_metadata import Server
-from revcan.reverse_engineering.models.experiment import Experiment, Value
+from revcan.reverse_engineering.models.experiment import Experiment, Signal, Value
+from revcan.reverse_engineering.models.sample_log import SampleLog
+from revcan.signal_discovery.doip_session_pool import DoIPSessionPool, connection_manager
+from revcan.signal_discovery.request_packing import RequestPackingPlanner, ServerLimits, split_response_data
 from revcan.signal_discovery.utils.doipclient import DoIPClient
 from revcan.signal_discovery.utils.doipclient.connectors import DoIPClientUDSConnector
 
@@ -20,6 +25,120 @@ from revcan.signal_discovery.utils.udsoncan.exceptions import ConfigError
 from revcan.signal_discovery.utils.udsoncan.services import DiagnosticSessionControl
 
 
+def create_request_planner(batch_size: int=None,
+                           max_payload_lengths: Dict[int, int]=None,
+                           performance_list: str=None) -> RequestPackingPlanner:
+    """
+    Create the request packing planner of the servers. The number of DIDs per request is derived from the limits
+    measured with check_dids_performance_automatic (performance_list) and the max_payload_length of every
+    server. Servers without any known limit are read one DID per request.
+
+    Args:
+        batch_size (int): Optional maximum number of DIDs per request of all servers, overriding larger limits.
+        max_payload_lengths (Dict[int, int]): Maximum response length per server id; values <= 0 are ignored.
+        performance_list (str): Path to the "<name>_config_file.csv" of check_dids_performance_automatic.
+
+    Returns:
+        RequestPackingPlanner: The planner.
+    """
+    if batch_size is not None and batch_size < 1:
+        batch_size = 1
+    planner = RequestPackingPlanner.from_performance_list(performance_list, batch_size or 1)
+    if batch_size is not None:
+        for server_id in list(planner.limits):
+            planner.set_limits(server_id, ServerLimits(max_dids=batch_size))
+    for server_id, max_payload_length in (max_payload_lengths or {}).items():
+        if max_payload_length is None or max_payload_length <= 0:
+            continue
+        planner.set_limits(server_id, ServerLimits(max_dids=batch_size, max_response_length=max_payload_length))
+    return planner
+
+
+def create_request_packs(signals: List[Signal],
+                         batch_size: int=None,
+                         max_payload_lengths: Dict[int, int]=None,
+                         planner: RequestPackingPlanner=None) -> List[List[Signal]]:
+    """
+    Group signals into packs which can be read with a single ReadDataByIdentifier request.
+    Only signals of the same server are packed together, into as few packs as the limits of the server allow.
+
+    Args:
+        signals (List[Signal]): Signals to be packed.
+        batch_size (int): Optional maximum number of DIDs per request; only used without planner.
+        max_payload_lengths (Dict[int, int]): Maximum response length per server id; only used without planner.
+        planner (RequestPackingPlanner): Planner holding the limits of the servers.
+
+    Returns:
+        List[List[Signal]]: The request packs, grouped by server.
+    """
+    if planner is None:
+        planner = create_request_planner(batch_size, max_payload_lengths)
+    return planner.plan(signals, lambda signal: signal.serverid, lambda signal: signal.did.length)
+
+
+def split_read_data_response(response, signals: List[Signal]) -> List[bytes] | None:
+    """
+    Split the response of a multi-DID ReadDataByIdentifier request into the values of the requested signals
+    using the known length of every DID.
+
+    Args:
+        response (Response): Response of the ReadDataByIdentifier request.
+        signals (List[Signal]): Signals in the order they were requested.
+
+    Returns:
+        List[bytes] | None: Value per signal or None if the response could not be split.
+    """
+    if response is None or not response.positive or response.data is None:
+        return None
+
+    values = split_response_data(response.data, [signal.did.did for signal in signals],
+                                 [signal.did.length for signal in signals])
+    if values is None or len(values) != len(signals):
+        return None
+    return [values[signal.did.did] for signal in signals]
+
+
+def read_request_pack(client: Client, pack: List[Signal], activate_logging_flag=False,
+                      planner: RequestPackingPlanner=None) -> List[Tuple[Signal, bytes]]:
+    """
+    Read the DIDs of a request pack. Packs with several DIDs are read with a single request; if the response
+    can not be split, the signals of the pack are read one by one. If the server rejects the pack as too large,
+    the limits of the planner are tightened.
+
+    Args:
+        client (Client): UDS client addressing the server of the pack.
+        pack (List[Signal]): Signals of one server.
+        activate_logging_flag (bool): Whether to log issues.
+        planner (RequestPackingPlanner): Planner of the request packs.
+
+    Returns:
+        List[Tuple[Signal, bytes]]: Signals which were read successfully and their values.
+    """
+    if len(pack) > 1:
+        try:
+            response = client.read_data_by_identifier(didlist=[signal.did.did for signal in pack])
+            values = split_read_data_response(response, pack)
+            if values is not None:
+                return list(zip(pack, values))
+            if planner is not None and response is not None and not response.positive:
+                planner.report_negative_response(pack[0].serverid, [signal.did.length for signal in pack],
+                                                 response.code)
+        except Exception as e:
+            print(f"An issue occurred while probing DIDs 0x{pack[0].did.did:04x} to 0x{pack[-1].did.did:04x} for server 0x{pack[0].serverid:04x}: {e}")
+            if activate_logging_flag:
+                logging.warning(f"An issue occurred while probing DIDs 0x{pack[0].did.did:04x} to 0x{pack[-1].did.did:04x} for server 0x{pack[0].serverid:04x}: {e}")
+
+    pack_values = []
+    for signal in pack:
+        try:
+            pack_values.append((signal, client.read_data_by_identifier_first(didlist=[signal.did.did])))
+        except Exception as e:
+            print(f"An issue occurred while probing DID 0x{signal.did.did:04x} for server 0x{signal.serverid:04x}: {e}")
+            if activate_logging_flag:
+                logging.warning(f"An issue occurred while probing DID 0x{signal.did.did:04x} for server 0x{signal.serverid:04x}: {e}")
+    return pack_values
+
+
 def read_data(    experiment:Experiment,
                   client_logical_address,
                   ecu_ip_address,
@@ -27,8 +146,40 @@ def read_data(    experiment:Experiment,
                   timeout=1,
                   print_results=True,
                   activate_logging_flag=False,
-                  continue_read:bool=False
+                  continue_read:bool=False,
+                  sample_log:SampleLog=None,
+                  sample_counts:dict=None,
+                  batch_size:int=None,
+                  max_in_flight_per_gateway:int=1,
+                  max_in_flight_per_server:int=1,
+                  performance_list:str=None
 ):
+    """
+    Read the values of all signals of an experiment.
+
+    Args:
+        experiment (Experiment): Experiment defining the signals to be read.
+        client_logical_address (int): Logical address of the client.
+        ecu_ip_address (str): IP address of the DoIP gateway.
+        num_samples (int): Number of values to read per signal. Infinity = -1.
+        timeout (float): Request timeout in seconds.
+        print_results (bool): Whether to print the progress.
+        activate_logging_flag (bool): Whether to log the progress.
+        continue_read (bool): Whether to continue the latest measurements.
+        sample_log (SampleLog): If set, values are appended to the sample log instead of the experiment.
+        sample_counts (dict): Number of already recorded values per (server_id, did). Defaults to the
+            number of values stored in the experiment.
+        batch_size (int): Optional maximum number of DIDs read with one request. By default the number of DIDs
+            is only limited by the performance list and the max_payload_length of the respective server.
+        max_in_flight_per_gateway (int): Maximum number of concurrent requests (DoIP connections) to the gateway.
+            Values > 1 overlap the requests to different servers.
+        max_in_flight_per_server (int): Maximum number of concurrent requests to the same server.
+        performance_list (str): Limits of the servers measured with check_dids_performance_automatic
+            ("<name>_config_file.csv"), used to pack the DIDs into requests.
+
+    Returns:
+        Experiment: The experiment.
+    """
     #sort measurements in order to have a higher chance to re-use already established connections
     experiment.measurements.sort(key= lambda x: x.serverid)
     experiment.starttime = datetime.datetime.now()
@@ -45,9 +196,17 @@ def read_data(    experiment:Experiment,
     
     signals_total_num = len(experiment.measurements)
 
-    # Check if continue_read flag is set
-    if continue_read and (len(experiment.measurements[-1].values)+1 == len(experiment.measurements[-1].values)):
-        sample_counter = len(experiment.measurements[-1].values)
+    # Known response size limits of the servers (-1 if unknown)
+    max_payload_lengths = {server.id: server.max_payload_length for server in experiment.car.servers}
+
+    # Number of already recorded values per signal, used to continue the latest measurements
+    if sample_counts is None:
+        sample_counts = {(signal.serverid, signal.did.did): len(signal.values) for signal in experiment.measurements}
+
+    # Check if continue_read flag is set; resume with the first incomplete sample
+    if continue_read and experiment.measurements:
+        sample_counter = min(sample_counts.get((signal.serverid, signal.did.did), 0)
+                             for signal in experiment.measurements)
     else:
         sample_counter = 0
 
@@ -55,49 +214,113 @@ def read_data(    experiment:Experiment,
         # Establish a connection with server of first signal
         if experiment.measurements:
             last_server_id = experiment.measurements[0].serverid
-            doip_client = DoIPClient(ecu_ip_address=ecu_ip_address, initial_ecu_logical_address=last_server_id,
-                                                client_logical_address=client_logical_address)
-            conn = DoIPClientUDSConnector(doip_client)
+            session = connection_manager.acquire(ecu_ip_address, client_logical_address, last_server_id)
         else:
             print(f"Error: No signals found in measurements. experiment.measurements={experiment.measurements}")
             if activate_logging_flag:
                 logging.warning(f"Error: No signals found in measurements. experiment.measurements={experiment.measurements}")
             return experiment
 
-        start_time = time.time()
-        while (sample_counter < num_samples or num_samples == -1):
-            sample_counter += 1
-            signal_counter = 0
-            for signal in experiment.measurements:
-                signal_counter += 1
-                if continue_read and (len(signal.values) >= sample_counter):
+        # Group the signals of each server into request packs sized by its limits
+        # The packs are re-planned when a server rejects a pack as too large
+        planner = create_request_planner(batch_size, max_payload_lengths, performance_list)
+        request_packs = create_request_packs(experiment.measurements, planner=planner)
+        planned_revision = planner.revision
+
+        def record_value(signal, value):
+            if sample_log is not None:
+                sample_log.append(signal.serverid, signal.did.did, time.time_ns(), value)
+            else:
+                signal.values.append(Value(time=datetime.datetime.now(), value=value))
+
+        def read_server_packs(packs):
+            # Reads the packs of one server with sessions of the pool
+            for pack in packs:
+                try:
+                    with session_pool.session(pack[0].serverid) as client:
+                        pack_values = read_request_pack(client, pack, activate_logging_flag, planner)
+                except Exception as e:
+                    print(f"An issue occurred while connecting to server 0x{pack[0].serverid:04x}: {e}")
+                    if activate_logging_flag:
+                        logging.warning(f"An issue occurred while connecting to server 0x{pack[0].serverid:04x}: {e}")
                     continue
+                for signal, value in pack_values:
+                    record_value(signal, value)
+
+        if max_in_flight_per_gateway > 1:
+            # Overlap the requests to different servers using a pool of DoIP connections
+            connection_manager.release(session)
+            session_pool = DoIPSessionPool(ecu_ip_address, client_logical_address,
+                                           max_in_flight_per_gateway=max_in_flight_per_gateway,
+                                           max_in_flight_per_server=max_in_flight_per_server,
+                                           request_timeout=timeout)
+            executor = ThreadPoolExecutor(max_workers=max_in_flight_per_gateway)
+        else:
+            # One session is re-used for all requests, with the cached client of every server
+            client = session.get_client(last_server_id, timeout)
 
-                if last_server_id != signal.serverid:
-                    last_server_id = signal.serverid
-                    doip_client.change_ecu_logical_address(signal.serverid)
-
-                if print_results:
-                    print("\rSample {2}/{3}: Reading did 0x{1:04x} for server 0x{0:04x} - {4}/{5}  "
-                            .format(signal.serverid, signal.did.did, sample_counter, num_samples_name, signal_counter, signals_total_num), end="")
+        start_time = time.time()
+        try:
+            while (sample_counter < num_samples or num_samples == -1):
+                sample_counter += 1
+                signal_counter = 0
+                if planner.revision != planned_revision:
+                    planned_revision = planner.revision
+                    request_packs = create_request_packs(experiment.measurements, planner=planner)
+                    if activate_logging_flag:
+                        logging.info(f"Request packs re-planned: {len(request_packs)} requests per cycle")
+                packs_per_server = defaultdict(list)
+                for pack in request_packs:
+                    signal_counter += len(pack)
+                    if continue_read:
+                        pack = [signal for signal in pack
+                                if sample_counts.get((signal.serverid, signal.did.did), 0) < sample_counter]
+                        if not pack:
+                            continue
+
+                    if max_in_flight_per_gateway > 1:
+                        packs_per_server[pack[0].serverid].append(pack)
+                        continue
+
+                    if last_server_id != pack[0].serverid:
+                        last_server_id = pack[0].serverid
+                        client = session.get_client(last_server_id, timeout)
+
+                    if print_results:
+                        print("\rSample {2}/{3}: Reading did 0x{1:04x} for server 0x{0:04x} - {4}/{5}  "
+                                .format(pack[0].serverid, pack[0].did.did, sample_counter, num_samples_name, signal_counter, signals_total_num), end="")
+
+                    # Suppress lower-level messages
+                    if activate_logging_flag:
+                        logging.getLogger().setLevel(logging.WARNING)
 
-                # Suppress lower-level messages
-                if activate_logging_flag:
-                    logging.getLogger().setLevel(logging.WARNING)
+                    for signal, value in read_request_pack(client, pack, activate_logging_flag, planner):
+                        record_value(signal, value)
 
-                # Establish a client to read data by identifier
-                try:
-                    with Client(conn, request_timeout=timeout) as client:
-                        response = client.read_data_by_identifier_first(didlist=[signal.did.did])
-                        signal.values.append(Value(time=datetime.datetime.now(), value=response))
-                except Exception as e:
-                    print(f"An issue occurred while probing DID 0x{signal.did.did:04x} for server 0x{signal.serverid:04x}: {e}")
+                    # Acitvate lower-level messages again
                     if activate_logging_flag:
-                        logging.warning(f"An issue occurred while probing DID 0x{signal.did.did:04x} for server 0x{signal.serverid:04x}: {e}")
-
-                # Acitvate lower-level messages again
-                if activate_logging_flag:
-                    logging.getLogger().setLevel(logging.INFO)      
+                        logging.getLogger().setLevel(logging.INFO)
+
+                if packs_per_server:
+                    if print_results:
+                        print("\rSample {0}/{1}: Reading {2} signals of {3} servers concurrently  "
+                                .format(sample_counter, num_samples_name, signal_counter, len(packs_per_server)), end="")
+
+                    # Split the packs of every server into as many tasks as requests may be in flight per server
+                    futures = []
+                    for packs in packs_per_server.values():
+                        tasks_num = min(max_in_flight_per_server, len(packs))
+                        for i in range(tasks_num):
+                            futures.append(executor.submit(read_server_packs, packs[i::tasks_num]))
+                    for future in futures:
+                        future.result()
+        finally:
+            if max_in_flight_per_gateway > 1:
+                executor.shutdown(wait=True, cancel_futures=True)
+                session_pool.close()
+            else:
+                connection_manager.release(session)
+                connection_manager.close(ecu_ip_address, client_logical_address)
 
     except KeyboardInterrupt:
         end_time = time.time()
@@ -127,7 +350,9 @@ def __read_data_wrapper(config_file_path,
                         num_samples, 
                         activate_logging_flag, 
                         reset_experiment:bool=False,
-                        continue_read:bool=False):
+                        continue_read:bool=False,
+                        batch_read:bool=False,
+                        concurrent_read:bool=False):
     """
        Wrapper function used read data as defined in an experiment.
 
@@ -135,6 +360,9 @@ def __read_data_wrapper(config_file_path,
            config_file_path (str): Path to the configuration file.
            experiment_file_path (str): Path to the experiment defintion file.
            activate_logging_flag: activate logging
+           batch_read (bool): read several DIDs of a server with one request (up to doip.batch_size DIDs)
+           concurrent_read (bool): overlap requests to different servers (limited by doip.max_in_flight_per_gateway
+               and doip.max_in_flight_per_server)
        """
     # Load config
     config = Config(config_file_path)
@@ -160,8 +388,12 @@ def __read_data_wrapper(config_file_path,
         print(f"Error saving experiment model: {e}")
         return
 
+    # Samples are streamed into an append-only log next to the experiment file and compacted at the end
+    sample_log = SampleLog(os.path.splitext(experiment_file_path)[0] + '_samples')
+
     # Reset Experiment if flag is set
     if reset_experiment:
+        sample_log.remove_segments()
         for signal in experiment.measurements:
             signal.values = []
         for measurement in experiment.external_measurements:
@@ -201,18 +433,41 @@ def __read_data_wrapper(config_file_path,
 
     timeout = doip_config.get("service_discovery_timeout")
     ecu_ip_address = config.get(f"vehicles.{experiment.car.model}_{experiment.car.vin}_ip_address")
+    batch_size = doip_config.get("batch_size") if batch_read else 1
+    if concurrent_read:
+        max_in_flight_per_gateway = doip_config.get("max_in_flight_per_gateway", 4)
+        max_in_flight_per_server = doip_config.get("max_in_flight_per_server", 1)
+    else:
+        max_in_flight_per_gateway = 1
+        max_in_flight_per_server = 1
 
+    # Samples of an interrupted run which have not been compacted yet are counted from the log tail
+    sample_counts = {(signal.serverid, signal.did.did): len(signal.values) for signal in experiment.measurements}
+    for key, count in sample_log.get_sample_counts().items():
+        if key in sample_counts:
+            sample_counts[key] += count
 
     # Probe dids
-    experiment = read_data(     experiment=experiment,
-                                client_logical_address=client_logical_address,
-                                ecu_ip_address=ecu_ip_address,
-                                num_samples=num_samples,
-                                timeout=timeout,
-                                print_results=True,
-                                activate_logging_flag=activate_logging_flag,
-                                continue_read=continue_read)
-
+    try:
+        experiment = read_data(     experiment=experiment,
+                                    client_logical_address=client_logical_address,
+                                    ecu_ip_address=ecu_ip_address,
+                                    num_samples=num_samples,
+                                    timeout=timeout,
+                                    print_results=True,
+                                    activate_logging_flag=activate_logging_flag,
+                                    continue_read=continue_read,
+                                    sample_log=sample_log,
+                                    sample_counts=sample_counts,
+                                    batch_size=batch_size,
+                                    max_in_flight_per_gateway=max_in_flight_per_gateway,
+                                    max_in_flight_per_server=max_in_flight_per_server,
+                                    performance_list=doip_config.get("performance_list"))
+    finally:
+        sample_log.close()
+
+    # Fold the logged samples into the experiment
+    experiment = sample_log.compact(experiment)
 
     try:
         experiment.save(experiment_file_path)
@@ -227,7 +482,8 @@ def __read_data_wrapper(config_file_path,
             logging.warning(f"Error saving experiment model: {e}")
         return
 
-    pass
+    # Samples are persisted in the experiment now
+    sample_log.remove_segments()
 
 
 if __name__ == "__main__":
@@ -271,6 +527,18 @@ if __name__ == "__main__":
         type=bool,
         help="Flag that indicates whether to continue the latest measurements",
     )
+    argparser.add_argument(
+        "--batch_read",
+        dest="batch_read",
+        type=bool,
+        help="Flag that indicates whether to read several DIDs per request (limited by doip.batch_size and the max payload length of each server)",
+    )
+    argparser.add_argument(
+        "--concurrent_read",
+        dest="concurrent_read",
+        type=bool,
+        help="Flag that indicates whether to overlap requests to different servers using several DoIP connections",
+    )
     
 
     args = argparser.parse_args()
@@ -280,4 +548,6 @@ if __name__ == "__main__":
                         args.num_samples, 
                         args.activate_logging_flag, 
                         args.reset_experiment,
-                        args.continue_read )
\ No newline at end of file
+                        args.continue_read,
+                        args.batch_read,
+                        args.concurrent_read )
\ No newline at end of file
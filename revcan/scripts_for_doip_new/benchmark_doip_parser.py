@@ -0,0 +1,203 @@
+"""
+Micro-benchmark of the DoIP stream parser (doipclient.client.Parser).
+
+A DoIP TCP stream is replayed in chunks of the socket read size through the current parser and through the
+previous byte-wise implementation, and the parse throughput of both is compared. The stream is either read from
+a capture file (raw TCP payload of the gateway to tester direction, e.g. exported from Wireshark with
+"Follow TCP Stream" -> "Save as raw") or generated: acknowledged multi-DID ReadDataByIdentifier responses as
+they occur when sampling signals with 05_read_data.py.
+"""
+
+import argparse
+import random
+import struct
+import time
+from enum import IntEnum
+
+from revcan.signal_discovery.utils.doipclient.client import Parser
+from revcan.signal_discovery.utils.doipclient.messages import GenericDoIPNegativeAcknowledge, \
+    ReservedMessage, payload_type_to_message
+
+
+class LegacyParser:
+    """
+    Byte-wise parser as used before, popping every header byte from the front of a bytearray.
+    Kept as baseline of the benchmark.
+    """
+
+    class ParserState(IntEnum):
+        READ_PROTOCOL_VERSION = 1
+        READ_INVERSE_PROTOCOL_VERSION = 2
+        READ_PAYLOAD_TYPE = 3
+        READ_PAYLOAD_SIZE = 4
+        READ_PAYLOAD = 5
+
+    def __init__(self):
+        self.rx_buffer = bytearray()
+        self.protocol_version = None
+        self.payload_type = None
+        self.payload_size = None
+        self.payload = bytearray()
+        self._state = LegacyParser.ParserState.READ_PROTOCOL_VERSION
+
+    def read_message(self, data_bytes):
+        self.rx_buffer += data_bytes
+        if self._state == LegacyParser.ParserState.READ_PROTOCOL_VERSION:
+            if len(self.rx_buffer) >= 1:
+                self.payload = bytearray()
+                self.payload_type = None
+                self.payload_size = None
+                self.protocol_version = int(self.rx_buffer.pop(0))
+                self._state = LegacyParser.ParserState.READ_INVERSE_PROTOCOL_VERSION
+
+        if self._state == LegacyParser.ParserState.READ_INVERSE_PROTOCOL_VERSION:
+            if len(self.rx_buffer) >= 1:
+                inverse_protocol_version = int(self.rx_buffer.pop(0))
+                if inverse_protocol_version != (0xFF ^ self.protocol_version):
+                    self.protocol_version = inverse_protocol_version
+                    return GenericDoIPNegativeAcknowledge(
+                        GenericDoIPNegativeAcknowledge.NackCode.IncorrectProtocolVersionInverse
+                    )
+                else:
+                    self._state = LegacyParser.ParserState.READ_PAYLOAD_TYPE
+
+        if self._state == LegacyParser.ParserState.READ_PAYLOAD_TYPE:
+            if len(self.rx_buffer) >= 2:
+                self.payload_type = self.rx_buffer.pop(0) << 8
+                self.payload_type |= self.rx_buffer.pop(0)
+                self._state = LegacyParser.ParserState.READ_PAYLOAD_SIZE
+
+        if self._state == LegacyParser.ParserState.READ_PAYLOAD_SIZE:
+            if len(self.rx_buffer) >= 4:
+                self.payload_size = self.rx_buffer.pop(0) << 24
+                self.payload_size |= self.rx_buffer.pop(0) << 16
+                self.payload_size |= self.rx_buffer.pop(0) << 8
+                self.payload_size |= self.rx_buffer.pop(0)
+                self._state = LegacyParser.ParserState.READ_PAYLOAD
+
+        if self._state == LegacyParser.ParserState.READ_PAYLOAD:
+            remaining_bytes = self.payload_size - len(self.payload)
+            self.payload += self.rx_buffer[:remaining_bytes]
+            self.rx_buffer = self.rx_buffer[remaining_bytes:]
+            if len(self.payload) == self.payload_size:
+                self._state = LegacyParser.ParserState.READ_PROTOCOL_VERSION
+                # The hex dump was formatted for every message, regardless of the log level
+                " ".join(f"{byte:02X}" for byte in self.payload)
+                try:
+                    return payload_type_to_message[self.payload_type].unpack(self.payload, self.payload_size)
+                except KeyError:
+                    return ReservedMessage.unpack(self.payload_type, self.payload, self.payload_size)
+
+
+def generate_stream(number_of_responses: int, dids_per_response: int, payload_length: int,
+                    protocol_version=0x02, seed=0) -> bytes:
+    """
+    Generate the gateway to tester stream of acknowledged multi-DID ReadDataByIdentifier responses.
+
+    Args:
+        number_of_responses (int): Number of responses.
+        dids_per_response (int): DIDs per response.
+        payload_length (int): Data length per DID.
+        protocol_version (int): DoIP protocol version.
+        seed (int): Seed of the random data.
+
+    Returns:
+        bytes: The stream.
+    """
+    rng = random.Random(seed)
+    tester, server = 0x0E00, 0x1001
+
+    def message(payload_type, payload):
+        return struct.pack("!BBHL", protocol_version, 0xFF ^ protocol_version, payload_type, len(payload)) + payload
+
+    stream = bytearray()
+    for i in range(number_of_responses):
+        user_data = bytearray([0x62])
+        for j in range(dids_per_response):
+            did = (i * dids_per_response + j) & 0xFFFF
+            user_data += struct.pack("!H", did) + rng.randbytes(payload_length)
+        stream += message(0x8002, struct.pack("!HHB", server, tester, 0x00) + bytes([0x22, 0x00, 0x00]))
+        stream += message(0x8001, struct.pack("!HH", server, tester) + bytes(user_data))
+    return bytes(stream)
+
+
+def replay(parser_class, stream: bytes, chunk_size: int) -> list:
+    """
+    Feed a stream to a new parser in chunks, the way DoIPClient.read_doip reads the socket.
+
+    Args:
+        parser_class: Parser or LegacyParser.
+        stream (bytes): The stream.
+        chunk_size (int): Bytes per socket read.
+
+    Returns:
+        list: The parsed messages.
+    """
+    parser = parser_class()
+    messages = []
+    for start in range(0, len(stream), chunk_size):
+        data = stream[start:start + chunk_size]
+        message = parser.read_message(data)
+        while message is not None:
+            messages.append(message)
+            message = parser.read_message(b"")
+    return messages
+
+
+def benchmark(parser_class, stream: bytes, chunk_size: int, repetitions: int) -> float:
+    """
+    Get the best parse throughput of several replays.
+
+    Returns:
+        float: Messages per second.
+    """
+    best = float("inf")
+    number_of_messages = 0
+    for _ in range(repetitions):
+        start_time = time.perf_counter()
+        number_of_messages = len(replay(parser_class, stream, chunk_size))
+        best = min(best, time.perf_counter() - start_time)
+    return number_of_messages / best
+
+
+def main(capture_file: str, number_of_responses: int, dids_per_response: int, payload_length: int,
+         chunk_size: int, repetitions: int):
+    if capture_file:
+        with open(capture_file, "rb") as f:
+            stream = f.read()
+        print(f"Replaying {len(stream)} bytes from '{capture_file}'")
+    else:
+        stream = generate_stream(number_of_responses, dids_per_response, payload_length)
+        print(f"Replaying {number_of_responses} generated responses with {dids_per_response} DIDs of "
+              f"{payload_length} bytes ({len(stream)} bytes)")
+
+    # Both parsers have to decode the same messages
+    legacy_messages = replay(LegacyParser, stream, chunk_size)
+    messages = replay(Parser, stream, chunk_size)
+    assert len(messages) == len(legacy_messages), "Parsers disagree on the number of messages"
+    for message, legacy_message in zip(messages, legacy_messages):
+        assert type(message) == type(legacy_message), "Parsers disagree on a message type"
+        if hasattr(message, "user_data"):
+            assert bytes(message.user_data) == bytes(legacy_message.user_data), "Parsers disagree on user data"
+
+    legacy_throughput = benchmark(LegacyParser, stream, chunk_size, repetitions)
+    throughput = benchmark(Parser, stream, chunk_size, repetitions)
+    print(f"Messages: {len(messages)}, chunk size: {chunk_size} bytes")
+    print(f"Legacy parser: {legacy_throughput:,.0f} messages/s")
+    print(f"Parser:        {throughput:,.0f} messages/s")
+    print(f"Speed-up:      {throughput / legacy_throughput:.1f}x")
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(description="Benchmark the DoIP stream parser.")
+    argparser.add_argument("--capture_file", type=str, default=None,
+                           help="Raw TCP payload of the gateway to tester direction; generated if not set")
+    argparser.add_argument("--number_of_responses", type=int, default=5000)
+    argparser.add_argument("--dids_per_response", type=int, default=16)
+    argparser.add_argument("--payload_length", type=int, default=8)
+    argparser.add_argument("--chunk_size", type=int, default=1024, help="Bytes per socket read")
+    argparser.add_argument("--repetitions", type=int, default=5)
+    args = argparser.parse_args()
+
+    main(args.capture_file, args.number_of_responses, args.dids_per_response, args.payload_length,
+         args.chunk_size, args.repetitions)
@@ -0,0 +1,51 @@
+import argparse
+import os
+import time
+
+from revcan.reverse_engineering.models.experiment_store import COLUMNAR_FILE_SUFFIX, convert_experiment_file
+
+
+def __convert_experiment_wrapper(experiment_file_path: str, output_file_path: str = None):
+    """
+    Convert a (legacy JSON) experiment file into the columnar, memory-mappable format.
+
+    Args:
+        experiment_file_path (str): Path to the experiment file to be converted.
+        output_file_path (str): Path of the converted experiment file. Defaults to the input path with '.npz' suffix.
+    """
+    if output_file_path is None:
+        output_file_path = os.path.splitext(experiment_file_path)[0] + COLUMNAR_FILE_SUFFIX
+
+    start_time = time.time()
+    try:
+        experiment = convert_experiment_file(experiment_file_path, output_file_path)
+    except FileNotFoundError:
+        print(f"Error: The experiment file at '{experiment_file_path}' was not found.")
+        return
+    except Exception as e:
+        print(f"Error converting experiment: {e}")
+        return
+
+    print(f"Converted {len(experiment.measurements)} signals to '{output_file_path}' "
+          f"in {round(time.time() - start_time, 3)} seconds.")
+
+
+if __name__ == "__main__":
+    argparser = argparse.ArgumentParser(
+        description="Convert an experiment file into the columnar experiment format"
+    )
+    argparser.add_argument(
+        "--experiment_file_path",
+        dest="experiment_file_path",
+        type=str,
+        help="Path to experiment file",
+    )
+    argparser.add_argument(
+        "--output_file_path",
+        dest="output_file_path",
+        type=str,
+        help="Path to the converted experiment file. Default: experiment file path with suffix '.npz'",
+    )
+    args = argparser.parse_args()
+
+    __convert_experiment_wrapper(args.experiment_file_path, args.output_file_path)
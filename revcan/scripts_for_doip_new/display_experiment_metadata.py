@@ -1,5 +1,6 @@
 import argparse
 from revcan.reverse_engineering.models.experiment import Experiment
+from revcan.reverse_engineering.models.experiment_store import ExperimentStore
 import datetime
 
 def display_experiment_name(experiment: Experiment):
@@ -11,10 +12,12 @@ def display_experiment_description(experiment: Experiment):
 def display_experiment_starttime(experiment: Experiment):
     print(f"Starttime: {experiment.starttime}")
 
-def display_experiment_value_metadata(experiment: Experiment):
+def display_experiment_value_metadata(store: ExperimentStore):
+    experiment = store.experiment
     experiment_runtime_seconds = experiment.experiment_runtime_seconds
     if experiment.measurements:
-        number_of_values_per_signal = len(experiment.measurements[-1].values)
+        signal = experiment.measurements[-1]
+        number_of_values_per_signal = len(store.get_signal_arrays(signal.serverid, signal.did.did)[0])
         if number_of_values_per_signal > 0:
             average_experiment_runtime_seconds = experiment_runtime_seconds / number_of_values_per_signal
         else:
@@ -31,9 +34,10 @@ def display_experiment_value_metadata(experiment: Experiment):
 def display_number_of_signals(experiment: Experiment):
     print(f"Number of Signals in Experiment: {len(experiment.measurements)}")
 
-def display_number_of_ground_truth_values(experiment: Experiment):
+def display_number_of_ground_truth_values(store: ExperimentStore):
+    experiment = store.experiment
     if experiment.external_measurements:
-        number_of_external_measurements = len(experiment.external_measurements[0].values)
+        number_of_external_measurements = len(store.get_extern_signal_arrays(experiment.external_measurements[0].id)[0])
     else:
         number_of_external_measurements = 0
 
@@ -47,7 +51,9 @@ def display_number_of_ground_truth_values(experiment: Experiment):
 def __display_experiment_metadata_wrapper(experiment_file_path: str, max_server_id: int = 65535):
     # Try to load experiment_file_path
     try:
-        experiment = Experiment.load(experiment_file_path)
+        # Only the number of values is needed, so no Value objects are created
+        store = Experiment.load_arrays(experiment_file_path)
+        experiment = store.experiment
     except FileNotFoundError:
         print(f"Error: The experiment file at '{experiment_file_path}' was not found.")
         return
@@ -60,9 +66,9 @@ def __display_experiment_metadata_wrapper(experiment_file_path: str, max_server_
     display_experiment_name(experiment)
     display_experiment_description(experiment)
     display_experiment_starttime(experiment)
-    display_experiment_value_metadata(experiment)
+    display_experiment_value_metadata(store)
     display_number_of_signals(experiment)
-    display_number_of_ground_truth_values(experiment)
+    display_number_of_ground_truth_values(store)
     print("\n")
 
 if __name__ == "__main__":
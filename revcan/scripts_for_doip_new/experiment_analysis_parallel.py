@@ -8,84 +8,45 @@ import argparse
 from datetime import datetime
 from numpy import  ndarray
 from revcan.reverse_engineering.models.experiment import Experiment, Extern_Signal, Signal
-from revcan.reverse_engineering.models.solutions import Solutions, Signal_Solution
+from revcan.reverse_engineering.models.experiment_store import ExperimentStore
+from revcan.reverse_engineering.models.groundtruth_alignment import GroundtruthAlignment, load_groundtruth_alignment
+from revcan.reverse_engineering.models.least_squares import candidate_values, score_signal
+from revcan.reverse_engineering.models.solutions import SolutionScore, SolutionsWriter
 import logging
 from tqdm import tqdm
 from copy import deepcopy
-from bisect import bisect_left
 
 
-def fast_groundtruth_lookup(timestamps, values, timestamp):
-    pos = bisect_left(timestamps, timestamp)
+# Ground truth alignment and experiment store of the worker processes, set once per worker by __init_worker
+_alignment = None
+_experiment_store = None
 
-    if pos == 0:
-        return values[0]
-    elif pos == len(timestamps):
-        return values[-1]
-    else:
-        before = timestamps[pos - 1]
-        after = timestamps[pos]
-        return values[pos - 1] if abs(before - timestamp) <= abs(after - timestamp) else values[pos]
 
-def construct_system (measured_signal: Signal, ground_truth_signal: Extern_Signal, datatype,  start_byte:int, length:int):
-    
+def __init_worker(alignment_file_path: str, experiment_file_path: str = None):
+    global _alignment, _experiment_store
+    # The alignment cache and columnar experiments are memory-mapped by every worker instead of sending the arrays
+    _alignment = GroundtruthAlignment(alignment_file_path)
+    if experiment_file_path is not None:
+        _experiment_store = ExperimentStore(experiment_file_path)
 
-    timestamps = [v.time for v in ground_truth_signal.values]
-    ground_values = [v.value for v in ground_truth_signal.values]
-
-    values = measured_signal.values
-    n = len(values)
-    
-    # Preallocate memory for efficiency
-    x_raw = np.empty((n, length), dtype=np.uint8)
-    y = np.empty(n)
-    try:
-        for i, v in enumerate(values):
-            x_raw[i]= v.value[start_byte:start_byte+length]
-            y[i]=(fast_groundtruth_lookup(timestamps,ground_values, v.time)[0])
-    
-        x = x_raw.view(datatype).ravel()
-        y= np.array(y)
-        X = np.vstack([x, np.ones(len(x))]).T
-        return x, X , y
-    except Exception as e:
-        print(f"Error with signal: {measured_signal} datatye: {datatype} start byte:{start_byte} length: {length}")
-        raise np.linalg.LinAlgError(str(e))
-    
-
-
-def solver ( measured_signal: Signal, ground_truth_signal: Extern_Signal, datatypes:List[str], start_byte:int, length:int):
-    all_solutions= Solutions()
-    for type in datatypes:
-            try:
-                x, X,y = construct_system(measured_signal, ground_truth_signal, type, start_byte, length)
-                coefficients, residuals, rank, singular_values = np.linalg.lstsq(X ,y, rcond=None)
-                if len(residuals) != 0:
-                    all_solutions.solutions.append(Signal_Solution(
-                        x=x,
-                        y=y,
-                        datatype=type,
-                        coefficients=coefficients,
-                        residuals=residuals,
-                        rank=rank,
-                        singular_values=singular_values,
-                        serverid=measured_signal.serverid,
-                        did=measured_signal.did.did,
-                        start_byte=start_byte,
-                        length=length,
-                        )
-                    )
-            except np.linalg.LinAlgError:
-                    pass
-    return all_solutions       
 
 def solver_task(args)    :
-    signal, ext_meas, data_type, index, length = args
-    return solver(signal, ext_meas, data_type, index, length)
-
-def experiment_analysis(experiment_file_path: str, output_file_path: str, silent = True, number_of_processes:int=0):
+    serverid, did, signal_arrays = args
+    if signal_arrays is None:
+        signal_arrays = _experiment_store.get_signal_arrays(serverid, did)[1:]
+    lengths, payload = signal_arrays
+    # Ground truth value of every sample of the signal, looked up in the precomputed alignment index
+    y = _alignment.get_groundtruth_values(serverid, did).astype(np.float64)
+    # Only the compact scores are returned, x and y are materialised by the parent for retained candidates
+    scores, _ = score_signal(lengths, payload, y)
+    return serverid, did, scores
+
+def experiment_analysis(experiment_file_path: str, output_file_path: str, silent = True, number_of_processes:int=0,
+                        top_k: int = 1000, rank_by: str = 'residuals', flush_interval_seconds: float = 30.0):
     try:
-        experiment = Experiment.load(experiment_file_path)
+        # No Value objects are created, the arrays of columnar files are memory-mapped
+        store = Experiment.load_arrays(experiment_file_path)
+        experiment = store.experiment
     except FileNotFoundError:
         print(f"Error: The experiment model file at '{experiment_file_path}' was not found.")
         return
@@ -96,51 +57,46 @@ def experiment_analysis(experiment_file_path: str, output_file_path: str, silent
     if number_of_processes == 0:
         number_of_processes = multiprocessing.cpu_count()-1
 
-    all_solutions= Solutions(groundtruth = experiment.external_measurements[0])
-    
+    ground_truth_signal = experiment.external_measurements[0]
+    ground_truth_signal = ground_truth_signal.model_copy(update={"values": store.get_extern_signal_values(ground_truth_signal.id)})
 
-    data_types_1 = ['<u1','<i1','>u1','>i1']
-    data_types_2 = ['<u2','<i2','<f2','>u2','>i2','>f2']
-    data_types_4 = ['<u4','<i4','<f4','>u4','>i4','>f4']
-    data_types_8 = ['<u8','<i8','<f8','>u8','>i8','>f8']
+    # Nearest ground truth sample of every value, cached next to the experiment file.
+    # The first value of every ground truth sample is used as target
+    alignment = load_groundtruth_alignment(experiment_file_path, ground_truth_signal.id)
 
-    number_of_systems = 0
-    number_of_measurements = len(experiment.measurements)
-    for i in range(0,number_of_measurements):
-        signal = experiment.measurements[i]
-        signal_length = len(signal.values[0].value)
-        number_of_systems+= signal_length*4+(max(0,signal_length-1))*6+(max(0,signal_length-3))*6+(max(0,signal_length-7))*6    
+    def signal_arrays(serverid: int, did: int):
+        return store.get_signal_arrays(serverid, did)[1:]
+
+    def materialise(score: SolutionScore):
+        lengths, payload = signal_arrays(score.serverid, score.did)
+        x = candidate_values(lengths, payload, score.datatype, score.start_byte)
+        y = alignment.get_groundtruth_values(score.serverid, score.did).astype(np.float64)
+        return x, y
 
+    writer = SolutionsWriter(output_file_path, ground_truth_signal, materialise, top_k=top_k, rank_by=rank_by,
+                             flush_interval_seconds=flush_interval_seconds)
+
+    number_of_measurements = len(experiment.measurements)
     print(number_of_measurements)
-    
-    tasks = []    
-    for i in range(number_of_measurements):
-        
-        signal = experiment.measurements[i]
-        n = len(signal.values[0].value)
-
-        ext_meas =(experiment.external_measurements[0])
-
-        # length 1
-        tasks += [( signal, ext_meas, data_types_1, x, 1) for x in range(n)]
-        # length 2
-        tasks += [( signal, ext_meas, data_types_2, x, 2) for x in range(n - 1)]
-        # length 4
-        tasks += [( signal, ext_meas, data_types_4, x, 4) for x in range(n - 3)]
-        # length 8
-        tasks += [( signal, ext_meas, data_types_8, x, 8) for x in range(n - 7)]
-
-    print(f"Number of tasks: {len(tasks)}")
-    all_solutions.save(output_file_path)
-    
-    with multiprocessing.Pool(number_of_processes) as pool:
-         results = list(tqdm(pool.imap(solver_task,tasks,100 ), total=len(tasks)))
-
-    for solutions in results:
-        for sol in solutions.solutions:
-            all_solutions.solutions.append(sol) 
-    
-    all_solutions.save(output_file_path)
+
+    # One task per signal, all candidates of a signal are solved in one vectorised pass.
+    # Payloads of columnar experiments are memory-mapped by the workers themselves
+    memory_mapped = store.file_path is not None
+    tasks = ((signal.serverid, signal.did.did, None if memory_mapped else signal_arrays(signal.serverid, signal.did.did))
+             for signal in experiment.measurements)
+
+    print(f"Number of tasks: {number_of_measurements}")
+    writer.flush()
+
+    try:
+        with multiprocessing.Pool(number_of_processes, initializer=__init_worker,
+                                  initargs=(alignment.file_path,
+                                            experiment_file_path if memory_mapped else None)) as pool:
+            for serverid, did, scores in tqdm(pool.imap_unordered(solver_task, tasks), total=number_of_measurements):
+                writer.add(serverid, did, scores)
+    finally:
+        # Keep the best solutions found so far, even if the analysis is interrupted
+        writer.close()
    
 
 if __name__ == "__main__":
@@ -176,6 +132,31 @@ if __name__ == "__main__":
         help="Flag that indicates if the programm shall run silent,withtout print",
     )
 
+    argparser.add_argument(
+        "--top_k",
+        dest="top_k",
+        type=int,
+        default=1000,
+        help="Number of best candidate solutions that are kept. 0 keeps all",
+    )
+
+    argparser.add_argument(
+        "--rank_by",
+        dest="rank_by",
+        type=str,
+        default="residuals",
+        help="Metric used to rank the candidate solutions. Possible values: 'residuals', 'r_squared'",
+    )
+
+    argparser.add_argument(
+        "--flush_interval_seconds",
+        dest="flush_interval_seconds",
+        type=float,
+        default=30.0,
+        help="Minimum time between two writes of the intermediate solutions",
+    )
+
     args = argparser.parse_args()
 
-    experiment_analysis(args.experiment_file_path, args.output_file_path, args.silent_flag, args.number_of_processes)
+    experiment_analysis(args.experiment_file_path, args.output_file_path, args.silent_flag, args.number_of_processes,
+                        args.top_k, args.rank_by, args.flush_interval_seconds)
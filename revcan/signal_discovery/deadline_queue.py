@@ -0,0 +1,288 @@
+"""
+This module defines the deadline-ordered scheduling of the requests of the schedulers.
+
+Every request is due once the time since its last execution exceeds its current interval. Instead of checking
+all requests of a subset in every update, the requests are kept in a binary heap keyed by their due time and
+addressed by integer handles (their index in the queue):
+
+    - Taking the due requests costs O(log n) per request, rescheduling a request after its execution or a change
+      of its interval costs O(log n).
+    - Rescheduled requests leave their old heap entry behind; it is skipped when it reaches the top and the heap
+      is rebuilt once the stale entries outnumber the valid ones.
+    - A request taken from the queue is not due again before it is rescheduled, so it is buffered at most once.
+
+The due requests wait in a RequestBuffer until the request thread of the scheduler sends them.
+
+Classes:
+    - DeadlineQueue: Requests ordered by their due time.
+    - RequestBuffer: Due requests waiting to be sent, grouped by server.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+from typing import Dict, Hashable, Iterable, List
+
+# Stale entries are only removed from the heap above this size
+_MINIMUM_COMPACTION_SIZE = 1024
+
+
+class DeadlineQueue:
+    """
+    A class holding requests ordered by the time they are due next. Thread-safe.
+
+    Attributes:
+        requests (list): The requests, the handle of a request is its index.
+
+    Methods:
+        add(request, due_time): Adds a request, returns its handle.
+        handle(request): Returns the handle of a request.
+        schedule(handle, due_time): Sets the due time of a request.
+        unschedule(handle): Removes a request from the schedule until it is scheduled again.
+        is_scheduled(handle): Checks whether a request is scheduled.
+        next_due_time(): Returns the earliest due time.
+        pop_due(now, limit): Removes and returns the handles of the due requests, earliest first.
+        wait(timeout): Waits until a request is due.
+    """
+
+    def __init__(self, requests: Iterable = ()):
+        self.requests: list = []
+        self._handles: Dict[int, int] = {}  # id(request) -> handle
+        self._entries: List[list] = []  # heap entry [due time, sequence, handle] per handle, None if not scheduled
+        self._heap: List[list] = []
+        self._sequence = itertools.count()  # requests due at the same time keep the order they were scheduled in
+        self._number_scheduled = 0
+        self._condition = threading.Condition()
+        for request in requests:
+            self.add(request)
+
+    def __len__(self):
+        return self._number_scheduled
+
+    def add(self, request, due_time: float = None) -> int:
+        """
+        Add a request.
+
+        :param request: The request.
+        :param due_time: Time the request is due (time.time()); None adds it unscheduled.
+        :return: Handle of the request.
+        """
+        with self._condition:
+            handle = len(self.requests)
+            self.requests.append(request)
+            self._handles[id(request)] = handle
+            self._entries.append(None)
+        if due_time is not None:
+            self.schedule(handle, due_time)
+        return handle
+
+    def handle(self, request) -> int:
+        """
+        :return: Handle of a request, None if the request is not in the queue.
+        """
+        return self._handles.get(id(request))
+
+    def schedule(self, handle: int, due_time: float):
+        """
+        Set the due time of a request, replacing the previous one.
+
+        :param handle: Handle of the request.
+        :param due_time: Time the request is due (time.time()).
+        """
+        with self._condition:
+            self._invalidate(handle)
+            entry = [due_time, next(self._sequence), handle]
+            self._entries[handle] = entry
+            self._number_scheduled += 1
+            heapq.heappush(self._heap, entry)
+            if self._heap[0] is entry:
+                # The request is due earlier than all others, a waiting update has to check again
+                self._condition.notify_all()
+
+    def unschedule(self, handle: int):
+        with self._condition:
+            self._invalidate(handle)
+
+    def is_scheduled(self, handle: int) -> bool:
+        return self._entries[handle] is not None
+
+    def _invalidate(self, handle: int):
+        # Called with the lock held
+        entry = self._entries[handle]
+        if entry is None:
+            return
+        entry[2] = None
+        self._entries[handle] = None
+        self._number_scheduled -= 1
+        if len(self._heap) > _MINIMUM_COMPACTION_SIZE and len(self._heap) > 2 * self._number_scheduled:
+            self._heap = [entry for entry in self._heap if entry[2] is not None]
+            heapq.heapify(self._heap)
+
+    def _top(self) -> list:
+        # Called with the lock held; drops stale entries from the top of the heap
+        while self._heap and self._heap[0][2] is None:
+            heapq.heappop(self._heap)
+        return self._heap[0] if self._heap else None
+
+    def next_due_time(self) -> float:
+        """
+        :return: The earliest due time, None if no request is scheduled.
+        """
+        with self._condition:
+            top = self._top()
+            return top[0] if top is not None else None
+
+    def pop_due(self, now: float = None, limit: int = None) -> List[int]:
+        """
+        Remove the due requests from the schedule.
+
+        :param now: Current time.
+        :param limit: Maximum number of requests, None for all due requests.
+        :return: Handles of the due requests, the earliest due first.
+        """
+        now = time.time() if now is None else now
+        handles = []
+        with self._condition:
+            while limit is None or len(handles) < limit:
+                top = self._top()
+                if top is None or top[0] > now:
+                    break
+                heapq.heappop(self._heap)
+                handle = top[2]
+                self._entries[handle] = None
+                self._number_scheduled -= 1
+                handles.append(handle)
+        return handles
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Wait until a request is due, at most for the given time. Returns early if a request is scheduled to be due
+        earlier than all others.
+
+        :param timeout: Maximum time to wait.
+        :return: True if a request is due.
+        """
+        with self._condition:
+            top = self._top()
+            if top is not None:
+                timeout = min(timeout, top[0] - time.time())
+            if timeout > 0:
+                self._condition.wait(timeout)
+            top = self._top()
+            return top is not None and top[0] <= time.time()
+
+
+class RequestBuffer:
+    """
+    A class holding the handles of due requests until they are sent. The handles are grouped, e.g. by server,
+    so that the requests of a server can be packed into one request; within a group they are kept in the order
+    they were added. Thread-safe.
+
+    Attributes:
+        window (int): Number of the longest waiting requests of a group returned by peek.
+
+    Methods:
+        put(handle, group): Adds a handle.
+        pop(): Removes and returns the longest waiting handle.
+        oldest_group(): Returns the group of the longest waiting handle.
+        peek(group): Returns the longest waiting handles of a group.
+        remove(group, handles): Removes handles of a group.
+        clear(): Removes all handles.
+        wait(timeout): Waits until a handle is added.
+    """
+
+    def __init__(self, window: int = 64):
+        self.window = window
+        self._groups: Dict[Hashable, deque] = {}  # group -> deque of (sequence, handle)
+        self._sequence = itertools.count()
+        self._length = 0
+        self._condition = threading.Condition()
+
+    def __len__(self):
+        return self._length
+
+    def put(self, handle: int, group: Hashable = None):
+        with self._condition:
+            self._groups.setdefault(group, deque()).append((next(self._sequence), handle))
+            self._length += 1
+            self._condition.notify_all()
+
+    def pop(self) -> int:
+        """
+        :return: The longest waiting handle, None if the buffer is empty.
+        """
+        with self._condition:
+            group = self._oldest_group()
+            if group is None:
+                return None
+            return self._remove_front(group, 1)[0]
+
+    def oldest_group(self) -> Hashable:
+        with self._condition:
+            return self._oldest_group()
+
+    def _oldest_group(self):
+        # Called with the lock held
+        if not self._groups:
+            return None
+        return min(self._groups, key=lambda group: self._groups[group][0][0])
+
+    def peek(self, group: Hashable) -> List[int]:
+        """
+        :return: Up to window handles of the group, the longest waiting first.
+        """
+        with self._condition:
+            entries = self._groups.get(group, ())
+            return [handle for _, handle in itertools.islice(entries, self.window)]
+
+    def remove(self, group: Hashable, handles: Iterable[int]):
+        """
+        Remove handles of a group, usually handles returned by peek.
+
+        :param group: The group.
+        :param handles: The handles to be removed.
+        """
+        handles = set(handles)
+        with self._condition:
+            entries = self._groups.get(group)
+            if entries is None:
+                return
+            # The handles are expected at the front, only the front of the group is rebuilt
+            kept = []
+            while entries and handles:
+                entry = entries.popleft()
+                if entry[1] in handles:
+                    handles.discard(entry[1])
+                    self._length -= 1
+                else:
+                    kept.append(entry)
+            entries.extendleft(reversed(kept))
+            if not entries:
+                del self._groups[group]
+
+    def _remove_front(self, group, count) -> List[int]:
+        # Called with the lock held
+        entries = self._groups[group]
+        handles = [entries.popleft()[1] for _ in range(min(count, len(entries)))]
+        self._length -= len(handles)
+        if not entries:
+            del self._groups[group]
+        return handles
+
+    def clear(self):
+        with self._condition:
+            self._groups.clear()
+            self._length = 0
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Wait until the buffer is not empty, at most for the given time.
+
+        :return: True if the buffer is not empty.
+        """
+        with self._condition:
+            if not self._length:
+                self._condition.wait(timeout)
+            return self._length > 0
@@ -0,0 +1,88 @@
+"""
+This module defines the append-only columnar log of the debug history of the requests.
+
+The debug history used to be a list of rows, which was extended by list concatenation (O(n) per row). The log
+appends rows in O(1): single rows are collected in a list and moved into NumPy column chunks once the list is full,
+batches of rows (e.g. one row for every request of a RequestTable) are stored as a chunk directly.
+
+Classes:
+    - DebugLog: Append-only columnar log.
+"""
+
+import math
+from typing import Dict, List, Sequence
+
+import numpy as np
+import pandas as pd
+
+DEBUG_COLUMNS = ("timestamp", "interval", "bits", "entropy", "blacklisted", "execution_duration")
+
+
+class DebugLog:
+    """
+    A class representing an append-only log with a fixed set of numeric columns. Values missing in a row are NaN.
+
+    Attributes:
+        columns (tuple): Names of the columns.
+        chunk_size (int): Number of single rows collected before they are moved into a chunk.
+
+    Methods:
+        append(**values): Appends one row.
+        extend(**values): Appends several rows, given as arrays (or scalars used for all rows).
+        column(name): Returns all values of a column.
+        to_frame(**filters): Returns the log as a DataFrame.
+    """
+
+    __slots__ = ("columns", "chunk_size", "_chunks", "_rows", "_length")
+
+    def __init__(self, columns: Sequence[str] = DEBUG_COLUMNS, chunk_size: int = 1024):
+        self.columns = tuple(columns)
+        self.chunk_size = chunk_size
+        self._chunks: List[Dict[str, np.ndarray]] = []
+        self._rows: List[tuple] = []  # single rows not yet moved into a chunk
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def append(self, **values):
+        self._rows.append(tuple(values.get(name, math.nan) for name in self.columns))
+        self._length += 1
+        if len(self._rows) >= self.chunk_size:
+            self._flush()
+
+    def extend(self, **values):
+        """
+        Append several rows.
+
+        :param values: Values per column, arrays of the same length or scalars; missing columns are NaN.
+        """
+        length = max((len(value) for value in values.values() if np.ndim(value)), default=1)
+        self._flush()
+        self._chunks.append(
+            {name: np.broadcast_to(np.asarray(values.get(name, math.nan), dtype=np.float64), (length,)).copy()
+             for name in self.columns}
+        )
+        self._length += length
+
+    def _flush(self):
+        if self._rows:
+            rows = np.array(self._rows, dtype=np.float64)
+            self._chunks.append({name: rows[:, i] for i, name in enumerate(self.columns)})
+            self._rows = []
+
+    def column(self, name: str) -> np.ndarray:
+        self._flush()
+        if not self._chunks:
+            return np.zeros(0)
+        return np.concatenate([chunk[name] for chunk in self._chunks])
+
+    def to_frame(self, **filters) -> pd.DataFrame:
+        """
+        :param filters: Column values of the rows to be returned, e.g. request=3.
+        :return: The rows of the log (matching the filters) as a DataFrame.
+        """
+        frame = pd.DataFrame({name: self.column(name) for name in self.columns})
+        for name, value in filters.items():
+            frame = frame[frame[name] == value]
+        return frame.reset_index(drop=True)
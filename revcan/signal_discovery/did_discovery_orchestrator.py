@@ -0,0 +1,256 @@
+"""
+This module defines the parallel DID discovery of several servers behind one gateway.
+
+Every server is searched by its own worker thread with an adaptive DIDSearch. The requests of all workers share
+a DoIPSessionPool (bounded number of connections to the gateway) and a token bucket which limits the request
+rate of the gateway, as bursts of requests lead to connection resets and broken pipes. If a request of a server
+fails on connection level, the worker backs off exponentially and resumes the search of that server at
+first_unchecked_did_in_did_discovery. A server is given up (and left incomplete for a later resume) after
+max_retries consecutive failures.
+
+The progress of every server is only advanced once all DIDs below first_unchecked_did_in_did_discovery were
+checked and their parameters were added, so the car model can be saved at any time and a resume is exact.
+
+Classes:
+    - TokenBucket: Thread-safe token bucket rate limiter.
+    - DIDDiscoveryOrchestrator: Runs the DID discovery of several servers in parallel.
+"""
+
+import bisect
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable, List
+
+from revcan.reverse_engineering.models import car_metadata
+from revcan.reverse_engineering.models.car_metadata import Server
+from revcan.signal_discovery.did_prior_index import DIDPriorIndex
+from revcan.signal_discovery.did_search import DIDSearch
+from revcan.signal_discovery.doip_session_pool import DoIPSessionPool
+
+
+class TokenBucket:
+    """
+    A class representing a thread-safe token bucket.
+
+    Attributes:
+        rate (float): Tokens added per second.
+        capacity (float): Maximum number of tokens (burst size).
+
+    Methods:
+        acquire(): Blocks until a token is available and takes it.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._last_update = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Block until a token is available and take it. A rate <= 0 disables the limit.
+        """
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last_update) * self.rate)
+                self._last_update = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                waiting_time = (1 - self._tokens) / self.rate
+            time.sleep(waiting_time)
+
+
+class DIDDiscoveryOrchestrator:
+    """
+    A class running the DID discovery of several servers behind one gateway in parallel.
+
+    Attributes:
+        session_pool (DoIPSessionPool): Connections to the gateway shared by all workers.
+        rate_limiter (TokenBucket): Request rate limit of the gateway.
+        did_prior (DIDPriorIndex): Known DIDs of other cars; their dense ranges are probed first if set.
+        max_batch_size (int): Maximum number of DIDs per request.
+        max_workers (int): Number of servers searched in parallel.
+        initial_backoff_seconds (float): Waiting time after the first failure of a server.
+        max_backoff_seconds (float): Maximum waiting time between retries of a server.
+        max_retries (int): Consecutive failures after which a server is given up.
+        print_results (bool): Flag to print progress.
+        activate_logging_flag (bool): Flag to log progress.
+
+    Methods:
+        run(servers, possible_dids, checkpoint, checkpoint_interval_seconds): Discovers the DIDs of all servers.
+    """
+
+    def __init__(self,
+                 session_pool: DoIPSessionPool,
+                 max_batch_size: int = 32,
+                 max_workers: int = 4,
+                 requests_per_second: float = 50,
+                 burst: int = 4,
+                 initial_backoff_seconds: float = 1,
+                 max_backoff_seconds: float = 60,
+                 max_retries: int = 5,
+                 did_prior: DIDPriorIndex = None,
+                 print_results=True,
+                 activate_logging_flag=False):
+        self.session_pool = session_pool
+        self.rate_limiter = TokenBucket(requests_per_second, burst)
+        self.max_batch_size = max_batch_size
+        self.max_workers = max(1, max_workers)
+        self.initial_backoff_seconds = initial_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.max_retries = max_retries
+        self.did_prior = did_prior
+        self.print_results = print_results
+        self.activate_logging_flag = activate_logging_flag
+
+        # Guards the servers, so a checkpoint never saves a partially updated server
+        self.progress_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _report(self, message: str, level=logging.INFO):
+        if self.print_results:
+            print(f"\n{message}", end="")
+        if self.activate_logging_flag:
+            logging.log(level, message)
+
+    def _discover_server(self, server: Server, possible_dids: List[int]):
+        start_time = time.time()
+        did_search = DIDSearch(self._read_data(server), max_batch_size=self.max_batch_size)
+        failures = 0
+
+        def on_found(did, length):
+            with self.progress_lock:
+                # DIDs of dense ranges are found out of order and again after a resume
+                position = bisect.bisect_left(server.parameters, did, key=lambda parameter: parameter.did)
+                if position < len(server.parameters) and server.parameters[position].did == did:
+                    server.parameters[position].length = length
+                else:
+                    server.parameters.insert(position, car_metadata.Parameter(did=did, length=length))
+            if self.activate_logging_flag:
+                logging.info("Found did 0x{1:04x} for server 0x{0:04x}: found {2}"
+                             .format(server.id, did, len(server.parameters)))
+
+        def on_progress(did):
+            nonlocal failures
+            failures = 0
+            with self.progress_lock:
+                server.first_unchecked_did_in_did_discovery = did + 1
+
+        try:
+            while not self._stop.is_set():
+                remaining_dids = [did for did in possible_dids if did >= server.first_unchecked_did_in_did_discovery]
+                if self.did_prior is not None:
+                    priority_dids, remaining_dids = self.did_prior.split_search_space(server, remaining_dids)
+                else:
+                    priority_dids = []
+                try:
+                    did_search.search_prioritised(priority_dids, remaining_dids, on_found=on_found,
+                                                  on_progress=on_progress)
+                    with self.progress_lock:
+                        # on_progress only covers the non-priority DIDs, so a resume must not repeat the search
+                        server.first_unchecked_did_in_did_discovery = max(server.first_unchecked_did_in_did_discovery,
+                                                                         max(possible_dids) + 1)
+                        server.discovery_complete_flag = True
+                    self._report(f"DID discovery complete for server 0x{server.id:04x}: {len(server.parameters)} DIDs "
+                                 f"found with {did_search.number_of_requests} requests.")
+                    return
+                except InterruptedError:
+                    # Raised by read_data on stop; a subclass of OSError, so it has to be caught first
+                    return
+                except OSError as e:
+                    # Connection resets, broken pipes and timeouts: back off and resume at the first unchecked DID
+                    failures += 1
+                    if failures > self.max_retries:
+                        self._report(f"Giving up DID discovery for server 0x{server.id:04x} after {self.max_retries} "
+                                     f"retries at DID 0x{server.first_unchecked_did_in_did_discovery:04x}: {e}",
+                                     logging.WARNING)
+                        return
+                    backoff_seconds = min(self.max_backoff_seconds,
+                                          self.initial_backoff_seconds * 2 ** (failures - 1))
+                    self._report(f"{type(e).__name__} for server 0x{server.id:04x} at DID "
+                                 f"0x{server.first_unchecked_did_in_did_discovery:04x}. Retrying in "
+                                 f"{backoff_seconds:.1f} seconds.", logging.WARNING)
+                    self._stop.wait(backoff_seconds)
+        finally:
+            with self.progress_lock:
+                server.did_discovery_time_seconds += int(round(time.time() - start_time))
+
+    def _read_data(self, server: Server) -> Callable:
+        def read_data(didlist):
+            if self._stop.is_set():
+                raise InterruptedError("DID discovery stopped")
+            self.rate_limiter.acquire()
+            # Suppress lower-level messages
+            if self.activate_logging_flag:
+                logging.getLogger().setLevel(logging.WARNING)
+            try:
+                with self.session_pool.session(server.id) as client:
+                    return client.read_data_by_identifier(didlist=didlist)
+            except OSError:
+                raise
+            except Exception as e:
+                # Handled like a missing response, the batch is bisected
+                print(f"An issue occurred while probing DIDs 0x{didlist[0]:04x} to 0x{didlist[-1]:04x} for server 0x{server.id:04x}: {e}")
+                if self.activate_logging_flag:
+                    logging.warning(f"An issue occurred while probing DIDs 0x{didlist[0]:04x} to 0x{didlist[-1]:04x} for server 0x{server.id:04x}: {e}")
+                return None
+            finally:
+                # Acitvate lower-level messages again
+                if self.activate_logging_flag:
+                    logging.getLogger().setLevel(logging.INFO)
+        return read_data
+
+    def run(self, servers: List[Server], possible_dids: List[int], checkpoint: Callable[[], None] = None,
+            checkpoint_interval_seconds: float = 60) -> List[Server]:
+        """
+        Discover the DIDs of all incomplete servers in parallel.
+
+        :param servers: The servers; their parameters and discovery progress are updated in place.
+        :param possible_dids: Sorted list of DIDs to probe.
+        :param checkpoint: Called periodically (with the progress lock held) to persist the progress.
+        :param checkpoint_interval_seconds: Interval between checkpoints.
+        :return: The servers.
+        """
+        pending_servers = [server for server in servers
+                           if not (server.discovery_complete_flag
+                                   and server.first_unchecked_did_in_did_discovery > max(possible_dids))]
+        if not pending_servers:
+            return servers
+        self._stop.clear()
+
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            futures = {executor.submit(self._discover_server, server, possible_dids): server
+                       for server in pending_servers}
+            not_done = set(futures)
+            while not_done:
+                done, not_done = wait(not_done, timeout=checkpoint_interval_seconds)
+                for future in done:
+                    if future.exception() is not None and not isinstance(future.exception(), InterruptedError):
+                        self._report(f"DID discovery for server 0x{futures[future].id:04x} failed: "
+                                     f"{future.exception()}", logging.WARNING)
+                if self.print_results:
+                    with self.progress_lock:
+                        completed = sum(server.discovery_complete_flag for server in pending_servers)
+                        found = sum(len(server.parameters) for server in pending_servers)
+                    print(f"\rDID discovery: {completed}/{len(pending_servers)} servers complete, {found} DIDs found.",
+                          end="")
+                if checkpoint is not None:
+                    with self.progress_lock:
+                        checkpoint()
+        except KeyboardInterrupt:
+            # Running requests finish, the progress of every server stays consistent
+            self._stop.set()
+            self._report("DID discovery interrupted. Waiting for running requests.", logging.WARNING)
+            raise
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.session_pool.close()
+        return servers
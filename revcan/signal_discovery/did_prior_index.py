@@ -0,0 +1,224 @@
+"""
+This module defines a prior over the DIDs supported by a server, built from previously discovered cars.
+
+The DIDs found on servers of saved car models (car_metadata.Server.parameters) and stored in DidRequestDatabase
+files are counted per DID range (256 DIDs sharing the high byte). For a new server, every known server is weighted
+by its similarity: servers with the same ECU identification (F18x/F19x strings read during server discovery)
+weigh most, servers with the same logical address less and all other servers least. The weighted mean of the
+hits per range estimates the number of supported DIDs per range of the new server.
+
+The DID discovery probes the densest ranges first and sweeps the remaining DIDs in ascending order afterwards,
+so first_unchecked_did_in_did_discovery keeps its meaning for the sweep and a resume stays exact.
+
+Classes:
+    - DIDPriorIndex: Hit counts per DID range of known servers.
+"""
+
+import glob
+import logging
+import os
+import sqlite3
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from revcan.reverse_engineering.models import car_metadata
+from revcan.reverse_engineering.models.car_metadata import Server
+
+DID_RANGE_BITS = 8
+NUMBER_OF_DID_RANGES = 1 << (16 - DID_RANGE_BITS)
+
+# Identification DIDs describing the type of an ECU; serial numbers and dates differ between equal ECUs
+ECU_TYPE_FIELDS = (
+    "vehicleManufacturerSparePartNumberDataIdentifier",
+    "vehicleManufacturerECUHardwareNumberDataIdentifier",
+    "systemSupplierIdentifierDataIdentifier",
+    "systemSupplierECUHardwareNumberDataIdentifier",
+    "systemNameOrEngineTypeDataIdentifier",
+)
+
+# Weights of a known server: base + same logical address + share of equal ECU type fields
+BASE_WEIGHT = 1.0
+SERVER_ID_WEIGHT = 4.0
+ECU_TYPE_WEIGHT = 16.0
+
+
+def ecu_type(server: Server) -> Dict[str, str]:
+    """
+    Get the non-empty ECU type identification strings of a server.
+
+    :param server: The server.
+    :return: Dict of field name to normalised identification string.
+    """
+    identification = {}
+    for field in ECU_TYPE_FIELDS:
+        value = str(getattr(server, field, "") or "").strip().strip("\x00").strip()
+        if value:
+            identification[field] = value
+    return identification
+
+
+class DIDPriorIndex:
+    """
+    A class representing the hit counts per DID range of known servers.
+
+    Attributes:
+        entries (List[Tuple[int, Dict[str, str], np.ndarray]]): Server ID, ECU type and hits per DID range
+            of every known server.
+
+    Methods:
+        add_server(server): Adds the discovered DIDs of a server.
+        add_car(car): Adds all servers of a car model.
+        add_did_request_database(db_file): Adds the DIDs stored in a DidRequestDatabase file.
+        from_files(car_model_paths, database_paths): Builds an index from car model and database files.
+        expected_hits(server): Estimates the number of supported DIDs per range of a server.
+        split_search_space(server, possible_dids, coverage, max_fraction): Splits DIDs into dense ranges and the rest.
+    """
+
+    def __init__(self):
+        self.entries: List[Tuple[int, Dict[str, str], np.ndarray]] = []
+
+    def _add(self, server_id: int, identification: Dict[str, str], dids):
+        dids = np.asarray(list(dids), dtype=np.int64)
+        if len(dids) == 0:
+            return
+        hits = np.bincount(dids >> DID_RANGE_BITS, minlength=NUMBER_OF_DID_RANGES)
+        self.entries.append((server_id, identification, hits))
+
+    def add_server(self, server: Server):
+        """
+        Add the discovered DIDs of a server.
+
+        :param server: The server; only completely discovered servers are representative.
+        """
+        self._add(server.id, ecu_type(server), {parameter.did for parameter in server.parameters})
+
+    def add_car(self, car: car_metadata.Car):
+        """
+        Add all completely discovered servers of a car model.
+
+        :param car: The car model.
+        """
+        for server in car.servers:
+            if server.discovery_complete_flag:
+                self.add_server(server)
+
+    def add_did_request_database(self, db_file: str):
+        """
+        Add the DIDs stored in a DidRequestDatabase file (DoIP or CAN layout).
+
+        :param db_file: Path to the database file.
+        """
+        conn = sqlite3.connect(db_file)
+        try:
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(did_requests)")]
+            server_column = "server_id" if "server_id" in columns else "response_id"
+            rows = conn.execute(f"SELECT DISTINCT {server_column}, did FROM did_requests").fetchall()
+        finally:
+            conn.close()
+
+        dids_per_server: Dict[int, set] = {}
+        for server_id, did in rows:
+            dids_per_server.setdefault(server_id, set()).add(did)
+        for server_id, dids in dids_per_server.items():
+            # The databases do not contain the identification of the servers
+            self._add(server_id, {}, dids)
+
+    @classmethod
+    def from_files(cls, car_model_paths: List[str] = (), database_paths: List[str] = (),
+                   exclude_paths: List[str] = (), activate_logging_flag=False) -> 'DIDPriorIndex':
+        """
+        Build an index from car model and DidRequestDatabase files. Glob patterns are expanded.
+
+        :param car_model_paths: Paths or glob patterns of car model files.
+        :param database_paths: Paths or glob patterns of DidRequestDatabase files.
+        :param exclude_paths: Files which are skipped, e.g. the car model of the current discovery.
+        :param activate_logging_flag: Whether to log issues.
+        :return: The index.
+        """
+        index = cls()
+        excluded = {os.path.abspath(path) for path in exclude_paths}
+
+        def expand(patterns):
+            paths = sorted({path for pattern in patterns for path in glob.glob(pattern)})
+            return [path for path in paths if os.path.abspath(path) not in excluded]
+
+        for path in expand(car_model_paths):
+            try:
+                index.add_car(car_metadata.Car.load(path))
+            except Exception as e:
+                print(f"Error loading car model '{path}' for the DID prior: {e}")
+                if activate_logging_flag:
+                    logging.warning(f"Error loading car model '{path}' for the DID prior: {e}")
+        for path in expand(database_paths):
+            try:
+                index.add_did_request_database(path)
+            except Exception as e:
+                print(f"Error loading DID database '{path}' for the DID prior: {e}")
+                if activate_logging_flag:
+                    logging.warning(f"Error loading DID database '{path}' for the DID prior: {e}")
+        return index
+
+    def expected_hits(self, server: Server) -> np.ndarray:
+        """
+        Estimate the number of supported DIDs per range of a server as the similarity weighted mean of the
+        hits of all known servers.
+
+        :param server: The server.
+        :return: Expected hits per DID range (zeros if the index is empty).
+        """
+        if not self.entries:
+            return np.zeros(NUMBER_OF_DID_RANGES)
+
+        identification = ecu_type(server)
+        weights = np.empty(len(self.entries))
+        for i, (server_id, entry_identification, _) in enumerate(self.entries):
+            common_fields = identification.keys() & entry_identification.keys()
+            equal_fields = sum(identification[field] == entry_identification[field] for field in common_fields)
+            weights[i] = BASE_WEIGHT + SERVER_ID_WEIGHT * (server_id == server.id) \
+                + ECU_TYPE_WEIGHT * (equal_fields / len(common_fields) if common_fields else 0)
+
+        hits = np.stack([entry[2] for entry in self.entries])
+        return weights @ hits / weights.sum()
+
+    def split_search_space(self, server: Server, possible_dids: List[int], coverage=0.9,
+                           max_fraction=0.05) -> Tuple[List[int], List[int]]:
+        """
+        Split the DIDs to probe into the densest ranges and the rest.
+
+        Ranges are taken in descending order of expected hits until they cover the given share of all expected
+        hits or contain max_fraction of the DIDs.
+
+        :param server: The server.
+        :param possible_dids: Sorted DIDs to probe.
+        :param coverage: Share of the expected hits the dense ranges should cover.
+        :param max_fraction: Maximum share of the DIDs in the dense ranges.
+        :return: Tuple of the DIDs of the dense ranges (densest range first, ascending within a range) and the
+            remaining DIDs in ascending order.
+        """
+        possible_dids = np.asarray(possible_dids, dtype=np.int64)
+        expected_hits = self.expected_hits(server)
+        total_hits = expected_hits.sum()
+        if total_hits <= 0 or len(possible_dids) == 0:
+            return [], possible_dids.tolist()
+
+        ranges = possible_dids >> DID_RANGE_BITS
+        dids_per_range = np.bincount(ranges, minlength=NUMBER_OF_DID_RANGES)
+        max_dense_dids = max_fraction * len(possible_dids)
+
+        dense_ranges, covered_hits, dense_dids = [], 0.0, 0
+        for did_range in np.argsort(-expected_hits, kind='stable'):
+            if expected_hits[did_range] <= 0 or covered_hits >= coverage * total_hits:
+                break
+            if dense_dids + dids_per_range[did_range] > max_dense_dids:
+                break
+            dense_ranges.append(did_range)
+            covered_hits += expected_hits[did_range]
+            dense_dids += dids_per_range[did_range]
+
+        rank = np.full(NUMBER_OF_DID_RANGES, len(dense_ranges))
+        rank[dense_ranges] = np.arange(len(dense_ranges))
+        dense = rank[ranges] < len(dense_ranges)
+        # Stable sort keeps the DIDs of a range in ascending order
+        dense_dids_sorted = possible_dids[dense][np.argsort(rank[ranges][dense], kind='stable')]
+        return dense_dids_sorted.tolist(), possible_dids[~dense].tolist()
@@ -0,0 +1,240 @@
+"""
+This module defines an adaptive group-testing search for the data identifiers (DIDs) supported by a server.
+
+A ReadDataByIdentifier request may contain several DIDs. The server answers with the identifier and data of
+every supported DID of the request in request order, or with RequestOutOfRange if none of them is supported.
+Consecutive DIDs are therefore probed in batches:
+
+    - RequestOutOfRange: no DID of the batch is supported.
+    - Positive response: the supported DIDs and their lengths are parsed from the response, assuming every
+      identifier of a requested DID in the response starts a new DID. If more than one DID was found, the
+      batch is requested once more in reversed order, which yields the same DIDs in reversed order if the
+      split was right. If the split was wrong (the data of a DID contains the identifier of a later DID of the
+      batch) or ambiguous, the batch is bisected.
+    - IncorrectMessageLengthOrInvalidFormat / ResponseTooLong: the batch exceeds what the server accepts.
+      The multi-DID limit of the server is lowered and the batch is bisected.
+    - Other negative responses or no response: a single DID is not readable. A batch is bisected, as a single
+      protected DID (e.g. SecurityAccessDenied) rejects the whole request.
+
+The batch width follows the observed hit density (about 1 / density, the optimum of group testing for sparse
+hits), bounded by the multi-DID limit of the server.
+
+Classes:
+    - DIDSearch: Adaptive DID search for a single server.
+"""
+
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Tuple
+
+from revcan.signal_discovery.utils.udsoncan.ResponseCode import ResponseCode
+
+# Negative responses indicating that the request carries too many DIDs or its response would be too long
+_REQUEST_TOO_BIG_CODES = (ResponseCode.IncorrectMessageLengthOrInvalidFormat, ResponseCode.ResponseTooLong)
+
+
+def split_multi_did_response(data: bytes, didlist: List[int]) -> Dict[int, bytes] | None:
+    """
+    Split the data of a positive ReadDataByIdentifier response into the supported DIDs and their data.
+
+    The response consists of [DID (2 bytes), data (>= 1 byte)] for a subsequence of the requested DIDs in
+    request order. As the data lengths are unknown, the data of a DID may always contain the following DIDs, so
+    the segmentation with the most segments is taken: every identifier of a following requested DID starts a new
+    segment. This is wrong if the data of a DID contains the identifier of a following requested DID, which
+    DIDSearch detects with a second request in reversed order.
+
+    :param data: Data of the positive response (without the service ID).
+    :param didlist: Requested DIDs in request order.
+    :return: Data per supported DID, or None if there is no valid segmentation or more than one with the most
+        segments.
+    """
+    data = bytes(data)
+    number_of_bytes = len(data)
+    positions = {did: i for i, did in enumerate(didlist)}
+    # A segment can only start where the identifier of a requested DID is followed by at least one data byte
+    starts = [offset for offset in range(number_of_bytes - 2)
+              if int.from_bytes(data[offset:offset + 2], "big") in positions]
+    ends = starts + [number_of_bytes]
+    # (most segments, number of segmentations with that many segments capped at 2) of data[offset:] whose
+    # first DID has a list position >= minimum; (-1, 0) if there is none
+    memo = {}
+
+    def best(offset: int, minimum: int) -> Tuple[int, int]:
+        if offset == number_of_bytes:
+            return 0, 1
+        key = (offset, minimum)
+        if key not in memo:
+            position = positions.get(int.from_bytes(data[offset:offset + 2], "big"), -1) \
+                if offset + 2 < number_of_bytes else -1
+            most, ways = -1, 0
+            if position >= minimum:
+                for end in ends[bisect_left(ends, offset + 3):]:
+                    segments, end_ways = best(end, position + 1)
+                    if segments < 0:
+                        continue
+                    if segments + 1 > most:
+                        most, ways = segments + 1, end_ways
+                    elif segments + 1 == most:
+                        ways = min(2, ways + end_ways)
+            memo[key] = (most, ways)
+        return memo[key]
+
+    if number_of_bytes == 0 or best(0, 0)[1] != 1:
+        return None
+
+    # Follow the unique segmentation with the most segments
+    values = {}
+    offset, minimum = 0, 0
+    while offset < number_of_bytes:
+        segments = best(offset, minimum)[0]
+        position = positions[int.from_bytes(data[offset:offset + 2], "big")]
+        end = next(end for end in ends[bisect_left(ends, offset + 3):]
+                   if best(end, position + 1) == (segments - 1, 1))
+        values[didlist[position]] = data[offset + 2:end]
+        offset, minimum = end, position + 1
+    return values
+
+
+def parse_multi_did_response(data: bytes, didlist: List[int]) -> Dict[int, int] | None:
+    """
+    Split the data of a positive ReadDataByIdentifier response into the supported DIDs and their lengths.
+
+    :param data: Data of the positive response (without the service ID).
+    :param didlist: Requested DIDs in request order.
+    :return: Length per supported DID, or None if the response can not be split (see split_multi_did_response).
+    """
+    values = split_multi_did_response(data, didlist)
+    if values is None:
+        return None
+    return {did: len(value) for did, value in values.items()}
+
+
+class DIDSearch:
+    """
+    A class representing the adaptive DID search for a single server.
+
+    Attributes:
+        read_data (Callable): Sends a ReadDataByIdentifier request for a list of DIDs and returns the response
+            (None if no response was received), e.g. Client.read_data_by_identifier.
+        max_dids_per_request (int): Current multi-DID limit of the server, lowered if the server rejects a batch.
+        initial_batch_size (int): Batch width used before any hit density is known.
+        number_of_requests (int): Number of requests sent.
+        number_of_checked_dids (int): Number of DIDs checked.
+        number_of_hits (int): Number of supported DIDs found.
+        values (Dict[int, bytes]): Data of every supported DID found.
+
+    Methods:
+        search(dids, on_found, on_progress): Probes a sorted list of DIDs and returns the supported DIDs and lengths.
+        search_prioritised(priority_dids, dids, on_found, on_progress): Probes likely DIDs first, then the rest.
+    """
+
+    def __init__(self, read_data: Callable[[List[int]], Any], max_batch_size: int = 64, initial_batch_size: int = 8):
+        self.read_data = read_data
+        self.max_dids_per_request = max(1, max_batch_size)
+        self.initial_batch_size = max(1, min(initial_batch_size, self.max_dids_per_request))
+        self.number_of_requests = 0
+        self.number_of_checked_dids = 0
+        self.number_of_hits = 0
+        self.values: Dict[int, bytes] = {}
+
+    def _batch_width(self) -> int:
+        # Estimated hit density, starting at 1 / initial_batch_size
+        density = (self.number_of_hits + 1) / (self.number_of_checked_dids + self.initial_batch_size)
+        return max(1, min(self.max_dids_per_request, round(1 / density)))
+
+    def _verify_split(self, batch: List[int], values: Dict[int, bytes]) -> bool:
+        # The response to the reversed request has to split at the same DIDs in reversed order with the same segment
+        # lengths; only the structure is compared, as the data of a DID may change between the requests
+        response = self.read_data(batch[::-1])
+        self.number_of_requests += 1
+        if response is None or not response.positive or response.data is None:
+            return False
+        data = bytes(response.data)
+        offset = 0
+        for did in batch[::-1]:
+            if did not in values:
+                continue
+            if data[offset:offset + 2] != did.to_bytes(2, "big"):
+                return False
+            offset += 2 + len(values[did])
+        return offset == len(data)
+
+    def _probe(self, batch: List[int], on_found: Callable[[int, int], None] = None):
+        found = {}
+        stack = [batch]
+        while stack:
+            batch = stack.pop()
+            if len(batch) > self.max_dids_per_request:
+                chunks = [batch[i:i + self.max_dids_per_request]
+                          for i in range(0, len(batch), self.max_dids_per_request)]
+                stack.extend(reversed(chunks))
+                continue
+
+            response = self.read_data(batch)
+            self.number_of_requests += 1
+            middle = len(batch) // 2
+
+            if response is not None and response.positive and response.data is not None:
+                values = split_multi_did_response(response.data, batch)
+                if values is not None and len(values) > 1 and not self._verify_split(batch, values):
+                    values = None
+                if values is not None:
+                    self.values.update(values)
+                    found.update({did: len(value) for did, value in values.items()})
+                elif len(batch) > 1:
+                    # Ambiguous or wrong split, resolve both halves separately (left half first)
+                    stack.extend([batch[middle:], batch[:middle]])
+            elif response is not None and response.code == ResponseCode.RequestOutOfRange:
+                continue
+            elif len(batch) > 1:
+                if response is not None and response.code in _REQUEST_TOO_BIG_CODES:
+                    self.max_dids_per_request = max(1, min(self.max_dids_per_request, middle))
+                stack.extend([batch[middle:], batch[:middle]])
+
+        for did in sorted(found):
+            if on_found is not None:
+                on_found(did, found[did])
+        return found
+
+    def search(self, dids: List[int], on_found: Callable[[int, int], None] = None,
+               on_progress: Callable[[int], None] = None) -> Dict[int, int]:
+        """
+        Probe a sorted list of DIDs.
+
+        :param dids: DIDs to probe, in ascending order.
+        :param on_found: Called with (DID, length) for every supported DID, in ascending order.
+        :param on_progress: Called with the last DID of every completed batch; all DIDs up to it are checked.
+        :return: Length per supported DID.
+        """
+        found = {}
+        index = 0
+        while index < len(dids):
+            batch = dids[index:index + self._batch_width()]
+            lengths = self._probe(batch, on_found)
+            found.update(lengths)
+
+            index += len(batch)
+            self.number_of_checked_dids += len(batch)
+            self.number_of_hits += len(lengths)
+            if on_progress is not None:
+                on_progress(batch[-1])
+        return found
+
+    def search_prioritised(self, priority_dids: List[int], dids: List[int], on_found: Callable[[int, int], None] = None,
+                           on_progress: Callable[[int], None] = None) -> Dict[int, int]:
+        """
+        Probe the DIDs of dense ranges first (e.g. from DIDPriorIndex.split_search_space), then the rest.
+
+        Progress is only reported for the sorted remaining DIDs, as the priority DIDs are not probed in order.
+
+        :param priority_dids: DIDs probed first.
+        :param dids: Remaining DIDs, in ascending order.
+        :param on_found: Called with (DID, length) for every supported DID.
+        :param on_progress: Called with the last DID of every completed batch of the remaining DIDs.
+        :return: Length per supported DID.
+        """
+        found = self.search(priority_dids, on_found)
+        # The hit density of the dense ranges does not carry over to the rest
+        self.number_of_checked_dids = 0
+        self.number_of_hits = 0
+        found.update(self.search(dids, on_found, on_progress))
+        return found
@@ -21,6 +21,7 @@ import pandas as pd
 from collections import deque
 from revcan.signal_discovery.utils.iso14229_1 import Iso14229_1
 from revcan.signal_discovery.utils.iso15765_2 import IsoTp
+from revcan.signal_discovery.feature_engine import history_features, stack_histories
 
 
 class DidPayloadHistory:
@@ -82,6 +83,7 @@ class Interval:
     Attributes:
         _current (int): The current value of the interval.
         _last (int): The last value of the interval.
+        base (float): The interval derived from the signal features, before it is scaled to the request capacity.
         minimum (int): The minimum allowed value for the interval.
         maximum (int): The maximum allowed value for the interval.
 
@@ -103,6 +105,7 @@ class Interval:
         """
         self._current = self.DEFAULT_INTERVAL
         self._last = self.DEFAULT_INTERVAL
+        self.base = self.DEFAULT_INTERVAL
         self.minimum = self.MIN_INTERVAL
         self.maximum = self.MAX_INTERVAL
 
@@ -126,12 +129,12 @@ class Interval:
     def update_current(self, value):
         self._last = self._current
 
-        if value < self._current:
+        # The new interval is derived from the base interval, the current one may be scaled by the scheduler
+        if value < self.base:
             value = round(value, 1)
         else:
             value = round(
-                self._current
-                + (1 - math.tanh(2.3 * (self._current / value))) * self._current,
+                self.base + (1 - math.tanh(2.3 * (self.base / value))) * self.base,
                 1,
             )
 
@@ -139,6 +142,7 @@ class Interval:
             value = self.minimum
         if value > self.maximum:
             value = self.maximum
+        self.base = value
         self.current = value
 
 
@@ -202,14 +206,8 @@ class DidRequest:
         update_interval(minimum_length): Updates the interval based on the payload history length.
         calculate_new_interval(): Calculates a new interval based on payload history features.
         get_feature_sum(): Calculates the sum of payload history features.
-        make_binary_list(request_history): Converts payload history to a list of binary numbers.
-        calculate_payload_history_features(payload_copy): Calculates various features from the payload history.
-        different_bits(payload_copy): Calculates the count of different bits between the saved payloads in the payload history.
-        calculate_entropy(payload_copy): Calculates the entropy from the payload history.
-        fourier_transform_history(payload_copy): Applies Fourier Transform to the payload history.
-        calculate_power_spectrum_density(): Calculates power spectrum density.
-        calculate_frequency_ratio(): Calculates frequency ratio.
-        calculate_dominant_frequency_components(): Calculates dominant frequency components.
+        calculate_payload_history_features(payload_copy): Calculates the changing bits, entropy, power spectrum density
+            and frequency ratio of the payload history with the feature engine.
         append_to_debug_history(new_interval): Appends debug information to the debug history.
         dump_debug_history(): Dumps debug history to a CSV file.
     """
@@ -383,96 +381,14 @@ class DidRequest:
         else:
             return 4
 
-    def make_binary_list(self, request_history):
-        binary_list = []
-        for bytelist in request_history:
-            bits = DidRequest.list_to_bits(bytelist[3:])
-            binary_list.append(bits)
-        return binary_list
-
     def calculate_payload_history_features(self, payload_copy):
-        self.different_bits(payload_copy)
-        self.calculate_entropy(payload_copy)
-        self.fourier_transform_history(payload_copy)
-        self.calculate_power_spectrum_density()
-        self.calculate_frequency_ratio()
-
-    def different_bits(self, payload_copy):
-        binary_list = self.make_binary_list(payload_copy)
-        total_different_bits = 0
-        for binary1, binary2 in zip(binary_list, binary_list[1:]):
-            for bit1, bit2 in zip(binary1, binary2):
-                if bit1 != bit2:
-                    total_different_bits += 1
-        self.history.changing_bits_count = math.tanh(total_different_bits)
-
-    def calculate_entropy(self, payload_copy):
-        binary_list = self.make_binary_list(payload_copy)
-
-        # Step 1: count the number of times each value appears in the sublist
-        if binary_list == []:
-            self.history.entropy = 0
-            return 0
-        counts = {}
-        for value in binary_list:
-            if value in counts:
-                counts[value] += 1
-            else:
-                counts[value] = 1
-        # Step 2: convert counts to probabilities
-        total_values = len(binary_list)
-        probabilities = {value: count / total_values for value, count in counts.items()}
-        # Step 3: calculate entropy
-        entropy = -sum(p * math.log2(p) for p in probabilities.values())
-        self.history.entropy = math.tanh(entropy)
-
-    def fourier_transform_history(self, payload_copy):
-        binary_list = self.make_binary_list(payload_copy)
-        concatenated_bit_string = "".join(binary_list)  # Concatenate all bit strings
-
-        # Convert the concatenated string to an array of integers
-        integer_array = np.array([int(bit) for bit in concatenated_bit_string])
-
-        # Perform the Fourier Transform
-        fourier_transform = np.fft.fft(integer_array)
-
-        # Calculate the power spectrum
-        power_spectrum = np.abs(fourier_transform) ** 2
-
-        self.history.fft_result = power_spectrum[1 : (len(power_spectrum) // 2)]
-
-    def calculate_power_spectrum_density(self):
-        # Calculate the total power as the sum of all squared magnitudes
-        power_spectrum_density = np.sum(np.abs(self.history.fft_result) ** 2)
-
-        self.history.power_spectrum_density = math.tanh(power_spectrum_density)
-
-    def calculate_frequency_ratio(self):
-        (
-            dominant_frequencies,
-            dominant_magnitudes,
-        ) = self.calculate_dominant_frequency_components()
-        # Sort the magnitudes in descending order
-        sorted_magnitudes = np.sort(dominant_magnitudes)[::-1]
-
-        # Calculate the ratio between the highest and second highest magnitudes
-        if sorted_magnitudes[1] == 0:
-            frequency_ratio = 0
-        else:
-            frequency_ratio = sorted_magnitudes[0] / sorted_magnitudes[1]
-
-        self.history.frequency_ratio = math.tanh(frequency_ratio)
-
-    def calculate_dominant_frequency_components(self):
-        # Find the indices of the highest magnitude peaks
-        frequency_bins = np.arange(len(self.history.fft_result))
-        sorted_indices = np.argsort(np.abs(self.history.fft_result))[::-1]
-
-        # Extract the corresponding frequencies and magnitudes
-        dominant_frequencies = frequency_bins[sorted_indices[:2]]
-        dominant_magnitudes = np.abs(self.history.fft_result[sorted_indices[:2]])
-
-        return dominant_frequencies, dominant_magnitudes
+        # The first three bytes of the responses are the SID and the DID
+        features = history_features(*stack_histories([payload_copy], skip=3))
+        self.history.changing_bits_count = math.tanh(features.changed_bits[0])
+        self.history.entropy = math.tanh(features.entropy[0])
+        self.history.fft_result = features.spectra[0]
+        self.history.power_spectrum_density = math.tanh(features.power_spectrum_density[0])
+        self.history.frequency_ratio = math.tanh(features.frequency_ratio[0])
 
     def append_to_debug_history(self, new_interval):
         self.debug_history = self.debug_history + [
@@ -880,6 +796,7 @@ class DidRequestDatabase:
                     request.history.payload_list = json.loads(row[3])
                     request.history.timestamp_list = json.loads(row[4])
                     request.interval._current = row[5]
+                    request.interval.base = row[5]
                     request.exec_time = row[6]
                     did_requests.append(request)
             elif has_interval and has_json_history_payload and want_payload_history:
@@ -891,6 +808,7 @@ class DidRequestDatabase:
                     request = DidRequest(*row[:3])
                     request.history.payload_list = json.loads(row[3])
                     request.interval._current = row[4]
+                    request.interval.base = row[4]
                     request.exec_time = row[5]
                     did_requests.append(request)
             elif has_json_history_payload and want_payload_history:
@@ -5,7 +5,7 @@ Classes:
     - DidPayloadHistory: Represents the payload history associated with a DID request.
     - Interval: Represents a time interval associated with a DID request.
     - RequestID: A class representing the identification of a request.
-    - DoIPConnector: A class representing a DoIP connector, which handels the connection to the DoIP server.
+    - DoIPConnector: A class representing a DoIP connector, which hands out the UDS clients of the shared DoIP session.
     - DoIPDidRequest: Represents a data structure for a DID request, including server ID, tester ID, DID, and associated information.
     - RequestList: Manages a list of DidRequest objects, reads DIDs from CSV files, and populates the request list.
     - DidRequestDatabase: Represents a database interface for storing and retrieving DidRequest objects.
@@ -23,8 +23,16 @@ import pandas as pd
 from collections import deque
 from utils.doipclient import DoIPClient
 from utils.doipclient.connectors import DoIPClientUDSConnector
-from utils.udsoncan.client import Client as UDSClient
 from utils.network_actions import NetworkActions
+from revcan.signal_discovery.doip_session_pool import connection_manager
+from revcan.signal_discovery.debug_log import DebugLog
+from revcan.signal_discovery.request_packing import split_response_data
+from revcan.signal_discovery.feature_engine import (
+    HistoryFeatures,
+    PayloadFeatureEngine,
+    history_features,
+    stack_histories,
+)
 
 
 class DidPayloadHistory:
@@ -36,10 +44,14 @@ class DidPayloadHistory:
         timestamp_list (deque): A deque to store the corresponding timestamps.
         changing_bits_count (int): Count of changing bits in the payload history.
         entropy (int): Entropy value calculated from the payload history.
+        feature_engine (PayloadFeatureEngine): Shared ring buffer the payloads are also stored in, or None.
+        feature_index (int): Index of the history in the feature engine.
 
     Methods:
         __init__(self): Initializes an instance of the DidPayloadHistory class.
         __str__(self): Returns a string representation of the payload history.
+        append(payload, timestamp): Appends a payload and its timestamp to the history.
+        attach(feature_engine): Stores the history in a shared feature engine.
     """
 
     HISTORY_MAX_LEN = 20
@@ -52,6 +64,8 @@ class DidPayloadHistory:
         self.timestamp_list = deque(maxlen=self.HISTORY_MAX_LEN)
         self.changing_bits_count: float = 0
         self.entropy: float = 0
+        self.feature_engine: PayloadFeatureEngine = None
+        self.feature_index: int = None
 
     def __str__(self):
         """
@@ -72,6 +86,27 @@ class DidPayloadHistory:
         #     output += hex_str + "\n"
         return output
 
+    def append(self, payload, timestamp: float = None):
+        """
+        Append a payload to the history, and to the feature engine if the history is attached to one.
+
+        :param payload: The payload.
+        :param timestamp: Time the payload was received, None for now.
+        """
+        self.payload_list.append(payload)
+        self.timestamp_list.append(time.time() if timestamp is None else timestamp)
+        if self.feature_engine is not None:
+            self.feature_engine.append(self.feature_index, payload)
+
+    def attach(self, feature_engine: PayloadFeatureEngine):
+        """
+        Store the history in a shared feature engine; the payloads appended afterwards are stored in both.
+
+        :param feature_engine: The feature engine.
+        """
+        self.feature_engine = feature_engine
+        self.feature_index = feature_engine.add(self.payload_list)
+
 
 class Interval:
     """
@@ -80,6 +115,7 @@ class Interval:
     Attributes:
         _current (int): The current value of the interval.
         _last (int): The last value of the interval.
+        base (float): The interval derived from the signal features, before it is scaled to the request capacity.
         minimum (int): The minimum allowed value for the interval.
         maximum (int): The maximum allowed value for the interval.
 
@@ -101,6 +137,7 @@ class Interval:
         """
         self._current = self.DEFAULT_INTERVAL
         self._last = self.DEFAULT_INTERVAL
+        self.base = self.DEFAULT_INTERVAL
         self.minimum = self.MIN_INTERVAL
         self.maximum = self.MAX_INTERVAL
 
@@ -161,25 +198,26 @@ class RequestID:
 
 class DoIPConnector:
     """
-    A class representing a DoIP connector
+    A class representing a DoIP connector, which hands out the UDS clients of the shared DoIP session of the
+    gateway and tester address (see doip_session_pool.DoIPConnectionManager).
     Attributes:
         ip_address (str): The IP address of the DoIP server.
         initial_server_id (int): The initial server ID for the client.
-        client_logical_address (int): The logical address of the client.
         client_ip_address (str): The IP address of the client.
-        conn (DoIPClientUDSConnector): The DoIP client UDS connector.
-        client (Client): The UDS client.
+        conn (DoIPClientUDSConnector): The DoIP client UDS connector of the shared session.
+        doip_client (DoIPClient): The DoIP client of the shared session.
     Methods:
-        __init__(self, ip_address, initial_server_id, client_logical_address, client_ip_address): Initializes a new instance of the DoIPConnector class.
-        __initiate_DoIP_client(cls): Initiates a new instance of the DoIP client.
-        get_client(self, server_id): Returns a new instance of the UDS client with the given server ID.
+        __init__(self, network_actions): Initializes the connection parameters of the DoIPConnector class.
+        initiate_DoIP_client(cls, tester_id): Opens the shared session of the tester.
+        get_doip_client(cls, tester_id): Returns the DoIP client of the shared session.
+        get_session(cls, tester_id): Returns the shared session.
+        get_client(cls, server_id, tester_id): Returns the cached UDS client of the server.
     """
 
     ip_address: str
     initial_server_id: int
     client_ip_address: str
     conn: DoIPClientUDSConnector
-    client: UDSClient
     doip_client: DoIPClient
 
     _initialized: bool = (
@@ -201,38 +239,40 @@ class DoIPConnector:
                 cls.client_ip_address = NetworkActions.ip_address_client
 
     @classmethod
-    def initiate_DoIP_client(cls, tester_id: int):
-        cls.doip_client = DoIPClient(
+    def _session(cls, tester_id: int):
+        # Opened on first use and re-connected if the gateway closed it
+        session = connection_manager.shared_session(
             cls.ip_address,
-            cls.initial_server_id,
-            client_logical_address=tester_id,
+            tester_id,
+            server_id=cls.initial_server_id,
             client_ip_address=cls.client_ip_address,
-            auto_reconnect_tcp=False,
         )
-        cls.conn = DoIPClientUDSConnector(cls.doip_client)
+        cls.doip_client = session.doip_client
+        cls.conn = session.conn
         cls._initialized = True
+        return session
+
+    @classmethod
+    def initiate_DoIP_client(cls, tester_id: int):
+        cls._session(tester_id)
 
     @classmethod
     def get_doip_client(cls, tester_id: int):
-        if not cls._initialized:
-            cls.initiate_DoIP_client(tester_id)
-        return cls.doip_client
+        return cls._session(tester_id).doip_client
+
+    @classmethod
+    def get_session(cls, tester_id: int):
+        return cls._session(tester_id)
 
     @classmethod
     def get_client(cls, server_id: int, tester_id: int):
         """
-        Returns a new instance of the UDS client with the given server ID.
+        Returns the UDS client with the given server ID. Clients are cached per server, so this is cheap enough
+        to be called for every request.
         param server_id: The server ID for the client.
-        return: A new instance of the UDS client.
+        return: The UDS client.
         """
-        if not cls._initialized:
-            cls.initiate_DoIP_client(tester_id)
-
-        if cls._initialized:
-            return UDSClient(cls.conn, ecu_logical_address=server_id)
-        else:
-            cls.initiate_DoIP_client(tester_id)
-            return UDSClient(cls.conn, ecu_logical_address=server_id)
+        return cls._session(tester_id).get_client(server_id)
 
 
 class DoIPDidRequest:
@@ -246,7 +286,7 @@ class DoIPDidRequest:
         exec_time (float): Execution time for the request.
         execution_duration (float): Duration of the execution.
         blacklisted (bool): Indicates if the request is blacklisted.
-        debug_history (list): A list to store debug information.
+        debug_history (DebugLog): Append-only log of the debug information.
 
     Methods:
         __init__(self, request_id, response_id, did): Initializes a new instance of the DidRequest class.
@@ -254,19 +294,14 @@ class DoIPDidRequest:
         list_to_bits(lst): Converts a list of integers to a binary number.
         is_positive_response(response): Returns a bool indicating whether the response is positive.
         get_value(wait_window): Sends a read data by identifier (DID) message and returns the response value.
+        get_values(requests, timeout): Reads several DIDs of the same server with one read data by identifier message.
         get_rnd_value(): Generates a random response value.
         make_unique_ID(): Creates a unique ID for the request.
         update_interval(minimum_length): Updates the interval based on the payload history length.
         calculate_new_interval(): Calculates a new interval based on payload history features.
         get_feature_sum(): Calculates the sum of payload history features.
-        make_binary_list(request_history): Converts payload history to a list of binary numbers.
-        calculate_payload_history_features(payload_copy): Calculates various features from the payload history.
-        different_bits(payload_copy): Calculates the count of different bits between the saved payloads in the payload history.
-        calculate_entropy(payload_copy): Calculates the entropy from the payload history.
-        fourier_transform_history(payload_copy): Applies Fourier Transform to the payload history.
-        calculate_power_spectrum_density(): Calculates power spectrum density.
-        calculate_frequency_ratio(): Calculates frequency ratio.
-        calculate_dominant_frequency_components(): Calculates dominant frequency components.
+        calculate_payload_history_features(payload_copy): Calculates the changing bits and the entropy of the payload history.
+        set_signal_features(features, position): Stores the features calculated by the feature engine.
         append_to_debug_history(new_interval): Appends debug information to the debug history.
         dump_debug_history(): Dumps debug history to a CSV file.
     """
@@ -291,16 +326,7 @@ class DoIPDidRequest:
         self.execution_duration = 0.03
         self.blacklisted = False
         self.feature_sum = 0
-        self.debug_history = [
-            [
-                "timestamps",
-                "payloads",
-                "bits",
-                "entropy",
-                "blacklisted",
-                "execution duration",
-            ]
-        ]
+        self.debug_history = DebugLog()
 
     def __str__(self):
         """
@@ -346,8 +372,7 @@ class DoIPDidRequest:
 
         if response and response.positive:
             self.blacklisted = False
-            self.history.payload_list.append(list(response.data[2:]))
-            self.history.timestamp_list.append(time.time())
+            self.history.append(list(response.data[2:]))
             self.exec_time = time.time()
             return list(response.data[2:]), self.exec_time, self.make_unique_ID()
 
@@ -355,23 +380,61 @@ class DoIPDidRequest:
             self.blacklisted = True
             # If there was a negative response, append it to the payload history
             if response:
-                self.history.payload_list.append(response.data)
-                self.history.timestamp_list.append(time.time())
+                self.history.append(response.data)
             self.exec_time = time.time()
             response = None
             return response, self.exec_time, self.make_unique_ID()
 
+    @staticmethod
+    def get_values(requests: list["DoIPDidRequest"], timeout):
+        """
+        Send one read data by identifier message for several DIDs of the same server and split the response
+        using the known payload length of every DID.
+
+        :param requests: the requests of one server, in the order of the DIDs in the message
+        :param timeout: time to wait for the response
+        :return: the response and the result of every request as returned by `get_value`; the results are `None`
+            if the response was not positive or could not be split
+
+        Not used in parallel requesting
+        """
+        client = DoIPConnector.get_client(requests[0].ids.server_id, requests[0].ids.tester_id)
+        start_time = time.time()
+        response = client.read_data_by_identifier(
+            [request.ids.did for request in requests], timeout
+        )
+        execution_duration = (time.time() - start_time) / len(requests)
+
+        if not (response and response.positive and response.data is not None):
+            return response, None
+
+        values = split_response_data(
+            response.data,
+            [request.ids.did for request in requests],
+            [request.ids.payload_length for request in requests],
+        )
+        if values is None or len(values) != len(requests):
+            return response, None
+        values = [list(values[request.ids.did]) for request in requests]
+
+        results = []
+        for request, value in zip(requests, values):
+            request.execution_duration = execution_duration
+            request.blacklisted = False
+            request.history.append(value)
+            request.exec_time = time.time()
+            results.append((value, request.exec_time, request.make_unique_ID()))
+        return response, results
+
     def update_values(self, data):
-        self.history.payload_list.append(data)
-        self.history.timestamp_list.append(time.time())
+        self.history.append(data)
         self.calculate_signal_feature()
 
     def enter_values(self, data):
         """
         same as update_values but without updating the interval
         """
-        self.history.payload_list.append(data)
-        self.history.timestamp_list.append(time.time())
+        self.history.append(data)
 
     def get_rnd_value(self):
         # self.history.payload_list.append(random.randbytes(8))
@@ -385,8 +448,7 @@ class DoIPDidRequest:
         if random.randint(0, 10) == 0:
             response = None
         if response:
-            self.history.payload_list.append(response)
-            self.history.timestamp_list.append(time.time())
+            self.history.append(response)
         self.exec_time = time.time()
         return response, self.exec_time, self.make_unique_ID()
 
@@ -404,69 +466,39 @@ class DoIPDidRequest:
         feature_sum = self.history.changing_bits_count + self.history.entropy
         return feature_sum
 
-    def make_binary_list(self, request_history):
-        binary_list = []
-        for bytelist in request_history:
-            bits = DoIPDidRequest.list_to_bits(bytelist)
-            binary_list.append(bits)
-        return binary_list
-
     def calculate_payload_history_features(self, payload_copy):
-        binary_list = self.make_binary_list(payload_copy)
-        if len(binary_list) > 1:
-            self.different_bits(binary_list)
-            self.calculate_entropy(binary_list)
-
-    def different_bits(self, binary_list):
-        try:
-            different_bits_list = []
-            total_different_bits = 0
-            for binary1, binary2 in zip(binary_list, binary_list[1:]):
-                for bit1, bit2 in zip(binary1, binary2):
-                    if bit1 != bit2:
-                        total_different_bits += 1
-                different_bits_list.append(total_different_bits)
-
-            average_different_bits = total_different_bits / (len(binary_list) - 1)
-            self.history.changing_bits_count = round(
-                (average_different_bits / len(binary_list[0])), 3
-            )
-        except ZeroDivisionError:
-            self.history.changing_bits_count = 0
-
-    def calculate_entropy(self, binary_list):
-        # Step 1: count the number of times each value appears in the sublist
-        if binary_list == []:
-            self.history.entropy = 0
-            return 0
-        counts = {}
-        for value in binary_list:
-            value_str = str(value)  # Convert the list to a string to make it hashable
-            if value_str in counts:
-                counts[value_str] += 1
-            else:
-                counts[value_str] = 1
-        # Step 2: convert counts to probabilities
-        total_values = len(binary_list)
-        probabilities = {value: count / total_values for value, count in counts.items()}
-        # Step 3: calculate entropy
-        entropy = sum(p * math.log2(1 / p) for p in probabilities.values())
-        self.history.entropy = round((entropy / math.log2(len(binary_list))), 3)
-
-    def append_to_debug_history(self):
-        self.debug_history = self.debug_history + [
-            [
-                self.history.timestamp_list,
-                self.history.payload_list,
-                self.history.changing_bits_count,
-                self.history.entropy,
-                self.blacklisted,
-                self.execution_duration,
-            ]
-        ]
+        features = history_features(*stack_histories([payload_copy]), spectrum=False)
+        if features.sample_count[0] > 1:
+            self.set_signal_features(features, 0)
+
+    def set_signal_features(self, features: HistoryFeatures, position: int):
+        """
+        Store the features of the payload history calculated by the feature engine.
+
+        :param features: Features of several payload histories.
+        :param position: Position of the history of this request in the features.
+        """
+        # Average share of the bits changing between two payloads and entropy divided by its maximum
+        self.history.changing_bits_count = round(float(features.changing_bit_rate()[position]), 3)
+        self.history.entropy = round(float(features.normalized_entropy()[position]), 3)
+
+    def append_to_debug_history(self, new_interval=None):
+        """
+        Append the current features of the request to the debug history.
+
+        :param new_interval: The new interval of the request, the current interval if None.
+        """
+        self.debug_history.append(
+            timestamp=time.time(),
+            interval=self.interval._current if new_interval is None else new_interval,
+            bits=self.history.changing_bits_count,
+            entropy=self.history.entropy,
+            blacklisted=self.blacklisted,
+            execution_duration=self.execution_duration,
+        )
 
     def dump_debug_history(self, directory: str):
-        df = pd.DataFrame(self.debug_history[1:], columns=self.debug_history[0])
+        df = self.debug_history.to_frame()
         path = os.path.join(
             directory
             + "/{}_{}_debug_history_dump.csv".format(
@@ -491,6 +523,8 @@ class RequestList:
         count (int): Total number of requests.
         count_blacklisted (int): Number of blacklisted requests.
         count_not_blacklisted (int): Number of non-blacklisted requests.
+        feature_engine (PayloadFeatureEngine): Payload histories of the requests for the batched signal features.
+        table (RequestTable): Columns of the requests loaded from database files, the requests are views of its rows.
 
     Methods:
         __init__(self): Initializes a new instance of the DidList class.
@@ -503,6 +537,8 @@ class RequestList:
         fill_request_list_from_database_files(absolute_directory_path, want_payload_history): Fills request list from multiple database files.
         count_requests(print_info): Counts the number of requests and blacklisted requests.
         create_did_obj(request_id, response_id, did): Creates a new DidRequest object.
+        attach_feature_engine(): Stores the payload histories of the requests in a shared feature engine.
+        calculate_signal_features(): Calculates the signal features of all requests in one batch.
     """
 
     def __init__(self):
@@ -514,6 +550,9 @@ class RequestList:
         self.count = 0
         self.count_blacklisted = 0
         self.count_not_blacklisted = 0
+        self.feature_engine: PayloadFeatureEngine = None
+        self._feature_requests: list[DoIPDidRequest] = []  # request of every history of the feature engine
+        self.table = None
 
     def __iter__(self):
         """
@@ -603,24 +642,28 @@ class RequestList:
             for did in dids:
                 self.request_list.append(self.create_did_obj(server_id, tester_id, did))
 
+    def _request_table(self):
+        # The table is imported here, as its views are based on the classes of this module
+        if self.table is None:
+            from revcan.signal_discovery.request_table import RequestTable
+
+            self.table = RequestTable()
+        return self.table
+
     def fill_request_list_from_single_database_file(
         self, database_file_path, want_payload_history: bool
     ):
-        loaded_requests: list[DoIPDidRequest]
-        count_duplicates = 0
-        added_requests = set()
-        with DidRequestDatabase(database_file_path) as db:
-            loaded_requests = db.load_list(want_payload_history)
-            for request in loaded_requests:
-                if (
-                    hex(request.ids.server_id) + hex(request.ids.did)
-                ) not in added_requests:
-                    self.request_list.append(request)
-                    added_requests.add(
-                        hex(request.ids.server_id) + hex(request.ids.did)
-                    )
-                else:
-                    count_duplicates += 1
+        """
+        Fill the request list with the requests stored in a DID database file. The requests are stored in the
+        RequestTable of the list and added as views of its rows; requests already in the table are skipped.
+
+        :param database_file_path: The path of the database file.
+        :param want_payload_history: Whether to load the payload history of the requests.
+        """
+        table = self._request_table()
+        first_row = len(table)
+        count_duplicates = table.load_database(database_file_path, want_payload_history)
+        self.request_list.extend(table.views(first_row))
         print(f"Counted {count_duplicates} duplicates.")
 
     def fill_request_list_from_database_files(
@@ -628,6 +671,8 @@ class RequestList:
     ):
         """
         Fill the request list of the instance with the requests stored in the DID database files located in the specified directory.
+        The requests are stored in the RequestTable of the list and added as views of its rows; a request stored in
+        several files (same server ID and DID) is only added once.
 
         Args:
             absolute_directory_path (str): The absolute path of the directory containing the DID database files.
@@ -644,7 +689,6 @@ class RequestList:
             request_list.fill_request_list_from_database_files(absolute_directory_path)
             ```
         """
-        loaded_requests: list[DoIPDidRequest]
         # Get the list of files in the DID directory
         files = (
             file
@@ -652,22 +696,13 @@ class RequestList:
             if os.path.isfile(os.path.join(absolute_directory_path, file))
             and file.endswith(".db")
         )
+        table = self._request_table()
+        first_row = len(table)
         count_duplicates = 0
-        added_requests = set()
         for file in files:
             database_file_path = os.path.join(absolute_directory_path, file)
-            with DidRequestDatabase(database_file_path) as db:
-                loaded_requests = db.load_list(want_payload_history)
-                for request in loaded_requests:
-                    if (
-                        hex(request.ids.server_id) + hex(request.ids.did)
-                    ) not in added_requests:
-                        self.request_list.append(request)
-                        added_requests.add(
-                            hex(request.ids.server_id) + hex(request.ids.did)
-                        )
-                    else:
-                        count_duplicates += 1
+            count_duplicates += table.load_database(database_file_path, want_payload_history)
+        self.request_list.extend(table.views(first_row))
         print(f"Counted {count_duplicates} duplicates.")
         # self.interval.minimum = len(self.request_list) * 0.025
 
@@ -700,6 +735,42 @@ class RequestList:
         did_obj = DoIPDidRequest(request_id, response_id, did)
         return did_obj
 
+    def attach_feature_engine(self):
+        """
+        Store the payload histories of the requests in a shared PayloadFeatureEngine, so that their signal features
+        can be calculated in one batch. Requests added to the list later are attached by the next call.
+        The histories of the views of a RequestTable are already stored in the feature engine of the table.
+        """
+        if self.table is not None:
+            self.feature_engine = self.table.feature_engine
+            return
+        if self.feature_engine is None:
+            self.feature_engine = PayloadFeatureEngine(DidPayloadHistory.HISTORY_MAX_LEN)
+        for request in self.request_list:
+            if request.history.feature_engine is not self.feature_engine:
+                request.history.attach(self.feature_engine)
+                self._feature_requests.append(request)
+
+    def calculate_signal_features(self):
+        """
+        Calculate the signal features of all requests like DoIPDidRequest.calculate_signal_feature, but in one batch
+        for the requests whose payload history changed since the last call.
+        """
+        if self.table is not None:
+            self.table.calculate_signal_features()
+            return
+        self.attach_feature_engine()
+        indices, features = self.feature_engine.refresh()
+        changing_bit_rates = features.changing_bit_rate().tolist()
+        entropies = features.normalized_entropy().tolist()
+        for position, (index, sample_count) in enumerate(zip(indices.tolist(), features.sample_count.tolist())):
+            if sample_count > 2:
+                request = self._feature_requests[index]
+                request.history.changing_bits_count = round(changing_bit_rates[position], 3)
+                request.history.entropy = round(entropies[position], 3)
+                request.feature_sum = request.get_feature_sum()
+                request.append_to_debug_history()
+
 
 class DidRequestDatabase:
     """
@@ -715,6 +786,7 @@ class DidRequestDatabase:
         __exit__(self, exc_type, exc_value, traceback): Closes the database connection when the context exits.
         reset_database(self): Resets the database by dropping the table.
         store_list(self, did_requests): Stores a list of DidRequest objects in the database.
+        load_rows(self, want_payload_history): Retrieves the stored requests as tuples.
         load_list(self): Retrieves a list of DidRequest objects from the database.
         export_db_as_csv(self): Exports the database to CSV files.
     """
@@ -873,102 +945,78 @@ class DidRequestDatabase:
                         ),
                     )
 
-    def load_list(self, want_payload_history: bool):
+    def load_rows(self, want_payload_history: bool):
         """
-        Retrieves a list of `DidRequest` objects from the database.
+        Retrieves the stored requests from the database without creating `DidRequest` objects.
 
-        :param want_payload_history: Whether to include payload history in the loaded objects.
+        :param want_payload_history: Whether to include the payload history.
         :type want_payload_history: bool
-        :return: A list of `DidRequest` objects retrieved from the database.
-        :rtype: list
+        :return: Tuples (server_id, tester_id, did, payload history, timestamp history, current interval,
+            execution time); values which are not stored in the database (or not wanted) are None.
+        :rtype: generator
         """
         with self.conn:
-            # Check if the did_requests table exists in the database
+            # Check which columns exist in the did_requests table
             cursor = self.conn.execute(f"PRAGMA table_info(did_requests)")
-
-            # iterate over the rows in the cursor and check if the column name matches "json_history_payload"
             column_names = [row[1] for row in cursor]
-            if "json_history_payload" in column_names:
-                # print("The json_history_payload column exists in the table.")
-                has_json_history_payload = True
-            else:
-                # print("The json_history_payload column does not exist in the table.")
-                has_json_history_payload = False
-
-            if "json_history_timestamp" in column_names:
-                # print("The json_history_timestamp column exists in the table.")
-                has_json_history_timestamp = True
-            else:
-                # print("The json_history_timestamp column does not exist in the table.")
-                has_json_history_timestamp = False
-
-            if "interval_current" in column_names:
-                # print("The interval_current column exists in the table.")
-                has_interval = True
-            else:
-                # print("The interval_current column does not exist in the table.")
-                has_interval = False
-
-            if (
-                has_interval
-                and has_json_history_payload
-                and has_json_history_timestamp
-                and want_payload_history
-            ):
-                cursor = self.conn.execute(
-                    "SELECT server_id, tester_id, did, json_history_payload, json_history_timestamp, interval_current, exec_time FROM did_requests"
-                )
-                did_requests = []
-                for row in cursor:
-                    json_history_payload = json.loads(row[3])
-                    request = DoIPDidRequest(
-                        row[0], row[1], row[2], json_history_payload[0]
-                    )
-                    request.history.payload_list = json.loads(row[3])
-                    request.history.timestamp_list = json.loads(row[4])
-                    request.interval._current = row[5]
-                    request.exec_time = row[6]
-                    did_requests.append(request)
-            elif has_interval and has_json_history_payload and want_payload_history:
-                cursor = self.conn.execute(
-                    "SELECT server_id, tester_id, did, json_history_payload, interval_current, exec_time FROM did_requests"
-                )
-                did_requests = []
-                for row in cursor:
-                    json_history_payload = json.loads(row[3])
-                    request = DoIPDidRequest(
-                        row[0], row[1], row[2], json_history_payload[0]
-                    )
-                    request.history.payload_list = json.loads(row[3])
-                    request.interval._current = row[4]
-                    request.exec_time = row[5]
-                    did_requests.append(request)
-            elif has_json_history_payload and want_payload_history:
-                cursor = self.conn.execute(
-                    "SELECT server_id, tester_id, did, json_history_payload FROM did_requests"
-                )
-                did_requests = []
-                for row in cursor:
-                    json_history_payload = json.loads(row[3])
-                    request = DoIPDidRequest(
-                        row[0], row[1], row[2], json_history_payload
-                    )
-                    request.history.payload_list = json.loads(row[3])
-                    did_requests.append(request)
-            else:
-                cursor = self.conn.execute(
-                    "SELECT server_id, tester_id, did FROM did_requests"
+            has_json_history_payload = "json_history_payload" in column_names
+            has_json_history_timestamp = "json_history_timestamp" in column_names
+            has_interval = "interval_current" in column_names
+
+            columns = ["server_id", "tester_id", "did"]
+            if has_json_history_payload and want_payload_history:
+                columns.append("json_history_payload")
+                if has_interval:
+                    if has_json_history_timestamp:
+                        columns.append("json_history_timestamp")
+                    columns += ["interval_current", "exec_time"]
+            cursor = self.conn.execute(f"SELECT {', '.join(columns)} FROM did_requests")
+            for row in cursor:
+                values = dict(zip(columns, row))
+                payloads = values.get("json_history_payload")
+                timestamps = values.get("json_history_timestamp")
+                yield (
+                    values["server_id"],
+                    values["tester_id"],
+                    values["did"],
+                    json.loads(payloads) if payloads is not None else None,
+                    json.loads(timestamps) if timestamps is not None else None,
+                    values.get("interval_current"),
+                    values.get("exec_time"),
                 )
-                did_requests = []
-                for row in cursor:
-                    request = DoIPDidRequest(
-                        row[0],
-                        row[1],
-                        row[2],
-                    )
-                    did_requests.append(request)
 
-            return did_requests
+    def load_list(self, want_payload_history: bool):
+        """
+        Retrieves a list of `DidRequest` objects from the database.
+
+        :param want_payload_history: Whether to include payload history in the loaded objects.
+        :type want_payload_history: bool
+        :return: A list of `DidRequest` objects retrieved from the database.
+        :rtype: list
+        """
+        did_requests = []
+        for (
+            server_id,
+            tester_id,
+            did,
+            payloads,
+            timestamps,
+            interval_current,
+            exec_time,
+        ) in self.load_rows(want_payload_history):
+            # The payload length of the request is the length of its first stored payload
+            request = DoIPDidRequest(server_id, tester_id, did, payloads[0] if payloads else [])
+            if payloads is not None:
+                request.history.payload_list = payloads
+            if timestamps is not None:
+                request.history.timestamp_list = timestamps
+            if interval_current is not None:
+                request.interval._current = interval_current
+                request.interval.base = interval_current
+            if exec_time is not None:
+                request.exec_time = exec_time
+            did_requests.append(request)
+        return did_requests
 
     def export_db_as_csv(self):
         """
@@ -11,6 +11,9 @@ from revcan.signal_discovery.doip_dids import (
     DoIPConnector,
 )
 
+from revcan.signal_discovery.deadline_queue import DeadlineQueue, RequestBuffer
+from revcan.signal_discovery.interval_allocation import IntervalAllocator
+from revcan.signal_discovery.request_packing import RequestPackingPlanner
 from utils.network_actions import NetworkActions
 import revcan.signal_discovery.utils.misc_methods as misc
 import threading
@@ -29,8 +32,9 @@ class Scheduler:
     Attributes:
     - request_list: A list of requests to be scheduled.
     - subset_lists: A list of subsets of the requests in case there are too many requests to be processed at once.
-    - buffer_list: A buffer for holding requests before execution.
-    - added_to_buffer: A set to track unique IDs of requests added to the buffer.
+    - buffer_list: A buffer for holding the handles of due requests before execution, grouped by server.
+    - deadline_queue: The requests of the current subset, ordered by the time they are due next.
+    - interval_allocator: Allocates the intervals of the current subset under the request capacity.
     - theoretical_loop_time: The estimated time it takes to loop through the list of requests.
     - average_request_time: The average time taken by a request.
     - script_directory: The directory of the script containing this class.
@@ -46,6 +50,7 @@ class Scheduler:
     - remaining_time: Remaining time for the initial request process.
     - iteration_counter: Counter for scheduling iterations.
     - subset_payload_for_csv: Payload list for CSV during debugging in random mode.
+    - packing_planner: Packs the DIDs of a server into read data by identifier requests.
 
     Methods:
     - __init__: Initializes the Scheduler instance.
@@ -53,14 +58,18 @@ class Scheduler:
     - load_requests: Loads requests from a specified path.
     - save_data: Saves the request data to a database and optionally exports as CSV.
     - request_all: Executes requests for the entire request list once.
+    - read_pack: Reads the requests of a pack, several DIDs with a single request if possible.
     - populate_history: Populates the history of requests using the request_all method.
     - check_if_subsets_necessary: Checks if subsets are necessary based on request count.
     - split_request_list: Splits the request list into subsets if necessary.
     - start: Starts the scheduling process with options for subsets and iterations.
+    - create_deadline_queue: Schedules the requests of a subset.
+    - reschedule: Schedules a request for the end of its current interval.
+    - rebalance_interval: Updates the interval allocation after the interval of a request changed.
     - update: Updates buffer_list during execution by comparing, when a request was executed last.
-    - add_requests_to_buffer: Adds requests to the buffer if certain conditions are met.
+    - add_requests_to_buffer: Adds the due requests to the buffer.
     - append_debug_history: Appends debug information of the request to the debug history.
-    - adjust_for_max_requests: Adjusts intervals to meet max requests requirement.
+    - adjust_for_max_requests: Scales the intervals to meet the max requests requirement.
     - calculate_send_count: Calculates the number of requests that could be sent during the average loop time.
     - request: Main method for executing requests in a separate thread.
     - append_to_output_csv: Appends results to the output CSV file.
@@ -73,13 +82,14 @@ class Scheduler:
 
         self.request_list: RequestList = RequestList()
         self.subset_lists: list[RequestList] = []
-        self.buffer_list: list[DoIPDidRequest] = []
+        self.buffer_list: RequestBuffer = RequestBuffer()
+        self.deadline_queue: DeadlineQueue = None
+        self.interval_allocator: IntervalAllocator = None
         self.connection = NetworkActions(
             interface
         )  # initiates a connection to the vehicle using the ethernet interface of the computer
         if interface != "test":
             self.doip_connector: DoIPConnector = DoIPConnector()
-        self.added_to_buffer = set()
         self.theoretical_loop_time: int
         self.average_request_time: float = 0
         self.script_directory = os.path.dirname(__file__)
@@ -97,6 +107,7 @@ class Scheduler:
         self.subset_payload_for_csv = (
             []
         )  # Explanation: while Debugging the GUI in the random-Mode at some point during the Recording the csv.-file couldnt be writen to anymor (Errno 13: Permission denied), after long testing the bug couldn't be found so the GUI first saves the Recording Data to the list, which is then writen to the csv.-file
+        self.packing_planner = RequestPackingPlanner()  # one DID per request
 
         # Preparations for threads
         self.request_thread = threading.Thread(target=self.request)
@@ -182,16 +193,19 @@ class Scheduler:
         """
 
         elapsed_time = []
-        for i, request in enumerate(self.request_list.request_list):
+        packs = self.packing_planner.plan(
+            self.request_list.request_list,
+            lambda request: request.ids.server_id,
+            lambda request: request.ids.payload_length,
+        )
+        left = len(self.request_list.request_list)
+        for pack in packs:
             start = time.time()
-            if self.random:
-                request.get_rnd_value()
-            else:
-                request.get_value(self.wait_window_request)
+            self.read_pack(pack)
             elapsed = time.time() - start
             elapsed_time.append(elapsed)
+            left -= len(pack)
             self.average = round(sum(elapsed_time) / len(elapsed_time), 3)
-            left = len(self.request_list.request_list) - i
             target_time = time.time() + (self.average * left)
             self.remaining_time = int(target_time - time.time())
             target_time = time.strftime("%T", time.localtime(target_time))
@@ -201,6 +215,33 @@ class Scheduler:
                 end="",
             )
 
+    def read_pack(self, pack: list[DoIPDidRequest]):
+        """
+        Reads the requests of a pack, several DIDs of the same server with a single request if possible.
+        If the response can not be split, the requests are read one by one; if the server rejects the pack
+        as too large, the limits of the packing planner are tightened.
+
+        :param pack: The requests of one server.
+        :type pack: list[DoIPDidRequest]
+
+        :return: The response, execution time and unique ID of every request.
+        :rtype: list[tuple]
+        """
+
+        if self.random:
+            return [request.get_rnd_value() for request in pack]
+        if len(pack) > 1:
+            response, results = DoIPDidRequest.get_values(pack, self.wait_window_request)
+            if results is not None:
+                return results
+            if response is not None and not response.positive:
+                self.packing_planner.report_negative_response(
+                    pack[0].ids.server_id,
+                    [request.ids.payload_length for request in pack],
+                    response.code,
+                )
+        return [request.get_value(self.wait_window_request) for request in pack]
+
     def populate_history(
         self,
         interval_maximum,
@@ -210,6 +251,8 @@ class Scheduler:
         random=True,
         save_dids_list_pickle=False,
         GUI_mode=False,
+        dids_in_request=1,
+        performance_list=None,
     ):
         """
         Populates the history of requests using the request_all method.
@@ -234,9 +277,18 @@ class Scheduler:
 
         :param GUI_mode: Flag for GUI mode.
         :type GUI_mode: bool
+
+        :param dids_in_request: The maximum number of DIDs in a request of servers which are not in the performance list.
+        :type dids_in_request: int
+
+        :param performance_list: The path to the performance list of check_dids_performance_automatic.
+        :type performance_list: str
         """
 
         self.GUI_mode = GUI_mode
+        self.packing_planner = RequestPackingPlanner.from_performance_list(
+            performance_list, dids_in_request
+        )
         elapsed_time_list = []
         self.iteration_counter = 0
         self.random = random
@@ -280,6 +332,7 @@ class Scheduler:
             request.interval.maximum = interval_maximum
             request.interval.minimum = interval_minimum
             request.interval._current = request.interval.maximum
+            request.interval.base = request.interval.maximum
             request.update_interval(self.iterations)
             self.append_debug_history(request, request.interval._current)
 
@@ -445,6 +498,7 @@ class Scheduler:
             # print(f"Start request thread for subset {subset_number}")
             # self.request_thread.start()
             self.end_request_thread = False
+            self.create_deadline_queue(subset_number)
             request_thread.start()  # request_threads[subset_number].start()
             while time.time() < self.end_time:
                 self.update(subset_number)
@@ -478,6 +532,7 @@ class Scheduler:
                     # print(f"Start request thread for subset {subset_number}")
                     # self.request_thread.start()
                     self.end_request_thread = False
+                    self.create_deadline_queue(subset_number)
                     request_threads[subset_number].start()
                     while time.time() < self.end_time:
                         self.update(subset_number)  # läuft immer wieder durch
@@ -489,9 +544,68 @@ class Scheduler:
                 else:
                     pass
 
+    def create_deadline_queue(self, subset_number):
+        """
+        Schedules the requests of a subset and empties the buffer. Requests are due at the end of their
+        current interval after their last execution, the intervals are scaled to meet the max requests requirement.
+
+        :param subset_number: The number of the subset to be scheduled.
+        :type subset_number: int
+        """
+
+        self.buffer_list.clear()
+        self.deadline_queue = DeadlineQueue(self.subset_lists[subset_number].request_list)
+        self.adjust_for_max_requests(self.deadline_queue.requests)
+        for handle in range(len(self.deadline_queue.requests)):
+            self.reschedule(handle)
+
+    def reschedule(self, handle):
+        """
+        Schedules a request for the end of its current interval, measured from its last execution.
+        Has to be called whenever the execution time or the interval of a scheduled request changes.
+
+        :param handle: The handle of the request in the deadline queue.
+        :type handle: int
+        """
+
+        request = self.deadline_queue.requests[handle]
+        if self.interval_allocator is not None and handle in self.interval_allocator:
+            request.interval.current = self.interval_allocator.interval(handle)
+        # If ignore_blacklisted_requests is True, blacklisted requests are not scheduled anymore
+        if self.ignore_blacklisted_requests and request.blacklisted:
+            self.deadline_queue.unschedule(handle)
+        else:
+            self.deadline_queue.schedule(
+                handle, request.exec_time + request.interval._current
+            )
+
+    def rebalance_interval(self, handle):
+        """
+        Updates the interval allocation after the base interval of a request was changed by its signal features.
+        Only the share of this request is recomputed; the other requests get their new interval, when they
+        are rescheduled.
+
+        :param handle: The handle of the request in the deadline queue.
+        :type handle: int
+        """
+
+        if self.interval_allocator is None:
+            return
+        request = self.deadline_queue.requests[handle]
+        if request.blacklisted:
+            self.interval_allocator.remove(handle)
+        else:
+            self.interval_allocator.set_base(
+                handle,
+                request.interval.base,
+                request.interval.minimum,
+                request.interval.maximum,
+            )
+
     def update(self, subset_number):
         """
         Updates buffer_list during execution by comparing, when a request was executed last.
+        Waits until the next request is due, at most until the end time.
 
         :param subset_number: The number of the subset being updated.
         :type subset_number: int
@@ -504,8 +618,7 @@ class Scheduler:
             )
             print("Before adjusting for max requests")
             print(self.subset_lists[subset_number].request_list[random_number])
-
-        self.subset_lists[subset_number].count_requests(self.print_info)
+            self.subset_lists[subset_number].count_requests(self.print_info)
 
         # self.adjust_for_max_requests()
 
@@ -518,29 +631,22 @@ class Scheduler:
         while len(self.buffer_list) > 20:
             time.sleep(0.5)
 
+        self.deadline_queue.wait(min(0.5, self.end_time - time.time()))
+
     def add_requests_to_buffer(self, subset_number):
         """
-        Adds requests to the buffer, if certain conditions are met.
+        Adds the due requests to the buffer.
 
         :param subset_number: The number of the subset being processed.
         :type subset_number: int
         """
 
-        now = time.time()
-        for request in self.subset_lists[subset_number].request_list:
-            # Only add the request to the buffer list, if the following conditions are met:
-            # 1. The time since the request has last been requested is larger than the current interval of the request
-            # 2. The unique ID of the request is not already in the buffer list
-            # 3. Either the attribute blacklisted of the request or the attribute ignore_blacklisted_requests of the Scheduler class
-            #    are False; If ignore_blacklisted_requests is False, all requests will be scheduled, if ignore_blacklisted_requests
-            #    is True, only not blacklisted requests will be scheduled
-            if (
-                (now - request.exec_time >= request.interval._current)
-                and ((request.make_unique_ID()) not in self.added_to_buffer)
-                and not (self.ignore_blacklisted_requests and request.blacklisted)
-            ):
-                self.buffer_list.append(request)
-                self.added_to_buffer.add(request.make_unique_ID())
+        # A request is due, if the time since it has last been requested is larger than its current interval.
+        # It leaves the deadline queue until it is rescheduled after its execution, so it is buffered only once.
+        for handle in self.deadline_queue.pop_due(time.time()):
+            request = self.deadline_queue.requests[handle]
+            if not (self.ignore_blacklisted_requests and request.blacklisted):
+                self.buffer_list.put(handle, request.ids.server_id)
 
     def append_debug_history(self, request: DoIPDidRequest, new_interval):
         """
@@ -553,53 +659,50 @@ class Scheduler:
         :type new_interval: int
         """
 
-        request.debug_history = request.debug_history + [
-            [
-                time.time(),
-                new_interval,
-                request.history.changing_bits_count,
-                request.history.entropy,
-                request.history.power_spectrum_density,
-                request.history.frequency_ratio,
-                request.blacklisted,
-            ]
-        ]
+        request.append_to_debug_history(new_interval)
 
-    def adjust_for_max_requests(self):
+    def adjust_for_max_requests(self, request_list=None):
         """
-        Adjusts intervals to meet max requests requirement.
+        Scales the intervals to meet the max requests requirement: The number of requests sent during the
+        theoretical loop time equals the number of not blacklisted requests.
+        The base intervals (derived from the signal features) of all not blacklisted requests are multiplied by a
+        common factor, which is solved for in one pass; each interval is clamped to the minimum and maximum interval of
+        its request. Only the current interval is scaled, the base interval is kept. The allocation is kept in
+        interval_allocator and updated by rebalance_interval, when the base interval of a single request changes.
+
+        :param request_list: The requests to be adjusted, the whole request list if None. The handles of the
+            requests in interval_allocator are their indices in this list.
+        :type request_list: list[DoIPDidRequest]
         """
 
-        total_requests = self.calculate_send_count()
+        if request_list is None:
+            request_list = self.request_list.request_list
+        self.request_list.count_requests()
         max_requests = self.request_list.count_not_blacklisted
-        iteration_counter = 0
-        print(f"Total requests: {total_requests}; Max. requests: {max_requests}")
-
-        while abs(total_requests - max_requests) > 0.05 * max_requests:
-            for request in self.request_list.request_list:
-                if not request.blacklisted:
-                    # Multiplication solution
-                    # new_interval = request.interval.current * (
-                    #     total_requests / max_requests
-                    # )
-                    # Addition solution
-                    if (total_requests / max_requests) > 1:
-                        summand = 1
-                    else:
-                        summand = -0.1
-                    new_interval = request.interval.current + summand
-                    request.interval.update_current(new_interval)
-                    self.append_debug_history(request, request.interval._current)
-            total_requests = self.calculate_send_count()
-            if self.print_info:
-                print(
-                    f"Total requests: {total_requests}; Max. requests: {max_requests}"
-                )
-            iteration_counter += 1
-            if iteration_counter > 100:
-                raise Exception(
-                    "Could not adjust intervals enough in 100 iterations to meet requirement: Total requests ~ Max. requests"
+        self.interval_allocator = IntervalAllocator(
+            max_requests / self.theoretical_loop_time
+            if self.theoretical_loop_time > 0
+            else math.inf
+        )
+        for handle, request in enumerate(request_list):
+            if not request.blacklisted:
+                self.interval_allocator.set_base(
+                    handle,
+                    request.interval.base,
+                    request.interval.minimum,
+                    request.interval.maximum,
+                    rebalance=False,
                 )
+        self.interval_allocator.rebalance()
+
+        for handle, request in enumerate(request_list):
+            if handle in self.interval_allocator:
+                request.interval.current = self.interval_allocator.interval(handle)
+                self.append_debug_history(request, request.interval._current)
+        total_requests = math.ceil(
+            self.interval_allocator.send_count(self.theoretical_loop_time)
+        )
+        print(f"Total requests: {total_requests}; Max. requests: {max_requests}")
 
     def calculate_send_count(self):
         """
@@ -628,32 +731,40 @@ class Scheduler:
                 print("Entered if end request")
                 break
             if len(self.buffer_list) > 0:
-                request = self.buffer_list.pop(0)
-                self.added_to_buffer.discard(request.make_unique_ID())
-                if self.random:
-                    response, execution_time, unique_ID = request.get_rnd_value()
-                    request.update_interval(self.iterations)
-                else:
-                    response, execution_time, unique_ID = request.get_value(
-                        self.wait_window_request
-                    )
+                # the longest waiting request and as many waiting requests of its server as the packing planner allows
+                server_id = self.buffer_list.oldest_group()
+                requests = self.deadline_queue.requests
+                handles = self.packing_planner.fill(
+                    server_id,
+                    self.buffer_list.peek(server_id),
+                    lambda handle: requests[handle].ids.payload_length,
+                )
+                self.buffer_list.remove(server_id, handles)
+                pack = [requests[handle] for handle in handles]
+                for handle, request, (response, execution_time, unique_ID) in zip(
+                    handles, pack, self.read_pack(pack)
+                ):
                     request.update_interval(self.iterations)
-                if self.create_output_csv and response:
-                    # ------------------------------------------------------
-                    # Reason for the next if-Statement: During testing the csv-Saving crashed while using the GUI. at somepoint during Recording "Errno 13 Permission denied" appeared and the program crashed. Bug couldn't be found so the csv is saved after each subset
-                    # TODO: save files in anians manual mode in the same way if he's ok with that
-                    # Anian is OK with that ;)
-                    # ------------------------------------------------------
-                    if self.GUI_mode:
-                        self.subset_payload_for_csv.append(
-                            [execution_time, unique_ID] + response
-                        )
-                    else:
-                        self.append_to_output_csv(response, execution_time, unique_ID)
+                    self.rebalance_interval(handle)
+                    self.reschedule(handle)
+                    if self.create_output_csv and response:
+                        # ------------------------------------------------------
+                        # Reason for the next if-Statement: During testing the csv-Saving crashed while using the GUI. at somepoint during Recording "Errno 13 Permission denied" appeared and the program crashed. Bug couldn't be found so the csv is saved after each subset
+                        # TODO: save files in anians manual mode in the same way if he's ok with that
+                        # Anian is OK with that ;)
+                        # ------------------------------------------------------
+                        if self.GUI_mode:
+                            self.subset_payload_for_csv.append(
+                                [execution_time, unique_ID] + response
+                            )
+                        else:
+                            self.append_to_output_csv(response, execution_time, unique_ID)
                 print(
                     f"\rCurrent time: {time.strftime('%T', time.localtime(time.time()))}, Target time: {time.strftime('%T', time.localtime(self.end_time))}, buffer length: {len(self.buffer_list)}  ",
                     end="",
                 )
+            else:
+                self.buffer_list.wait(0.1)
         if self.GUI_mode:
             for row in self.subset_payload_for_csv:
                 self.append_to_output_csv(row[2:], row[0], row[1])
@@ -12,10 +12,23 @@ from revcan.signal_discovery.doip_dids import (
 from utils.network_actions import NetworkActions
 from utils.udsoncan.client import Client as UDSClient
 from utils.udsoncan import services, Request, Response
+from revcan.signal_discovery.utils.doipclient.messages import (
+    DiagnosticMessage,
+    DiagnosticMessageNegativeAcknowledgement,
+)
 from utils.udsoncan.ResponseCode import ResponseCode
+from revcan.signal_discovery.deadline_queue import DeadlineQueue, RequestBuffer
+from revcan.signal_discovery.interval_allocation import IntervalAllocator
+from revcan.signal_discovery.request_dispatch import RequestSlot, SlotTable
+from revcan.signal_discovery.request_packing import (
+    REPLAN_CODES,
+    RequestPackingPlanner,
+    ServerLimits,
+    split_response_data,
+)
 import revcan.signal_discovery.utils.misc_methods as misc
 from io import BufferedWriter
-from collections import defaultdict
+import queue
 import threading
 import time
 import math
@@ -37,8 +50,9 @@ class ParallelScheduler:
     Attributes:
     - request_list: A list of requests to be scheduled.
     - subset_lists: A list of subsets of the requests in case there are too many requests to be processed at once.
-    - buffer_list: A buffer for holding requests before execution.
-    - added_to_buffer: A set to track unique IDs of requests added to the buffer.
+    - buffer_list: A buffer for holding the handles of due requests before execution, grouped by server.
+    - deadline_queue: The requests of the current subset, ordered by the time they are due next.
+    - interval_allocator: Allocates the intervals of the current subset under the request capacity.
     - theoretical_loop_time: The estimated time it takes to loop through the list of requests.
     - average_request_time: The average time taken by a request.
     - script_directory: The directory of the script containing this class.
@@ -54,6 +68,9 @@ class ParallelScheduler:
     - remaining_time: Remaining time for the initial request process.
     - iteration_counter: Counter for scheduling iterations.
     - subset_payload_for_csv: Payload list for CSV during debugging in random mode.
+    - response_queue: Captured diagnostic messages waiting to be distributed to the request slots.
+    - packing_planner: Packs the DIDs of a server into read data by identifier requests.
+    - performance_dict: The measured DID and payload limits per server.
 
     Methods:
     - __init__: Initializes the Scheduler instance.
@@ -62,23 +79,24 @@ class ParallelScheduler:
     - save_data: Saves the request data to a database and optionally exports as CSV.
     - request_all: Executes requests for the entire request list once.
     - populate_history: Populates the history of requests using the request_all method.
+    - set_up_packing_planner: Sets up the packing planner from the performance list.
     - check_if_subsets_necessary: Checks if subsets are necessary based on request count.
     - split_request_list: Splits the request list into subsets if necessary.
     - start: Starts the scheduling process with options for subsets and iterations.
+    - create_deadline_queue: Schedules the requests of a subset.
+    - reschedule: Schedules a request for the end of its current interval.
     - update: Updates buffer_list during execution by comparing, when a request was executed last.
-    - add_requests_to_buffer: Adds requests to the buffer if certain conditions are met.
+    - add_requests_to_buffer: Adds the due requests to the buffer.
     - append_debug_history: Appends debug information of the request to the debug history.
-    - adjust_for_max_requests: Adjusts intervals to meet max requests requirement.
+    - adjust_for_max_requests: Scales the intervals to meet the max requests requirement.
     - calculate_send_count: Calculates the number of requests that could be sent during the average loop time.
     - request: Main method for executing requests in a separate thread.
     - append_to_output_csv: Appends results to the output CSV file.
     """
 
-    current_request_dict = {}  # Dictionary of requests
-    requesters = []  # List of Requester instances
-    evaluators = []  # List of Evaluator instances
-    capture_dict = {}  # List of distributed responses
-    capture_list = []  # List of captured responses
+    slot_table: SlotTable = None  # Request slots in flight, one per Requester/Evaluator pair
+    Requesters = []  # List of Requester instances
+    Evaluators = []  # List of Evaluator instances
 
     def __init__(self, interface: str, number_of_requesters: int):
         """
@@ -87,14 +105,15 @@ class ParallelScheduler:
         self.parallel = False
         self.request_list: RequestList = RequestList()
         self.subset_lists: list[RequestList] = []
-        self.buffer_list: list[DoIPDidRequest] = []
+        self.buffer_list: RequestBuffer = RequestBuffer()
+        self.deadline_queue: DeadlineQueue = None
+        self.interval_allocator: IntervalAllocator = None
         self.interface = interface
         self.number_of_requesters = number_of_requesters
         self.connection = NetworkActions(
             self.interface
         )  # initiates a connection to the vehicle using the ethernet interface of the computer
         self.doip_connector: DoIPConnector = DoIPConnector()  # type: ignore
-        self.added_to_buffer = set()
         self.theoretical_loop_time: int
         self.average_request_time: float = 0
         self.script_directory = os.path.dirname(__file__)
@@ -112,6 +131,11 @@ class ParallelScheduler:
         self.subset_payload_for_csv = (
             []
         )  # Explanation: while Debugging the GUI in the random-Mode at some point during the Recording the csv.-file couldnt be writen to anymor (Errno 13: Permission denied), after long testing the bug couldn't be found so the GUI first saves the Recording Data to the list, which is then writen to the csv.-file
+        self.performance_dict = {}
+        self.packing_planner = RequestPackingPlanner()  # one DID per request
+        self.response_queue = queue.Queue()
+        self.capture_started = threading.Event()
+        self.capture_thread = None
 
         # Preparations for threads
         # self.request_thread = threading.Thread(target=self.request)
@@ -195,27 +219,18 @@ class ParallelScheduler:
         interface: str,
         csv_file_path: Union[str, None] = None,
     ):
-        # set up current_request_dict and create Requester instances
-        self.create_current_request_dict(number_of_requesters)
+        # set up the request slots and create the Requester and Evaluator instances
+        self.create_slot_table(number_of_requesters, self.wait_window_request)
         self.create_requesters(number_of_requesters)
         self.create_evaluators(
             number_of_requesters, interface, csv_file_path, self.wait_window_request
         )
-        self.set_up_capture_dict(self.number_of_requesters)
 
     @classmethod
     def get_current_requested_server(cls):
-        server_ids = []
-        for key, value in cls.current_request_dict.items():
-            if value["List"] is not None:
-                if isinstance(value["List"], list):
-                    try:
-                        server_ids.append(value["List"][0].ids.server_id)
-                    except:
-                        pass
-                else:
-                    server_ids.append(value["List"].ids.server_id)
-        return server_ids
+        if cls.slot_table is None:
+            return []
+        return cls.slot_table.in_flight_servers()
 
     def request_all(self):
         """
@@ -227,53 +242,38 @@ class ParallelScheduler:
 
         if self.parallel:  # Wenn parallel True ist, Anfragen parallel senden
 
-            while not self.capture_active:
-                time.sleep(0.1)  # Sleep for a short duration to avoid busy waiting
-                # to wait for the capture thread to start
-                # should be activated only at fist iteration of the request_all method
+            # wait for the capture thread to start
+            self.capture_started.wait()
 
             start = time.time()
 
-            while request_list_copy:
-                requests_to_send = []
-                payload_length = 0
+            # Pack the DIDs of every server into as few requests as its limits allow; re-plan if the limits change
+            packs = self.packing_planner.plan(
+                request_list_copy,
+                lambda request: request.ids.server_id,
+                lambda request: request.ids.payload_length,
+            )
+            planned_revision = self.packing_planner.revision
+            while packs:
+                if self.packing_planner.revision != planned_revision:
+                    planned_revision = self.packing_planner.revision
+                    packs = self.packing_planner.plan(
+                        [request for pack in packs for request in pack],
+                        lambda request: request.ids.server_id,
+                        lambda request: request.ids.payload_length,
+                    )
+
+                # send the next pack of a server which is not requested at the moment
                 server_ids = self.get_current_requested_server()
-                for request in request_list_copy:
-                    if (
-                        requests_to_send == []
-                    ):  # if requests_to_send is empty, add the first request to the list
-                        if request.ids.server_id not in server_ids:
-                            requests_to_send.append(request)
-                            payload_length += request.ids.payload_length
-                            if self.performance_dict:
-                                try:
-                                    max_did = self.performance_dict[
-                                        request.ids.server_id
-                                    ]["DID_length"]
-                                    max_payload = self.performance_dict[
-                                        request.ids.server_id
-                                    ]["Payload_length"]
-                                except:
-                                    max_did = self.dids_in_request
-                            else:
-                                max_did = self.dids_in_request
-                            continue
-                        else:
-                            continue
-
-                    if request.ids.server_id == requests_to_send[0].ids.server_id:
-                        requests_to_send.append(request)
-                        payload_length += request.ids.payload_length
-                        if max_payload and (
-                            payload_length > max_payload
-                        ):  # if the payload length is too long, stop adding requests and remove last entry
-                            requests_to_send.pop()
-                            break
-
-                        if (
-                            len(requests_to_send) == max_did
-                        ):  # if the maximum number of DIDs is reached, stop adding requests
-                            break
+                requests_to_send = next(
+                    (pack for pack in packs if pack[0].ids.server_id not in server_ids),
+                    None,
+                )
+                if requests_to_send is None:
+                    # all servers with remaining packs are requested at the moment
+                    self.slot_table.wait_for_release(self.wait_window_request)
+                    continue
+                packs.remove(requests_to_send)
 
                 for request in requests_to_send:
                     sent_requests += 1
@@ -325,6 +325,8 @@ class ParallelScheduler:
     def start_capture_distribute_threads(self, server_id, tester_id):
         self.capture_is_active = True
         self.distribute_active = True
+        self.capture_started.clear()
+        self.response_queue = queue.Queue()
         self.capture_thread = threading.Thread(
             target=self.capture_task,
             args=(server_id, tester_id, self.wait_window_request),
@@ -332,15 +334,16 @@ class ParallelScheduler:
         self.response_distribution_thread = threading.Thread(
             target=self.distribute_responses
         )
-        self.capture_active = False
         self.response_distribution_thread.start()
         self.capture_thread.start()
 
     def stop_capture_distribute_threads(self):
         self.capture_is_active = False
         self.distribute_active = False
+        self.response_queue.put(None)  # wakes up the distribution thread
         self.capture_thread.join()
         self.response_distribution_thread.join()
+        self.capture_thread = None
 
     def populate_history(
         self,
@@ -386,8 +389,7 @@ class ParallelScheduler:
         self.wait_window_request = wait_window
         self.dids_in_request = dids_in_request
 
-        if performance_list is not None:
-            self.performance_dict = self.get_performance_dict(performance_list)
+        self.set_up_packing_planner(performance_list, dids_in_request)
 
         self.set_up_dict_req_eval(
             self.number_of_requesters,
@@ -416,6 +418,11 @@ class ParallelScheduler:
             if answer:
                 if self.parallel:
                     self.start_threads()
+                    if self.capture_thread is None:
+                        self.start_capture_distribute_threads(
+                            self.request_list.request_list[0].ids.server_id,
+                            self.request_list.request_list[0].ids.tester_id,
+                        )
                 print(f"\nStarted Iteration {self.iteration_counter}")
 
                 self.request_all()
@@ -426,6 +433,7 @@ class ParallelScheduler:
                 )
                 if self.parallel:
                     self.stop_threads()
+                    self.stop_capture_distribute_threads()
             else:
                 continue
 
@@ -444,10 +452,11 @@ class ParallelScheduler:
         print("Average request time: ", round(self.average_request_time, 3), "s")
 
     def get_signal_features(self):
+        # The features of all requests are calculated in one batch by the feature engine of the request list
+        self.request_list.calculate_signal_features()
         feature_sum_list = []
         for request in self.request_list.request_list:
             if isinstance(request, DoIPDidRequest):
-                request.calculate_signal_feature()
                 feature_sum_list.append(request.feature_sum)
         return feature_sum_list
 
@@ -546,8 +555,7 @@ class ParallelScheduler:
         self.wait_window_request = wait_window
         self.dids_in_request = dids_in_request
 
-        if performance_list is not None:
-            self.performance_dict = self.get_performance_dict(performance_list)
+        self.set_up_packing_planner(performance_list, dids_in_request)
 
         self.set_up_dict_req_eval(
             self.number_of_requesters,
@@ -638,8 +646,7 @@ class ParallelScheduler:
         self.dids_in_request = dids_in_request
         self.esc_pressed = False
 
-        if performance_list is not None:
-            self.performance_dict = self.get_performance_dict(performance_list)
+        self.set_up_packing_planner(performance_list, dids_in_request)
 
         self.set_up_dict_req_eval(
             self.number_of_requesters,
@@ -705,23 +712,41 @@ class ParallelScheduler:
                 request.blacklisted = True
 
     def get_performance_dict(self, path):
+        """
+        Loads the DID and payload limits per server saved by check_dids_performance_automatic.
+
+        :param path: The path to the performance list (Server_ID, DID Length, Payload Size).
+        :type path: str
+
+        :return: The limits per server ID.
+        :rtype: dict
+        """
         performance_dict = {}
-        with open(path, "r") as file:
-            # Die erste Zeile überspringen
-            next(file)
-            for line in file:
-                line = line.split(",")
-                server_id = int(line[0].strip('\''), 16)  # Hexadezimal in Dezimal umwandeln
-                did_length = int(line[2].strip('\''))
-                payload_length = int(line[2].strip().strip('\''))
-                # Die Werte für jede Server-ID aktualisieren
-                performance_dict[server_id] = {
-                    "DID_length": did_length,
-                    "Payload_length": payload_length,
-                }
+        for server_id, limits in ServerLimits.load_performance_list(path).items():
+            performance_dict[server_id] = {
+                "DID_length": limits.max_dids,
+                "Payload_length": limits.max_payload_length,
+            }
 
         return performance_dict
 
+    def set_up_packing_planner(self, performance_list=None, dids_in_request=1):
+        """
+        Sets up the packing planner from the performance list.
+
+        :param performance_list: The path to the performance list.
+        :type performance_list: str
+
+        :param dids_in_request: The number of DIDs in a request of servers which are not in the performance list.
+        :type dids_in_request: int
+        """
+        self.packing_planner = RequestPackingPlanner.from_performance_list(
+            performance_list, dids_in_request
+        )
+        self.performance_dict = (
+            self.get_performance_dict(performance_list) if performance_list else {}
+        )
+
     def start(
         self,
         subsetnumber=0,
@@ -778,6 +803,7 @@ class ParallelScheduler:
         self.iterations = iterations
         self.print_info = print_info
         self.maximum_dids_in_request = maximum_dids_in_request
+        self.packing_planner.default_limits = ServerLimits(max_dids=maximum_dids_in_request)
         subset = self.subset_lists[subset_number]
 
         if self.create_output_csv:
@@ -826,6 +852,11 @@ class ParallelScheduler:
             # self.request_thread.start()
             self.end_request_thread = False
             self.start_threads()  # creates threads for Requesters and Evaluators for later execution in send_request()
+            self.start_capture_distribute_threads(
+                subset.request_list[0].ids.server_id,
+                subset.request_list[0].ids.tester_id,
+            )
+            self.create_deadline_queue(subset_number)
             request_thread.start()  # request_threads[subset_number].start()
             while time.time() < self.end_time:
                 self.update(subset_number)
@@ -834,6 +865,7 @@ class ParallelScheduler:
             request_thread.join()  # request_threads[subset_number].join()
             # self.request_thread.join()
             self.stop_threads()
+            self.stop_capture_distribute_threads()
             print("\nJoined thread.")
         else:
             for subset_number, subset in enumerate(self.subset_lists):
@@ -860,8 +892,13 @@ class ParallelScheduler:
                     # print(f"Start request thread for subset {subset_number}")
                     # self.request_thread.start()
                     self.end_request_thread = False
-                    subset_threads[subset_number].start()
                     self.start_threads()  # creates threads for Requesters and Evaluators for later execution in send_request()
+                    self.start_capture_distribute_threads(
+                        subset.request_list[0].ids.server_id,
+                        subset.request_list[0].ids.tester_id,
+                    )
+                    self.create_deadline_queue(subset_number)
+                    subset_threads[subset_number].start()
                     while time.time() < self.end_time:
                         self.update(subset_number)
                     print("\nFinished update.")
@@ -869,13 +906,53 @@ class ParallelScheduler:
                     subset_threads[subset_number].join()
                     # self.request_thread.join()
                     self.stop_threads()  # stops the threads for the Requesters and Evaluators
+                    self.stop_capture_distribute_threads()
                     print("\nJoined thread.")
                 else:
                     pass
 
+    def create_deadline_queue(self, subset_number):
+        """
+        Schedules the requests of a subset and empties the buffer. Requests are due at the end of their
+        current interval after their last execution, the intervals are scaled to meet the max requests requirement.
+
+        :param subset_number: The number of the subset to be scheduled.
+        :type subset_number: int
+        """
+
+        self.buffer_list.clear()
+        self.deadline_queue = DeadlineQueue(self.subset_lists[subset_number].request_list)
+        self.adjust_for_max_requests(self.deadline_queue.requests)
+        for handle in range(len(self.deadline_queue.requests)):
+            self.reschedule(handle)
+
+    def reschedule(self, handle, exec_time=None):
+        """
+        Schedules a request for the end of its current interval, measured from its last execution.
+        Has to be called whenever the execution time or the interval of a scheduled request changes.
+
+        :param handle: The handle of the request in the deadline queue.
+        :type handle: int
+
+        :param exec_time: The time of the last execution, the exec_time of the request if None.
+        :type exec_time: float
+        """
+
+        request = self.deadline_queue.requests[handle]
+        if self.interval_allocator is not None and handle in self.interval_allocator:
+            request.interval.current = self.interval_allocator.interval(handle)
+        if exec_time is None:
+            exec_time = request.exec_time
+        # If ignore_blacklisted_requests is True, blacklisted requests are not scheduled anymore
+        if self.ignore_blacklisted_requests and request.blacklisted:
+            self.deadline_queue.unschedule(handle)
+        else:
+            self.deadline_queue.schedule(handle, exec_time + request.interval._current)
+
     def update(self, subset_number):
         """
         Updates buffer_list during execution by comparing, when a request was executed last.
+        Waits until the next request is due, at most until the end time.
 
         :param subset_number: The number of the subset being updated.
         :type subset_number: int
@@ -888,8 +965,7 @@ class ParallelScheduler:
             )
             print("Before adjusting for max requests")
             print(self.subset_lists[subset_number].request_list[random_number])
-
-        self.subset_lists[subset_number].count_requests(self.print_info)
+            self.subset_lists[subset_number].count_requests(self.print_info)
 
         # self.adjust_for_max_requests()
 
@@ -902,29 +978,22 @@ class ParallelScheduler:
         while len(self.buffer_list) > 20:
             time.sleep(0.2)
 
+        self.deadline_queue.wait(min(0.5, self.end_time - time.time()))
+
     def add_requests_to_buffer(self, subset_number):
         """
-        Adds requests to the buffer, if certain conditions are met.
+        Adds the due requests to the buffer.
 
         :param subset_number: The number of the subset being processed.
         :type subset_number: int
         """
 
-        now = time.time()
-        for request in self.subset_lists[subset_number].request_list:
-            # Only add the request to the buffer list, if the following conditions are met:
-            # 1. The time since the request has last been requested is larger than the current interval of the request
-            # 2. The unique ID of the request is not already in the buffer list
-            # 3. Either the attribute blacklisted of the request or the attribute ignore_blacklisted_requests of the Scheduler class
-            #    are False; If ignore_blacklisted_requests is False, all requests will be scheduled, if ignore_blacklisted_requests
-            #    is True, only not blacklisted requests will be scheduled
-            if (
-                (now - request.exec_time >= request.interval._current)
-                and ((request.make_unique_ID()) not in self.added_to_buffer)
-                and not (self.ignore_blacklisted_requests and request.blacklisted)
-            ):
-                self.buffer_list.append(request)
-                self.added_to_buffer.add(request.make_unique_ID())
+        # A request is due, if the time since it has last been requested is larger than its current interval.
+        # It leaves the deadline queue until it is rescheduled after its response, so it is buffered only once.
+        for handle in self.deadline_queue.pop_due(time.time()):
+            request = self.deadline_queue.requests[handle]
+            if not (self.ignore_blacklisted_requests and request.blacklisted):
+                self.buffer_list.put(handle, request.ids.server_id)
 
     def append_debug_history(self, request: DoIPDidRequest, new_interval):
         """
@@ -937,51 +1006,50 @@ class ParallelScheduler:
         :type new_interval: int
         """
 
-        request.debug_history = request.debug_history + [
-            [
-                time.time(),
-                new_interval,
-                request.history.changing_bits_count,
-                request.history.entropy,
-                request.blacklisted,
-            ]
-        ]
+        request.append_to_debug_history(new_interval)
 
-    def adjust_for_max_requests(self):
+    def adjust_for_max_requests(self, request_list=None):
         """
-        Adjusts intervals to meet max requests requirement.
+        Scales the intervals to meet the max requests requirement: The number of requests sent during the
+        theoretical loop time equals the number of not blacklisted requests.
+        The base intervals (derived from the signal features) of all not blacklisted requests are multiplied by a
+        common factor, which is solved for in one pass; each interval is clamped to the minimum and maximum interval of
+        its request. Only the current interval is scaled, the base interval is kept. The allocation is kept in
+        interval_allocator and updated by rebalance_interval, when the base interval of a single request changes.
+
+        :param request_list: The requests to be adjusted, the whole request list if None. The handles of the
+            requests in interval_allocator are their indices in this list.
+        :type request_list: list[DoIPDidRequest]
         """
 
-        total_requests = self.calculate_send_count()
+        if request_list is None:
+            request_list = self.request_list.request_list
+        self.request_list.count_requests()
         max_requests = self.request_list.count_not_blacklisted
-        iteration_counter = 0
-        print(f"Total requests: {total_requests}; Max. requests: {max_requests}")
-
-        while abs(total_requests - max_requests) > 0.05 * max_requests:
-            for request in self.request_list.request_list:
-                if not request.blacklisted:
-                    # Multiplication solution
-                    # new_interval = request.interval.current * (
-                    #     total_requests / max_requests
-                    # )
-                    # Addition solution
-                    if (total_requests / max_requests) > 1:
-                        summand = 1
-                    else:
-                        summand = -0.1
-                    new_interval = request.interval.current + summand
-                    request.interval.update_current(new_interval)
-                    self.append_debug_history(request, request.interval._current)
-            total_requests = self.calculate_send_count()
-            if self.print_info:
-                print(
-                    f"Total requests: {total_requests}; Max. requests: {max_requests}"
-                )
-            iteration_counter += 1
-            if iteration_counter > 100:
-                raise Exception(
-                    "Could not adjust intervals enough in 100 iterations to meet requirement: Total requests ~ Max. requests"
+        self.interval_allocator = IntervalAllocator(
+            max_requests / self.theoretical_loop_time
+            if self.theoretical_loop_time > 0
+            else math.inf
+        )
+        for handle, request in enumerate(request_list):
+            if not request.blacklisted:
+                self.interval_allocator.set_base(
+                    handle,
+                    request.interval.base,
+                    request.interval.minimum,
+                    request.interval.maximum,
+                    rebalance=False,
                 )
+        self.interval_allocator.rebalance()
+
+        for handle, request in enumerate(request_list):
+            if handle in self.interval_allocator:
+                request.interval.current = self.interval_allocator.interval(handle)
+                self.append_debug_history(request, request.interval._current)
+        total_requests = math.ceil(
+            self.interval_allocator.send_count(self.theoretical_loop_time)
+        )
+        print(f"Total requests: {total_requests}; Max. requests: {max_requests}")
 
     def calculate_send_count(self):
         """
@@ -1000,83 +1068,29 @@ class ParallelScheduler:
         total_requests = math.ceil(sum(send_counts))
         return total_requests
 
-    def send_request(self, request_list: list[DoIPDidRequest]):
+    def send_request(self, request_list: list[DoIPDidRequest]) -> RequestSlot:
         """
-        Send a list of requests in parallel.
+        Hands a list of requests of one server to the next free request slot.
+        Blocks until a slot is free.
+
+        :return: The slot of the requests, None if they could not be handed to a slot.
         """
         try:
             logging.debug("%s: Entering send_request()", time.time())
-            unique_dids = self._get_unique_dids()
-            self._handle_request_order(request_list, unique_dids)
-            self._start_threads(request_list)
+            if not request_list:
+                return None
+            if not self.doip_connector._initialized:
+                self.doip_connector.initiate_DoIP_client(request_list[0].ids.tester_id)
+            slot = self.slot_table.acquire(request_list)
+            ParallelScheduler.Requesters[slot.number].add_slot(slot)
             logging.debug("%s: Leaving send_request()", time.time())
+            return slot
         except Exception as e:
             print("\nError in send_request():", e)
-
-    def _get_unique_dids(self):
-        """
-        Get unique DIDs from current_request_dict.
-        """
-        unique_dids = [
-            request["List"][0].ids.did
-            for request in self.current_request_dict.values()
-            if request.get("List")
-        ]
-        return unique_dids
-
-    def _handle_request_order(self, request_list, unique_dids):
-        """
-        Ensure the first DID in request_list is unique.+
-        Otherwise move the first DID to the first unique position.
-        """
-        dids = [request.ids.did for request in request_list]
-        for i, did in enumerate(dids):
-            if did not in unique_dids and i != 0:
-                request_list[0], request_list[i] = request_list[i], request_list[0]
-                break
-
-    def _start_threads(self, request_list):
-        """
-        Add request_list to current_request_dict and start threads.
-        """
-        sent = False
-        while not sent:
-            for key, value in ParallelScheduler.current_request_dict.items():
-                try:
-                    if not self.doip_connector._initialized:
-                        self.doip_connector.initiate_DoIP_client(
-                            request_list[0].ids.tester_id
-                        )
-                    else:
-                        if value["List"] is None or value["List"] == []:
-                            ParallelScheduler.current_request_dict[key][
-                                "List"
-                            ] = request_list
-                            ParallelScheduler.Evaluators[key].is_active = True
-                            sent = True
-
-                            logging.debug(
-                                "\n%s Request assigned to Requester", time.time()
-                            )
-
-                            break
-                except Exception as e:
-                    for request in request_list:
-                        self.request_list.request_list.append(request)
-                        print(
-                            "\n Request returned to request_list; Connection error:", e
-                        )
+            return None
 
     def start_threads(self):
         # Erstelle Threads für Requesters und Evaluatoren für spätere Ausführung in send_request()
-        self.evaluate_threads = []
-        self.request_threads = []
-        for evaluator in ParallelScheduler.Evaluators:
-            evaluator.evaluate_active = True
-
-        for requester in ParallelScheduler.Requesters:
-            requester.request_active = True
-
         self.evaluate_threads = [
             threading.Thread(target=evaluator.activate_evaluation)
             for evaluator in ParallelScheduler.Evaluators
@@ -1095,15 +1109,15 @@ class ParallelScheduler:
             thread.start()
 
     def stop_threads(self):
+        # the requesters and evaluators finish the slots handed to them before they stop
         for requester in ParallelScheduler.Requesters:
             requester.stop_request()
+        for thread in self.request_threads:
+            thread.join()
         for evaluator in ParallelScheduler.Evaluators:
             evaluator.stop_evaluation()
-
         for thread in self.evaluate_threads:
             thread.join()
-        for thread in self.request_threads:
-            thread.join()
         return
 
     def request(self):
@@ -1116,28 +1130,32 @@ class ParallelScheduler:
                 break
             if len(self.buffer_list) > 0:
 
-                # get all (maximum is self.maximum_dids_in_request) request with the same server_id in buffer_list
-                request_list: list[DoIPDidRequest] = []
-                request_list.append(self.buffer_list.pop(0))
-                i = 0
-                while i < len(self.buffer_list):
-                    if (
-                        self.buffer_list[i].ids.server_id
-                        == request_list[0].ids.server_id
-                    ):
-                        request_list.append(self.buffer_list[i])
-                        self.buffer_list.pop(i)  # Remove the item from buffer_list
-                        if len(request_list) == self.maximum_dids_in_request:
-                            i = len(self.buffer_list)  # ends the while loop
-                    else:
-                        i += 1
+                # the longest waiting request and as many waiting requests of its server as the packing planner allows
+                server_id = self.buffer_list.oldest_group()
+                requests = self.deadline_queue.requests
+                handles = self.packing_planner.fill(
+                    server_id,
+                    self.buffer_list.peek(server_id),
+                    lambda handle: requests[handle].ids.payload_length,
+                )
+                self.buffer_list.remove(server_id, handles)
+                request_list: list[DoIPDidRequest] = [requests[handle] for handle in handles]
 
-                self.send_request(
+                slot = self.send_request(
                     request_list
                 )  # makes the request and handles the Threads
 
+                # the requests are due again one interval after their response or timeout
+                def reschedule_pack(future=None, handles=handles):
+                    for handle in handles:
+                        self.reschedule(handle, time.time())
+
+                if slot is not None:
+                    slot.future.add_done_callback(reschedule_pack)
+                else:
+                    reschedule_pack()
+
                 """ ###not used###
-                self.added_to_buffer.discard(request.make_unique_ID())
                 if self.random:
                     response, execution_time, unique_ID = request.get_rnd_value()
                     request.update_interval(self.iterations)
@@ -1164,6 +1182,8 @@ class ParallelScheduler:
                     f"\rCurrent time: {time.strftime('%T', time.localtime(time.time()))}, Target time: {time.strftime('%T', time.localtime(self.end_time))}, buffer length: {len(self.buffer_list)}  ",
                     end="",
                 )
+            else:
+                self.buffer_list.wait(0.1)
         if self.GUI_mode:
             for row in self.subset_payload_for_csv:
                 self.append_to_output_csv(row[2:], row[0], row[1])
@@ -1192,31 +1212,17 @@ class ParallelScheduler:
             print("No csv file path specified.")
 
     @classmethod
-    def set_up_capture_dict(cls, number_of_evaluators: int):
+    def create_slot_table(cls, number_of_slots: int, timeout: float):
         """
-        Sets up the capture dictionary.
+        Creates the request slots.
 
-        :param number_of_evaluators: The number of evaluators.
-        :type number_of_evaluators: int
-        """
-        cls.capture_dict = defaultdict(list)
-        for i in range(number_of_evaluators):
-            cls.capture_dict[i] = []
+        :param number_of_slots: The number of slots, equal to the number of requesters.
+        :type number_of_slots: int
 
-    @classmethod
-    def create_current_request_dict(cls, number_of_requesters: int):
+        :param timeout: Time to wait for a response.
+        :type timeout: float
         """
-        Creates a dictionary of requests.
-
-        :param number_of_requesters: The number of requesters.
-        :type number_of_requesters: int
-        """
-        cls.current_request_dict = {}
-        for i in range(number_of_requesters):
-            cls.current_request_dict[i] = {
-                "Sent": False,
-                "List": None,
-            }
+        cls.slot_table = SlotTable(number_of_slots, timeout)
 
     @classmethod
     def create_requesters(cls, number_of_requesters: int):
@@ -1239,123 +1245,63 @@ class ParallelScheduler:
         """
         cls.Evaluators = []
         cls.Evaluators = [
-            Evaluator(i, interface, csv_filepath) for i in range(number_of_evaluators)
+            Evaluator(i, interface, csv_filepath, timeout)
+            for i in range(number_of_evaluators)
         ]
 
     def capture_task(self, server_id, tester_id, timeout_value=1):
         """
-        Captures the response data.
-        Runs in a separate thread.
+        Captures the diagnostic messages of the shared DoIP connection and queues them for distribution.
+        Runs in a separate thread; blocks on the socket while no message arrives.
         """
-        client = self.doip_connector.get_client(server_id, tester_id)
-        if client.conn.is_open():
-            self.capture_active = True
-        else:
-            client.open()
-            self.capture_active = True
+        doip_client = self.doip_connector.get_doip_client(tester_id)
+        self.capture_started.set()
 
         while self.capture_is_active:
-            if client.conn.is_open():
-                payload = client.conn.wait_frame_complete_message(
-                    timeout=timeout_value
-                )  # wait for a response
-                if payload:
-                    self.capture_list.append(payload)
-                    logging.debug(
-                        "\n%s: Received answer: %s",
-                        time.time(),
-                        bytes(payload.user_data),
-                    )
-            else:
-                client.open()  # Reopen the connection if it was closed
+            try:
+                message = doip_client.read_doip(timeout=timeout_value)
+            except TimeoutError:
+                if doip_client.tcp_close_detected:
+                    # Re-open the connection if the gateway closed it
+                    doip_client = self.doip_connector.get_doip_client(tester_id)
+                continue
+            except Exception as e:
+                logging.warning(f"Error in capture_task(): {e}")
+                continue
+            if isinstance(message, (DiagnosticMessage, DiagnosticMessageNegativeAcknowledgement)):
+                self.response_queue.put(message)
+                logging.debug("\n%s: Received message: %s", time.time(), message)
 
     def distribute_responses(self):
         """
-        Distributes the responses to the respective evaluators.
-        Runs in a separate thread.
+        Distributes the captured responses to the request slots and completes the slots whose timeout expired.
+        Runs in a separate thread; blocks on the response queue while no request is in flight.
         """
         while self.distribute_active:
             try:
-                if self.capture_list:
-                    logging.debug("\n%s: Distributing responses", time.time())
-                    for payload in self.capture_list:
-                        response = Response.from_payload(bytes(payload.user_data))
-                        if response and response.positive and response.data is not None:
-                            identifier = (response.data[0] << 8) | response.data[1]
-                            server = payload.source_address
-                            for i in range(self.number_of_requesters):
-                                if (
-                                    self.current_request_dict[i]["List"]
-                                    and self.current_request_dict[i]["Sent"] is True
-                                ):
-                                    if (
-                                        server
-                                        == self.current_request_dict[i]["List"][
-                                            0
-                                        ].ids.server_id
-                                    ):
-                                        try:
-                                            did_list = [
-                                                request.ids.did
-                                                for request in self.current_request_dict[
-                                                    i
-                                                ][
-                                                    "List"
-                                                ]
-                                            ]
-                                        except:
-                                            logging.debug(
-                                                "\n%s: DID-List not creatable",
-                                                time.time(),
-                                            )
-
-                                        if identifier in did_list:
-                                            self.capture_dict[i].append(response.data)
-
-                                            logging.debug(
-                                                "\n%s: added to capture_dict: %s",
-                                                time.time(),
-                                                response.data,
-                                            )
-                                            self.capture_list.remove(payload)
-                                            break
-                                    else:
-                                        logging.debug(
-                                            "\n%s: Server not matching", time.time()
-                                        )
-                            else:
-                                logging.debug("\n%s: Request not found", time.time())
-                                self.capture_list.remove(payload)
-
-                        elif response and (
-                            response.code == ResponseCode.RequestOutOfRange
-                            or response.code == ResponseCode.ResponseTooLong
-                        ):
-                            # remove the request from the current_request_dict
-                            for i in range(self.number_of_requesters):
-                                if (
-                                    self.current_request_dict[i]["List"]
-                                    and self.current_request_dict[i]["Sent"] is True
-                                ):
-                                    if (
-                                        server
-                                        == self.current_request_dict[i]["List"][
-                                            0
-                                        ].ids.server_id
-                                    ):
-                                        self.current_request_dict[i]["List"] = None
-                                        self.current_request_dict[i]["Sent"] = False
-                                        self.capture_list.remove(payload)
-                        elif (
-                            response
-                            and response.code
-                            == ResponseCode.RequestCorrectlyReceived_ResponsePending
-                        ):
-                            self.capture_list.remove(payload)
-                            ##TODO: handle request out of range
-                            # schedule the request again but in single mode
-                            # shouldn't be necessary, because of the dids perfomance algorith
+                message = self.response_queue.get(timeout=self.slot_table.wait_time())
+            except queue.Empty:
+                message = None
+
+            try:
+                if isinstance(message, DiagnosticMessage):
+                    slot, response_code = self.slot_table.dispatch(
+                        message.source_address, message.user_data
+                    )
+                    if slot is None:
+                        logging.debug("\n%s: Request not found", time.time())
+                    elif response_code in REPLAN_CODES:
+                        # too large requests tighten the limits of the server for the next packs
+                        self.packing_planner.report_negative_response(
+                            slot.server_id,
+                            [request.ids.payload_length for request in slot.requests],
+                            response_code,
+                        )
+                elif isinstance(message, DiagnosticMessageNegativeAcknowledgement):
+                    # the gateway did not route the request to the server
+                    self.slot_table.fail(message.source_address)
 
+                self.slot_table.expire(time.time())
             except Exception as e:
                 print("Error in distribute_responses():", e)
 
@@ -1369,74 +1315,57 @@ class ParallelScheduler:
 
 class Requester:
     """
-    A class for managing requests and sending them to the vehicle.
+    A class for sending the requests of a request slot to the vehicle.
 
     Attributes:
-    - requester_number: The number of the requester.
+    - requester_number: The number of the requester and its request slot.
     - request_list: A list of requests to be sent.
-    - is_active: Flag indicating whether the requester is active.
+    - inbox: The slots waiting to be sent.
 
     Methods:
     - __init__: Initializes the Requester instance.
-    - request: Sends requests to the vehicle.
+    - add_slot: Hands a filled request slot to the requester.
+    - stop_request: Stops the requester after the slots handed to it.
+    - activate_request: Sends the slots handed to the requester, runs in a separate thread.
+    - make_request: Sends the request of a slot.
     - create_didlist: Creates a list of DIDs to be requested.
-    - add_request_to_request_dict: Adds a request to the request list.
     """
 
     def __init__(self, requester_number: int):
         self.requester_number = requester_number
         self.request_list: list[DoIPDidRequest] = []
         self.request: Request
-        self.request_active = True
+        self.inbox = queue.Queue()
+
+    def add_slot(self, slot: RequestSlot):
+        self.inbox.put(slot)
 
     def stop_request(self):
-        self.request_active = False
+        self.inbox.put(None)
 
     def activate_request(self):
-        while self.request_active:
-            if not ParallelScheduler.current_request_dict[self.requester_number][
-                "Sent"
-            ]:
-                request_list = ParallelScheduler.current_request_dict[
-                    self.requester_number
-                ]["List"]
-                if request_list:
-                    self.make_request()
-                    time.sleep(0.0001)
-        else:
-            return
-
-    def make_request(self):
+        while True:
+            slot = self.inbox.get()
+            if slot is None:
+                return
+            self.make_request(slot)
+            ParallelScheduler.Evaluators[self.requester_number].add_slot(slot)
+
+    def make_request(self, slot: RequestSlot):
+        self.request_list = slot.requests
         try:
-            self.request_list = ParallelScheduler.current_request_dict[
-                self.requester_number
-            ]["List"]
-            if self.request_list:
-                client = DoIPConnector.get_client(
-                    self.request_list[0].ids.server_id,
-                    self.request_list[0].ids.tester_id,
-                )
-                did_list = self.create_didlist()
-                request = services.ReadDataByIdentifier.make_request(didlist=did_list)
-                ParallelScheduler.current_request_dict[self.requester_number][
-                    "Sent"
-                ] = True
-                try:
-                    client.send_request_no_response(request)
-                except:
-                    ParallelScheduler.current_request_dict[self.requester_number][
-                        "Sent"
-                    ] = False
-            else:
-                logging.debug("%s\nNo requests to send", time.time())
-
+            session = DoIPConnector.get_session(slot.tester_id)
+            did_list = self.create_didlist()
+            request = services.ReadDataByIdentifier.make_request(didlist=did_list)
+            message = DiagnosticMessage(slot.tester_id, slot.server_id, request.get_payload())
+            # the timeout starts before sending, so that no response can arrive before the slot is in flight
+            ParallelScheduler.slot_table.mark_sent(slot)
+            with session.lock:
+                session.doip_client.send_doip_message(message, disable_retry=True)
+                session.last_used = time.time()
         except Exception as e:
-            self.request_list = ParallelScheduler.current_request_dict[
-                self.requester_number
-            ]["List"]
-            # ParallelScheduler.return_to_request_list(
-            #     request_list=self.request_list, requester_number=self.reqester_number
-            # )
+            # the evaluator finds no response and handles the requests as timed out
+            ParallelScheduler.slot_table.cancel(slot)
             print("Error in Requester: make_request():", e)
 
     def create_didlist(self):
@@ -1456,100 +1385,88 @@ class Evaluator:
         self.csv_filepath = csv_filepath
         self.request_list: list[DoIPDidRequest]
         self.timeout = timeout
-        self.is_active = False
         self.csv_data = []  # Buffer for batch writing
-        self.evaluate_active = True
+        self.inbox = queue.Queue()
+        self.slot: RequestSlot = None
+
+    def add_slot(self, slot: RequestSlot):
+        self.inbox.put(slot)
 
     def stop_evaluation(self):
-        self.write_to_csv()
-        self.evaluate_active = False
+        self.inbox.put(None)
 
     def activate_evaluation(self):
-        while self.evaluate_active:
-            if (
-                self.is_active
-                and ParallelScheduler.current_request_dict[self.evaluator_number][
-                    "Sent"
-                ]
-            ):
-                self.start_evaluation()
-            time.sleep(0.0001)
-        else:
-            return
+        while True:
+            slot = self.inbox.get()
+            if slot is None:
+                if self.csv_filepath:
+                    self.write_to_csv()
+                return
+            self.start_evaluation(slot)
 
-    def start_evaluation(self):
+    def start_evaluation(self, slot: RequestSlot):
+        self.slot = slot
+        self.request_list = list(slot.requests)
         self.search_for_payload()
 
     def search_for_payload(self):
         try:
-            if (
-                ParallelScheduler.current_request_dict[self.evaluator_number]["List"]
-                is not None
-                and not []
-            ):
-                self.request_list = ParallelScheduler.current_request_dict[
-                    self.evaluator_number
-                ]["List"]
-
-                did_list = [
-                    request.ids.did
-                    for request in ParallelScheduler.current_request_dict[
-                        self.evaluator_number
-                    ]["List"]
-                ]
-                start_time = time.time()
-                while time.time() - start_time < self.timeout:
-                    try:
-                        if ParallelScheduler.capture_dict[self.evaluator_number]:
-                            for resp in ParallelScheduler.capture_dict[
-                                self.evaluator_number
-                            ]:
-                                response = list(resp)
-                                did = (response[0] << 8) | response[1]
-
-                                if (
-                                    did in did_list
-                                ):  # already checked in distribution, but to make sure
-                                    self.evaluate_payload(response)
-                                    return
-                    except Exception as e:
-                        print("Error in search_for_payload() inner Loop:", e)
-                self.handle_timeout()
-
+            # the distribution thread completes the future with the response or after the timeout
+            payload, response_code = self.slot.future.result()
+        except TimeoutError:
+            self.handle_timeout()
+            return
         except Exception as e:
             print("Error in search_for_payload():", e)
             self.handle_timeout()
+            return
+
+        if payload is None:
+            logging.debug(
+                "\n%s: Negative response 0x%02x for server 0x%04x",
+                time.time(),
+                response_code or 0,
+                self.slot.server_id,
+            )
+            self.handle_timeout()
+            return
+
+        # the response time is shared by the requested DIDs
+        execution_duration = (self.slot.completion_time - self.slot.sent_time) / len(
+            self.request_list
+        )
+        for request in self.request_list:
+            request.execution_duration = execution_duration
+        self.evaluate_payload(list(payload))
 
     def evaluate_payload(self, payload):
         logging.debug("\n%s start Evaluation", time.time())
         try:
-            payload_copy = payload.copy()
-            while payload:
-                did = (payload[0] << 8) | payload[1]  # get the DID from the payload
-                payload = payload[2:]  # removes identifier
-                for request in self.request_list:  #
-                    if request.ids.did == did:
-                        data = payload[: request.ids.payload_length]
-                        payload = payload[
-                            request.ids.payload_length :
-                        ]  # remove the data from the payload
-                        request.enter_values(data)
-                        if self.csv_filepath:
-                            self.csv_data.append(
-                                (
-                                    time.time(),
-                                    request.unique_ID,
-                                    data,
-                                    0,
-                                    self.evaluator_number,
-                                )
-                            )  # Append data as it is
-                        self.request_list.remove(request)
-                        break
-                else:  # if no request was found for a did set timeout for the remaining requests
-                    self.handle_timeout()
-                    self.clear_all_after_evaluation()
-                    return
+            values = split_response_data(
+                payload,
+                [request.ids.did for request in self.request_list],
+                [request.ids.payload_length for request in self.request_list],
+            )
+            if values is None:  # the response does not match the requests, set timeout for all requests
+                self.handle_timeout()
+                return
+
+            for request in list(self.request_list):
+                if request.ids.did not in values:
+                    continue
+                data = list(values[request.ids.did])
+                request.enter_values(data)
+                if self.csv_filepath:
+                    self.csv_data.append(
+                        (
+                            time.time(),
+                            request.unique_ID,
+                            data,
+                            0,
+                            self.evaluator_number,
+                        )
+                    )  # Append data as it is
+                self.request_list.remove(request)
 
             # handle timeout for requests that did not return a response
             for request_2 in self.request_list:
@@ -1564,6 +1481,7 @@ class Evaluator:
         except Exception as e:
             print("Error in evaluate_payload():", e)
             self.handle_timeout()
+            return
 
         logging.debug("\n%s end Evaluation", time.time())
         self.clear_all_after_evaluation()
@@ -1592,11 +1510,10 @@ class Evaluator:
         logging.debug("%s: start Clearing all after evaluation", time.time())
         if self.csv_data and len(self.csv_data) > 50:
             self.write_to_csv()
-        ParallelScheduler.current_request_dict[self.evaluator_number]["Sent"] = False
-        ParallelScheduler.current_request_dict[self.evaluator_number]["List"] = None
         self.request_list = []
-        self.is_active = False
-        ParallelScheduler.capture_dict[self.evaluator_number] = []
+        if self.slot is not None:
+            ParallelScheduler.slot_table.release(self.slot)
+            self.slot = None
         logging.debug("%s: Cleared all after evaluation", time.time())
 
     def write_to_csv(self):
@@ -0,0 +1,440 @@
+"""
+This module defines the management of activated DoIP connections to the gateways, shared by the discovery scripts,
+the readout and the schedulers.
+
+Setting up a DoIP connection (TCP handshake and routing activation) takes a multiple of a request. Connections are
+therefore kept open by a DoIPConnectionManager and re-used, keyed by (gateway IP, tester address):
+
+    - A lease hands out a connection for exclusive use, e.g. one request or the scan of one server. Connections
+      are health-checked before they are handed out; late responses of a previous user are discarded.
+    - The shared session of a key is used without lease by code multiplexing one connection over several
+      threads (the schedulers send requests and capture the responses in different threads).
+    - A keep-alive thread answers alive checks of the gateway on idle connections and keeps ECUs, which were
+      switched to a non-default diagnostic session, in their session with TesterPresent.
+    - Closed connections are re-established and re-activated transparently, including the diagnostic sessions.
+
+A DoIP connection only handles one outstanding diagnostic request at a time. Requests to different servers
+are therefore overlapped by using several TCP connections to the gateway. The number of connections
+(in-flight requests per gateway) and the number of concurrent requests per server are limited separately.
+Note that some gateways only accept a small number of sockets per tester address.
+
+Classes:
+    - DoIPSession: A single DoIP connection with its UDS clients.
+    - DoIPConnectionManager: Pools of DoIP sessions keyed by gateway and tester address.
+    - DoIPSessionPool: A bounded pool of DoIP sessions to one gateway.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+from revcan.signal_discovery.utils.doipclient import DoIPClient
+from revcan.signal_discovery.utils.doipclient.connectors import DoIPClientUDSConnector
+from revcan.signal_discovery.utils.doipclient.messages import DiagnosticMessage
+from revcan.signal_discovery.utils.udsoncan.client import Client
+
+DEFAULT_SESSION = 0x01
+# TesterPresent with suppressed positive response
+_TESTER_PRESENT = bytes([0x3E, 0x80])
+
+
+class DoIPSession:
+    """
+    A class representing a single DoIP connection to the gateway and the UDS clients using it.
+
+    Attributes:
+        doip_client (DoIPClient): The DoIP client holding the TCP connection.
+        conn (DoIPClientUDSConnector): The connector between the DoIP client and the UDS clients.
+        client (Client): The UDS client of the initial server.
+        server_id (int): Logical address of the server the session currently addresses.
+        session_types (Dict[int, int]): Active diagnostic session per server, if not the default session.
+        lock (threading.RLock): Held while the session is in use, so the keep-alive skips it.
+        last_used (float): Time of the last lease or keep-alive.
+
+    Methods:
+        get_client(server_id, request_timeout): Returns the cached UDS client of a server.
+        change_server(server_id): Addresses another server with this session.
+        change_session(server_id, session_type): Switches a server to a diagnostic session.
+        is_healthy(): Checks the connection and discards unread messages.
+        reconnect(): Re-establishes the connection and the diagnostic sessions.
+        keep_alive(): Answers alive checks and sends TesterPresent to servers in non-default sessions.
+        close(): Closes the connection.
+    """
+
+    def __init__(self, ecu_ip_address: str, server_id: int, client_logical_address: int, request_timeout=1,
+                 client_ip_address: str = None):
+        self.doip_client = DoIPClient(ecu_ip_address=ecu_ip_address, initial_ecu_logical_address=server_id,
+                                      client_logical_address=client_logical_address,
+                                      client_ip_address=client_ip_address)
+        self.conn = DoIPClientUDSConnector(self.doip_client)
+        self.conn.open()
+        self.client_logical_address = client_logical_address
+        self.request_timeout = request_timeout
+        self.server_id = server_id
+        self.session_types: Dict[int, int] = {}
+        self.lock = threading.RLock()
+        self.last_used = time.time()
+        self._clients: Dict[Tuple[int, float], Client] = {}
+        self.client = self.get_client(server_id)
+
+    def get_client(self, server_id: int, request_timeout: float = None) -> Client:
+        """
+        Get the cached UDS client of a server. The client addresses its server with every request, so clients
+        of different servers can be used alternately on this session.
+
+        :param server_id: Logical address of the server.
+        :param request_timeout: Request timeout of the client, defaults to the timeout of the session.
+        :return: The UDS client.
+        """
+        request_timeout = self.request_timeout if request_timeout is None else request_timeout
+        client = self._clients.get((server_id, request_timeout))
+        if client is None:
+            client = Client(self.conn, request_timeout=request_timeout, ecu_logical_address=server_id)
+            self._clients[(server_id, request_timeout)] = client
+        self.change_server(server_id)
+        return client
+
+    def change_server(self, server_id: int):
+        """
+        Address another server with this session.
+
+        :param server_id: Logical address of the server.
+        """
+        if server_id != self.server_id:
+            self.doip_client.change_ecu_logical_address(server_id)
+            self.server_id = server_id
+
+    def change_session(self, server_id: int, session_type: int):
+        """
+        Switch a server to a diagnostic session and keep it there while the session is idle.
+
+        :param server_id: Logical address of the server.
+        :param session_type: Diagnostic session, e.g. 0x03 for the extended session.
+        :return: The response of the server.
+        """
+        response = self.get_client(server_id).change_session(session_type)
+        if response is not None and response.positive:
+            if session_type == DEFAULT_SESSION:
+                self.session_types.pop(server_id, None)
+            else:
+                self.session_types[server_id] = session_type
+        return response
+
+    def is_healthy(self) -> bool:
+        """
+        Check the connection without blocking. Unread messages (late responses of a previous user) are discarded
+        and alive checks are answered.
+
+        :return: False if the gateway closed the connection.
+        """
+        try:
+            for message in self.doip_client.poll_messages():
+                logging.debug(f"Discarding unread DoIP message: {message}")
+        except OSError:
+            return False
+        return not self.doip_client.tcp_close_detected
+
+    def reconnect(self, close_delay: float = 0.1):
+        """
+        Re-establish and re-activate the connection and restore the diagnostic sessions of the servers.
+
+        :param close_delay: Time to wait between closing and re-opening the socket.
+        """
+        self.doip_client.reconnect(close_delay=close_delay)
+        self.doip_client.change_ecu_logical_address(self.server_id)
+        for server_id, session_type in list(self.session_types.items()):
+            try:
+                self.change_session(server_id, session_type)
+            except Exception as e:
+                logging.warning(f"Could not restore diagnostic session 0x{session_type:02x} of server "
+                                f"0x{server_id:04x}: {e}")
+                self.session_types.pop(server_id, None)
+
+    def keep_alive(self, shared=False):
+        """
+        Answer alive checks of the gateway and send TesterPresent to all servers in a non-default session.
+
+        :param shared: The session is used by other threads without lock; received messages are left to them.
+        """
+        if not shared:
+            self.is_healthy()
+        for server_id in list(self.session_types):
+            self.doip_client.send_doip_message(DiagnosticMessage(self.client_logical_address, server_id,
+                                                                 _TESTER_PRESENT))
+        self.last_used = time.time()
+
+    def close(self):
+        """
+        Close the connection of this session.
+        """
+        try:
+            self.conn.close()
+            self.doip_client.close()
+        except Exception:
+            pass
+
+
+class DoIPConnectionManager:
+    """
+    A class managing pools of activated DoIP sessions, keyed by (gateway IP, tester address).
+
+    Attributes:
+        max_sessions_per_key (int): Maximum number of leased sessions per gateway and tester address.
+        request_timeout (float): Default request timeout of the UDS clients.
+        keep_alive_interval (float): Interval of alive check handling and TesterPresent on idle sessions;
+            <= 0 disables the keep-alive thread.
+
+    Methods:
+        lease(ecu_ip_address, client_logical_address, server_id, client_ip_address): Context manager yielding
+            a session for exclusive use.
+        acquire(ecu_ip_address, client_logical_address, server_id, client_ip_address): Takes a session.
+        release(session, discard): Returns a taken session.
+        shared_session(ecu_ip_address, client_logical_address, server_id, client_ip_address): The shared session
+            of a key.
+        close(ecu_ip_address, client_logical_address, include_shared): Closes the sessions of one or all keys.
+    """
+
+    def __init__(self, max_sessions_per_key: int = 8, request_timeout=1, keep_alive_interval=2.0):
+        self.max_sessions_per_key = max(1, max_sessions_per_key)
+        self.request_timeout = request_timeout
+        self.keep_alive_interval = keep_alive_interval
+
+        self._idle_sessions: Dict[Tuple[str, int], List[DoIPSession]] = {}
+        self._session_slots: Dict[Tuple[str, int], threading.BoundedSemaphore] = {}
+        self._shared_sessions: Dict[Tuple[str, int], DoIPSession] = {}
+        self._session_keys: Dict[int, Tuple[str, int]] = {}
+        self._lock = threading.Lock()
+        self._keep_alive_thread = None
+
+    def _slots(self, key) -> threading.BoundedSemaphore:
+        with self._lock:
+            if key not in self._session_slots:
+                self._session_slots[key] = threading.BoundedSemaphore(self.max_sessions_per_key)
+                self._idle_sessions[key] = []
+            return self._session_slots[key]
+
+    def _start_keep_alive(self):
+        if self.keep_alive_interval <= 0 or self._keep_alive_thread is not None:
+            return
+        self._keep_alive_thread = threading.Thread(target=self._keep_alive_loop, name="DoIPKeepAlive", daemon=True)
+        self._keep_alive_thread.start()
+
+    def _keep_alive_loop(self):
+        while True:
+            time.sleep(self.keep_alive_interval / 2)
+            with self._lock:
+                sessions = [(session, False) for sessions in self._idle_sessions.values() for session in sessions]
+                sessions += [(session, True) for session in self._shared_sessions.values()]
+            now = time.time()
+            for session, shared in sessions:
+                if now - session.last_used < self.keep_alive_interval / 2:
+                    continue
+                # Sessions in use are kept alive by their requests
+                if not session.lock.acquire(blocking=False):
+                    continue
+                try:
+                    session.keep_alive(shared)
+                except Exception as e:
+                    logging.debug(f"Keep-alive of DoIP session failed: {e}")
+                finally:
+                    session.lock.release()
+
+    def acquire(self, ecu_ip_address: str, client_logical_address: int, server_id: int = None,
+                client_ip_address: str = None) -> DoIPSession:
+        """
+        Take a session for exclusive use. Blocks while max_sessions_per_key sessions of the key are taken.
+        An idle session is re-used if it is healthy, otherwise re-connected; a new session is opened if none
+        is idle.
+
+        :param ecu_ip_address: IP address of the gateway.
+        :param client_logical_address: Logical address of the tester.
+        :param server_id: Logical address of the server to address first.
+        :param client_ip_address: Optional IP address of the client interface.
+        :return: The session; return it with release().
+        """
+        key = (ecu_ip_address, client_logical_address)
+        self._slots(key).acquire()
+        try:
+            with self._lock:
+                session = self._idle_sessions[key].pop() if self._idle_sessions[key] else None
+            if session is None:
+                session = DoIPSession(ecu_ip_address, 0 if server_id is None else server_id,
+                                      client_logical_address, self.request_timeout, client_ip_address)
+                with self._lock:
+                    self._session_keys[id(session)] = key
+            else:
+                session.lock.acquire()
+                try:
+                    if not session.is_healthy():
+                        logging.debug(f"Reconnecting DoIP session to {ecu_ip_address}.")
+                        session.reconnect()
+                finally:
+                    session.lock.release()
+            session.lock.acquire()
+        except BaseException:
+            self._slots(key).release()
+            raise
+        if server_id is not None:
+            session.change_server(server_id)
+        session.last_used = time.time()
+        self._start_keep_alive()
+        return session
+
+    def release(self, session: DoIPSession, discard=False):
+        """
+        Return a session taken with acquire().
+
+        :param session: The session.
+        :param discard: Close the session instead of re-using it, e.g. after a failed request.
+        """
+        with self._lock:
+            key = self._session_keys[id(session)]
+            if discard:
+                del self._session_keys[id(session)]
+            else:
+                session.last_used = time.time()
+                self._idle_sessions[key].append(session)
+        session.lock.release()
+        if discard:
+            session.close()
+        self._session_slots[key].release()
+
+    @contextmanager
+    def lease(self, ecu_ip_address: str, client_logical_address: int, server_id: int = None,
+              client_ip_address: str = None):
+        """
+        Context manager yielding a session for exclusive use. The session is closed instead of re-used if the
+        block raises an exception, as the connection might be broken afterwards.
+
+        :param ecu_ip_address: IP address of the gateway.
+        :param client_logical_address: Logical address of the tester.
+        :param server_id: Logical address of the server to address first.
+        :param client_ip_address: Optional IP address of the client interface.
+        :return: The session.
+        """
+        session = self.acquire(ecu_ip_address, client_logical_address, server_id, client_ip_address)
+        try:
+            yield session
+        except BaseException:
+            logging.debug(f"Discarding DoIP session to {ecu_ip_address} after a failed request.")
+            self.release(session, discard=True)
+            raise
+        self.release(session)
+
+    def shared_session(self, ecu_ip_address: str, client_logical_address: int, server_id: int = 0,
+                       client_ip_address: str = None) -> DoIPSession:
+        """
+        Get the shared session of a gateway and tester address, which is used without lease. It is opened on
+        first use and re-connected if the gateway closed it.
+
+        :param ecu_ip_address: IP address of the gateway.
+        :param client_logical_address: Logical address of the tester.
+        :param server_id: Logical address of the server to address first when the session is opened.
+        :param client_ip_address: Optional IP address of the client interface.
+        :return: The session.
+        """
+        key = (ecu_ip_address, client_logical_address)
+        with self._lock:
+            session = self._shared_sessions.get(key)
+            if session is None:
+                session = DoIPSession(ecu_ip_address, server_id, client_logical_address, self.request_timeout,
+                                      client_ip_address)
+                self._shared_sessions[key] = session
+            elif session.doip_client.tcp_close_detected:
+                logging.debug(f"Reconnecting shared DoIP session to {ecu_ip_address}.")
+                session.reconnect()
+        session.last_used = time.time()
+        self._start_keep_alive()
+        return session
+
+    def close(self, ecu_ip_address: str = None, client_logical_address: int = None, include_shared=True):
+        """
+        Close the idle sessions of one key, or of all keys if no key is given.
+
+        :param ecu_ip_address: IP address of the gateway.
+        :param client_logical_address: Logical address of the tester.
+        :param include_shared: Also close the shared sessions.
+        """
+        with self._lock:
+            keys = [key for key in set(self._idle_sessions) | set(self._shared_sessions)
+                    if ecu_ip_address is None or key == (ecu_ip_address, client_logical_address)]
+            sessions = []
+            for key in keys:
+                for session in self._idle_sessions.get(key, []):
+                    del self._session_keys[id(session)]
+                    sessions.append(session)
+                self._idle_sessions[key] = []
+                if include_shared and key in self._shared_sessions:
+                    sessions.append(self._shared_sessions.pop(key))
+        for session in sessions:
+            with session.lock:
+                session.close()
+
+
+# Shared by all discovery, readout and scheduler code of a process
+connection_manager = DoIPConnectionManager()
+
+
+class DoIPSessionPool:
+    """
+    A class representing a bounded pool of DoIP sessions to one gateway, leased from a DoIPConnectionManager.
+
+    Sessions are created lazily, re-used for subsequent requests and discarded if a request raises an exception,
+    as the connection might be broken afterwards.
+
+    Attributes:
+        ecu_ip_address (str): IP address of the gateway.
+        client_logical_address (int): Logical address of the client.
+        max_in_flight_per_gateway (int): Maximum number of sessions (concurrent requests) to the gateway.
+        max_in_flight_per_server (int): Maximum number of concurrent requests to the same server.
+        request_timeout (float): Request timeout of the UDS clients.
+        manager (DoIPConnectionManager): The manager the sessions are leased from.
+
+    Methods:
+        session(server_id): Context manager yielding a UDS client addressing the server.
+        close(): Closes all idle sessions.
+    """
+
+    def __init__(self, ecu_ip_address: str, client_logical_address: int, max_in_flight_per_gateway: int = 4,
+                 max_in_flight_per_server: int = 1, request_timeout=1, client_ip_address: str = None,
+                 manager: DoIPConnectionManager = None):
+        self.ecu_ip_address = ecu_ip_address
+        self.client_logical_address = client_logical_address
+        self.max_in_flight_per_gateway = max(1, max_in_flight_per_gateway)
+        self.max_in_flight_per_server = max(1, max_in_flight_per_server)
+        self.request_timeout = request_timeout
+        self.client_ip_address = client_ip_address
+        self.manager = connection_manager if manager is None else manager
+
+        self._gateway_slots = threading.BoundedSemaphore(self.max_in_flight_per_gateway)
+        self._server_slots: Dict[int, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+
+    def _get_server_slots(self, server_id: int) -> threading.BoundedSemaphore:
+        with self._lock:
+            if server_id not in self._server_slots:
+                self._server_slots[server_id] = threading.BoundedSemaphore(self.max_in_flight_per_server)
+            return self._server_slots[server_id]
+
+    @contextmanager
+    def session(self, server_id: int):
+        """
+        Context manager yielding a UDS client which addresses the given server. Blocks until both a gateway
+        and a server slot are available.
+
+        :param server_id: Logical address of the server.
+        :return: The UDS client.
+        """
+        server_slots = self._get_server_slots(server_id)
+        with server_slots, self._gateway_slots:
+            with self.manager.lease(self.ecu_ip_address, self.client_logical_address, server_id,
+                                    self.client_ip_address) as session:
+                yield session.get_client(server_id, self.request_timeout)
+
+    def close(self):
+        """
+        Close all idle sessions to the gateway.
+        """
+        self.manager.close(self.ecu_ip_address, self.client_logical_address, include_shared=False)
@@ -0,0 +1,207 @@
+"""
+This module defines the readout of the ECU identification DIDs (0xF180 - 0xF19F, ISO 14229-1 Table C.1).
+
+The identification DIDs of a server are read with as few multi-DID ReadDataByIdentifier requests as the server
+accepts (see DIDSearch), decoded in one pass and stored in the identification fields of car_metadata.Server.
+The servers are read concurrently over a DoIPSessionPool.
+
+The decoded identification is cached per (VIN, server ID, application software fingerprint 0xF184). A re-run only
+reads the fingerprint of a server and takes the remaining fields from the cache if the fingerprint is unchanged.
+
+Classes:
+    - IdentificationCache: JSON file cache of decoded ECU identifications.
+"""
+
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from revcan.reverse_engineering.models import car_metadata
+from revcan.signal_discovery.did_search import DIDSearch, split_multi_did_response
+from revcan.signal_discovery.doip_session_pool import DoIPSessionPool
+
+# Identification DID -> field of car_metadata.Server
+IDENTIFICATION_FIELDS: Dict[int, str] = {
+    0xF180: "BootSoftwareIdentificationDataIdentifier",
+    0xF181: "applicationSoftwareIdentificationDataIdentifier",
+    0xF182: "applicationDataIdentificationDataIdentifier",
+    0xF183: "bootSoftwareFingerprintDataIdentifier",
+    0xF184: "applicationSoftwareFingerprintDataIdentifier",
+    0xF185: "applicationDataFingerprintDataIdentifier",
+    0xF186: "ActiveDiagnosticSessionDataIdentifier",
+    0xF187: "vehicleManufacturerSparePartNumberDataIdentifier",
+    0xF188: "vehicleManufacturerECUSoftwareNumberDataIdentifier",
+    0xF189: "vehicleManufacturerECUSoftwareVersionNumberDataIdentier",
+    0xF18A: "systemSupplierIdentifierDataIdentifier",
+    0xF18B: "ECUManufacturingDateDataIdentifier",
+    0xF18C: "ECUSerialNumberDataIdentifier",
+    0xF18D: "supportedFunctionalUnitsDataIdentifier",
+    0xF18E: "VehicleManufacturerKitAssemblyPartNumberDataIdentifier",
+    0xF18F: "RegulationXSoftwareIdentificationNumbers",
+    0xF190: "VINDataIdentifier",
+    0xF191: "vehicleManufacturerECUHardwareNumberDataIdentifier",
+    0xF192: "systemSupplierECUHardwareNumberDataIdentifier",
+    0xF193: "systemSupplierECUHardwareVersionNumberDataIdentifier",
+    0xF194: "systemSupplierECUSoftwareNumberDataIdentifier",
+    0xF195: "systemSupplierECUSoftwareVersionNumberDataIdentifier",
+    0xF196: "exhaustRegulationOrTypeApprovalNumberDataIdentifier",
+    0xF197: "systemNameOrEngineTypeDataIdentifier",
+    0xF198: "repairShopCodeOrTesterSerialNumberDataIdentifier",
+    0xF199: "programmingDateDataIdentifier",
+    0xF19A: "calibrationRepairShopCodeOrCalibrationEquipmentSerialNumberDataIdentifier",
+    0xF19B: "calibrationDateDataIdentifier",
+    0xF19C: "calibrationEquipmentSoftwareNumberDataIdentifier",
+    0xF19D: "ECUInstallationDateDataIdentifier",
+    0xF19E: "ODXFileDataIdentifier",
+    0xF19F: "EntityDataIdentifier",
+}
+
+FINGERPRINT_DID = 0xF184
+
+
+def decode_identification(data: bytes) -> str:
+    """
+    Decode the data of an identification DID as UTF-8, falling back to latin-1.
+
+    :param data: Raw data of the DID.
+    :return: Decoded string.
+    """
+    try:
+        return bytes(data).decode('utf-8')
+    except UnicodeDecodeError:
+        return bytes(data).decode('latin-1')
+
+
+class IdentificationCache:
+    """
+    A class representing a JSON file cache of decoded ECU identifications, keyed by VIN, server ID and the
+    application software fingerprint (0xF184) of the server.
+
+    Attributes:
+        file_path (str): Path to the cache file.
+
+    Methods:
+        key(vin, server_id, fingerprint): Builds the cache key.
+        get(key): Returns the cached identification fields or None.
+        put(key, fields): Stores identification fields.
+        save(): Writes the cache file.
+    """
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self._entries: Dict[str, Dict[str, str]] = {}
+        self._lock = threading.Lock()
+        if os.path.exists(file_path):
+            try:
+                with open(file_path, "r") as f:
+                    self._entries = json.load(f)
+            except Exception as e:
+                print(f"Error loading ECU identification cache '{file_path}': {e}. Starting with an empty cache.")
+
+    @staticmethod
+    def key(vin: str, server_id: int, fingerprint: bytes) -> str:
+        return f"{vin}:{server_id:04x}:{bytes(fingerprint).hex()}"
+
+    def get(self, key: str) -> Dict[str, str] | None:
+        with self._lock:
+            return self._entries.get(key)
+
+    def put(self, key: str, fields: Dict[str, str]):
+        with self._lock:
+            self._entries[key] = dict(fields)
+
+    def save(self):
+        with self._lock:
+            temporary_file_path = self.file_path + ".tmp"
+            with open(temporary_file_path, "w") as f:
+                json.dump(self._entries, f, indent=1)
+            os.replace(temporary_file_path, self.file_path)
+
+
+def read_ecu_identification(read_data, server: car_metadata.Server, vin: str = None,
+                            cache: IdentificationCache = None, max_dids_per_request=32) -> bool:
+    """
+    Read the identification DIDs of a server and store them in its identification fields.
+
+    :param read_data: Sends a ReadDataByIdentifier request for a list of DIDs and returns the response.
+    :param server: The server.
+    :param vin: VIN of the car, part of the cache key.
+    :param cache: Identification cache; if set, unchanged servers are only asked for their fingerprint.
+    :param max_dids_per_request: Maximum number of DIDs per request.
+    :return: True if the identification was taken from the cache.
+    """
+    cache_key = None
+    if cache is not None:
+        response = read_data([FINGERPRINT_DID])
+        if response is not None and response.positive and response.data is not None:
+            values = split_multi_did_response(response.data, [FINGERPRINT_DID])
+            if values:
+                cache_key = IdentificationCache.key(vin or "", server.id, values[FINGERPRINT_DID])
+                cached_fields = cache.get(cache_key)
+                if cached_fields is not None:
+                    for field, value in cached_fields.items():
+                        setattr(server, field, value)
+                    return True
+
+    dids = list(IDENTIFICATION_FIELDS)
+    # Start with a single request for all DIDs, the search splits it if the server does not accept it
+    did_search = DIDSearch(read_data, max_batch_size=max_dids_per_request, initial_batch_size=len(dids))
+    did_search.search(dids)
+
+    fields = {}
+    for did, data in did_search.values.items():
+        fields[IDENTIFICATION_FIELDS[did]] = decode_identification(data)
+    for field, value in fields.items():
+        setattr(server, field, value)
+
+    if cache is not None and cache_key is not None:
+        cache.put(cache_key, fields)
+    return False
+
+
+def read_ecu_identifications(session_pool: DoIPSessionPool, servers: List[car_metadata.Server], vin: str = None,
+                             cache: IdentificationCache = None, max_dids_per_request=32, max_workers=4,
+                             print_results=True, activate_logging_flag=False):
+    """
+    Read the identification DIDs of several servers concurrently.
+
+    :param session_pool: Connections to the gateway.
+    :param servers: The servers; their identification fields are updated in place.
+    :param vin: VIN of the car, part of the cache key.
+    :param cache: Identification cache, saved afterwards.
+    :param max_dids_per_request: Maximum number of DIDs per request.
+    :param max_workers: Number of servers read concurrently.
+    :param print_results: Flag to print progress.
+    :param activate_logging_flag: Flag to log issues.
+    """
+
+    def read_server(server):
+        def read_data(didlist):
+            with session_pool.session(server.id) as client:
+                return client.read_data_by_identifier(didlist=didlist)
+
+        try:
+            cached = read_ecu_identification(read_data, server, vin, cache, max_dids_per_request)
+        except Exception as e:
+            print(f"\033[91mError while requesting metadata for server 0x{server.id:04x}: {e}\033[0m")
+            if activate_logging_flag:
+                logging.warning(f"Error while requesting metadata for server 0x{server.id:04x}: {e}")
+            return
+        if print_results:
+            print(f"Requested ECU metadata for server 0x{server.id:04x}{' (cached)' if cached else ''}")
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        list(executor.map(read_server, servers))
+    session_pool.close()
+
+    if cache is not None:
+        try:
+            cache.save()
+        except Exception as e:
+            print(f"Error saving ECU identification cache '{cache.file_path}': {e}")
+            if activate_logging_flag:
+                logging.warning(f"Error saving ECU identification cache '{cache.file_path}': {e}")
+
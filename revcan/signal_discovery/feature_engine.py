@@ -0,0 +1,466 @@
+"""
+This module defines the computation of the signal features of the payload histories with NumPy.
+
+The payloads are kept as bytes instead of '0'/'1' strings, the features of many requests are computed at once:
+
+    - Changing bits: XOR of consecutive payloads, the set bits counted word by word (popcount).
+    - Bit toggle rates: Frequency with which every single bit of a payload changes between consecutive payloads.
+    - Entropy: Every payload is hashed to one 64 bit integer (together with its length); the hashes of a history
+      are sorted and the runs of equal hashes counted instead of comparing strings.
+    - Power spectrum: FFT of the concatenated bits of a history, computed for all histories of the same shape at once.
+
+The payloads of the requests are stored in one ring buffer of shape (requests, history length, payload length).
+Payloads longer than the buffer widen it; shorter ones are padded with zeros and masked by their length. The
+features except the spectrum do not depend on the position of the oldest payload, so the ring buffer is not
+reordered to compute them.
+
+Classes:
+    - HistoryFeatures: Signal features of several payload histories.
+    - PayloadFeatureEngine: Payload histories of many requests in one ring buffer and their batched features.
+"""
+
+import threading
+from typing import Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+# Requests per chunk, limits the size of the temporary arrays
+_CHUNK_SIZE = 16384
+
+# Payloads are stored in whole 64 bit words, so that they can be compared and hashed word by word
+_WORD_LENGTH = 8
+
+# Hashes of the payloads are kept below this value, missing payloads are sorted behind them
+_HASH_MASK = np.uint64(2**63 - 1)
+_MISSING = np.uint64(2**64 - 1)
+
+
+def _as_bytes(payload) -> bytes:
+    if isinstance(payload, np.ndarray):
+        return payload.astype(np.uint8, copy=False).tobytes()
+    return bytes(payload)
+
+
+def _word_aligned(payload_length: int) -> int:
+    return -(-payload_length // _WORD_LENGTH) * _WORD_LENGTH
+
+
+def _popcount(words: np.ndarray) -> np.ndarray:
+    # Number of set bits of every 64 bit word (SWAR, numpy 1.x has no bitwise_count); overwrites words
+    temporary = words >> np.uint64(1)
+    temporary &= np.uint64(0x5555555555555555)
+    words -= temporary
+    np.right_shift(words, np.uint64(2), out=temporary)
+    temporary &= np.uint64(0x3333333333333333)
+    words &= np.uint64(0x3333333333333333)
+    words += temporary
+    np.right_shift(words, np.uint64(4), out=temporary)
+    words += temporary
+    words &= np.uint64(0x0F0F0F0F0F0F0F0F)
+    words *= np.uint64(0x0101010101010101)
+    words >>= np.uint64(56)
+    return words
+
+
+def _hash_weights(number_of_words: int) -> np.ndarray:
+    # Fixed odd 64 bit weights, the hash of a payload is the weighted sum of its words and its length (modulo 2^64)
+    generator = np.random.default_rng(0x5EED)
+    weights = generator.integers(0, 2**63, size=number_of_words + 1, dtype=np.uint64)
+    return weights * np.uint64(2) + np.uint64(1)
+
+
+def stack_histories(histories: Iterable[Sequence], skip: int = 0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Stack payload histories into arrays, e.g. to compute the features of single histories.
+
+    :param histories: Payload histories, every payload is a list of integers, bytes or an array.
+    :param skip: Number of leading bytes of every payload that are not part of the signal, e.g. the response header.
+    :return: Payloads (histories, history length, payload length), payload lengths (histories, history length)
+        and number of payloads per history; the payloads are in chronological order.
+    """
+    histories = [[_as_bytes(payload)[skip:] for payload in history] for history in histories]
+    history_length = max((len(history) for history in histories), default=0)
+    payload_length = max((len(payload) for history in histories for payload in history), default=0)
+    payloads = np.zeros((len(histories), history_length, _word_aligned(payload_length)), dtype=np.uint8)
+    lengths = np.zeros((len(histories), history_length), dtype=np.int32)
+    counts = np.zeros(len(histories), dtype=np.int32)
+    for i, history in enumerate(histories):
+        counts[i] = len(history)
+        for j, payload in enumerate(history):
+            payloads[i, j, : len(payload)] = np.frombuffer(payload, dtype=np.uint8)
+            lengths[i, j] = len(payload)
+    return payloads, lengths, counts
+
+
+class HistoryFeatures:
+    """
+    A class holding the signal features of several payload histories. Every attribute is an array with one value per
+    history, in the order of the histories.
+
+    Attributes:
+        sample_count (ndarray): Number of payloads.
+        changed_bits (ndarray): Number of bits that changed between consecutive payloads, summed over the history.
+        pair_count (ndarray): Number of pairs of consecutive payloads.
+        first_bit_count (ndarray): Number of bits of the oldest payload.
+        entropy (ndarray): Shannon entropy of the payload values in bits.
+        power_spectrum_density (ndarray): Sum of the squared power spectrum; None if not computed.
+        frequency_ratio (ndarray): Ratio of the highest to the second highest power; None if not computed.
+        spectra (list): Power spectrum of every history (without the constant component); None if not computed.
+
+    Methods:
+        changing_bit_rate(): Average share of bits changing between consecutive payloads.
+        normalized_entropy(): Entropy divided by its maximum for the number of payloads.
+    """
+
+    def __init__(self, sample_count, changed_bits, pair_count, first_bit_count, entropy,
+                 power_spectrum_density=None, frequency_ratio=None, spectra=None):
+        self.sample_count = sample_count
+        self.changed_bits = changed_bits
+        self.pair_count = pair_count
+        self.first_bit_count = first_bit_count
+        self.entropy = entropy
+        self.power_spectrum_density = power_spectrum_density
+        self.frequency_ratio = frequency_ratio
+        self.spectra = spectra
+
+    def __len__(self):
+        return len(self.sample_count)
+
+    def changing_bit_rate(self) -> np.ndarray:
+        """
+        :return: Changed bits per pair of payloads divided by the bits of the oldest payload, 0 without pairs or bits.
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rate = self.changed_bits / self.pair_count / self.first_bit_count
+        return np.where((self.pair_count > 0) & (self.first_bit_count > 0), rate, 0.0)
+
+    def normalized_entropy(self) -> np.ndarray:
+        """
+        :return: Entropy divided by log2 of the number of payloads, 0 for less than two payloads.
+        """
+        with np.errstate(divide="ignore", invalid="ignore"):
+            entropy = self.entropy / np.log2(self.sample_count)
+        return np.where(self.sample_count > 1, entropy, 0.0)
+
+
+def history_features(payloads: np.ndarray, lengths: np.ndarray, counts: np.ndarray, heads: np.ndarray = None,
+                     spectrum: bool = True) -> HistoryFeatures:
+    """
+    Compute the signal features of payload histories.
+
+    :param payloads: Payloads (histories, history length, payload length), the payload length a multiple of 8.
+    :param lengths: Payload lengths (histories, history length).
+    :param counts: Number of payloads per history.
+    :param heads: Position after the newest payload of every history if the histories are ring buffers,
+        None if the payloads are in chronological order.
+    :param spectrum: False skips the power spectrum features.
+    :return: The features.
+    """
+    number_of_histories, history_length, payload_length = payloads.shape
+    counts = counts.astype(np.int64)
+    if heads is None:
+        oldest = np.zeros(number_of_histories, dtype=np.int64)
+    else:
+        oldest = (heads.astype(np.int64) - counts) % max(history_length, 1)
+    changed_bits = np.zeros(number_of_histories, dtype=np.int64)
+    entropy = np.zeros(number_of_histories)
+    first_bit_count = np.zeros(number_of_histories, dtype=np.int64)
+    if history_length == 0:
+        return HistoryFeatures(counts, changed_bits, np.maximum(counts - 1, 0), first_bit_count, entropy,
+                               *((np.zeros(number_of_histories), np.zeros(number_of_histories),
+                                  [np.zeros(0)] * number_of_histories) if spectrum else ()))
+    number_of_words = payload_length // _WORD_LENGTH
+    weights = _hash_weights(number_of_words)
+    rows = np.arange(history_length, dtype=np.int32)
+    # c * log2(c) for the number c of equal payloads in a history
+    count_log_count = np.zeros(history_length + 1)
+    count_log_count[1:] = np.arange(1, history_length + 1) * np.log2(np.arange(1, history_length + 1))
+
+    for start in range(0, number_of_histories, _CHUNK_SIZE):
+        chunk = slice(start, start + _CHUNK_SIZE)
+        chunk_lengths, chunk_counts = lengths[chunk], counts[chunk].astype(np.int32)
+        size = len(chunk_counts)
+        words = np.ascontiguousarray(payloads[chunk]).view(np.uint64)  # (histories, history length, words)
+        # Position of every row in chronological order; the row after row k is row k + 1 (modulo the length)
+        age = rows[None, :] - oldest[chunk, None].astype(np.int32)
+        age %= history_length
+        first_bit_count[chunk] = 8 * np.take_along_axis(chunk_lengths, oldest[chunk, None], axis=1)[:, 0]
+
+        if history_length > 1:
+            following = np.roll(words, -1, axis=1)
+            following_lengths = np.roll(chunk_lengths, -1, axis=1)
+            pair_valid = age < (chunk_counts[:, None] - 1)
+            toggled = words ^ following
+            pair_bits = _popcount(toggled).sum(axis=-1, dtype=np.int64)
+            # Payloads of different lengths are only compared up to the length of the shorter one
+            ragged = np.nonzero(pair_valid & (chunk_lengths != following_lengths))
+            if len(ragged[0]):
+                shorter = np.minimum(chunk_lengths, following_lengths)[ragged]
+                ragged_bytes = (words[ragged] ^ following[ragged]).view(np.uint8)
+                ragged_bytes = ragged_bytes * (np.arange(payload_length)[None, :] < shorter[:, None])
+                pair_bits[ragged] = np.unpackbits(ragged_bytes, axis=-1).sum(axis=-1)
+            pair_bits *= pair_valid
+            changed_bits[chunk] = pair_bits.sum(axis=-1)
+
+        # Equal payloads (value and length) have equal hashes. After sorting the hashes of every history, equal
+        # payloads form runs; the entropy is log2(n) - sum(c * log2(c)) / n over the runs of length c.
+        with np.errstate(over="ignore"):
+            hashes = (words * weights[:number_of_words]).sum(axis=-1, dtype=np.uint64)
+            hashes += chunk_lengths.astype(np.uint64) * weights[number_of_words]
+        hashes &= _HASH_MASK
+        hashes[age >= chunk_counts[:, None]] = _MISSING
+        hashes.sort(axis=1)
+        flat = hashes.ravel()
+        run_start = np.empty(flat.size, dtype=bool)
+        run_start[:1] = True
+        np.not_equal(flat[1:], flat[:-1], out=run_start[1:])
+        run_start[::history_length] = True
+        run_start = np.flatnonzero(run_start)
+        run_length = np.diff(run_start, append=flat.size)
+        run_weight = np.where(flat[run_start] != _MISSING, count_log_count[run_length], 0.0)
+        log_sum = np.bincount(run_start // history_length, weights=run_weight, minlength=size)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            entropy[chunk] = np.where(chunk_counts > 0, np.log2(chunk_counts) - log_sum / chunk_counts, 0.0)
+
+    features = HistoryFeatures(counts, changed_bits, np.maximum(counts - 1, 0), first_bit_count, entropy)
+    if spectrum:
+        if heads is not None:
+            order = (oldest[:, None] + np.arange(history_length)[None, :]) % history_length
+            payloads = np.take_along_axis(payloads, order[:, :, None], axis=1)
+            lengths = np.take_along_axis(lengths, order, axis=1)
+        _spectrum_features(payloads, lengths, counts, features)
+    return features
+
+
+def _spectrum_features(payloads, lengths, counts, features: HistoryFeatures):
+    # Power spectrum of the concatenated bits of every history (payloads in chronological order). Histories with the
+    # same number of payloads of the same length are transformed together, the others one by one.
+    number_of_histories = len(counts)
+    power_spectrum_density = np.zeros(number_of_histories)
+    frequency_ratio = np.zeros(number_of_histories)
+    spectra: List[np.ndarray] = [np.zeros(0)] * number_of_histories
+    valid = np.arange(payloads.shape[1])[None, :] < counts[:, None]
+    first_length = lengths[:, 0].astype(np.int64)
+    uniform = np.all((lengths == first_length[:, None]) | ~valid, axis=1)
+
+    def evaluate(indices, bits):
+        # bits: (histories, sequence length), the one-sided spectrum without the constant component
+        sequence_length = bits.shape[1]
+        power_spectrum = np.abs(np.fft.rfft(bits, axis=-1)) ** 2
+        power_spectrum = power_spectrum[:, 1 : sequence_length // 2]
+        power_spectrum_density[indices] = np.sum(power_spectrum**2, axis=-1)
+        if power_spectrum.shape[1] >= 2:
+            top_two = np.partition(power_spectrum, -2, axis=-1)[:, -2:]
+            with np.errstate(divide="ignore", invalid="ignore"):
+                frequency_ratio[indices] = np.where(top_two[:, 0] == 0, 0.0, top_two[:, 1] / top_two[:, 0])
+        for index, history_spectrum in zip(indices, power_spectrum):
+            spectra[index] = history_spectrum
+
+    uniform_indices = np.flatnonzero(uniform & (counts > 0) & (first_length > 0))
+    if len(uniform_indices):
+        shapes = np.column_stack([counts[uniform_indices], first_length[uniform_indices]])
+        keys, inverse = np.unique(shapes, axis=0, return_inverse=True)
+        for key_index, (count, length) in enumerate(keys):
+            indices = uniform_indices[inverse.ravel() == key_index]
+            bits = np.unpackbits(payloads[indices, :count, :length], axis=-1).reshape(len(indices), -1)
+            evaluate(indices, bits.astype(np.float64))
+    for index in np.flatnonzero(~uniform & (counts > 0)):
+        bits = np.concatenate([np.unpackbits(payloads[index, row, : lengths[index, row]])
+                               for row in range(counts[index])])
+        evaluate(np.array([index]), bits[None, :].astype(np.float64))
+
+    features.power_spectrum_density = power_spectrum_density
+    features.frequency_ratio = frequency_ratio
+    features.spectra = spectra
+
+
+class PayloadFeatureEngine:
+    """
+    A class keeping the payload histories of many requests in one ring buffer and computing their signal features
+    in batches. Every history is addressed by an integer index. Thread-safe.
+
+    Attributes:
+        history_length (int): Number of payloads kept per request.
+        skip (int): Number of leading bytes of every payload that are not part of the signal.
+        payloads (ndarray): Ring buffer of the payloads (requests, history_length, payload length).
+        lengths (ndarray): Length of every payload in the ring buffer.
+        counts (ndarray): Number of payloads per request, at most history_length.
+        heads (ndarray): Position of the next payload of every request in the ring buffer.
+        changed (ndarray): Whether a history changed since its features were last refreshed.
+
+    Methods:
+        add(payloads): Adds a history, returns its index.
+        load(index, payloads): Replaces a history.
+        append(index, payload): Appends a payload to a history, replacing the oldest one if it is full.
+        history(index): Returns the payloads of a history.
+        snapshot(indices): Returns a copy of the ring buffer of histories.
+        compute(indices, spectrum): Computes the features of histories.
+        refresh(spectrum): Computes the features of the histories that changed since the last refresh.
+        bit_toggle_rates(indices): Computes the toggle frequency of every bit of histories.
+    """
+
+    def __init__(self, history_length: int, payload_length: int = 8, skip: int = 0, capacity: int = 64):
+        self.history_length = history_length
+        self.skip = skip
+        self.payloads = np.zeros((capacity, history_length, _word_aligned(payload_length)), dtype=np.uint8)
+        self.lengths = np.zeros((capacity, history_length), dtype=np.int32)
+        self.counts = np.zeros(capacity, dtype=np.int32)
+        self.heads = np.zeros(capacity, dtype=np.int32)
+        self.changed = np.zeros(capacity, dtype=bool)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def _reserve(self, size: int, payload_length: int):
+        # Called with the lock held; grows the buffer to hold size histories and payloads of payload_length bytes
+        capacity, _, width = self.payloads.shape
+        if size <= capacity and payload_length <= width:
+            return
+        new_capacity = max(capacity, 1)
+        while new_capacity < size:
+            new_capacity *= 2
+        new_width = max(width, _word_aligned(payload_length))
+        payloads = np.zeros((new_capacity, self.history_length, new_width), dtype=np.uint8)
+        payloads[:capacity, :, :width] = self.payloads
+        self.payloads = payloads
+        for name in ("lengths", "counts", "heads", "changed"):
+            old = getattr(self, name)
+            new = np.zeros((new_capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:capacity] = old
+            setattr(self, name, new)
+
+    def add(self, payloads: Iterable = ()) -> int:
+        """
+        Add a history.
+
+        :param payloads: Payloads of the history, oldest first; only the last history_length are kept.
+        :return: Index of the history.
+        """
+        with self._lock:
+            index = self._size
+            self._reserve(index + 1, 0)
+            self._size += 1
+        self.load(index, payloads)
+        return index
+
+    def load(self, index: int, payloads: Iterable):
+        """
+        Replace a history.
+
+        :param index: Index of the history.
+        :param payloads: Payloads of the history, oldest first; only the last history_length are kept.
+        """
+        payloads = [_as_bytes(payload)[self.skip :] for payload in list(payloads)[-self.history_length :]]
+        lengths = list(map(len, payloads))
+        with self._lock:
+            self._reserve(self._size, max(lengths, default=0))
+            self.payloads[index] = 0
+            self.lengths[index] = 0
+            if payloads and min(lengths) == max(lengths):
+                block = np.frombuffer(b"".join(payloads), dtype=np.uint8).reshape(len(payloads), lengths[0])
+                self.payloads[index, : len(payloads), : lengths[0]] = block
+            else:
+                for row, payload in enumerate(payloads):
+                    self.payloads[index, row, : len(payload)] = np.frombuffer(payload, dtype=np.uint8)
+            self.lengths[index, : len(payloads)] = lengths
+            self.counts[index] = len(payloads)
+            self.heads[index] = len(payloads) % self.history_length
+            self.changed[index] = True
+
+    def append(self, index: int, payload) -> int:
+        """
+        Append a payload to a history, replacing the oldest payload if the history is full.
+
+        :param index: Index of the history.
+        :param payload: The payload.
+        :return: Position of the payload in the ring buffer of the history.
+        """
+        payload = _as_bytes(payload)[self.skip :]
+        with self._lock:
+            self._reserve(self._size, len(payload))
+            head = self.heads[index]
+            row = self.payloads[index, head]
+            row[len(payload) :] = 0
+            row[: len(payload)] = np.frombuffer(payload, dtype=np.uint8)
+            self.lengths[index, head] = len(payload)
+            self.heads[index] = (head + 1) % self.history_length
+            if self.counts[index] < self.history_length:
+                self.counts[index] += 1
+            self.changed[index] = True
+        return int(head)
+
+    def history(self, index: int) -> List[bytes]:
+        """
+        :return: The payloads of a history, oldest first.
+        """
+        with self._lock:
+            count, head = int(self.counts[index]), int(self.heads[index])
+            rows = [(head - count + age) % self.history_length for age in range(count)]
+            return [self.payloads[index, row, : self.lengths[index, row]].tobytes() for row in rows]
+
+    def snapshot(self, indices=None) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Copy the ring buffer of histories, e.g. to compute their features without holding the lock.
+
+        :param indices: Indices of the histories, None for all.
+        :return: Payloads, payload lengths, number of payloads and heads of the histories.
+        """
+        with self._lock:
+            if indices is None:
+                indices = slice(0, self._size)
+            else:
+                indices = np.asarray(indices, dtype=np.int64)
+            return (self.payloads[indices].copy(), self.lengths[indices].copy(),
+                    self.counts[indices].copy(), self.heads[indices].copy())
+
+    def compute(self, indices=None, spectrum: bool = False) -> HistoryFeatures:
+        """
+        Compute the features of histories.
+
+        :param indices: Indices of the histories, None for all.
+        :param spectrum: True also computes the power spectrum features.
+        :return: The features, in the order of the indices.
+        """
+        payloads, lengths, counts, heads = self.snapshot(indices)
+        return history_features(payloads, lengths, counts, heads, spectrum=spectrum)
+
+    def refresh(self, spectrum: bool = False) -> Tuple[np.ndarray, HistoryFeatures]:
+        """
+        Compute the features of the histories that changed since the last refresh.
+
+        :param spectrum: True also computes the power spectrum features.
+        :return: Indices of the changed histories and their features.
+        """
+        with self._lock:
+            indices = np.flatnonzero(self.changed[: self._size])
+            self.changed[indices] = False
+            snapshot = (self.payloads[indices], self.lengths[indices], self.counts[indices], self.heads[indices])
+        return indices, history_features(*snapshot, spectrum=spectrum)
+
+    def bit_toggle_rates(self, indices=None) -> np.ndarray:
+        """
+        Compute how often every bit of the payloads changes between consecutive payloads.
+
+        :param indices: Indices of the histories, None for all.
+        :return: Toggle frequency (histories, 8 * payload length), bit 0 is the most significant bit of the first byte;
+            bits beyond the payloads of a history are 0.
+        """
+        payloads, lengths, counts, heads = self.snapshot(indices)
+        number_of_histories, history_length, payload_length = payloads.shape
+        rates = np.zeros((number_of_histories, 8 * payload_length))
+        if history_length < 2:
+            return rates
+        counts = counts.astype(np.int64)
+        age = (np.arange(history_length)[None, :] - (heads[:, None] - counts[:, None])) % history_length
+        byte_positions = np.arange(payload_length)
+        for start in range(0, number_of_histories, _CHUNK_SIZE):
+            chunk = slice(start, start + _CHUNK_SIZE)
+            pair_valid = age[chunk] < counts[chunk, None] - 1
+            shorter = np.minimum(lengths[chunk], np.roll(lengths[chunk], -1, axis=1))
+            byte_mask = (byte_positions[None, None, :] < shorter[:, :, None]) & pair_valid[:, :, None]
+            toggled = (payloads[chunk] ^ np.roll(payloads[chunk], -1, axis=1)) * byte_mask
+            pair_count = np.maximum(counts[chunk] - 1, 1)
+            rates[chunk] = np.unpackbits(toggled, axis=-1).sum(axis=1) / pair_count[:, None]
+        return rates
@@ -0,0 +1,251 @@
+"""
+This module defines the allocation of the request intervals under the request capacity of the bus.
+
+Every request has a base interval derived from its signal features and limits for its interval. The allocated
+interval of a request is its base interval scaled by a factor common to all requests and clamped to its limits:
+
+    interval_i = min(max(scale * base_i, minimum_i), maximum_i)
+
+The scale is chosen so that the request rate sum(1 / interval_i) equals the capacity, e.g. the number of not
+blacklisted requests per theoretical loop time. The rate decreases monotonically with the scale and is of the form
+A + W / scale between the scales at which a request reaches one of its limits (its breakpoints), so the scale is
+found in one sweep over the sorted breakpoints.
+
+Changing the base interval of a single request only updates its contribution to the sums A and W. The scale is
+moved from its current value to the new solution, updating only the requests whose breakpoints are crossed on the
+way, so an update costs O(log n) plus the crossed breakpoints instead of a pass over all requests.
+
+Classes:
+    - IntervalAllocator: Allocates the request intervals with a common scale factor.
+"""
+
+import bisect
+import math
+import threading
+from typing import Dict, Hashable, List, Tuple
+
+_LOW, _FREE, _HIGH = 0, 1, 2  # interval at its minimum, scaled base interval, interval at its maximum
+
+# Base intervals are kept above this value to keep the rates finite
+_MINIMUM_BASE_INTERVAL = 1e-6
+
+
+class IntervalAllocator:
+    """
+    A class allocating the intervals of requests so that their request rate matches a capacity. Thread-safe.
+
+    Attributes:
+        capacity (float): Requests per second that can be sent.
+        scale (float): Factor of the base intervals.
+
+    Methods:
+        set_base(key, base, minimum, maximum, rebalance): Adds a request or changes its base interval.
+        remove(key): Removes a request.
+        rebalance(): Computes the scale from all requests.
+        interval(key): Returns the allocated interval of a request.
+        send_count(duration): Returns the number of requests sent during a duration.
+    """
+
+    def __init__(self, capacity: float):
+        self.capacity = capacity
+        self.scale = 1.0
+        self._entries: Dict[Hashable, list] = {}  # key -> [base, minimum, maximum, state]
+        self._lower_breakpoints: List[Tuple[float, Hashable]] = []  # (minimum / base, key), sorted
+        self._upper_breakpoints: List[Tuple[float, Hashable]] = []  # (maximum / base, key), sorted
+        self._sorted = True  # False while requests were added without rebalancing
+        self._clamped_rate = 0.0  # A: rate of the requests at one of their limits
+        self._free_weight = 0.0  # W: sum of 1 / base of the other requests
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def set_base(self, key: Hashable, base: float, minimum: float = None, maximum: float = None,
+                 rebalance: bool = True):
+        """
+        Add a request or change its base interval.
+
+        :param key: Key of the request, e.g. its handle.
+        :param base: Base interval of the request.
+        :param minimum: Minimum interval; None keeps the previous one of the request.
+        :param maximum: Maximum interval; None keeps the previous one of the request.
+        :param rebalance: False only adds the request, until rebalance is called, e.g. while adding many requests.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._sort()
+                minimum = entry[1] if minimum is None else minimum
+                maximum = entry[2] if maximum is None else maximum
+                self._remove(key)
+            if minimum is None or maximum is None:
+                raise ValueError("The interval limits are required for a new request.")
+            base = max(base, _MINIMUM_BASE_INTERVAL)
+            maximum = max(maximum, minimum)
+            entry = [base, minimum, maximum, _FREE]
+            self._entries[key] = entry
+            if rebalance and self._sorted:
+                bisect.insort(self._lower_breakpoints, (minimum / base, key))
+                bisect.insort(self._upper_breakpoints, (maximum / base, key))
+            else:
+                self._lower_breakpoints.append((minimum / base, key))
+                self._upper_breakpoints.append((maximum / base, key))
+                self._sorted = False
+            self._enter(entry, self._state(entry, self.scale))
+            if rebalance:
+                self._sort()
+                self._rescale()
+
+    def remove(self, key: Hashable):
+        with self._lock:
+            if key in self._entries:
+                self._sort()
+                self._remove(key)
+                self._rescale()
+
+    def rebalance(self):
+        with self._lock:
+            self._sort()
+            self._reset()
+            self._rescale()
+
+    def interval(self, key: Hashable) -> float:
+        """
+        :return: The allocated interval of a request.
+        """
+        base, minimum, maximum, _ = self._entries[key]
+        return min(max(self.scale * base, minimum), maximum)
+
+    def send_count(self, duration: float) -> float:
+        """
+        :return: The number of requests sent during the duration with the allocated intervals.
+        """
+        with self._lock:
+            return duration * self._rate(self.scale)
+
+    def _sort(self):
+        # Called with the lock held
+        if not self._sorted:
+            self._lower_breakpoints.sort()
+            self._upper_breakpoints.sort()
+            self._sorted = True
+
+    def _remove(self, key):
+        # Called with the lock held, the breakpoints have to be sorted
+        entry = self._entries.pop(key)
+        self._leave(entry)
+        base, minimum, maximum, _ = entry
+        for breakpoints, value in ((self._lower_breakpoints, minimum / base), (self._upper_breakpoints, maximum / base)):
+            index = bisect.bisect_left(breakpoints, (value, key))
+            del breakpoints[index]
+
+    @staticmethod
+    def _state(entry, scale) -> int:
+        base, minimum, maximum, _ = entry
+        if minimum / base >= scale:
+            return _LOW
+        if maximum / base <= scale:
+            return _HIGH
+        return _FREE
+
+    def _enter(self, entry, state):
+        # Adds the contribution of a request to the sums
+        entry[3] = state
+        if state == _LOW:
+            self._clamped_rate += 1 / entry[1]
+        elif state == _HIGH:
+            self._clamped_rate += 1 / entry[2]
+        else:
+            self._free_weight += 1 / entry[0]
+
+    def _leave(self, entry):
+        state = entry[3]
+        if state == _LOW:
+            self._clamped_rate -= 1 / entry[1]
+        elif state == _HIGH:
+            self._clamped_rate -= 1 / entry[2]
+        else:
+            self._free_weight -= 1 / entry[0]
+
+    def _rate(self, scale) -> float:
+        return sum(1 / min(max(scale * base, minimum), maximum) for base, minimum, maximum, _ in self._entries.values())
+
+    def _reset(self):
+        # Called with the lock held. Recomputes the states and sums for the current scale.
+        self._clamped_rate = 0.0
+        self._free_weight = 0.0
+        for entry in self._entries.values():
+            self._enter(entry, self._state(entry, self.scale))
+
+    def _candidate(self) -> float:
+        # Scale at which A + W / scale equals the capacity for the current states, None if there is none
+        if self._free_weight > 0 and self.capacity > self._clamped_rate:
+            return self._free_weight / (self.capacity - self._clamped_rate)
+        return None
+
+    def _rescale(self):
+        # Called with the lock held; the states have to match the current scale. Moves the scale over the
+        # breakpoints towards the capacity, starting at the current scale, and updates the states of the crossed
+        # requests. After a change of a single request, usually no or only a few breakpoints are crossed.
+        if not self._entries:
+            self.scale = 1.0
+            return
+        lower, upper = self._lower_breakpoints, self._upper_breakpoints
+        scale = self.scale
+        rate = self._clamped_rate + self._free_weight / scale
+        if rate > self.capacity:
+            # Increase the scale; the next breakpoints are the smallest ones of requests at their minimum (p >= scale)
+            # and of the other requests (q > scale)
+            i = bisect.bisect_left(lower, (scale,))
+            j = bisect.bisect_right(upper, (scale, math.inf))
+            while True:
+                if i < len(lower) and (j >= len(upper) or lower[i] <= upper[j]):
+                    (breakpoint, key), lower_breakpoint = lower[i], True
+                elif j < len(upper):
+                    (breakpoint, key), lower_breakpoint = upper[j], False
+                else:
+                    # All requests at their maximum interval, the capacity is not reached
+                    scale = upper[-1][0]
+                    break
+                candidate = self._candidate()
+                if candidate is not None and (candidate <= breakpoint if lower_breakpoint else candidate < breakpoint):
+                    scale = candidate
+                    break
+                entry = self._entries[key]
+                self._leave(entry)
+                if lower_breakpoint:
+                    i += 1
+                    self._enter(entry, _HIGH if entry[2] / entry[0] <= breakpoint else _FREE)
+                else:
+                    j += 1
+                    self._enter(entry, _HIGH)
+        elif rate < self.capacity:
+            # Decrease the scale; the next breakpoints are the largest ones of requests at their maximum (q <= scale)
+            # and of the other requests (p < scale)
+            i = bisect.bisect_left(lower, (scale,)) - 1
+            j = bisect.bisect_right(upper, (scale, math.inf)) - 1
+            while True:
+                if j >= 0 and (i < 0 or upper[j] >= lower[i]):
+                    (breakpoint, key), lower_breakpoint = upper[j], False
+                elif i >= 0:
+                    (breakpoint, key), lower_breakpoint = lower[i], True
+                else:
+                    # All requests can be sent with their minimum interval
+                    scale = lower[0][0]
+                    break
+                candidate = self._candidate()
+                if candidate is not None and (candidate > breakpoint if lower_breakpoint else candidate >= breakpoint):
+                    scale = candidate
+                    break
+                entry = self._entries[key]
+                self._leave(entry)
+                if lower_breakpoint:
+                    i -= 1
+                    self._enter(entry, _LOW)
+                else:
+                    j -= 1
+                    self._enter(entry, _LOW if entry[1] / entry[0] >= breakpoint else _FREE)
+        self.scale = scale
@@ -0,0 +1,350 @@
+"""
+This module defines the in-flight request slots of the ParallelScheduler and the routing of the captured
+responses to them.
+
+Every slot holds one multi-DID ReadDataByIdentifier request. Its outcome is delivered through a future, so the
+threads sending and evaluating the requests block instead of polling shared state:
+
+    - Positive responses are routed by (source address, first DID) through a dispatch table. The servers answer
+      the DIDs in the requested order, and no two slots in flight share the key.
+    - Negative responses carry no DID; they complete the oldest request in flight to the server.
+      ResponsePending extends the deadline of that request.
+    - A server answers its requests in order, so the response to a timed-out request can only arrive before the
+      responses to later requests. The timed-out requests of a server are recorded for another timeout: the next
+      negative response of the server and a positive response with the key of a timed-out request are dropped
+      instead of completing a later slot. A positive response to a later slot discards the older records.
+    - Deadlines are kept in a hashed timer wheel; scheduling and cancelling a timeout is O(1).
+
+Classes:
+    - TimerWheel: Hashed timer wheel for the request timeouts.
+    - RequestSlot: A request slot with the requests in flight and the future of their outcome.
+    - SlotTable: The request slots, their dispatch table and timeouts.
+"""
+
+import itertools
+import math
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from concurrent.futures import Future
+from typing import Dict, Hashable, List, Tuple
+
+from revcan.signal_discovery.utils.udsoncan.ResponseCode import ResponseCode
+
+_READ_DATA_BY_IDENTIFIER = 0x22
+_POSITIVE_RESPONSE_OFFSET = 0x40
+_NEGATIVE_RESPONSE_SID = 0x7F
+
+
+class TimerWheel:
+    """
+    A class representing a hashed timer wheel. Timers are put into the bucket of their expiry tick; advancing the
+    wheel only visits the buckets of the elapsed ticks. Not thread-safe.
+
+    Attributes:
+        tick (float): Resolution of the timers in seconds.
+        number_of_buckets (int): Number of buckets of the wheel.
+
+    Methods:
+        schedule(deadline, value): Adds a timer, returns its handle.
+        cancel(handle): Removes a timer.
+        advance(now): Removes and returns the values of all expired timers.
+    """
+
+    def __init__(self, tick: float = 0.01, number_of_buckets: int = 512, now: float = None):
+        self.tick = tick
+        self.number_of_buckets = number_of_buckets
+        self._buckets: List[Dict[int, Tuple[int, object]]] = [{} for _ in range(number_of_buckets)]
+        self._bucket_of_handle: Dict[int, int] = {}
+        self._handles = itertools.count()
+        self._current_tick = int((time.time() if now is None else now) / tick)
+
+    def __len__(self):
+        return len(self._bucket_of_handle)
+
+    def schedule(self, deadline: float, value) -> int:
+        """
+        Add a timer.
+
+        :param deadline: Expiry time (time.time()).
+        :param value: Returned by advance once the timer expired.
+        :return: Handle of the timer.
+        """
+        expiry_tick = max(math.ceil(deadline / self.tick), self._current_tick + 1)
+        handle = next(self._handles)
+        bucket = expiry_tick % self.number_of_buckets
+        self._buckets[bucket][handle] = (expiry_tick, value)
+        self._bucket_of_handle[handle] = bucket
+        return handle
+
+    def cancel(self, handle: int):
+        bucket = self._bucket_of_handle.pop(handle, None)
+        if bucket is not None:
+            del self._buckets[bucket][handle]
+
+    def advance(self, now: float) -> list:
+        """
+        Advance the wheel to the given time.
+
+        :param now: Current time (time.time()).
+        :return: Values of the expired timers.
+        """
+        target_tick = int(now / self.tick)
+        if target_tick <= self._current_tick:
+            return []
+        if target_tick - self._current_tick >= self.number_of_buckets:
+            # More than one revolution elapsed, every bucket is due
+            buckets = range(self.number_of_buckets)
+        else:
+            buckets = [tick % self.number_of_buckets for tick in range(self._current_tick + 1, target_tick + 1)]
+        self._current_tick = target_tick
+
+        expired = []
+        for bucket in buckets:
+            timers = self._buckets[bucket]
+            if not timers:
+                continue
+            for handle, (expiry_tick, value) in list(timers.items()):
+                if expiry_tick <= target_tick:
+                    del timers[handle]
+                    del self._bucket_of_handle[handle]
+                    expired.append(value)
+        return expired
+
+
+class RequestSlot:
+    """
+    A class representing a request slot of the ParallelScheduler.
+
+    Attributes:
+        number (int): Number of the slot, equal to the number of its Requester and Evaluator.
+        requests (list[DoIPDidRequest]): Requests of the slot, in the order of the DIDs of the request.
+        server_id (int): Server of the requests.
+        tester_id (int): Tester address of the requests.
+        future (Future): Outcome of the request: (data, response code); data is the response without SID
+            (DID and data for every DID) or None for negative responses. Raises TimeoutError without response.
+        sent_time (float): Time the request was sent.
+        completion_time (float): Time the outcome was set.
+    """
+
+    def __init__(self, number: int):
+        self.number = number
+        self.requests = []
+        self.server_id = None
+        self.tester_id = None
+        self.future: Future = None
+        self.sent_time = 0.0
+        self.completion_time = 0.0
+        self._key = None
+        self._timer = None
+
+    @property
+    def did_list(self) -> List[int]:
+        return [request.ids.did for request in self.requests]
+
+
+class SlotTable:
+    """
+    A class holding the request slots of the ParallelScheduler, their dispatch table and timeouts. Thread-safe.
+
+    Attributes:
+        slots (list[RequestSlot]): All slots.
+        timeout (float): Time to wait for a response.
+
+    Methods:
+        acquire(requests): Waits for a free slot and assigns the requests to it.
+        mark_sent(slot): Starts the timeout of a slot; called right before its request is sent.
+        dispatch(source_address, user_data): Routes a received diagnostic message to its slot.
+        fail(source_address): Completes the oldest request in flight to a server without response.
+        cancel(slot): Completes a slot without response, e.g. if its request could not be sent.
+        expire(now): Completes the slots whose timeout expired.
+        release(slot): Frees a slot after its outcome was evaluated.
+        wait_time(): Time until the timeouts have to be checked again.
+        wait_for_release(timeout): Waits until a slot is released.
+        in_flight_servers(): Servers with requests in slots.
+    """
+
+    def __init__(self, number_of_slots: int, timeout: float = 1.0, tick: float = 0.01):
+        self.slots = [RequestSlot(i) for i in range(number_of_slots)]
+        self.timeout = timeout
+        self._free = queue.Queue()
+        for slot in self.slots:
+            self._free.put(slot.number)
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        self._by_key: Dict[Hashable, RequestSlot] = {}
+        self._in_flight: Dict[int, deque] = defaultdict(deque)
+        # Server ID -> timed-out requests whose response may still arrive: [key, sent time, end of the record]
+        self._timed_out: Dict[int, deque] = defaultdict(deque)
+        self._wheel = TimerWheel(tick)
+
+    def acquire(self, requests: list) -> RequestSlot:
+        """
+        Wait for a free slot and assign the requests to it. The requests are reordered, so that their first DID
+        is not the first DID of another slot of the server; if all are, the call waits for such a slot to be released.
+
+        :param requests: Requests of one server.
+        :return: The slot.
+        """
+        slot = self.slots[self._free.get()]
+        server_id = requests[0].ids.server_id
+        with self._lock:
+            while True:
+                first = next((i for i, request in enumerate(requests)
+                              if (server_id, request.ids.did) not in self._by_key), None)
+                if first is not None:
+                    break
+                self._released.wait()
+            requests = list(requests)
+            requests[0], requests[first] = requests[first], requests[0]
+            slot.requests = requests
+            slot.server_id = server_id
+            slot.tester_id = requests[0].ids.tester_id
+            slot.future = Future()
+            slot._key = (server_id, requests[0].ids.did)
+            self._by_key[slot._key] = slot
+        return slot
+
+    def mark_sent(self, slot: RequestSlot):
+        with self._lock:
+            slot.sent_time = time.time()
+            self._in_flight[slot.server_id].append(slot)
+            slot._timer = self._wheel.schedule(slot.sent_time + self.timeout, slot)
+
+    def _complete(self, slot: RequestSlot, data=None, response_code=None, timeout=False):
+        # Called with the lock held
+        if slot._timer is not None:
+            self._wheel.cancel(slot._timer)
+            slot._timer = None
+        if self._by_key.get(slot._key) is slot:
+            del self._by_key[slot._key]
+        in_flight = self._in_flight.get(slot.server_id)
+        sent = bool(in_flight) and slot in in_flight
+        if sent:
+            in_flight.remove(slot)
+        slot.completion_time = time.time()
+        if timeout:
+            if sent:
+                self._timed_out[slot.server_id].append([slot._key, slot.sent_time, slot.completion_time + self.timeout])
+            slot.future.set_exception(TimeoutError("No response within the request timeout"))
+        else:
+            slot.future.set_result((data, response_code))
+
+    def dispatch(self, source_address: int, user_data: bytes) -> Tuple[RequestSlot, int]:
+        """
+        Route a received diagnostic message to its slot.
+
+        :param source_address: Source address of the message (server ID).
+        :param user_data: UDS payload of the message.
+        :return: The completed slot and the response code (ResponseCode.PositiveResponse for positive responses),
+            or (None, None) if the message completed no slot.
+        """
+        user_data = bytes(user_data)
+        with self._lock:
+            timed_out = self._late_responses(source_address, time.time())
+            if len(user_data) >= 3 and user_data[0] == _READ_DATA_BY_IDENTIFIER + _POSITIVE_RESPONSE_OFFSET:
+                key = (source_address, int.from_bytes(user_data[1:3], "big"))
+                late = next((i for i, record in enumerate(timed_out) if record[0] == key), None)
+                if late is not None:
+                    # Late response to a timed-out request; the older timed-out requests remain unanswered
+                    for _ in range(late + 1):
+                        timed_out.popleft()
+                    return None, None
+                slot = self._by_key.get(key)
+                if slot is None or slot.future.done():
+                    return None, None
+                while timed_out and timed_out[0][1] <= slot.sent_time:
+                    timed_out.popleft()
+                self._complete(slot, data=user_data[1:], response_code=ResponseCode.PositiveResponse)
+                return slot, ResponseCode.PositiveResponse
+
+            if (len(user_data) >= 3 and user_data[0] == _NEGATIVE_RESPONSE_SID
+                    and user_data[1] == _READ_DATA_BY_IDENTIFIER and timed_out):
+                # Negative responses carry no DID, the oldest timed-out request may still be answered
+                if user_data[2] == ResponseCode.RequestCorrectlyReceived_ResponsePending:
+                    timed_out[0][2] = time.time() + self.timeout
+                else:
+                    timed_out.popleft()
+                return None, None
+
+            if (len(user_data) >= 3 and user_data[0] == _NEGATIVE_RESPONSE_SID
+                    and user_data[1] == _READ_DATA_BY_IDENTIFIER and self._in_flight.get(source_address)):
+                slot = self._in_flight[source_address][0]
+                response_code = user_data[2]
+                if response_code == ResponseCode.RequestCorrectlyReceived_ResponsePending:
+                    self._wheel.cancel(slot._timer)
+                    slot._timer = self._wheel.schedule(time.time() + self.timeout, slot)
+                    return None, None
+                self._complete(slot, response_code=response_code)
+                return slot, response_code
+        return None, None
+
+    def _late_responses(self, server_id: int, now: float) -> deque:
+        # Called with the lock held; drops the records of timed-out requests which are no longer answered
+        timed_out = self._timed_out.get(server_id)
+        if not timed_out:
+            return deque()
+        if any(record[2] < now for record in timed_out):
+            timed_out = deque(record for record in timed_out if record[2] >= now)
+            self._timed_out[server_id] = timed_out
+        return timed_out
+
+    def fail(self, source_address: int) -> RequestSlot:
+        """
+        Complete the oldest request in flight to a server without response, e.g. after a diagnostic negative
+        acknowledgement of the gateway.
+
+        :param source_address: Server ID.
+        :return: The completed slot or None.
+        """
+        with self._lock:
+            if not self._in_flight.get(source_address):
+                return None
+            slot = self._in_flight[source_address][0]
+            self._complete(slot)
+            return slot
+
+    def cancel(self, slot: RequestSlot):
+        with self._lock:
+            if slot.future is not None and not slot.future.done():
+                self._complete(slot)
+
+    def expire(self, now: float = None) -> List[RequestSlot]:
+        """
+        Complete the slots whose timeout expired with a TimeoutError.
+
+        :param now: Current time.
+        :return: The expired slots.
+        """
+        with self._lock:
+            slots = self._wheel.advance(time.time() if now is None else now)
+            for slot in slots:
+                slot._timer = None
+                self._complete(slot, timeout=True)
+        return slots
+
+    def release(self, slot: RequestSlot):
+        with self._lock:
+            if slot.future is not None and not slot.future.done():
+                self._complete(slot, timeout=True)
+            slot.requests = []
+            slot.server_id = None
+            slot._key = None
+            self._released.notify_all()
+        self._free.put(slot.number)
+
+    def wait_time(self) -> float:
+        """
+        :return: Time until the timeouts have to be checked again, None without requests in flight.
+        """
+        with self._lock:
+            return self._wheel.tick if len(self._wheel) else None
+
+    def wait_for_release(self, timeout: float = None):
+        with self._lock:
+            self._released.wait(timeout)
+
+    def in_flight_servers(self) -> List[int]:
+        with self._lock:
+            return [slot.server_id for slot in self.slots if slot.server_id is not None]
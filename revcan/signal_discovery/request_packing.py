@@ -0,0 +1,312 @@
+"""
+This module defines the packing of DIDs into multi-DID ReadDataByIdentifier requests.
+
+Every server limits the number of DIDs per request and the size of the response. The limits are measured with
+DOIP_Discoverer.check_dids_performance_automatic, which saves them as "<name>_config_file.csv"
+(Server_ID, DID Length, Payload Size), or are known from the car metadata (max_payload_length). The planner packs
+the DIDs of every server into as few requests as possible without exceeding these limits (first-fit decreasing
+bin packing, the number of requests is at most 11/9 of the optimum plus one). If a server rejects a request with
+ResponseTooLong or IncorrectMessageLengthOrInvalidFormat, its limits are tightened and the users of the planner
+re-plan their requests. The positive responses of packed requests are split with split_response_data using the
+known data length of every DID.
+
+Classes:
+    - ServerLimits: Measured request limits of a server.
+    - RequestPackingPlanner: Response-size-aware packing of DIDs into requests.
+"""
+
+import csv
+import logging
+import math
+import threading
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Sequence, TypeVar
+
+from revcan.signal_discovery.utils.udsoncan.ResponseCode import ResponseCode
+
+T = TypeVar("T")
+
+# Negative response codes which mean that the request contained too many DIDs or the response got too large
+REPLAN_CODES = (ResponseCode.ResponseTooLong, ResponseCode.IncorrectMessageLengthOrInvalidFormat)
+
+# Positive response: SID followed by DID (2 bytes) and data for every requested DID
+_RESPONSE_SID_LENGTH = 1
+_DID_LENGTH = 2
+
+
+def split_response_data(data: bytes, dids: Sequence[int], lengths: Sequence[int]) -> Dict[int, bytes] | None:
+    """
+    Split the data of a positive ReadDataByIdentifier response to a packed request using the known data length of
+    every DID. The response contains DID (2 bytes) and data of the requested DIDs in request order; DIDs the server
+    does not support are missing.
+
+    :param data: Data of the positive response (without the service ID).
+    :param dids: Requested DIDs in request order.
+    :param lengths: Data length of every requested DID.
+    :return: Data per DID contained in the response, or None if the response does not match the request.
+    """
+    data = bytes(data)
+    values = {}
+    offset = 0
+    position = 0
+    while offset < len(data):
+        if offset + _DID_LENGTH > len(data):
+            return None
+        did = int.from_bytes(data[offset:offset + _DID_LENGTH], "big")
+        while position < len(dids) and dids[position] != did:
+            position += 1
+        if position == len(dids):
+            return None
+        end = offset + _DID_LENGTH + lengths[position]
+        if end > len(data):
+            return None
+        values[did] = data[offset + _DID_LENGTH:end]
+        offset = end
+        position += 1
+    return values
+
+
+class ServerLimits:
+    """
+    A class representing the request limits of a server. A limit of None is unknown and not enforced.
+
+    Attributes:
+        max_dids (int): Maximum number of DIDs per request.
+        max_payload_length (int): Maximum sum of the data lengths of the DIDs of a request,
+            as measured by check_dids_performance_automatic.
+        max_response_length (int): Maximum length of the positive response (SID, and DID + data for every DID).
+
+    Methods:
+        fits(number_of_dids, payload_length): Checks whether a request is within the limits.
+    """
+
+    def __init__(self, max_dids: int = None, max_payload_length: int = None, max_response_length: int = None):
+        self.max_dids = max_dids if max_dids is not None and max_dids > 0 else None
+        self.max_payload_length = max_payload_length if max_payload_length is not None and max_payload_length > 0 else None
+        self.max_response_length = max_response_length if max_response_length is not None and max_response_length > 0 else None
+
+    def __str__(self):
+        return f"DIDs: {self.max_dids}, payload: {self.max_payload_length}, response: {self.max_response_length}"
+
+    def fits(self, number_of_dids: int, payload_length: int) -> bool:
+        """
+        Check whether a request is within the limits.
+
+        :param number_of_dids: Number of DIDs of the request.
+        :param payload_length: Sum of the data lengths of the DIDs.
+        :return: True if the request is within the limits.
+        """
+        if self.max_dids is not None and number_of_dids > self.max_dids:
+            return False
+        if self.max_payload_length is not None and payload_length > self.max_payload_length:
+            return False
+        if (self.max_response_length is not None
+                and _RESPONSE_SID_LENGTH + _DID_LENGTH * number_of_dids + payload_length > self.max_response_length):
+            return False
+        return True
+
+    def merge(self, other: "ServerLimits") -> "ServerLimits":
+        """
+        Combine two limits of the same server, the tighter value of every limit applies.
+
+        :param other: Limits of another source.
+        :return: The combined limits.
+        """
+        def tighter(a, b):
+            if a is None:
+                return b
+            if b is None:
+                return a
+            return min(a, b)
+
+        return ServerLimits(tighter(self.max_dids, other.max_dids),
+                            tighter(self.max_payload_length, other.max_payload_length),
+                            tighter(self.max_response_length, other.max_response_length))
+
+    @staticmethod
+    def load_performance_list(path: str) -> Dict[int, "ServerLimits"]:
+        """
+        Load the limits saved by check_dids_performance_automatic (Server_ID, DID Length, Payload Size).
+        A payload size of 0 was not measured.
+
+        :param path: Path to the "<name>_config_file.csv".
+        :return: Limits per server ID.
+        """
+        limits = {}
+        with open(path, "r", newline="") as file:
+            reader = csv.reader(file)
+            next(reader, None)  # header
+            for line in reader:
+                if len(line) < 3:
+                    continue
+                server_id = int(line[0].strip().strip("'"), 16)
+                limits[server_id] = ServerLimits(max_dids=int(line[1].strip().strip("'")),
+                                                 max_payload_length=int(line[2].strip().strip("'")))
+        return limits
+
+
+class RequestPackingPlanner:
+    """
+    A class packing the DIDs of several servers into ReadDataByIdentifier requests. Only DIDs of the same server
+    are packed together. The planner is thread-safe; its revision is increased whenever the limits of a server
+    change, so that users can re-plan their requests.
+
+    Attributes:
+        default_limits (ServerLimits): Limits of servers without own limits.
+        limits (Dict[int, ServerLimits]): Limits per server ID.
+        revision (int): Number of limit changes.
+
+    Methods:
+        from_performance_list(path, max_dids): Creates a planner from the saved limits of the servers.
+        set_limits(server_id, limits): Sets (merges) the limits of a server.
+        get_limits(server_id): Returns the limits of a server.
+        plan(items, server_of, length_of): Packs items into as few requests as possible.
+        lower_bound(server_id, lengths): Returns the minimum number of requests for DIDs of a server.
+        fill(server_id, items, length_of): Builds the next request from items of one server, the first one is always included.
+        report_negative_response(server_id, payload_lengths, response_code): Tightens the limits after a rejected request.
+    """
+
+    def __init__(self, default_limits: ServerLimits = None, limits: Dict[int, ServerLimits] = None):
+        self.default_limits = default_limits if default_limits is not None else ServerLimits(max_dids=1)
+        self.limits: Dict[int, ServerLimits] = dict(limits) if limits else {}
+        self.revision = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_performance_list(cls, path: str = None, max_dids: int = 1) -> "RequestPackingPlanner":
+        """
+        Create a planner from the limits saved by check_dids_performance_automatic.
+
+        :param path: Path to the "<name>_config_file.csv"; None uses max_dids for all servers.
+        :param max_dids: Maximum number of DIDs per request of servers which are not in the list.
+        :return: The planner.
+        """
+        limits = ServerLimits.load_performance_list(path) if path else None
+        return cls(ServerLimits(max_dids=max_dids), limits)
+
+    def set_limits(self, server_id: int, limits: ServerLimits):
+        """
+        Set the limits of a server; limits already known for the server are combined with the new ones.
+
+        :param server_id: Server ID.
+        :param limits: Limits of the server.
+        """
+        with self._lock:
+            if server_id in self.limits:
+                limits = self.limits[server_id].merge(limits)
+            self.limits[server_id] = limits
+            self.revision += 1
+
+    def get_limits(self, server_id: int) -> ServerLimits:
+        return self.limits.get(server_id, self.default_limits)
+
+    def plan(self, items: Iterable[T], server_of: Callable[[T], int], length_of: Callable[[T], int]) -> List[List[T]]:
+        """
+        Pack items into as few requests as possible (first-fit decreasing per server). An item exceeding the limits
+        on its own gets a request of its own. The requests are ordered by server in the order of their first
+        appearance; the items of a request keep their original order.
+
+        :param items: Items to be requested, e.g. Signal or DoIPDidRequest.
+        :param server_of: Returns the server ID of an item.
+        :param length_of: Returns the data length of an item.
+        :return: The requests.
+        """
+        items_per_server = defaultdict(list)
+        for index, item in enumerate(items):
+            items_per_server[server_of(item)].append((index, length_of(item), item))
+
+        packs = []
+        for server_id, server_items in items_per_server.items():
+            limits = self.get_limits(server_id)
+            if limits.max_payload_length is None and limits.max_response_length is None:
+                # Only the number of DIDs is limited, any split into full requests is optimal
+                size = limits.max_dids or len(server_items)
+                bins = [server_items[i:i + size] for i in range(0, len(server_items), size)]
+            else:
+                bins = []
+                bin_lengths = []
+                for entry in sorted(server_items, key=lambda entry: entry[1], reverse=True):
+                    for i, current_bin in enumerate(bins):
+                        if limits.fits(len(current_bin) + 1, bin_lengths[i] + entry[1]):
+                            current_bin.append(entry)
+                            bin_lengths[i] += entry[1]
+                            break
+                    else:
+                        bins.append([entry])
+                        bin_lengths.append(entry[1])
+                bins.sort(key=lambda current_bin: min(entry[0] for entry in current_bin))
+            for current_bin in bins:
+                packs.append([entry[2] for entry in sorted(current_bin, key=lambda entry: entry[0])])
+        return packs
+
+    def lower_bound(self, server_id: int, lengths: List[int]) -> int:
+        """
+        Minimum number of requests needed for DIDs of a server, used to rate a plan.
+
+        :param server_id: Server ID.
+        :param lengths: Data lengths of the DIDs.
+        :return: The minimum number of requests.
+        """
+        if not lengths:
+            return 0
+        limits = self.get_limits(server_id)
+        bound = 1
+        if limits.max_dids is not None:
+            bound = max(bound, math.ceil(len(lengths) / limits.max_dids))
+        if limits.max_payload_length is not None:
+            bound = max(bound, math.ceil(sum(lengths) / limits.max_payload_length))
+        if limits.max_response_length is not None:
+            usable = limits.max_response_length - _RESPONSE_SID_LENGTH
+            if usable > 0:
+                bound = max(bound, math.ceil(sum(_DID_LENGTH + length for length in lengths) / usable))
+        return bound
+
+    def fill(self, server_id: int, items: List[T], length_of: Callable[[T], int]) -> List[T]:
+        """
+        Build the next request from waiting items of one server. The first (most urgent) item is always included,
+        the following items are added in their order as long as they fit.
+
+        :param server_id: Server ID of the items.
+        :param items: Waiting items of the server, most urgent first.
+        :param length_of: Returns the data length of an item.
+        :return: The items of the request.
+        """
+        if not items:
+            return []
+        limits = self.get_limits(server_id)
+        pack = [items[0]]
+        payload_length = length_of(items[0])
+        for item in items[1:]:
+            if limits.max_dids is not None and len(pack) >= limits.max_dids:
+                break
+            length = length_of(item)
+            if limits.fits(len(pack) + 1, payload_length + length):
+                pack.append(item)
+                payload_length += length
+        return pack
+
+    def report_negative_response(self, server_id: int, payload_lengths: List[int], response_code: int) -> bool:
+        """
+        Tighten the limits of a server after it rejected a request with several DIDs. ResponseTooLong limits the
+        payload length below the rejected one, IncorrectMessageLengthOrInvalidFormat the number of DIDs.
+
+        :param server_id: Server ID.
+        :param payload_lengths: Data lengths of the DIDs of the rejected request.
+        :param response_code: Negative response code.
+        :return: True if the limits were tightened and the requests have to be re-planned.
+        """
+        if response_code not in REPLAN_CODES or len(payload_lengths) < 2:
+            return False
+        with self._lock:
+            limits = self.limits.get(server_id, self.default_limits)
+            if response_code == ResponseCode.ResponseTooLong:
+                new_limits = limits.merge(ServerLimits(max_payload_length=sum(payload_lengths) - 1))
+            else:
+                new_limits = limits.merge(ServerLimits(max_dids=len(payload_lengths) - 1))
+            if (new_limits.max_dids, new_limits.max_payload_length) == (limits.max_dids, limits.max_payload_length):
+                return False
+            self.limits[server_id] = new_limits
+            self.revision += 1
+        logging.info(f"Request limits of server 0x{server_id:04x} tightened after negative response "
+                     f"0x{response_code:02x}: {new_limits}")
+        return True
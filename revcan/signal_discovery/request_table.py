@@ -0,0 +1,408 @@
+"""
+This module defines a compact, array-backed storage of the DoIP requests for the schedulers.
+
+Every DoIPDidRequest holds a RequestID, an Interval, a DidPayloadHistory with two deques, a debug history and a
+unique ID string; for vehicles with tens of thousands of DIDs, these objects take hundreds of MB and are slow to
+create. The RequestTable stores the requests as NumPy columns (struct of arrays) instead:
+
+    - One row per request, rows are addressed by their index. Requests are identified by server ID and DID, the
+      lookup uses an integer key instead of hex strings.
+    - The payload histories are stored in the shared ring buffer of a PayloadFeatureEngine (row = history index),
+      their timestamps in a column of the same shape. The signal features of all rows are computed in one batch.
+    - The debug history of all rows is one append-only DebugLog with a column for the row.
+
+RequestView objects keep the API of DoIPDidRequest (ids, interval, history, blacklisted, get_value, ...) for the
+existing users; they only hold the table and their row and read and write the columns.
+
+Classes:
+    - RequestTable: Columns of the requests.
+    - RequestView: A request of the table with the API of DoIPDidRequest.
+    - RequestIDView: RequestID of a row.
+    - IntervalView: Interval of a row.
+    - HistoryView: DidPayloadHistory of a row.
+"""
+
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from revcan.signal_discovery.debug_log import DEBUG_COLUMNS, DebugLog
+from revcan.signal_discovery.doip_dids import (
+    DidPayloadHistory,
+    DidRequestDatabase,
+    DoIPDidRequest,
+    Interval,
+    RequestID,
+)
+from revcan.signal_discovery.feature_engine import PayloadFeatureEngine
+
+# Column name -> (dtype, default value)
+_COLUMNS = {
+    "server_id": (np.int32, 0),
+    "tester_id": (np.int32, 0),
+    "did": (np.int32, 0),
+    "payload_length": (np.int32, 0),
+    "interval": (np.float64, Interval.DEFAULT_INTERVAL),
+    "interval_base": (np.float64, Interval.DEFAULT_INTERVAL),
+    "interval_minimum": (np.float64, Interval.MIN_INTERVAL),
+    "interval_maximum": (np.float64, Interval.MAX_INTERVAL),
+    "exec_time": (np.float64, 0.0),
+    "execution_duration": (np.float64, 0.03),
+    "blacklisted": (np.bool_, False),
+    "feature_sum": (np.float64, 0.0),
+    "changing_bits_count": (np.float64, 0.0),
+    "entropy": (np.float64, 0.0),
+}
+
+
+def _key(server_id: int, did: int) -> int:
+    # DIDs have 16 bits
+    return (int(server_id) << 16) | int(did)
+
+
+class RequestTable:
+    """
+    A class storing DoIP requests as NumPy columns, one row per request. Adding rows is not thread-safe; reading and
+    writing the values of existing rows is.
+
+    Attributes:
+        server_id, tester_id, did, payload_length (ndarray): Identification of the requests.
+        interval, interval_minimum, interval_maximum (ndarray): Current interval and its limits.
+        interval_base (ndarray): Interval derived from the signal features, before scaling.
+        exec_time, execution_duration (ndarray): Time of the last execution and its duration.
+        blacklisted (ndarray): Whether the requests are blacklisted.
+        feature_sum, changing_bits_count, entropy (ndarray): Signal features of the payload histories.
+        history_length (int): Number of payloads kept per request.
+        timestamps (ndarray): Receive times of the payloads in the ring buffer (rows, history length).
+        feature_engine (PayloadFeatureEngine): Payload histories of the rows.
+        debug_log (DebugLog): Debug history of all rows, the column "request" is the row.
+
+    Methods:
+        add(server_id, tester_id, did, payloads, timestamps): Adds a request, returns its row.
+        row_of(server_id, did): Returns the row of a request.
+        load_database(database_file_path, want_payload_history): Adds the requests of a DID database file.
+        append_payload(row, payload, timestamp): Appends a payload to the history of a row.
+        payloads(row): Returns the payload history of a row.
+        payload_timestamps(row): Returns the timestamps of the payload history of a row.
+        view(row): Returns the RequestView of a row.
+        views(first_row): Returns the RequestViews of the rows.
+        calculate_signal_features(rows): Calculates the signal features of rows in one batch.
+        append_to_debug_history(rows, new_interval): Appends the features of rows to the debug log.
+    """
+
+    def __init__(self, capacity: int = 1024, history_length: int = DidPayloadHistory.HISTORY_MAX_LEN):
+        self.history_length = history_length
+        for name, (dtype, default) in _COLUMNS.items():
+            setattr(self, name, np.full(capacity, default, dtype=dtype))
+        self.timestamps = np.zeros((capacity, history_length))
+        self.feature_engine = PayloadFeatureEngine(history_length, capacity=capacity)
+        self.debug_log = DebugLog(("request",) + DEBUG_COLUMNS)
+        self.rows: Dict[int, int] = {}  # key of server ID and DID -> row
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _reserve(self, size: int):
+        capacity = len(self.server_id)
+        if size <= capacity:
+            return
+        new_capacity = max(capacity, 1)
+        while new_capacity < size:
+            new_capacity *= 2
+        for name, (dtype, default) in _COLUMNS.items():
+            column = np.full(new_capacity, default, dtype=dtype)
+            column[:capacity] = getattr(self, name)
+            setattr(self, name, column)
+        timestamps = np.zeros((new_capacity, self.history_length))
+        timestamps[:capacity] = self.timestamps
+        self.timestamps = timestamps
+
+    def add(self, server_id: int, tester_id: int, did: int, payloads=(), timestamps=()) -> int:
+        """
+        Add a request.
+
+        :param server_id: The request Server ID.
+        :param tester_id: The response Tester ID.
+        :param did: The data identifier.
+        :param payloads: Payload history, oldest first; the payload length is the length of the first payload.
+        :param timestamps: Receive times of the payloads.
+        :return: Row of the request, None if a request with the same server ID and DID is already in the table.
+        """
+        key = _key(server_id, did)
+        if key in self.rows:
+            return None
+        payloads = list(payloads)
+        row = self._size
+        self._reserve(row + 1)
+        self.server_id[row] = server_id
+        self.tester_id[row] = tester_id
+        self.did[row] = did
+        self.payload_length[row] = len(payloads[0]) if payloads else 0
+        if self.feature_engine.add(payloads) != row:
+            raise RuntimeError("The feature engine of the request table was used by another owner.")
+        # The engine keeps the last payloads, starting at position 0; their timestamps are the last ones
+        count = int(self.feature_engine.counts[row])
+        timestamps = list(timestamps)[-count:] if count else []
+        self.timestamps[row, count - len(timestamps) : count] = timestamps
+        self.rows[key] = row
+        self._size += 1
+        return row
+
+    def row_of(self, server_id: int, did: int) -> int:
+        """
+        :return: Row of the request, None if it is not in the table.
+        """
+        return self.rows.get(_key(server_id, did))
+
+    def load_database(self, database_file_path: str, want_payload_history: bool) -> int:
+        """
+        Add the requests stored in a DID database file (see DidRequestDatabase).
+
+        :param database_file_path: The path of the database file.
+        :param want_payload_history: Whether to load the payload history of the requests.
+        :return: The number of requests which were already in the table.
+        """
+        count_duplicates = 0
+        with DidRequestDatabase(database_file_path) as database:
+            for (
+                server_id,
+                tester_id,
+                did,
+                payloads,
+                timestamps,
+                interval_current,
+                exec_time,
+            ) in database.load_rows(want_payload_history):
+                row = self.add(server_id, tester_id, did, payloads or (), timestamps or ())
+                if row is None:
+                    count_duplicates += 1
+                    continue
+                if interval_current is not None:
+                    self.interval[row] = interval_current
+                    self.interval_base[row] = interval_current
+                if exec_time is not None:
+                    self.exec_time[row] = exec_time
+        return count_duplicates
+
+    def append_payload(self, row: int, payload, timestamp: float = None):
+        position = self.feature_engine.append(row, payload)
+        self.timestamps[row, position] = time.time() if timestamp is None else timestamp
+
+    def payloads(self, row: int) -> List[list]:
+        """
+        :return: The payload history of a row, oldest first.
+        """
+        return [list(payload) for payload in self.feature_engine.history(row)]
+
+    def payload_timestamps(self, row: int) -> List[float]:
+        """
+        :return: The receive times of the payload history of a row, oldest first.
+        """
+        count, head = int(self.feature_engine.counts[row]), int(self.feature_engine.heads[row])
+        return [float(self.timestamps[row, (head - count + age) % self.history_length]) for age in range(count)]
+
+    def view(self, row: int) -> "RequestView":
+        return RequestView(self, row)
+
+    def views(self, first_row: int = 0) -> List["RequestView"]:
+        return [RequestView(self, row) for row in range(first_row, self._size)]
+
+    def calculate_signal_features(self, rows=None):
+        """
+        Calculate the signal features of rows like DoIPDidRequest.calculate_signal_feature, but in one batch. Only
+        rows with more than two payloads are updated.
+
+        :param rows: The rows, None for the rows whose payload history changed since the last call.
+        """
+        if rows is None:
+            rows, features = self.feature_engine.refresh()
+        else:
+            rows = np.asarray(rows, dtype=np.int64)
+            features = self.feature_engine.compute(rows)
+        updated = features.sample_count > 2
+        rows = rows[updated]
+        if not len(rows):
+            return
+        # Average share of the bits changing between two payloads and entropy divided by its maximum
+        self.changing_bits_count[rows] = np.round(features.changing_bit_rate()[updated], 3)
+        self.entropy[rows] = np.round(features.normalized_entropy()[updated], 3)
+        self.feature_sum[rows] = self.changing_bits_count[rows] + self.entropy[rows]
+        self.append_to_debug_history(rows)
+
+    def append_to_debug_history(self, rows, new_interval=None):
+        """
+        Append the current features of rows to the debug log.
+
+        :param rows: The rows.
+        :param new_interval: The new intervals of the rows, the current intervals if None.
+        """
+        rows = np.asarray(rows, dtype=np.int64).reshape(-1)
+        if len(rows) == 1:
+            row = int(rows[0])
+            self.debug_log.append(
+                request=row,
+                timestamp=time.time(),
+                interval=self.interval[row] if new_interval is None else new_interval,
+                bits=self.changing_bits_count[row],
+                entropy=self.entropy[row],
+                blacklisted=self.blacklisted[row],
+                execution_duration=self.execution_duration[row],
+            )
+            return
+        self.debug_log.extend(
+            request=rows,
+            timestamp=time.time(),
+            interval=self.interval[rows] if new_interval is None else new_interval,
+            bits=self.changing_bits_count[rows],
+            entropy=self.entropy[rows],
+            blacklisted=self.blacklisted[rows],
+            execution_duration=self.execution_duration[rows],
+        )
+
+
+def _column_property(column: str, cast):
+    def getter(self):
+        return cast(getattr(self.table, column)[self.row])
+
+    def setter(self, value):
+        getattr(self.table, column)[self.row] = value
+
+    return property(getter, setter)
+
+
+class RequestIDView(RequestID):
+    """
+    A class representing the RequestID of a row of a RequestTable.
+    """
+
+    __slots__ = ("table", "row")
+
+    def __init__(self, table: RequestTable, row: int):
+        self.table = table
+        self.row = row
+
+    server_id = _column_property("server_id", int)
+    tester_id = _column_property("tester_id", int)
+    did = _column_property("did", int)
+    payload_length = _column_property("payload_length", int)
+
+
+class IntervalView(Interval):
+    """
+    A class representing the Interval of a row of a RequestTable.
+    """
+
+    __slots__ = ("table", "row")
+
+    def __init__(self, table: RequestTable, row: int):
+        self.table = table
+        self.row = row
+
+    _current = _column_property("interval", float)
+    _last = Interval.DEFAULT_INTERVAL  # never updated by DoIPDidRequest
+    base = _column_property("interval_base", float)
+    minimum = _column_property("interval_minimum", float)
+    maximum = _column_property("interval_maximum", float)
+
+
+class HistoryView(DidPayloadHistory):
+    """
+    A class representing the DidPayloadHistory of a row of a RequestTable. The payload and timestamp lists are
+    copies; payloads are added with append.
+    """
+
+    __slots__ = ("table", "row")
+
+    def __init__(self, table: RequestTable, row: int):
+        self.table = table
+        self.row = row
+
+    changing_bits_count = _column_property("changing_bits_count", float)
+    entropy = _column_property("entropy", float)
+
+    @property
+    def payload_list(self) -> List[list]:
+        return self.table.payloads(self.row)
+
+    @property
+    def timestamp_list(self) -> List[float]:
+        return self.table.payload_timestamps(self.row)
+
+    @property
+    def feature_engine(self) -> PayloadFeatureEngine:
+        return self.table.feature_engine
+
+    @property
+    def feature_index(self) -> int:
+        return self.row
+
+    def append(self, payload, timestamp: float = None):
+        self.table.append_payload(self.row, payload, timestamp)
+
+    def attach(self, feature_engine: PayloadFeatureEngine):
+        raise TypeError("The payload history is stored in the feature engine of its RequestTable.")
+
+
+class RequestView(DoIPDidRequest):
+    """
+    A class representing a row of a RequestTable with the API of DoIPDidRequest. Attributes which are not columns
+    of the table (e.g. the UDS client of get_value) are stored in the view.
+
+    Attributes:
+        table (RequestTable): The table.
+        row (int): The row of the request.
+    """
+
+    __slots__ = ("table", "row", "_ids", "_interval", "_history")
+
+    def __init__(self, table: RequestTable, row: int):
+        self.table = table
+        self.row = row
+        self._ids = None
+        self._interval = None
+        self._history = None
+
+    @property
+    def ids(self) -> RequestIDView:
+        if self._ids is None:
+            self._ids = RequestIDView(self.table, self.row)
+        return self._ids
+
+    @property
+    def interval(self) -> IntervalView:
+        if self._interval is None:
+            self._interval = IntervalView(self.table, self.row)
+        return self._interval
+
+    @property
+    def history(self) -> HistoryView:
+        if self._history is None:
+            self._history = HistoryView(self.table, self.row)
+        return self._history
+
+    @property
+    def unique_ID(self) -> str:
+        return self.make_unique_ID()
+
+    @property
+    def debug_history(self) -> DebugLog:
+        """
+        The debug history of the request, a copy of its rows of the debug log of the table.
+        """
+        frame = self.table.debug_log.to_frame(request=self.row)
+        log = DebugLog()
+        log.extend(**{name: frame[name].to_numpy() for name in log.columns})
+        return log
+
+    exec_time = _column_property("exec_time", float)
+    execution_duration = _column_property("execution_duration", float)
+    blacklisted = _column_property("blacklisted", bool)
+    feature_sum = _column_property("feature_sum", float)
+
+    def calculate_signal_feature(self):
+        self.table.calculate_signal_features([self.row])
+
+    def append_to_debug_history(self, new_interval=None):
+        self.table.append_to_debug_history([self.row], new_interval)
@@ -9,6 +9,8 @@ from revcan.signal_discovery.dids import (
     RequestList,
     DidRequestDatabase,
 )
+from revcan.signal_discovery.deadline_queue import DeadlineQueue, RequestBuffer
+from revcan.signal_discovery.interval_allocation import IntervalAllocator
 import revcan.signal_discovery.utils.misc_methods as misc
 import threading
 import time
@@ -26,8 +28,9 @@ class Scheduler:
     Attributes:
     - request_list: A list of requests to be scheduled.
     - subset_lists: A list of subsets of the requests in case there are too many requests to be processed at once.
-    - buffer_list: A buffer for holding requests before execution.
-    - added_to_buffer: A set to track unique IDs of requests added to the buffer.
+    - buffer_list: A buffer for holding the handles of due requests before execution.
+    - deadline_queue: The requests of the current subset, ordered by the time they are due next.
+    - interval_allocator: Allocates the intervals of the current subset under the request capacity.
     - theoretical_loop_time: The estimated time it takes to loop through the list of requests.
     - average_request_time: The average time taken by a request.
     - script_directory: The directory of the script containing this class.
@@ -54,10 +57,13 @@ class Scheduler:
     - check_if_subsets_necessary: Checks if subsets are necessary based on request count.
     - split_request_list: Splits the request list into subsets if necessary.
     - start: Starts the scheduling process with options for subsets and iterations.
+    - create_deadline_queue: Schedules the requests of a subset.
+    - reschedule: Schedules a request for the end of its current interval.
+    - rebalance_interval: Updates the interval allocation after the interval of a request changed.
     - update: Updates buffer_list during execution by comparing, when a request was executed last.
-    - add_requests_to_buffer: Adds requests to the buffer if certain conditions are met.
+    - add_requests_to_buffer: Adds the due requests to the buffer.
     - append_debug_history: Appends debug information of the request to the debug history.
-    - adjust_for_max_requests: Adjusts intervals to meet max requests requirement.
+    - adjust_for_max_requests: Scales the intervals to meet the max requests requirement.
     - calculate_send_count: Calculates the number of requests that could be sent during the average loop time.
     - request: Main method for executing requests in a separate thread.
     - append_to_output_csv: Appends results to the output CSV file.
@@ -70,8 +76,9 @@ class Scheduler:
 
         self.request_list: RequestList = RequestList()
         self.subset_lists: list[RequestList] = []
-        self.buffer_list: list[DidRequest] = []
-        self.added_to_buffer = set()
+        self.buffer_list: RequestBuffer = RequestBuffer()
+        self.deadline_queue: DeadlineQueue = None
+        self.interval_allocator: IntervalAllocator = None
         self.theoretical_loop_time: int
         self.average_request_time: float = 0
         self.script_directory = os.path.dirname(__file__)
@@ -272,6 +279,7 @@ class Scheduler:
             request.interval.maximum = interval_maximum
             request.interval.minimum = interval_minimum
             request.interval._current = request.interval.maximum
+            request.interval.base = request.interval.maximum
             request.update_interval(self.iterations)
             self.append_debug_history(request, request.interval._current)
 
@@ -434,6 +442,7 @@ class Scheduler:
             # print(f"Start request thread for subset {subset_number}")
             # self.request_thread.start()
             self.end_request_thread = False
+            self.create_deadline_queue(subset_number)
             request_thread.start()  # request_threads[subset_number].start()
             while time.time() < self.end_time:
                 self.update(subset_number)
@@ -471,6 +480,7 @@ class Scheduler:
                     # print(f"Start request thread for subset {subset_number}")
                     # self.request_thread.start()
                     self.end_request_thread = False
+                    self.create_deadline_queue(subset_number)
                     request_threads[subset_number].start()
                     while time.time() < self.end_time:
                         self.update(subset_number)
@@ -482,9 +492,68 @@ class Scheduler:
                 else:
                     pass
 
+    def create_deadline_queue(self, subset_number):
+        """
+        Schedules the requests of a subset and empties the buffer. Requests are due at the end of their
+        current interval after their last execution, the intervals are scaled to meet the max requests requirement.
+
+        :param subset_number: The number of the subset to be scheduled.
+        :type subset_number: int
+        """
+
+        self.buffer_list.clear()
+        self.deadline_queue = DeadlineQueue(self.subset_lists[subset_number].request_list)
+        self.adjust_for_max_requests(self.deadline_queue.requests)
+        for handle in range(len(self.deadline_queue.requests)):
+            self.reschedule(handle)
+
+    def reschedule(self, handle):
+        """
+        Schedules a request for the end of its current interval, measured from its last execution.
+        Has to be called whenever the execution time or the interval of a scheduled request changes.
+
+        :param handle: The handle of the request in the deadline queue.
+        :type handle: int
+        """
+
+        request = self.deadline_queue.requests[handle]
+        if self.interval_allocator is not None and handle in self.interval_allocator:
+            request.interval.current = self.interval_allocator.interval(handle)
+        # If ignore_blacklisted_requests is True, blacklisted requests are not scheduled anymore
+        if self.ignore_blacklisted_requests and request.blacklisted:
+            self.deadline_queue.unschedule(handle)
+        else:
+            self.deadline_queue.schedule(
+                handle, request.exec_time + request.interval._current
+            )
+
+    def rebalance_interval(self, handle):
+        """
+        Updates the interval allocation after the base interval of a request was changed by its signal features.
+        Only the share of this request is recomputed; the other requests get their new interval, when they
+        are rescheduled.
+
+        :param handle: The handle of the request in the deadline queue.
+        :type handle: int
+        """
+
+        if self.interval_allocator is None:
+            return
+        request = self.deadline_queue.requests[handle]
+        if request.blacklisted:
+            self.interval_allocator.remove(handle)
+        else:
+            self.interval_allocator.set_base(
+                handle,
+                request.interval.base,
+                request.interval.minimum,
+                request.interval.maximum,
+            )
+
     def update(self, subset_number):
         """
         Updates buffer_list during execution by comparing, when a request was executed last.
+        Waits until the next request is due, at most until the end time.
 
         :param subset_number: The number of the subset being updated.
         :type subset_number: int
@@ -497,8 +566,7 @@ class Scheduler:
             )
             print("Before adjusting for max requests")
             print(self.subset_lists[subset_number].request_list[random_number])
-
-        self.subset_lists[subset_number].count_requests(self.print_info)
+            self.subset_lists[subset_number].count_requests(self.print_info)
 
         # self.adjust_for_max_requests()
 
@@ -511,30 +579,23 @@ class Scheduler:
         while len(self.buffer_list) > 20:
             time.sleep(0.5)
 
+        self.deadline_queue.wait(min(0.5, self.end_time - time.time()))
+
     def add_requests_to_buffer(self, subset_number):
         """
-        Adds requests to the buffer, if certain conditions are met.
+        Adds the due requests to the buffer.
 
         :param subset_number: The number of the subset being processed.
         :type subset_number: int
         """
 
-        now = time.time()
-        for request in self.subset_lists[subset_number].request_list:
-            # Only add the request to the buffer list, if the following conditions are met:
-            # 1. The time since the request has last been requested is larger than the current interval of the request
-            # 2. The unique ID of the request is not already in the buffer list
-            # 3. Either the attribute blacklisted of the request or the attribute ignore_blacklisted_requests of the Scheduler class
-            #    are False; If ignore_blacklisted_requests is False, all requests will be scheduled, if ignore_blacklisted_requests
-            #    is True, only not blacklisted requests will be scheduled
-            if (
-                (now - request.exec_time >= request.interval._current)
-                and ((request.make_unique_ID()) not in self.added_to_buffer)
-                and not (self.ignore_blacklisted_requests and request.blacklisted)
-            ):
-                self.buffer_list.append(request)
-                self.added_to_buffer.add(request.make_unique_ID())
-                request_ids = RequestID(0x17FC0076, 0x17FE0076, 0x346)
+        # A request is due, if the time since it has last been requested is larger than its current interval.
+        # It leaves the deadline queue until it is rescheduled after its execution, so it is buffered only once.
+        request_ids = RequestID(0x17FC0076, 0x17FE0076, 0x346)
+        for handle in self.deadline_queue.pop_due(time.time()):
+            request = self.deadline_queue.requests[handle]
+            if not (self.ignore_blacklisted_requests and request.blacklisted):
+                self.buffer_list.put(handle)
                 if request.ids == request_ids:
                     print(request)
                     print("Lenkradwinkel in buffer geschrieben")
@@ -562,41 +623,48 @@ class Scheduler:
             ]
         ]
 
-    def adjust_for_max_requests(self):
+    def adjust_for_max_requests(self, request_list=None):
         """
-        Adjusts intervals to meet max requests requirement.
+        Scales the intervals to meet the max requests requirement: The number of requests sent during the
+        theoretical loop time equals the number of not blacklisted requests.
+        The base intervals (derived from the signal features) of all not blacklisted requests are multiplied by a
+        common factor, which is solved for in one pass; each interval is clamped to the minimum and maximum interval of
+        its request. Only the current interval is scaled, the base interval is kept. The allocation is kept in
+        interval_allocator and updated by rebalance_interval, when the base interval of a single request changes.
+
+        :param request_list: The requests to be adjusted, the whole request list if None. The handles of the
+            requests in interval_allocator are their indices in this list.
+        :type request_list: list[DidRequest]
         """
 
-        total_requests = self.calculate_send_count()
+        if request_list is None:
+            request_list = self.request_list.request_list
+        self.request_list.count_requests()
         max_requests = self.request_list.count_not_blacklisted
-        iteration_counter = 0
-        print(f"Total requests: {total_requests}; Max. requests: {max_requests}")
-
-        while abs(total_requests - max_requests) > 0.05 * max_requests:
-            for request in self.request_list.request_list:
-                if not request.blacklisted:
-                    # Multiplication solution
-                    # new_interval = request.interval.current * (
-                    #     total_requests / max_requests
-                    # )
-                    # Addition solution
-                    if (total_requests / max_requests) > 1:
-                        summand = 1
-                    else:
-                        summand = -0.1
-                    new_interval = request.interval.current + summand
-                    request.interval.update_current(new_interval)
-                    self.append_debug_history(request, request.interval._current)
-            total_requests = self.calculate_send_count()
-            if self.print_info:
-                print(
-                    f"Total requests: {total_requests}; Max. requests: {max_requests}"
-                )
-            iteration_counter += 1
-            if iteration_counter > 100:
-                raise Exception(
-                    "Could not adjust intervals enough in 100 iterations to meet requirement: Total requests ~ Max. requests"
+        self.interval_allocator = IntervalAllocator(
+            max_requests / self.theoretical_loop_time
+            if self.theoretical_loop_time > 0
+            else math.inf
+        )
+        for handle, request in enumerate(request_list):
+            if not request.blacklisted:
+                self.interval_allocator.set_base(
+                    handle,
+                    request.interval.base,
+                    request.interval.minimum,
+                    request.interval.maximum,
+                    rebalance=False,
                 )
+        self.interval_allocator.rebalance()
+
+        for handle, request in enumerate(request_list):
+            if handle in self.interval_allocator:
+                request.interval.current = self.interval_allocator.interval(handle)
+                self.append_debug_history(request, request.interval._current)
+        total_requests = math.ceil(
+            self.interval_allocator.send_count(self.theoretical_loop_time)
+        )
+        print(f"Total requests: {total_requests}; Max. requests: {max_requests}")
 
     def calculate_send_count(self):
         """
@@ -625,8 +693,8 @@ class Scheduler:
                 print("Entered if end request")
                 break
             if len(self.buffer_list) > 0:
-                request = self.buffer_list.pop(0)
-                self.added_to_buffer.discard(request.make_unique_ID())
+                handle = self.buffer_list.pop()
+                request = self.deadline_queue.requests[handle]
                 if self.random:
                     response, execution_time, unique_ID = request.get_rnd_value()
                     request.update_interval(self.iterations)
@@ -635,6 +703,8 @@ class Scheduler:
                         self.wait_window_request
                     )
                     request.update_interval(self.iterations)
+                self.rebalance_interval(handle)
+                self.reschedule(handle)
                 if self.create_output_csv and response:
                     # ------------------------------------------------------
                     # Reason for the next if-Statement: During testing the csv-Saving crashed while using the GUI. at somepoint during Recording "Errno 13 Permission denied" appeared and the program crashed. Bug couldn't be found so the csv is saved after each subset
@@ -651,6 +721,8 @@ class Scheduler:
                     f"\rCurrent time: {time.strftime('%T', time.localtime(time.time()))}, Target time: {time.strftime('%T', time.localtime(self.end_time))}, buffer length: {len(self.buffer_list)}  ",
                     end="",
                 )
+            else:
+                self.buffer_list.wait(0.1)
         if self.GUI_mode:
             for row in self.subset_payload_for_csv:
                 self.append_to_output_csv(row[2:], row[0], row[1])
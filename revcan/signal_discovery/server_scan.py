@@ -0,0 +1,275 @@
+"""
+This module defines a fast scan for the logical addresses of UDS servers behind a DoIP gateway.
+
+Instead of a new TCP connection and routing activation per candidate address, every connection is activated
+once and addresses the candidates by the target address of its diagnostic messages. Several
+DiagnosticSessionControl (defaultSession) probes are kept in flight per connection; the responses are matched
+to the probes by their source address:
+
+    - DoIP diagnostic negative acknowledgement (e.g. unknown target address): no server, resolved immediately
+    - DoIP diagnostic positive acknowledgement: the gateway forwarded the probe, the UDS response is awaited
+    - Positive UDS response: server found
+    - Negative UDS response (ResponsePending extends the deadline): no server
+    - No response within the timeout: no server
+
+Blocks of consecutive addresses are distributed to a small pool of connections sharing a token bucket rate limit.
+Progress is reported as the first address below which all addresses were checked. If the gateway refuses or resets
+a connection, the first unchecked address is skipped and the block is continued on a new connection, as the
+sequential scan skipped the address. An interrupt or any other error stops all connections.
+
+Classes:
+    - ServerScanner: Pipelined scan of addresses over a single DoIP connection.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+from typing import Callable, Dict, List
+
+from revcan.signal_discovery.did_discovery_orchestrator import TokenBucket
+from revcan.signal_discovery.doip_session_pool import connection_manager
+from revcan.signal_discovery.utils.doipclient import DoIPClient
+from revcan.signal_discovery.utils.doipclient.messages import DiagnosticMessage, \
+    DiagnosticMessageNegativeAcknowledgement, DiagnosticMessagePositiveAcknowledgement
+
+# DiagnosticSessionControl, defaultSession
+_PROBE_PAYLOAD = bytes([0x10, 0x01])
+_POSITIVE_RESPONSE_SID = 0x50
+_NEGATIVE_RESPONSE_SID = 0x7F
+_RESPONSE_PENDING = 0x78
+
+
+class ServerScanner:
+    """
+    A class representing a pipelined server scan over a single activated DoIP connection.
+
+    Attributes:
+        doip_client (DoIPClient): The activated DoIP connection.
+        client_logical_address (int): Logical address of the client (tester).
+        timeout (float): Time to wait for the response of a probe.
+        pipeline_depth (int): Maximum number of probes in flight.
+        rate_limiter (TokenBucket): Optional rate limit shared with other scanners.
+        stop (threading.Event): Optional event ending the scan early, e.g. on an interrupt.
+        number_of_probes (int): Number of probes sent.
+        number_of_nacks (int): Number of probes rejected by the gateway.
+
+    Methods:
+        scan(server_ids, on_found, on_progress): Probes the addresses and returns the found servers.
+    """
+
+    def __init__(self, doip_client: DoIPClient, client_logical_address: int, timeout=1.0, pipeline_depth=4,
+                 rate_limiter: TokenBucket = None, stop: threading.Event = None):
+        self.doip_client = doip_client
+        self.client_logical_address = client_logical_address
+        self.timeout = timeout
+        self.pipeline_depth = max(1, pipeline_depth)
+        self.rate_limiter = rate_limiter
+        self.stop = stop
+        self.number_of_probes = 0
+        self.number_of_nacks = 0
+
+    def _send_probe(self, server_id: int):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        message = DiagnosticMessage(self.client_logical_address, server_id, _PROBE_PAYLOAD)
+        self.doip_client.send_doip_message(message)
+        self.number_of_probes += 1
+
+    def scan(self, server_ids: List[int], on_found: Callable[[int], None] = None,
+             on_progress: Callable[[int], None] = None) -> List[int]:
+        """
+        Probe the given addresses in ascending order. If the stop event is set, the scan returns without waiting
+        for the probes in flight; the progress is only reported up to the oldest of them.
+
+        :param server_ids: Addresses to probe, in ascending order.
+        :param on_found: Called with the address of every found server.
+        :param on_progress: Called with the first unchecked address whenever all lower addresses were checked
+            (None once all addresses were checked).
+        :return: Addresses of the found servers.
+        """
+        server_ids = list(server_ids)
+        next_index = 0
+        in_flight: Dict[int, float] = {}  # address -> deadline
+        sent = deque()  # addresses in sending order, to report the progress
+        resolved = set()
+        found = []
+
+        def resolve(server_id, is_server=False):
+            if server_id not in in_flight:
+                return
+            del in_flight[server_id]
+            resolved.add(server_id)
+            if is_server:
+                found.append(server_id)
+                if on_found is not None:
+                    on_found(server_id)
+
+        while self.stop is None or not self.stop.is_set():
+            # Fill the pipeline
+            while next_index < len(server_ids) and len(in_flight) < self.pipeline_depth:
+                server_id = server_ids[next_index]
+                next_index += 1
+                self._send_probe(server_id)
+                in_flight[server_id] = time.time() + self.timeout
+                sent.append(server_id)
+
+            if not in_flight:
+                break
+
+            # Resolve probes without response
+            now = time.time()
+            for server_id, deadline in list(in_flight.items()):
+                if deadline <= now:
+                    resolve(server_id)
+
+            if in_flight:
+                try:
+                    message = self.doip_client.read_doip(timeout=max(0.0, min(in_flight.values()) - now))
+                except TimeoutError:
+                    message = None
+
+                if type(message) == DiagnosticMessageNegativeAcknowledgement:
+                    # The gateway does not route to this address
+                    self.number_of_nacks += 1
+                    resolve(message.source_address)
+                elif type(message) == DiagnosticMessagePositiveAcknowledgement:
+                    pass
+                elif type(message) == DiagnosticMessage and message.source_address in in_flight:
+                    user_data = bytes(message.user_data)
+                    if user_data[:1] == bytes([_POSITIVE_RESPONSE_SID]):
+                        resolve(message.source_address, is_server=True)
+                    elif len(user_data) >= 3 and user_data[0] == _NEGATIVE_RESPONSE_SID \
+                            and user_data[2] == _RESPONSE_PENDING:
+                        in_flight[message.source_address] = time.time() + self.timeout
+                    else:
+                        resolve(message.source_address)
+                elif message is not None:
+                    logging.debug(f"Ignoring unexpected DoIP message during server scan: {message}")
+
+            # Report the progress up to the oldest probe in flight
+            progressed = False
+            while sent and sent[0] in resolved:
+                resolved.discard(sent.popleft())
+                progressed = True
+            if progressed and on_progress is not None:
+                if sent:
+                    on_progress(sent[0])
+                else:
+                    on_progress(server_ids[next_index] if next_index < len(server_ids) else None)
+
+        return found
+
+
+def scan_servers(ecu_ip_address: str,
+                 client_logical_address: int,
+                 server_ids: List[int],
+                 on_found: Callable[[int], None] = None,
+                 on_progress: Callable[[int], None] = None,
+                 number_of_connections=1,
+                 pipeline_depth=4,
+                 requests_per_second: float = 0,
+                 timeout=1.0,
+                 block_size=256,
+                 client_ip_address: str = None) -> List[int]:
+    """
+    Scan addresses for UDS servers over a small pool of DoIP connections.
+
+    The addresses are split into blocks of consecutive addresses, which the connections take in ascending order.
+    Note that some gateways only accept one routing activation per tester address.
+
+    :param ecu_ip_address: IP address of the gateway.
+    :param client_logical_address: Logical address of the client (tester).
+    :param server_ids: Addresses to probe, in ascending order.
+    :param on_found: Called with the address of every found server (from the scanning threads, serialised).
+    :param on_progress: Called with the first unchecked address whenever all lower addresses were checked
+        (None once all addresses were checked).
+    :param number_of_connections: Number of DoIP connections scanning in parallel.
+    :param pipeline_depth: Probes in flight per connection.
+    :param requests_per_second: Rate limit of all connections together; <= 0 disables it.
+    :param timeout: Time to wait for the response of a probe.
+    :param block_size: Number of addresses per block.
+    :param client_ip_address: Optional IP address of the client interface.
+    :return: Addresses of the found servers, sorted.
+    """
+    server_ids = [server_id for server_id in server_ids if server_id != client_logical_address]
+    blocks = deque(server_ids[i:i + block_size] for i in range(0, len(server_ids), block_size))
+    rate_limiter = TokenBucket(requests_per_second, max(1, pipeline_depth))
+    lock = threading.Lock()
+    # Set on an interrupt or error, ends the scan of all connections
+    stop = threading.Event()
+
+    # First unchecked address of every unfinished block, in block order
+    block_progress = {block[0]: block[0] for block in blocks}
+    found = []
+
+    def report_progress():
+        if on_progress is not None:
+            on_progress(min(block_progress.values()) if block_progress else None)
+
+    def on_block_found(server_id):
+        with lock:
+            found.append(server_id)
+            if on_found is not None:
+                on_found(server_id)
+
+    def set_block_progress(block, server_id):
+        with lock:
+            if server_id is None:
+                del block_progress[block[0]]
+            else:
+                block_progress[block[0]] = server_id
+            report_progress()
+
+    def scan_block(block):
+        remaining = block
+        while remaining and not stop.is_set():
+            try:
+                with connection_manager.lease(ecu_ip_address, client_logical_address, remaining[0],
+                                              client_ip_address) as session:
+                    scanner = ServerScanner(session.doip_client, client_logical_address, timeout=timeout,
+                                            pipeline_depth=pipeline_depth, rate_limiter=rate_limiter, stop=stop)
+                    scanner.scan(remaining, on_block_found,
+                                 lambda server_id: set_block_progress(block, server_id))
+                return
+            except (ConnectionRefusedError, ConnectionResetError, TimeoutError) as e:
+                # Skip the first unchecked address and continue on a new connection
+                with lock:
+                    first_unchecked = block_progress.get(block[0])
+                if first_unchecked is None:
+                    return
+                logging.warning(f"Server scan: {type(e).__name__} at 0x{first_unchecked:04x}, "
+                                f"skipping the address: {e}")
+                remaining = [server_id for server_id in block if server_id > first_unchecked]
+                set_block_progress(block, remaining[0] if remaining else None)
+                # Give the gateway time to recover before reconnecting
+                stop.wait(timeout)
+
+    def worker():
+        while not stop.is_set():
+            with lock:
+                if not blocks:
+                    return
+                block = blocks.popleft()
+            scan_block(block)
+
+    if not server_ids:
+        return []
+    if number_of_connections <= 1:
+        worker()
+    else:
+        executor = ThreadPoolExecutor(max_workers=number_of_connections)
+        try:
+            futures = [executor.submit(worker) for _ in range(number_of_connections)]
+            wait(futures, return_when=FIRST_EXCEPTION)
+            stop.set()
+            for future in futures:
+                future.result()
+        except BaseException:
+            # Interrupt or error of a connection, the other connections stop after their current probes
+            stop.set()
+            raise
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
+    return sorted(found)
@@ -0,0 +1,173 @@
+"""
+This module defines a fast scan for the UDS services supported by one or several servers.
+
+All servers are probed over a single activated DoIP connection. Every server is first switched into the requested
+diagnostic session and then receives one probe [service ID, 0x00] after the other, without reconnecting or
+re-opening a session in between. Probes to different servers are in flight at the same time; the responses are
+matched by their source address. Servers waiting for a response are kept in their session with TesterPresent
+(suppressed positive response).
+
+The raw response of every probe is classified:
+
+    - Positive response or any negative response code except ServiceNotSupported: the service is supported.
+      ServiceNotSupportedInActiveSession means that the service exists in another session; the code is kept in
+      the responses, so the session requirement stays visible
+    - ResponsePending: the deadline of the probe is extended
+    - No response within the timeout: the service is not supported
+
+Classes:
+    - ServiceScanner: Session-persistent service scan of several servers over one DoIP connection.
+"""
+
+import logging
+import time
+from collections import deque
+from typing import Callable, Dict, List
+
+from revcan.signal_discovery.did_discovery_orchestrator import TokenBucket
+from revcan.signal_discovery.utils.doipclient import DoIPClient
+from revcan.signal_discovery.utils.doipclient.messages import DiagnosticMessage, \
+    DiagnosticMessageNegativeAcknowledgement
+from revcan.signal_discovery.utils.udsoncan.ResponseCode import ResponseCode
+
+_DIAGNOSTIC_SESSION_CONTROL = 0x10
+_TESTER_PRESENT_SUPPRESSED = bytes([0x3E, 0x80])
+_NEGATIVE_RESPONSE_SID = 0x7F
+_POSITIVE_RESPONSE_OFFSET = 0x40
+
+# Negative response codes which mean that the service is not supported by the server
+NOT_SUPPORTED_CODES = (ResponseCode.ServiceNotSupported,)
+
+
+class ServiceScanner:
+    """
+    A class representing a service scan of several servers over one activated DoIP connection.
+
+    Attributes:
+        doip_client (DoIPClient): The activated DoIP connection.
+        client_logical_address (int): Logical address of the client (tester).
+        timeout (float): Time to wait for the response of a probe.
+        session_type (int): Diagnostic session used for the scan; None keeps the active session.
+        keep_alive_interval (float): Time after which a waiting server receives TesterPresent.
+        rate_limiter (TokenBucket): Optional rate limit of the requests.
+        responses (Dict[int, Dict[int, int]]): Response code per server and service ID
+            (ResponseCode.PositiveResponse for positive responses, None without response).
+        unreachable_servers (List[int]): Servers the gateway rejected with a diagnostic negative acknowledgement.
+
+    Methods:
+        scan(server_ids, service_ids, on_found, on_progress): Probes the services of the servers.
+    """
+
+    def __init__(self, doip_client: DoIPClient, client_logical_address: int, timeout=1.0, session_type: int = 0x03,
+                 keep_alive_interval=2.0, rate_limiter: TokenBucket = None):
+        self.doip_client = doip_client
+        self.client_logical_address = client_logical_address
+        self.timeout = timeout
+        self.session_type = session_type
+        self.keep_alive_interval = keep_alive_interval
+        self.rate_limiter = rate_limiter
+        self.responses: Dict[int, Dict[int, int]] = {}
+        self.unreachable_servers: List[int] = []
+
+    def _send(self, server_id: int, payload: bytes):
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+        self.doip_client.send_doip_message(DiagnosticMessage(self.client_logical_address, server_id, payload))
+
+    def scan(self, server_ids: List[int], service_ids: List[int] = range(0x100),
+             on_found: Callable[[int, int], None] = None,
+             on_progress: Callable[[int, int], None] = None) -> Dict[int, List[int]]:
+        """
+        Probe the services of all servers, one request in flight per server.
+
+        :param server_ids: Logical addresses of the servers.
+        :param service_ids: Service IDs to probe.
+        :param on_found: Called with (server ID, service ID) for every supported service.
+        :param on_progress: Called with (server ID, service ID) after every probe.
+        :return: Supported service IDs per reachable server.
+        """
+        # Per server: queue of (service ID, payload), request in flight, its deadline and the last request time
+        queues = {}
+        for server_id in server_ids:
+            queue = deque((service_id, bytes([service_id, 0x00])) for service_id in service_ids)
+            if self.session_type is not None:
+                queue.appendleft((None, bytes([_DIAGNOSTIC_SESSION_CONTROL, self.session_type])))
+            queues[server_id] = queue
+            self.responses[server_id] = {}
+        in_flight: Dict[int, int] = {}
+        deadlines: Dict[int, float] = {}
+        last_requests: Dict[int, float] = {}
+        found: Dict[int, List[int]] = {server_id: [] for server_id in server_ids}
+
+        def complete(server_id, response_code=None):
+            service_id = in_flight.pop(server_id)
+            del deadlines[server_id]
+            if service_id is None:
+                # Session change, its result shows in the responses to the probes
+                return
+            self.responses[server_id][service_id] = response_code
+            if response_code is not None and response_code not in NOT_SUPPORTED_CODES:
+                found[server_id].append(service_id)
+                if on_found is not None:
+                    on_found(server_id, service_id)
+            if on_progress is not None:
+                on_progress(server_id, service_id)
+
+        while True:
+            now = time.time()
+            # Send the next request to every idle server
+            for server_id, queue in queues.items():
+                if server_id not in in_flight and queue:
+                    service_id, payload = queue.popleft()
+                    self._send(server_id, payload)
+                    in_flight[server_id] = service_id
+                    deadlines[server_id] = now + self.timeout
+                    last_requests[server_id] = now
+
+            if not in_flight:
+                break
+
+            # Keep the session of servers waiting for a (pending) response alive
+            for server_id in in_flight:
+                if now - last_requests[server_id] >= self.keep_alive_interval:
+                    self._send(server_id, _TESTER_PRESENT_SUPPRESSED)
+                    last_requests[server_id] = now
+
+            for server_id in [server_id for server_id, deadline in deadlines.items() if deadline <= now]:
+                complete(server_id)
+            if not in_flight:
+                continue
+
+            try:
+                waiting_time = min(min(deadlines.values()) - now, self.keep_alive_interval)
+                message = self.doip_client.read_doip(timeout=max(0.0, waiting_time))
+            except TimeoutError:
+                continue
+
+            if type(message) == DiagnosticMessageNegativeAcknowledgement and message.source_address in in_flight:
+                # The gateway does not route to this server, skip its remaining probes
+                server_id = message.source_address
+                in_flight.pop(server_id)
+                del deadlines[server_id]
+                queues[server_id].clear()
+                del found[server_id]
+                self.unreachable_servers.append(server_id)
+            elif type(message) == DiagnosticMessage and message.source_address in in_flight:
+                server_id = message.source_address
+                service_id = in_flight[server_id]
+                requested_service_id = _DIAGNOSTIC_SESSION_CONTROL if service_id is None else service_id
+                user_data = bytes(message.user_data)
+
+                if len(user_data) >= 3 and user_data[0] == _NEGATIVE_RESPONSE_SID:
+                    if user_data[1] != requested_service_id:
+                        continue  # e.g. a late response to a previous request or TesterPresent
+                    if user_data[2] == ResponseCode.RequestCorrectlyReceived_ResponsePending:
+                        deadlines[server_id] = time.time() + self.timeout
+                    else:
+                        complete(server_id, user_data[2])
+                elif user_data[:1] == bytes([(requested_service_id + _POSITIVE_RESPONSE_OFFSET) & 0xFF]):
+                    complete(server_id, ResponseCode.PositiveResponse)
+            elif message is not None:
+                logging.debug(f"Ignoring unexpected DoIP message during service scan: {message}")
+
+        return found
@@ -1 +1,2 @@
 from .client import DoIPClient
+from .async_client import AsyncDoIPClient
@@ -0,0 +1,429 @@
+import asyncio
+import logging
+import ssl
+import struct
+from collections import deque
+from typing import Dict, List, Union
+from .constants import TCP_DATA_UNSECURED, A_PROCESSING_TIME
+from .messages import *
+
+logger = logging.getLogger("doipclient")
+
+_HEADER = struct.Struct("!BBHL")
+
+_NEGATIVE_RESPONSE_SID = 0x7F
+_RESPONSE_PENDING = 0x78
+_POSITIVE_RESPONSE_OFFSET = 0x40
+# Number of request bytes after the SID which a positive response echoes (sub-function, data or routine identifier)
+_ECHOED_LENGTHS = {0x10: 1, 0x11: 1, 0x19: 1, 0x22: 2, 0x27: 1, 0x28: 1, 0x2E: 2, 0x2F: 2, 0x31: 3, 0x3E: 1, 0x85: 1}
+# Services whose first request byte after the SID is a sub-function with the suppressPosRspMsgIndicationBit
+_SUBFUNCTION_SERVICES = (0x10, 0x11, 0x19, 0x27, 0x28, 0x31, 0x3E, 0x85)
+# Diagnostic messages which are not the response to a request are kept up to this number per server
+_MAX_UNMATCHED_RESPONSES = 64
+
+
+class _PendingRequest:
+    """A request waiting for its response: the response has to carry the SID and echo the identifier of the
+    request. A request that timed out stays registered for another timeout, so that its late response is dropped
+    instead of being matched to a later request."""
+
+    __slots__ = ("sid", "identifier", "future", "response_pending", "expiry")
+
+    def __init__(self, diagnostic_payload: bytes, loop):
+        self.sid = diagnostic_payload[0]
+        identifier = bytearray(diagnostic_payload[1:1 + _ECHOED_LENGTHS.get(self.sid, 0)])
+        if identifier and self.sid in _SUBFUNCTION_SERVICES:
+            identifier[0] &= 0x7F
+        self.identifier = bytes(identifier)
+        self.future = loop.create_future()
+        self.response_pending = asyncio.Event()
+        self.expiry = None  # loop time until which a late response is expected, set on timeout
+
+    def matches(self, user_data) -> bool:
+        if user_data[0] == _NEGATIVE_RESPONSE_SID:
+            return len(user_data) >= 3 and user_data[1] == self.sid
+        return (user_data[0] == self.sid + _POSITIVE_RESPONSE_OFFSET
+                and bytes(user_data[1:1 + len(self.identifier)]) == self.identifier)
+
+
+class AsyncDoIPClient:
+    """An asyncio based DoIP client for diagnostic communication over a single TCP connection.
+
+    In contrast to DoIPClient, which polls the socket from the calling thread, a reader task reads the
+    connection with a StreamReader: first the fixed 8 byte generic header, then exactly the announced payload.
+    Messages are unpacked from a memoryview of the payload, so the user data of diagnostic messages is not copied.
+
+    Any number of diagnostic requests may be outstanding at the same time. Every response is matched to its
+    request by the source address (the logical address of the responding server), the SID and the echoed
+    identifier (e.g. the first DID of ReadDataByIdentifier); requests with the same key are answered in sending
+    order. Late responses to requests that timed out are dropped. Acknowledgements are matched to the requests of
+    a target address in sending order. Alive check requests of the gateway are answered by the reader task.
+
+    :param ecu_ip_address: IP address of the DoIP gateway (IPv4 or IPv6).
+    :type ecu_ip_address: str
+    :param tcp_port: The destination TCP port for DoIP data communication.
+    :type tcp_port: int, optional
+    :param activation_type: The activation type to request on connection. Use `None` to disable activation.
+    :type activation_type: RoutingActivationRequest.ActivationType, optional
+    :param protocol_version: The DoIP protocol version to use for communication.
+    :type protocol_version: int
+    :param client_logical_address: The logical address of this client, 0x0E00 to 0x0FFF.
+    :type client_logical_address: int
+    :param client_ip_address: If specified, binds the connection to this source IP.
+    :type client_ip_address: str, optional
+    :param use_secure: Enables TLS, either with a default or the given SSL context.
+    :type use_secure: Union[bool,ssl.SSLContext]
+    :param timeout: Default timeout for activation, acknowledgements and responses.
+    :type timeout: float
+    :param max_payload_size: Largest accepted payload; larger messages close the connection.
+    :type max_payload_size: int
+
+    :raises ConnectionRefusedError: If the activation request fails
+    """
+
+    def __init__(
+        self,
+        ecu_ip_address,
+        tcp_port=TCP_DATA_UNSECURED,
+        activation_type=RoutingActivationRequest.ActivationType.Default,
+        protocol_version=0x02,
+        client_logical_address=0x0E00,
+        client_ip_address=None,
+        use_secure: Union[bool, ssl.SSLContext] = False,
+        timeout=A_PROCESSING_TIME,
+        max_payload_size=0x100000,
+    ):
+        self._ecu_ip_address = ecu_ip_address
+        self._tcp_port = tcp_port
+        self._activation_type = activation_type
+        self._protocol_version = protocol_version
+        self._client_logical_address = client_logical_address
+        self._client_ip_address = client_ip_address
+        self._use_secure = use_secure
+        self.timeout = timeout
+        self.max_payload_size = max_payload_size
+
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._closed = None
+        # Requests waiting for their response per source address, in sending order
+        self._pending: Dict[int, List[_PendingRequest]] = {}
+        # Diagnostic messages per source address which are not the response to a request
+        self._responses: Dict[int, deque] = {}
+        self._response_received: Dict[int, asyncio.Event] = {}
+        # Acknowledgement futures per target address, in sending order
+        self._acknowledgements: Dict[int, deque] = {}
+        # Futures for other messages (e.g. the routing activation response) per message type
+        self._message_waiters: Dict[type, deque] = {}
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+
+    @property
+    def client_logical_address(self):
+        return self._client_logical_address
+
+    async def connect(self):
+        """Open the TCP connection, start the reader task and request the routing activation.
+
+        :raises ConnectionRefusedError: If the activation request fails
+        """
+        ssl_context = None
+        if self._use_secure:
+            if isinstance(self._use_secure, ssl.SSLContext):
+                ssl_context = self._use_secure
+            else:
+                ssl_context = ssl.create_default_context()
+        local_address = (self._client_ip_address, 0) if self._client_ip_address is not None else None
+        self._reader, self._writer = await asyncio.open_connection(
+            self._ecu_ip_address, self._tcp_port, ssl=ssl_context, local_addr=local_address
+        )
+        self._closed = asyncio.get_running_loop().create_future()
+        self._reader_task = asyncio.create_task(self._read_loop())
+
+        if self._activation_type is not None:
+            result = await self.request_activation(self._activation_type)
+            if result.response_code != RoutingActivationResponse.ResponseCode.Success:
+                await self.close()
+                raise ConnectionRefusedError(
+                    f"Activation Request failed with code {result.response_code}"
+                )
+
+    async def close(self):
+        """Stop the reader task and close the connection. Waiting calls raise ConnectionError."""
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._reader_task = None
+        self._set_closed(ConnectionAbortedError("DoIP connection closed"))
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except (ConnectionError, ssl.SSLError):
+                pass
+            self._writer = None
+
+    def _set_closed(self, exception):
+        if self._closed is None or self._closed.done():
+            return
+        self._closed.set_exception(exception)
+        # Retrieved here, so a connection loss nobody waits for is not reported as unhandled
+        self._closed.exception()
+        for waiters in list(self._acknowledgements.values()) + list(self._message_waiters.values()):
+            for future in waiters:
+                if not future.done():
+                    future.set_exception(exception)
+            waiters.clear()
+        for pending in self._pending.values():
+            for request in pending:
+                if not request.future.done():
+                    request.future.set_exception(exception)
+            pending.clear()
+
+    async def _read_loop(self):
+        """Read header and payload of every message and dispatch it."""
+        try:
+            while True:
+                header = await self._reader.readexactly(_HEADER.size)
+                protocol_version, inverse_protocol_version, payload_type, payload_size = _HEADER.unpack(header)
+                if inverse_protocol_version != (0xFF ^ protocol_version):
+                    # A TCP stream can not be re-synchronised, ISO 13400-2 requires closing the socket
+                    raise ConnectionError("Bad DoIP Header - Inverse protocol version does not match")
+                if payload_size > self.max_payload_size:
+                    raise ConnectionError(f"DoIP payload of {payload_size} bytes exceeds the maximum payload size")
+                payload = memoryview(await self._reader.readexactly(payload_size))
+                try:
+                    message = payload_type_to_message[payload_type].unpack(payload, payload_size)
+                except KeyError:
+                    message = ReservedMessage.unpack(payload_type, payload, payload_size)
+                self._dispatch(message)
+        except asyncio.IncompleteReadError:
+            logger.debug("TCP Connection closed by ECU")
+            self._set_closed(ConnectionResetError("DoIP connection closed by ECU"))
+        except (ConnectionError, OSError) as e:
+            logger.warning(f"DoIP connection failed: {e}")
+            self._set_closed(e if isinstance(e, ConnectionError) else ConnectionError(str(e)))
+
+    def _dispatch(self, message):
+        message_type = type(message)
+        if message_type == DiagnosticMessage:
+            self._dispatch_diagnostic(message.source_address, message.user_data)
+        elif message_type in (DiagnosticMessagePositiveAcknowledgement, DiagnosticMessageNegativeAcknowledgement):
+            # Acknowledgements of one target arrive in the order of its requests; a request that timed out
+            # keeps its (done) future in the queue, so a late acknowledgement is not matched to the next request
+            waiters = self._acknowledgements.get(message.source_address)
+            if waiters:
+                future = waiters.popleft()
+                if not future.done():
+                    future.set_result(message)
+            else:
+                logger.debug(f"Ignoring unexpected acknowledgement: {message}")
+        elif message_type == AliveCheckRequest:
+            logger.warning("Responding to an alive check")
+            self._write_message(AliveCheckResponse(self._client_logical_address))
+        elif message_type == GenericDoIPNegativeAcknowledge:
+            logger.warning(f"DoIP Negative Acknowledge. NACK Code: {message.nack_code}")
+        else:
+            waiters = self._message_waiters.get(message_type)
+            if waiters:
+                future = waiters.popleft()
+                if not future.done():
+                    future.set_result(message)
+            else:
+                logger.warning(f"Received unexpected DoIP message type {message_type}. Ignoring")
+
+    def _dispatch_diagnostic(self, source_address, user_data):
+        pending = self._pending.get(source_address)
+        if pending and len(user_data):
+            now = asyncio.get_running_loop().time()
+            pending[:] = [request for request in pending if request.expiry is None or request.expiry >= now]
+            for index, request in enumerate(pending):
+                if not request.matches(user_data):
+                    continue
+                if user_data[0] == _NEGATIVE_RESPONSE_SID and user_data[2] == _RESPONSE_PENDING:
+                    if request.expiry is None:
+                        request.response_pending.set()
+                    return
+                del pending[index]
+                if request.future.done():
+                    logger.debug(f"Dropping late response of server 0x{source_address:04x}: "
+                                 f"{bytes(user_data[:3]).hex()}")
+                else:
+                    request.future.set_result(user_data)
+                return
+        # Not the response to a request, e.g. a request sent with send_diagnostic
+        responses = self._responses.setdefault(source_address, deque(maxlen=_MAX_UNMATCHED_RESPONSES))
+        responses.append(user_data)
+        event = self._response_received.get(source_address)
+        if event is not None:
+            event.set()
+
+    def _check_connection(self):
+        if self._closed is None:
+            raise ConnectionError("DoIP connection not open")
+        if self._closed.done():
+            raise self._closed.exception()
+
+    def _write_message(self, doip_message):
+        payload_data = doip_message.pack()
+        payload_type = payload_message_to_type[type(doip_message)]
+        self._writer.write(
+            _HEADER.pack(self._protocol_version, 0xFF ^ self._protocol_version, payload_type, len(payload_data))
+            + payload_data
+        )
+
+    async def _await(self, future, timeout):
+        """Wait for a future, the connection loss or the timeout, whichever is first."""
+        done, _ = await asyncio.wait({future, self._closed}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        if future in done:
+            return future.result()
+        if self._closed in done:
+            raise self._closed.exception()
+        raise TimeoutError("ECU failed to respond in time", timeout)
+
+    async def send_doip_message(self, doip_message):
+        """Pack a DoIP message, add the header and send it.
+
+        :param doip_message: DoIP message object
+        :type doip_message: object
+        """
+        self._check_connection()
+        self._write_message(doip_message)
+        await self._writer.drain()
+
+    async def request_activation(self, activation_type, vm_specific=None):
+        """Request a routing activation for this connection.
+
+        :param activation_type: The type of activation to request
+        :type activation_type: RoutingActivationRequest.ActivationType
+        :param vm_specific: Optional 4 byte long int
+        :type vm_specific: int, optional
+        :return: The resulting activation response object
+        :rtype: RoutingActivationResponse
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._message_waiters.setdefault(RoutingActivationResponse, deque()).append(future)
+        await self.send_doip_message(
+            RoutingActivationRequest(self._client_logical_address, activation_type, vm_specific=vm_specific)
+        )
+        return await self._await(future, self.timeout)
+
+    async def send_diagnostic(self, target_address, diagnostic_payload, timeout=None, wait_for_acknowledgement=True):
+        """Send a raw diagnostic payload (ie: UDS) to a server and await its DoIP acknowledgement.
+
+        Other requests may be sent while waiting, also to the same server.
+
+        :param target_address: Logical address of the server
+        :type target_address: int
+        :param diagnostic_payload: UDS payload to transmit to the server
+        :type diagnostic_payload: bytes
+        :param timeout: Maximum time to wait for the acknowledgement, defaults to the client timeout
+        :type timeout: float, optional
+        :param wait_for_acknowledgement: Return right after sending if False
+        :type wait_for_acknowledgement: bool
+        :raises IOError: DoIP negative acknowledgement received
+        :raises TimeoutError: No acknowledgement received in time
+        """
+        future = asyncio.get_running_loop().create_future()
+        if wait_for_acknowledgement:
+            self._acknowledgements.setdefault(target_address, deque()).append(future)
+        await self.send_doip_message(
+            DiagnosticMessage(self._client_logical_address, target_address, bytes(diagnostic_payload))
+        )
+        if not wait_for_acknowledgement:
+            return
+        try:
+            result = await self._await(future, self.timeout if timeout is None else timeout)
+        finally:
+            # A late acknowledgement still consumes this future
+            future.cancel()
+        if type(result) == DiagnosticMessageNegativeAcknowledgement:
+            raise IOError(
+                "Diagnostic request rejected with negative acknowledge code: {}".format(
+                    result.nack_code
+                )
+            )
+
+    async def receive_diagnostic(self, source_address, timeout=None):
+        """Receive the next raw diagnostic payload (ie: UDS) of a server which is not the response to a request
+        sent with `request`. At most the last 64 of these payloads are kept per server.
+
+        :param source_address: Logical address of the server
+        :type source_address: int
+        :param timeout: Maximum time to wait, defaults to the client timeout
+        :type timeout: float, optional
+        :return: Raw UDS payload, a view into the received message
+        :rtype: memoryview
+        :raises TimeoutError: No diagnostic response received in time
+        """
+        responses = self._responses.get(source_address)
+        if responses:
+            return responses.popleft()
+        self._check_connection()
+        event = self._response_received.setdefault(source_address, asyncio.Event())
+        event.clear()
+        wait_task = asyncio.ensure_future(event.wait())
+        try:
+            await self._await(wait_task, self.timeout if timeout is None else timeout)
+        finally:
+            wait_task.cancel()
+        return self._responses[source_address].popleft()
+
+    async def request(self, target_address, diagnostic_payload, timeout=None):
+        """Send a raw diagnostic payload and receive the final response of the server.
+
+        The response is matched to the request by SID and echoed identifier, so several requests may be
+        outstanding, also to the same server. ResponsePending (0x7F xx 0x78) responses restart the timeout.
+
+        :param target_address: Logical address of the server
+        :type target_address: int
+        :param diagnostic_payload: UDS payload to transmit to the server
+        :type diagnostic_payload: bytes
+        :param timeout: Maximum time to wait for the acknowledgement and each response
+        :type timeout: float, optional
+        :return: Raw UDS response
+        :rtype: memoryview
+        :raises IOError: DoIP negative acknowledgement received
+        :raises TimeoutError: No diagnostic response received in time
+        """
+        timeout = self.timeout if timeout is None else timeout
+        request = _PendingRequest(bytes(diagnostic_payload), asyncio.get_running_loop())
+        pending = self._pending.setdefault(target_address, [])
+        pending.append(request)
+        try:
+            await self.send_diagnostic(target_address, diagnostic_payload, timeout)
+            while True:
+                request.response_pending.clear()
+                pending_task = asyncio.ensure_future(request.response_pending.wait())
+                try:
+                    done, _ = await asyncio.wait({request.future, pending_task, self._closed}, timeout=timeout,
+                                                 return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    pending_task.cancel()
+                if request.future in done:
+                    return request.future.result()
+                if self._closed in done:
+                    raise self._closed.exception()
+                if pending_task not in done:
+                    raise TimeoutError("ECU failed to respond in time", timeout)
+        except BaseException:
+            # Keep the request registered for another timeout, so that its late response is dropped
+            request.future.cancel()
+            request.expiry = asyncio.get_running_loop().time() + timeout
+            raise
+
+    def empty_rxqueue(self, source_address=None):
+        """Drop queued diagnostic responses of one or all servers."""
+        if source_address is None:
+            self._responses.clear()
+        else:
+            self._responses.pop(source_address, None)
@@ -18,6 +18,9 @@ from .messages import *
 logger = logging.getLogger("doipclient")
 
 
+_HEADER = struct.Struct("!BBHL")
+
+
 class Parser:
     """Implements state machine for DoIP transport layer.
 
@@ -25,90 +28,82 @@ class Parser:
     is reliable, the UDP broadcasts are not, so the state machine is a little more defensive
     than one might otherwise expect. When using TCP, reads from the socket aren't guaranteed
     to be exactly one DoIP message, so the running buffer needs to be maintained across reads
-    """
 
-    class ParserState(IntEnum):
-        READ_PROTOCOL_VERSION = 1
-        READ_INVERSE_PROTOCOL_VERSION = 2
-        READ_PAYLOAD_TYPE = 3
-        READ_PAYLOAD_SIZE = 4
-        READ_PAYLOAD = 5
+    The received chunks are kept as immutable bytes and consumed through a read offset. The 8 byte
+    header is decoded with a single struct.unpack_from and messages are unpacked from a memoryview of
+    their payload, so a message which lies within one received chunk (the usual case) is never copied.
+    Only the unconsumed rest of a chunk is joined with the next chunk when a message spans both.
+    """
 
     def __init__(self):
         self.reset()
 
     def reset(self):
-        self.rx_buffer = bytearray()
+        self._buffer = b""
+        self._offset = 0
         self.protocol_version = None
         self.payload_type = None
         self.payload_size = None
-        self.payload = bytearray()
-        self._state = Parser.ParserState.READ_PROTOCOL_VERSION
+
+    @property
+    def rx_buffer(self):
+        """Received bytes not consumed yet"""
+        return memoryview(self._buffer)[self._offset:]
 
     def push_bytes(self, data_bytes):
-        self.rx_buffer += data_bytes
+        if not data_bytes:
+            return
+        if self._offset >= len(self._buffer):
+            # Everything consumed, take over the new chunk (no copy for bytes)
+            self._buffer = bytes(data_bytes)
+        else:
+            self._buffer = self._buffer[self._offset:] + bytes(data_bytes)
+        self._offset = 0
 
     def read_message(self, data_bytes):
-        logger.debug(" Reading TCP Message")
-        self.rx_buffer += data_bytes
-        if self._state == Parser.ParserState.READ_PROTOCOL_VERSION:
-            if len(self.rx_buffer) >= 1:
-                self.payload = bytearray()
-                self.payload_type = None
-                self.payload_size = None
-                self.protocol_version = int(self.rx_buffer.pop(0))
-                self._state = Parser.ParserState.READ_INVERSE_PROTOCOL_VERSION
-
-        if self._state == Parser.ParserState.READ_INVERSE_PROTOCOL_VERSION:
-            if len(self.rx_buffer) >= 1:
-                inverse_protocol_version = int(self.rx_buffer.pop(0))
-                if inverse_protocol_version != (0xFF ^ self.protocol_version):
-                    logger.warning(
-                        "Bad DoIP Header - Inverse protocol version does not match. Ignoring."
-                    )
-                    # Bad protocol version inverse - shift the buffer forward
-                    self.protocol_version = inverse_protocol_version
-                    return GenericDoIPNegativeAcknowledge(
-                        GenericDoIPNegativeAcknowledge.NackCode.IncorrectProtocolVersionInverse
-                    )
-                else:
-                    self._state = Parser.ParserState.READ_PAYLOAD_TYPE
-
-        if self._state == Parser.ParserState.READ_PAYLOAD_TYPE:
-            if len(self.rx_buffer) >= 2:
-                self.payload_type = self.rx_buffer.pop(0) << 8
-                self.payload_type |= self.rx_buffer.pop(0)
-                self._state = Parser.ParserState.READ_PAYLOAD_SIZE
-
-        if self._state == Parser.ParserState.READ_PAYLOAD_SIZE:
-            if len(self.rx_buffer) >= 4:
-                self.payload_size = self.rx_buffer.pop(0) << 24
-                self.payload_size |= self.rx_buffer.pop(0) << 16
-                self.payload_size |= self.rx_buffer.pop(0) << 8
-                self.payload_size |= self.rx_buffer.pop(0)
-                self._state = Parser.ParserState.READ_PAYLOAD
-
-        if self._state == Parser.ParserState.READ_PAYLOAD:
-            remaining_bytes = self.payload_size - len(self.payload)
-            self.payload += self.rx_buffer[:remaining_bytes]
-            self.rx_buffer = self.rx_buffer[remaining_bytes:]
-            if len(self.payload) == self.payload_size:
-                self._state = Parser.ParserState.READ_PROTOCOL_VERSION
-                logger.debug(
-                    "Received DoIP Message. Type: 0x{:X}, Payload Size: {} bytes, Payload: {}".format(
-                        self.payload_type,
-                        self.payload_size,
-                        " ".join(f"{byte:02X}" for byte in self.payload),
-                    )
+        self.push_bytes(data_bytes)
+        available = len(self._buffer) - self._offset
+        if available < _HEADER.size:
+            return None
+
+        (
+            protocol_version,
+            inverse_protocol_version,
+            payload_type,
+            payload_size,
+        ) = _HEADER.unpack_from(self._buffer, self._offset)
+        if inverse_protocol_version != (0xFF ^ protocol_version):
+            logger.warning(
+                "Bad DoIP Header - Inverse protocol version does not match. Ignoring."
+            )
+            # Bad protocol version inverse - shift the buffer forward
+            self._offset += 1
+            return GenericDoIPNegativeAcknowledge(
+                GenericDoIPNegativeAcknowledge.NackCode.IncorrectProtocolVersionInverse
+            )
+
+        self.protocol_version = protocol_version
+        self.payload_type = payload_type
+        self.payload_size = payload_size
+        if available < _HEADER.size + payload_size:
+            # Wait for the rest of the payload
+            return None
+
+        start = self._offset + _HEADER.size
+        self._offset = start + payload_size
+        payload = memoryview(self._buffer)[start : self._offset]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Received DoIP Message. Type: 0x{:X}, Payload Size: {} bytes, Payload: {}".format(
+                    payload_type,
+                    payload_size,
+                    " ".join(f"{byte:02X}" for byte in payload),
                 )
-                try:
-                    return payload_type_to_message[self.payload_type].unpack(
-                        self.payload, self.payload_size
-                    )
-                except KeyError:
-                    return ReservedMessage.unpack(
-                        self.payload_type, self.payload, self.payload_size
-                    )
+            )
+        try:
+            return payload_type_to_message[payload_type].unpack(payload, payload_size)
+        except KeyError:
+            return ReservedMessage.unpack(payload_type, payload, payload_size)
 
 
 class DoIPClient:
@@ -482,6 +477,32 @@ class DoIPClient:
         finally:
             self._tcp_sock.settimeout(original_timeout)
 
+    @property
+    def tcp_close_detected(self):
+        """True if the ECU closed or reset the TCP connection"""
+        return self._tcp_close_detected
+
+    def poll_messages(self):
+        """Service the TCP socket without blocking.
+
+        Reads everything received so far, answers alive check requests and returns the other messages.
+        Useful to keep idle connections alive and to discard late responses before a connection is re-used.
+
+        :return: The received messages
+        :rtype: list
+        """
+        self._tcp_socket_check(first_timeout=0)
+        messages = []
+        while True:
+            response = self._tcp_parser.read_message(b"")
+            if response is None:
+                return messages
+            if type(response) == AliveCheckRequest:
+                logger.warning("Responding to an alive check")
+                self.send_doip_message(AliveCheckResponse(self._client_logical_address))
+            else:
+                messages.append(response)
+
     def send_doip(
         self,
         payload_type,
@@ -505,13 +526,14 @@ class DoIPClient:
         retry = self._auto_reconnect_tcp and not disable_retry
 
         data_bytes = self._pack_doip(self._protocol_version, payload_type, payload_data)
-        logging.debug(
-            "Sending DoIP Message: Type: 0x{:X}, Payload Size: {}, Payload: {}".format(
-                payload_type,
-                len(payload_data),
-                " ".join(f"{byte:02X}" for byte in payload_data),
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(
+                "Sending DoIP Message: Type: 0x{:X}, Payload Size: {}, Payload: {}".format(
+                    payload_type,
+                    len(payload_data),
+                    " ".join(f"{byte:02X}" for byte in payload_data),
+                )
             )
-        )
 
         # The ECU is well within its rights to have closed the socket since we last sent it data -
         # particularly if the tester has been quiet for a while. For TCP there's two possibilities
@@ -757,8 +779,8 @@ class DoIPClient:
     def receive_diagnostic(self, timeout: float = None):
         """Receive a raw diagnostic payload (ie: UDS) from the ECU.
         :param: timeout: Maximum time allowed for response from ECU
-        :return: Raw UDS payload
-        :rtype: bytearray
+        :return: Raw UDS payload, a view into the received message
+        :rtype: memoryview
         :raises TimeoutError: No diagnostic response received in time
         """
 